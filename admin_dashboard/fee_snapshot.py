@@ -0,0 +1,201 @@
+"""
+In-process fee settings snapshot.
+
+Fee and commission calculations read an immutable copy of the FeeSettings
+singleton instead of querying MongoDB on every call. The snapshot carries the
+document's version stamp; FeeSettingsService.update_fee_settings publishes the
+new version on Redis so every worker reloads. A max age bounds staleness if a
+pub/sub message is missed (e.g. Redis was briefly unreachable).
+"""
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+FEE_SETTINGS_CHANNEL = 'fee_settings:updated'
+LISTEN_POLL_SECONDS = 30
+
+_FeeSnapshotBase = namedtuple('FeeSnapshot', [
+    'version',
+    'minimum_fee',
+    'fee_percentage',
+    'threshold_amount_1',
+    'threshold_amount_2',
+    'maximum_fee',
+    'transaction_fee_fixed',
+    'default_affiliate_commission_percentage',
+    'loaded_at'
+])
+
+
+class FeeSnapshot(_FeeSnapshotBase):
+    """Immutable copy of FeeSettings with vectorized fee helpers"""
+    __slots__ = ()
+
+    def platform_fees(self, order_amounts):
+        """Tiered platform fee (OrderService rules) for each order amount"""
+        minimum_fee = round(self.minimum_fee, 2)
+        maximum_fee = round(self.maximum_fee, 2)
+        rate = self.fee_percentage / 100.0
+        threshold_1 = self.threshold_amount_1
+        threshold_2 = self.threshold_amount_2
+        return [
+            minimum_fee if amount <= threshold_1
+            else round(amount * rate, 2) if amount <= threshold_2
+            else maximum_fee
+            for amount in order_amounts
+        ]
+
+    def commission_percentage(self, affiliate=None):
+        """Affiliate's own rate when set and positive, otherwise the default rate"""
+        if affiliate and affiliate.commission_rate:
+            try:
+                affiliate_rate = float(affiliate.commission_rate)
+                if affiliate_rate > 0:
+                    return affiliate_rate
+            except (ValueError, TypeError):
+                pass
+        return self.default_affiliate_commission_percentage
+
+    def affiliate_commissions(self, platform_fees, affiliates=None):
+        """Affiliate commission for each platform fee; affiliates may be None or a parallel list"""
+        if affiliates is None:
+            rate = self.commission_percentage() / 100.0
+            return [round(fee * rate, 2) for fee in platform_fees]
+        return [
+            round(fee * (self.commission_percentage(affiliate) / 100.0), 2) if affiliate else 0.0
+            for fee, affiliate in zip(platform_fees, affiliates)
+        ]
+
+    def transaction_fees(self, amounts):
+        """Clamped percentage fee plus fixed fee (admin calculator rules) as (base_fee, total_fee) pairs"""
+        rate = self.fee_percentage / 100.0
+        results = []
+        for amount in amounts:
+            base_fee = float(amount) * rate
+            if base_fee < self.minimum_fee:
+                base_fee = self.minimum_fee
+            elif base_fee > self.maximum_fee:
+                base_fee = self.maximum_fee
+            results.append((base_fee, base_fee + self.transaction_fee_fixed))
+        return results
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+_listener_pid = None
+
+
+def _load():
+    from admin_dashboard.models import FeeSettings
+
+    fee_settings = FeeSettings.objects().first()
+    if not fee_settings:
+        fee_settings = FeeSettings()  # Model defaults, not persisted
+    return FeeSnapshot(
+        version=fee_settings.version or 0,
+        minimum_fee=fee_settings.minimum_fee,
+        fee_percentage=fee_settings.fee_percentage,
+        threshold_amount_1=fee_settings.threshold_amount_1,
+        threshold_amount_2=fee_settings.threshold_amount_2,
+        maximum_fee=fee_settings.maximum_fee,
+        transaction_fee_fixed=fee_settings.transaction_fee_fixed,
+        default_affiliate_commission_percentage=fee_settings.default_affiliate_commission_percentage,
+        loaded_at=time.monotonic()
+    )
+
+
+def refresh(min_version=None):
+    """Reload the snapshot, unless the current one is already at min_version or newer"""
+    global _snapshot
+    with _snapshot_lock:
+        if min_version is not None and _snapshot is not None and _snapshot.version >= min_version:
+            return _snapshot
+        _snapshot = _load()
+        return _snapshot
+
+
+def invalidate():
+    """Drop the snapshot so the next read reloads it"""
+    global _snapshot
+    _snapshot = None
+
+
+def get_fee_snapshot():
+    """Return the current fee settings snapshot, loading it if missing or stale"""
+    _ensure_listener()
+    snapshot = _snapshot
+    max_age = getattr(settings, 'FEE_SETTINGS_MAX_AGE_SECONDS', 300)
+    if snapshot is None or time.monotonic() - snapshot.loaded_at > max_age:
+        snapshot = refresh()
+    return snapshot
+
+
+def publish_update(version):
+    """Tell every worker that fee settings changed"""
+    try:
+        from dolabb_backend.redis_client import get_redis
+        get_redis().publish(FEE_SETTINGS_CHANNEL, str(version))
+    except Exception as e:
+        logger.warning(f"Could not publish fee settings update: {str(e)}")
+
+
+def _listen():
+    import redis
+    from dolabb_backend.redis_client import get_redis_url
+
+    backoff = 1
+    while True:
+        client = None
+        try:
+            # Own connection without a read timeout: an idle channel is normal, so silence
+            # is waited out with get_message(timeout=...) instead of ending in an error.
+            # The health check pings the server so a dead connection is still detected.
+            client = redis.Redis.from_url(
+                get_redis_url(),
+                decode_responses=True,
+                socket_connect_timeout=2,
+                socket_timeout=None,
+                health_check_interval=30
+            )
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(FEE_SETTINGS_CHANNEL)
+            backoff = 1
+            while True:
+                message = pubsub.get_message(timeout=LISTEN_POLL_SECONDS)
+                if message is None:
+                    continue
+                try:
+                    version = int(message.get('data'))
+                except (TypeError, ValueError):
+                    version = None
+                refresh(min_version=version)
+        except Exception as e:
+            # The connection really dropped, so the snapshot may have missed an update
+            invalidate()
+            logger.warning(f"Fee settings listener disconnected: {str(e)}")
+            if client is not None:
+                try:
+                    client.close()
+                except Exception:
+                    pass
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+
+def _ensure_listener():
+    """Start the pub/sub listener thread once per process (again after a fork)"""
+    global _listener_pid
+    pid = os.getpid()
+    if _listener_pid == pid:
+        return
+    with _snapshot_lock:
+        if _listener_pid == pid:
+            return
+        _listener_pid = pid
+        thread = threading.Thread(target=_listen, name='fee-settings-listener', daemon=True)
+        thread.start()
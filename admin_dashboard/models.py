@@ -22,6 +22,7 @@ class FeeSettings(Document):
     # Default affiliate commission percentage (25% of platform fee)
     default_affiliate_commission_percentage = FloatField(default=25.0)
     
+    version = IntField(default=0)  # Bumped on every update so cached snapshots can tell they are stale
     updated_at = DateTimeField(default=datetime.utcnow)
     
     meta = {
@@ -44,6 +45,8 @@ class CashoutRequest(Document):
     notes = StringField()  # Admin notes
     moyasar_payout_id = StringField()  # Moyasar payout transaction ID
     payout_error = StringField()  # Error message if payout fails
+    payout_batch_id = StringField()  # Set while a bulk payout batch is processing the request
+    payout_attempt_id = StringField()  # Provider idempotency key of the payout sent for this request
     
     meta = {
         'collection': 'cashout_requests',
@@ -51,6 +54,55 @@ class CashoutRequest(Document):
     }
 
 
+class SellerLedgerEntry(Document):
+    """
+    Append-only seller earnings ledger.
+    Each entry carries the signed change it makes to every SellerBalance bucket,
+    so balances can always be rebuilt by summing the ledger.
+    """
+    seller_id = ReferenceField(User, required=True)
+    entry_key = StringField(required=True, unique=True)  # Idempotency key, e.g. 'sale_locked:<order_id>'
+    entry_type = StringField(required=True, choices=[
+        'sale_locked',       # Payment completed, held until shipment proof
+        'sale_released',     # Shipment proof uploaded, moved to available
+        'payout_requested',  # Seller requested a cashout
+        'payout_approved',   # Admin approved the cashout
+        'payout_rejected',   # Admin rejected the cashout, amount returned
+        'payout_reversed'    # Admin rejected an already approved cashout
+    ])
+    amount = FloatField(required=True)
+    locked = FloatField(default=0.0)
+    earned = FloatField(default=0.0)
+    available = FloatField(default=0.0)
+    pending_payout = FloatField(default=0.0)
+    paid_out = FloatField(default=0.0)
+    order_id = ReferenceField(Order)
+    cashout_id = ReferenceField(CashoutRequest)
+    source = StringField(choices=['live', 'backfill'], default='live')
+    created_at = DateTimeField(default=datetime.utcnow)
+    
+    meta = {
+        'collection': 'seller_ledger',
+        'indexes': ['seller_id', 'entry_key', 'created_at', 'order_id']
+    }
+
+
+class SellerBalance(Document):
+    """Running seller balance, updated atomically with every ledger entry"""
+    seller_id = ReferenceField(User, required=True, unique=True)
+    locked = FloatField(default=0.0)  # Paid orders waiting for shipment proof
+    earned = FloatField(default=0.0)  # Paid orders with shipment proof
+    available = FloatField(default=0.0)  # earned - paid_out - pending_payout
+    pending_payout = FloatField(default=0.0)  # Cashout requests awaiting review
+    paid_out = FloatField(default=0.0)  # Approved cashouts
+    updated_at = DateTimeField(default=datetime.utcnow)
+    
+    meta = {
+        'collection': 'seller_balances',
+        'indexes': ['seller_id']
+    }
+
+
 class DisputeMessage(EmbeddedDocument):
     """Dispute message/comment model"""
     message = StringField(required=True)
@@ -4,6 +4,7 @@ Admin Dashboard services
 from datetime import datetime, timedelta
 from admin_dashboard.models import FeeSettings, CashoutRequest, Dispute, ActivityLog, HeroSection
 from authentication.models import User, Admin
+from authentication.principal import PrincipalResolver
 from products.models import Product, Order, Offer
 from affiliates.models import AffiliatePayoutRequest
 import random
@@ -239,6 +240,7 @@ class UserManagementService:
         
         user.status = 'suspended'
         user.save()
+        PrincipalResolver.invalidate(user.id)
         
         # Send policy violation notification
         try:
@@ -262,6 +264,7 @@ class UserManagementService:
         
         user.status = 'deactivated'
         user.save()
+        PrincipalResolver.invalidate(user.id)
         
         return user
     
@@ -273,6 +276,7 @@ class UserManagementService:
             raise ValueError("User not found")
         
         user.delete()
+        PrincipalResolver.invalidate(user.id)
         
         return True
     
@@ -325,6 +329,7 @@ class UserManagementService:
         
         user.status = 'active'
         user.save()
+        PrincipalResolver.invalidate(user.id)
         
         return user
 
@@ -637,6 +642,23 @@ class CashoutService:
         if not seller:
             raise ValueError("Seller not found")
         
+        # Claim the request (conditional on the status just read) so a bulk payout or a
+        # second approval cannot pay it at the same time
+        from payments.bulk_payouts import BulkPayoutService
+        claim_id = BulkPayoutService.claim_request('cashout', cashout.id, cashout.status)
+        if not claim_id:
+            raise ValueError("Cashout request is already being processed or was reviewed")
+        
+        from products.seller_service import SellerLedgerService
+        SellerLedgerService.ensure_balance(seller.id)
+        previous_status = cashout.status
+        
+        # A rejected request returned its amount to available; take it out again, or refuse
+        review_id = claim_id if previous_status == 'rejected' else None
+        if review_id and not SellerLedgerService.reserve_reapproval(cashout, review_id):
+            BulkPayoutService.release_claim('cashout', cashout.id, claim_id)
+            raise ValueError("Seller's available balance no longer covers this cashout")
+        
         # Try to process payout via Moyasar if payment method is Bank Transfer
         payout_success = False
         payout_error = None
@@ -685,12 +707,9 @@ class CashoutService:
                 
                 # Create payout via Moyasar
                 logger.info(f"Creating Moyasar payout for cashout {cashout_id}: {cashout.amount} {currency}")
-                payout_response = MoyasarPaymentService.create_payout(
-                    amount=amount_in_cents,
-                    currency=currency,
-                    destination=destination,
-                    purpose='seller_payout',
-                    metadata=metadata
+                payout_response = BulkPayoutService.send_claimed_payout(
+                    'cashout', cashout.id, claim_id, cashout.payout_attempt_id,
+                    amount_in_cents, currency, destination, 'seller_payout', metadata
                 )
                 
                 moyasar_payout_id = payout_response.get('id')
@@ -714,6 +733,9 @@ class CashoutService:
                 # Validation error - don't approve the cashout
                 payout_error = str(e)
                 logger.error(f"Payout validation error: {payout_error}")
+                if review_id:
+                    SellerLedgerService.release_reapproval(cashout, review_id)
+                BulkPayoutService.release_claim('cashout', cashout.id, claim_id)
                 raise ValueError(f"Failed to process payout: {payout_error}")
             except Exception as e:
                 # API error - log but don't fail the approval
@@ -730,6 +752,13 @@ class CashoutService:
         if payout_error:
             cashout.payout_error = payout_error
         cashout.save()
+        BulkPayoutService.release_claim('cashout', cashout.id, claim_id)
+        
+        # Move the amount from pending payout to paid out in the seller ledger
+        try:
+            SellerLedgerService.record_payout_reviewed(cashout, previous_status, review_id)
+        except Exception as e:
+            logger.error(f"Error recording seller ledger payout for cashout {cashout_id}: {str(e)}")
         
         # Send notification to seller
         try:
@@ -751,12 +780,23 @@ class CashoutService:
         if not cashout:
             raise ValueError("Cashout request not found")
         
+        from products.seller_service import SellerLedgerService
+        SellerLedgerService.ensure_balance(cashout.seller_id.id)
+        previous_status = cashout.status
+        
         cashout.status = 'rejected'
         cashout.rejection_reason = reason
         cashout.reviewed_at = datetime.utcnow()
         cashout.reviewed_by = admin_id
         cashout.save()
         
+        # Return the amount to the seller's available balance
+        try:
+            SellerLedgerService.record_payout_reviewed(cashout, previous_status)
+        except Exception as e:
+            import logging
+            logging.error(f"Error recording seller ledger rejection for cashout {cashout_id}: {str(e)}")
+        
         # Send notification to seller
         try:
             from notifications.notification_helper import NotificationHelper
@@ -860,53 +900,138 @@ class FeeSettingsService:
         if default_affiliate_commission_percentage is not None:
             settings.default_affiliate_commission_percentage = float(default_affiliate_commission_percentage)
         
+        settings.version = (settings.version or 0) + 1
         settings.updated_at = datetime.utcnow()
         settings.save()
         
+        # Refresh this worker's snapshot and tell the others
+        from admin_dashboard import fee_snapshot
+        fee_snapshot.refresh()
+        fee_snapshot.publish_update(settings.version)
+        
         return settings
     
     @staticmethod
     def get_fee_collection_summary(from_date=None, to_date=None):
-        """Get fee collection summary"""
-        query = Order.objects(payment_status='completed')
+        """Get fee collection summary (single $group round trip, broken down by currency)"""
+        match = {'payment_status': 'completed'}
+        if from_date or to_date:
+            match['created_at'] = {}
+            if from_date:
+                match['created_at']['$gte'] = from_date
+            if to_date:
+                match['created_at']['$lte'] = to_date
+        
+        pipeline = [
+            {'$match': match},
+            {'$group': {
+                '_id': {'$ifNull': ['$currency', 'SAR']},
+                'count': {'$sum': 1},
+                'fees': {'$sum': {'$ifNull': ['$dolabb_fee', 0]}}
+            }}
+        ]
+        
+        total_transactions = 0
+        total_fees = 0.0
+        by_currency = {}
+        for row in Order.objects.aggregate(pipeline):
+            total_transactions += row['count']
+            total_fees += row['fees']
+            by_currency[row['_id']] = {
+                'totalFees': round(row['fees'], 2),
+                'transactions': row['count']
+            }
+        avg_fee = total_fees / total_transactions if total_transactions > 0 else 0
         
+        return {
+            'Total Fees Collected': total_fees,
+            'Total Transactions': total_transactions,
+            'Time Period': {
+                'from': from_date.isoformat() if from_date else None,
+                'to': to_date.isoformat() if to_date else None
+            },
+            'Average Fee per Transaction': avg_fee,
+            'byCurrency': by_currency
+        }
+    
+    @staticmethod
+    def get_fee_recalculation_report(from_date=None, to_date=None, chunk_size=1000):
+        """
+        Compare the fees and commissions charged on completed orders with what the
+        current fee settings would charge. Orders are streamed and priced a chunk at
+        a time with each order's own affiliate rate.
+        """
+        from admin_dashboard.fee_snapshot import get_fee_snapshot
+        from authentication.models import Affiliate
+        
+        query = Order.objects(payment_status='completed')
         if from_date:
             query = query.filter(created_at__gte=from_date)
         if to_date:
             query = query.filter(created_at__lte=to_date)
         
-        total_transactions = query.count()
-        total_fees = sum(order.dolabb_fee for order in query)
-        avg_fee = total_fees / total_transactions if total_transactions > 0 else 0
+        snapshot = get_fee_snapshot()
+        # Affiliates are few. Like checkout, a stripped code matches exactly and only active
+        # affiliates earn a commission
+        affiliates = {
+            affiliate.affiliate_code: affiliate
+            for affiliate in Affiliate.objects(status='active').only('affiliate_code', 'commission_rate')
+            if affiliate.affiliate_code
+        }
+        totals = {
+            'orders': 0, 'changed': 0, 'charged_fees': 0.0, 'recalculated_fees': 0.0,
+            'charged_commissions': 0.0, 'recalculated_commissions': 0.0
+        }
+        
+        def price(rows):
+            base_amounts = [row.get('offer_price') or row.get('price') or 0.0 for row in rows]
+            fees = snapshot.platform_fees(base_amounts)
+            commissions = snapshot.affiliate_commissions(fees, [
+                affiliates.get(row['affiliate_code'].strip()) if row.get('affiliate_code') else None
+                for row in rows
+            ])
+            for row, fee, commission in zip(rows, fees, commissions):
+                charged_fee = row.get('dolabb_fee') or 0.0
+                totals['orders'] += 1
+                totals['changed'] += round(charged_fee, 2) != fee
+                totals['charged_fees'] += charged_fee
+                totals['recalculated_fees'] += fee
+                totals['charged_commissions'] += row.get('affiliate_commission') or 0.0
+                totals['recalculated_commissions'] += commission
+        
+        chunk = []
+        for row in query.only(
+            'price', 'offer_price', 'dolabb_fee', 'affiliate_code', 'affiliate_commission'
+        ).as_pymongo().batch_size(chunk_size):
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                price(chunk)
+                chunk = []
+        if chunk:
+            price(chunk)
         
         return {
-            'Total Fees Collected': total_fees,
-            'Total Transactions': total_transactions,
+            'settingsVersion': snapshot.version,
+            'totalOrders': totals['orders'],
+            'ordersWithDifferentFee': totals['changed'],
+            'chargedFees': round(totals['charged_fees'], 2),
+            'recalculatedFees': round(totals['recalculated_fees'], 2),
+            'feeDifference': round(totals['recalculated_fees'] - totals['charged_fees'], 2),
+            'chargedAffiliateCommissions': round(totals['charged_commissions'], 2),
+            'recalculatedAffiliateCommissions': round(totals['recalculated_commissions'], 2),
             'Time Period': {
                 'from': from_date.isoformat() if from_date else None,
                 'to': to_date.isoformat() if to_date else None
-            },
-            'Average Fee per Transaction': avg_fee
+            }
         }
     
     @staticmethod
     def calculate_fee(amount):
         """Calculate fee for a given transaction amount"""
-        settings = FeeSettings.objects().first()
-        if not settings:
-            settings = FeeSettings()
-            settings.save()
-        
-        # Calculate fee based on settings
-        base_fee = float(amount) * (settings.fee_percentage / 100.0)
-        
-        # Apply minimum and maximum
-        if base_fee < settings.minimum_fee:
-            base_fee = settings.minimum_fee
-        elif base_fee > settings.maximum_fee:
-            base_fee = settings.maximum_fee
+        from admin_dashboard.fee_snapshot import get_fee_snapshot
         
-        total_fee = base_fee + settings.transaction_fee_fixed
+        settings = get_fee_snapshot()
+        base_fee, total_fee = settings.transaction_fees([amount])[0]
         
         return {
             'transaction_amount': float(amount),
@@ -0,0 +1,196 @@
+"""
+Admin dashboard service tests.
+
+MongoDB and Redis are not needed: model queries are mocked.
+"""
+import time
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
+from bson import ObjectId
+from django.test import SimpleTestCase, override_settings
+from admin_dashboard import fee_snapshot
+from admin_dashboard.fee_snapshot import FeeSnapshot
+from admin_dashboard.services import FeeSettingsService, CashoutService
+from payments.bulk_payouts import BulkPayoutService
+from products.seller_service import SellerLedgerService
+
+
+def make_snapshot(version=1, loaded_at=None, **overrides):
+    values = {
+        'version': version,
+        'minimum_fee': 5.0,
+        'fee_percentage': 5.0,
+        'threshold_amount_1': 100.0,
+        'threshold_amount_2': 2000.0,
+        'maximum_fee': 100.0,
+        'transaction_fee_fixed': 0.0,
+        'default_affiliate_commission_percentage': 25.0,
+        'loaded_at': time.monotonic() if loaded_at is None else loaded_at
+    }
+    values.update(overrides)
+    return FeeSnapshot(**values)
+
+
+class FeeSnapshotTests(SimpleTestCase):
+    """The cached snapshot prices like OrderService and reloads when stale"""
+
+    def setUp(self):
+        listener = mock.patch.object(fee_snapshot, '_ensure_listener')
+        listener.start()
+        self.addCleanup(listener.stop)
+        self.addCleanup(fee_snapshot.invalidate)
+        fee_snapshot.invalidate()
+
+    def test_platform_fee_tiers(self):
+        snapshot = make_snapshot()
+        self.assertEqual(snapshot.platform_fees([50.0, 100.0, 500.0, 2000.0, 5000.0]), [5.0, 5.0, 25.0, 100.0, 100.0])
+
+    def test_affiliate_commission_uses_the_affiliate_rate_when_positive(self):
+        snapshot = make_snapshot()
+        own_rate = mock.Mock(commission_rate='10')
+        zero_rate = mock.Mock(commission_rate='0')
+        self.assertEqual(snapshot.affiliate_commissions([20.0, 20.0, 20.0], [own_rate, zero_rate, None]), [2.0, 5.0, 0.0])
+
+    def test_snapshot_is_reused_until_it_is_older_than_the_max_age(self):
+        fresh = make_snapshot(version=1)
+        with mock.patch.object(fee_snapshot, '_load', return_value=fresh) as load:
+            self.assertIs(fee_snapshot.get_fee_snapshot(), fresh)
+            self.assertIs(fee_snapshot.get_fee_snapshot(), fresh)
+        self.assertEqual(load.call_count, 1)
+
+    @override_settings(FEE_SETTINGS_MAX_AGE_SECONDS=60)
+    def test_stale_snapshot_is_reloaded(self):
+        stale = make_snapshot(version=1, loaded_at=time.monotonic() - 61)
+        reloaded = make_snapshot(version=1)
+        with mock.patch.object(fee_snapshot, '_load', side_effect=[stale, reloaded]):
+            fee_snapshot.refresh()
+            self.assertIs(fee_snapshot.get_fee_snapshot(), reloaded)
+
+    def test_refresh_skips_reload_when_already_at_the_published_version(self):
+        current = make_snapshot(version=3)
+        newer = make_snapshot(version=4)
+        with mock.patch.object(fee_snapshot, '_load', side_effect=[current, newer]) as load:
+            fee_snapshot.refresh()
+            self.assertIs(fee_snapshot.refresh(min_version=3), current)
+            self.assertIs(fee_snapshot.refresh(min_version=4), newer)
+        self.assertEqual(load.call_count, 2)
+
+
+class FeeRecalculationReportTests(SimpleTestCase):
+    """Report commissions match affiliates exactly as checkout does"""
+
+    def _report(self, rows, affiliates):
+        orders = mock.MagicMock()
+        orders.return_value.only.return_value.as_pymongo.return_value.batch_size.return_value = rows
+        affiliate_objects = mock.MagicMock()
+        affiliate_objects.return_value.only.return_value = affiliates
+        with mock.patch('admin_dashboard.services.Order.objects', orders), \
+                mock.patch('authentication.models.Affiliate.objects', affiliate_objects), \
+                mock.patch('admin_dashboard.fee_snapshot.get_fee_snapshot', return_value=make_snapshot()):
+            report = FeeSettingsService.get_fee_recalculation_report(chunk_size=2)
+        self.assertEqual(affiliate_objects.call_args[1], {'status': 'active'})
+        return report
+
+    def test_commission_only_for_exact_active_affiliate_codes(self):
+        affiliates = [mock.Mock(affiliate_code='SUMMER', commission_rate='10')]
+        rows = [
+            {'price': 500.0, 'dolabb_fee': 25.0, 'affiliate_code': ' SUMMER '},  # Stripped like checkout
+            {'price': 500.0, 'dolabb_fee': 25.0, 'affiliate_code': 'summer'},  # Codes are case-sensitive
+            {'price': 500.0, 'dolabb_fee': 25.0, 'affiliate_code': 'RETIRED'},  # Not an active affiliate
+        ]
+        report = self._report(rows, affiliates)
+        self.assertEqual(report['totalOrders'], 3)
+        self.assertEqual(report['recalculatedAffiliateCommissions'], 2.5)
+
+    def test_orders_are_priced_across_chunks(self):
+        rows = [
+            {'price': 50.0, 'dolabb_fee': 5.0},
+            {'price': 500.0, 'offer_price': 400.0, 'dolabb_fee': 25.0},
+            {'price': 3000.0, 'dolabb_fee': 100.0},
+        ]
+        report = self._report(rows, [])
+        self.assertEqual(report['totalOrders'], 3)
+        self.assertEqual(report['ordersWithDifferentFee'], 1)  # The offer price lowers the fee to 20
+        self.assertEqual(report['recalculatedFees'], 125.0)
+        self.assertEqual(report['feeDifference'], -5.0)
+
+
+class FeeCollectionSummaryTests(SimpleTestCase):
+    """Fee totals are summed by MongoDB, broken down by currency"""
+
+    def test_summary_folds_the_grouped_currencies(self):
+        orders = mock.Mock()
+        orders.aggregate.return_value = [
+            {'_id': 'SAR', 'count': 3, 'fees': 30.0},
+            {'_id': 'USD', 'count': 1, 'fees': 6.004},
+        ]
+        start = datetime(2026, 1, 1)
+        with mock.patch('admin_dashboard.services.Order.objects', orders):
+            summary = FeeSettingsService.get_fee_collection_summary(from_date=start)
+
+        match = orders.aggregate.call_args[0][0][0]['$match']
+        self.assertEqual(match, {'payment_status': 'completed', 'created_at': {'$gte': start}})
+        self.assertEqual(summary['Total Transactions'], 4)
+        self.assertAlmostEqual(summary['Total Fees Collected'], 36.004)
+        self.assertAlmostEqual(summary['Average Fee per Transaction'], 9.001)
+        self.assertEqual(summary['byCurrency']['USD'], {'totalFees': 6.0, 'transactions': 1})
+
+    def test_no_orders_means_zero_average(self):
+        orders = mock.Mock()
+        orders.aggregate.return_value = []
+        with mock.patch('admin_dashboard.services.Order.objects', orders):
+            summary = FeeSettingsService.get_fee_collection_summary()
+        self.assertEqual(summary['Average Fee per Transaction'], 0)
+        self.assertEqual(summary['byCurrency'], {})
+
+
+class CashoutReapprovalTests(SimpleTestCase):
+    """A rejected cashout is only re-approved if the seller can still cover it"""
+
+    def setUp(self):
+        self.cashout = mock.Mock(
+            id=ObjectId(), seller_id=SimpleNamespace(id=ObjectId()), amount=80.0, status='rejected',
+            payment_method='PayPal', account_details=None, payout_attempt_id=None
+        )
+        cashouts = mock.MagicMock()
+        cashouts.return_value.first.return_value = self.cashout
+        users = mock.MagicMock()
+        users.return_value.first.return_value = mock.Mock(id=self.cashout.seller_id.id)
+        for patcher in (
+            mock.patch('admin_dashboard.services.CashoutRequest.objects', cashouts),
+            mock.patch('admin_dashboard.services.User.objects', users),
+            mock.patch.object(BulkPayoutService, 'claim_request', return_value='claim-1'),
+            mock.patch.object(SellerLedgerService, 'ensure_balance'),
+            mock.patch('notifications.notification_helper.NotificationHelper.send_payout_sent'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_reapproval_is_refused_when_the_balance_no_longer_covers_it(self):
+        with mock.patch.object(SellerLedgerService, 'reserve_reapproval', return_value=False), \
+                mock.patch.object(SellerLedgerService, 'record_payout_reviewed') as reviewed, \
+                mock.patch.object(BulkPayoutService, 'release_claim') as release_claim:
+            with self.assertRaisesMessage(ValueError, 'no longer covers'):
+                CashoutService.approve_cashout(self.cashout.id, 'admin')
+        release_claim.assert_called_once_with('cashout', self.cashout.id, 'claim-1')
+        self.cashout.save.assert_not_called()
+        reviewed.assert_not_called()
+
+    def test_reapproval_settles_under_its_own_review_id(self):
+        with mock.patch.object(SellerLedgerService, 'reserve_reapproval', return_value=True) as reserve, \
+                mock.patch.object(SellerLedgerService, 'record_payout_reviewed') as reviewed, \
+                mock.patch.object(BulkPayoutService, 'release_claim'):
+            CashoutService.approve_cashout(self.cashout.id, 'admin')
+        reserve.assert_called_once_with(self.cashout, 'claim-1')
+        self.assertEqual(self.cashout.status, 'approved')
+        reviewed.assert_called_once_with(self.cashout, 'rejected', 'claim-1')
+
+    def test_pending_cashout_needs_no_new_reservation(self):
+        self.cashout.status = 'pending'
+        with mock.patch.object(SellerLedgerService, 'reserve_reapproval') as reserve, \
+                mock.patch.object(SellerLedgerService, 'record_payout_reviewed') as reviewed, \
+                mock.patch.object(BulkPayoutService, 'release_claim'):
+            CashoutService.approve_cashout(self.cashout.id, 'admin')
+        reserve.assert_not_called()
+        reviewed.assert_called_once_with(self.cashout, 'pending', None)
@@ -32,6 +32,7 @@ urlpatterns = [
     
     # Cashout Requests
     path('cashout-requests/', views.get_cashout_requests, name='get_cashout_requests'),
+    path('cashout-requests/bulk-approve/', views.bulk_approve_cashouts, name='bulk_approve_cashouts'),
     path('cashout-requests/<str:cashout_id>/approve/', views.approve_cashout, name='approve_cashout'),
     path('cashout-requests/<str:cashout_id>/reject/', views.reject_cashout, name='reject_cashout'),
     
@@ -39,6 +40,7 @@ urlpatterns = [
     path('fee-settings/', views.get_fee_settings, name='get_fee_settings'),
     path('fee-settings/update/', views.update_fee_settings, name='update_fee_settings'),
     path('fee-settings/summary/', views.fee_collection_summary, name='fee_collection_summary'),
+    path('fee-settings/recalculation/', views.fee_recalculation_report, name='fee_recalculation_report'),
     
     # Disputes
     path('disputes/', views.get_disputes, name='get_disputes'),
@@ -60,6 +62,7 @@ urlpatterns = [
     
     # Dashboard - Additional
     path('dashboard/recent-activities/', views.get_recent_activities, name='get_recent_activities'),
+    path('dashboard/integration-metrics/', views.integration_metrics, name='integration_metrics'),
     
     # Fee Settings - Additional
     path('fee-settings/calculate/', views.calculate_fee, name='calculate_fee'),
@@ -374,6 +374,23 @@ def approve_cashout(request, cashout_id):
         return Response({'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@api_view(['POST'])
+def bulk_approve_cashouts(request):
+    """Approve pending cashout requests in one batch and send their payouts"""
+    if not check_admin(request):
+        return Response({'success': False, 'error': 'Unauthorized'}, status=status.HTTP_403_FORBIDDEN)
+    
+    try:
+        from payments.bulk_payouts import BulkPayoutService
+        admin_id = str(request.user.id)
+        report = BulkPayoutService.execute('cashout', request.data.get('ids', []), admin_id)
+        return Response({'success': True, **report}, status=status.HTTP_200_OK)
+    except ValueError as e:
+        return Response({'success': False, 'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @api_view(['PUT'])
 def reject_cashout(request, cashout_id):
     """Reject cashout request"""
@@ -457,6 +474,28 @@ def fee_collection_summary(request):
         return Response({'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@api_view(['GET'])
+def fee_recalculation_report(request):
+    """Compare charged fees with the fees the current settings would charge"""
+    if not check_admin(request):
+        return Response({'success': False, 'error': 'Unauthorized'}, status=status.HTTP_403_FORBIDDEN)
+    
+    try:
+        from datetime import datetime
+        from_date = request.GET.get('fromDate')
+        to_date = request.GET.get('toDate')
+        
+        from_date_obj = datetime.fromisoformat(from_date) if from_date else None
+        to_date_obj = datetime.fromisoformat(to_date) if to_date else None
+        
+        report = FeeSettingsService.get_fee_recalculation_report(from_date_obj, to_date_obj)
+        return Response({'success': True, **report}, status=status.HTTP_200_OK)
+    except ValueError as e:
+        return Response({'success': False, 'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 # Disputes
 @api_view(['GET'])
 def get_disputes(request):
@@ -859,6 +898,30 @@ def calculate_fee(request):
         return Response({'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@api_view(['GET'])
+def integration_metrics(request):
+    """
+    Moyasar call counts, errors and latency percentiles as seen by the worker process serving
+    this request, and throttled chat WebSocket frames (this process and cluster-wide)
+    """
+    if not check_admin(request):
+        return Response({'success': False, 'error': 'Unauthorized'}, status=status.HTTP_403_FORBIDDEN)
+    
+    try:
+        import os
+        from payments.moyasar_client import get_moyasar_client
+        from chat.rate_limit import get_metrics as get_chat_throttle_metrics
+        
+        return Response({
+            'success': True,
+            'process': os.getpid(),
+            'moyasar': get_moyasar_client().get_metrics(),
+            'chatThrottle': get_chat_throttle_metrics()
+        }, status=status.HTTP_200_OK)
+    except Exception as e:
+        return Response({'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 # General Admin APIs
 @api_view(['GET'])
 def get_admin_profile(request):
@@ -22,7 +22,7 @@ class AffiliateTransaction(Document):
     
     meta = {
         'collection': 'affiliate_transactions',
-        'indexes': ['affiliate_id', 'status', 'date', 'currency']
+        'indexes': ['affiliate_id', 'status', 'date', 'currency', 'transaction_id']
     }
 
 
@@ -41,6 +41,8 @@ class AffiliatePayoutRequest(Document):
     reviewed_by = StringField()
     moyasar_payout_id = StringField()  # Moyasar payout transaction ID
     payout_error = StringField()  # Error message if payout fails
+    payout_batch_id = StringField()  # Set while a bulk payout batch is processing the request
+    payout_attempt_id = StringField()  # Provider idempotency key of the payout sent for this request
     
     meta = {
         'collection': 'affiliate_payout_requests',
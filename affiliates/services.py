@@ -3,6 +3,7 @@ Affiliate services
 """
 from datetime import datetime, timedelta
 from collections import defaultdict
+from bson import ObjectId
 from affiliates.models import AffiliateTransaction, AffiliatePayoutRequest
 from authentication.models import Affiliate, User
 from products.models import Order
@@ -42,6 +43,45 @@ class AffiliateService:
         
         return formatted_earnings
     
+    @staticmethod
+    def get_transaction_totals(affiliate_ids):
+        """
+        Commission totals per affiliate in one $group round trip.
+        Returns {affiliate_id: {'count', 'total', 'byStatus', 'byCurrency'}}.
+        """
+        object_ids = [ObjectId(str(affiliate_id)) for affiliate_id in affiliate_ids]
+        totals = {
+            affiliate_id: {'count': 0, 'total': 0.0, 'byStatus': {}, 'byCurrency': {}}
+            for affiliate_id in object_ids
+        }
+        if not object_ids:
+            return totals
+        
+        pipeline = [
+            {'$match': {'affiliate_id': {'$in': object_ids}}},
+            {'$group': {
+                '_id': {
+                    'affiliate': '$affiliate_id',
+                    'status': '$status',
+                    'currency': {'$ifNull': ['$currency', 'SAR']}
+                },
+                'count': {'$sum': 1},
+                'total': {'$sum': {'$ifNull': ['$commission_amount', 0]}}
+            }}
+        ]
+        for row in AffiliateTransaction.objects.aggregate(pipeline):
+            key = row['_id']
+            summary = totals.setdefault(key['affiliate'], {'count': 0, 'total': 0.0, 'byStatus': {}, 'byCurrency': {}})
+            summary['count'] += row['count']
+            summary['total'] += row['total']
+            status_summary = summary['byStatus'].setdefault(key['status'], {'count': 0, 'total': 0.0})
+            status_summary['count'] += row['count']
+            status_summary['total'] = round(status_summary['total'] + row['total'], 2)
+            currency_summary = summary['byCurrency'].setdefault(key['currency'], {'count': 0, 'total': 0.0})
+            currency_summary['count'] += row['count']
+            currency_summary['total'] = round(currency_summary['total'] + row['total'], 2)
+        return totals
+    
     @staticmethod
     def validate_affiliate_code(code):
         """Validate affiliate code"""
@@ -72,14 +112,15 @@ class AffiliateService:
         
         total = affiliates.count()
         skip = (page - 1) * limit
-        affiliates = affiliates.skip(skip).limit(limit)
+        affiliates = list(affiliates.skip(skip).limit(limit))
+        
+        # Transaction stats for the whole page in one aggregation
+        transaction_totals = AffiliateService.get_transaction_totals([affiliate.id for affiliate in affiliates])
         
         affiliates_list = []
         for affiliate in affiliates:
             # Calculate stats
-            transactions = AffiliateTransaction.objects(affiliate_id=affiliate.id)
-            total_referrals = transactions.count()
-            total_earnings = sum(t.commission_amount for t in transactions)
+            total_referrals = transaction_totals.get(affiliate.id, {}).get('count', 0)
             
             # Get earnings by currency
             earnings_by_currency = AffiliateService.get_earnings_by_currency(affiliate)
@@ -107,7 +148,9 @@ class AffiliateService:
                 'stats': {
                     'totalReferrals': total_referrals,
                     'totalEarnings': round(total_all, 2),
-                    'totalTransactions': total_referrals
+                    'totalTransactions': total_referrals,
+                    'transactionsByStatus': transaction_totals.get(affiliate.id, {}).get('byStatus', {}),
+                    'transactionsByCurrency': transaction_totals.get(affiliate.id, {}).get('byCurrency', {})
                 }
             })
         
@@ -122,16 +165,26 @@ class AffiliateService:
         skip = (page - 1) * limit
         transactions = transactions.skip(skip).limit(limit)
         
-        # Get affiliate stats
-        affiliate = Affiliate.objects(id=affiliate_id).first()
-        all_transactions = AffiliateTransaction.objects(affiliate_id=affiliate_id)
-        total_referrals = all_transactions.count()
-        total_earnings = sum(t.commission_amount for t in all_transactions)
-        total_sales = all_transactions.count()
+        # Get affiliate stats (count and sum in one aggregation)
+        totals = AffiliateService.get_transaction_totals([affiliate_id]).get(ObjectId(str(affiliate_id)), {})
+        total_referrals = totals.get('count', 0)
+        total_earnings = totals.get('total', 0.0)
+        total_sales = total_referrals
+        
+        # Referred users for the page in one query (only needed when the name wasn't stored)
+        transactions = list(transactions.no_dereference())
+        referred_ids = {
+            t.referred_user_id.id for t in transactions
+            if t.referred_user_id and not t.referred_user_name
+        }
+        referred_users = {
+            row['_id']: row.get('full_name')
+            for row in User.objects(id__in=referred_ids).only('full_name').as_pymongo()
+        } if referred_ids else {}
         
         transactions_list = []
         for transaction in transactions:
-            referred_user = User.objects(id=transaction.referred_user_id.id).first() if transaction.referred_user_id else None
+            referred_user_name = referred_users.get(transaction.referred_user_id.id) if transaction.referred_user_id else None
             
             # Get currency from transaction (default to SAR if not set)
             transaction_currency = transaction.currency if hasattr(transaction, 'currency') and transaction.currency else 'SAR'
@@ -144,11 +197,13 @@ class AffiliateService:
                     'totalReferrals': total_referrals,
                     'totalEarnings': total_earnings,
                     'Total Sales': total_sales,
-                    'Commission Rate': transaction.commission_rate
+                    'Commission Rate': transaction.commission_rate,
+                    'byStatus': totals.get('byStatus', {}),
+                    'byCurrency': totals.get('byCurrency', {})
                 },
                 'Transaction ID': str(transaction.transaction_id.id) if transaction.transaction_id else '',
                 'date': transaction.date.isoformat(),
-                'Referred User Name': transaction.referred_user_name or (referred_user.full_name if referred_user else ''),
+                'Referred User Name': transaction.referred_user_name or referred_user_name or '',
                 'Referred User Commission': transaction.commission_amount,
                 'currency': transaction_currency,  # New: Currency of this commission
                 'status': transaction.status
@@ -261,6 +316,13 @@ class AffiliateService:
         if not affiliate:
             raise ValueError("Affiliate not found")
         
+        # Claim the request (conditional on the status just read) so a bulk payout or a
+        # second approval cannot pay it at the same time
+        from payments.bulk_payouts import BulkPayoutService, affiliate_paid_operations
+        claim_id = BulkPayoutService.claim_request('affiliate', payout.id, payout.status)
+        if not claim_id:
+            raise ValueError("Payout request is already being processed or was reviewed")
+        
         # Try to process payout via Moyasar if payment method is Bank Transfer
         payout_success = False
         payout_error = None
@@ -311,12 +373,9 @@ class AffiliateService:
                 
                 # Create payout via Moyasar
                 logger.info(f"Creating Moyasar payout for affiliate payout {payout_id}: {payout.amount} {currency}")
-                payout_response = MoyasarPaymentService.create_payout(
-                    amount=amount_in_cents,
-                    currency=currency,
-                    destination=destination,
-                    purpose='affiliate_payout',
-                    metadata=metadata
+                payout_response = BulkPayoutService.send_claimed_payout(
+                    'affiliate', payout.id, claim_id, payout.payout_attempt_id,
+                    amount_in_cents, currency, destination, 'affiliate_payout', metadata
                 )
                 
                 moyasar_payout_id = payout_response.get('id')
@@ -340,6 +399,7 @@ class AffiliateService:
                 # Validation error - don't approve the payout
                 payout_error = str(e)
                 logger.error(f"Payout validation error: {payout_error}")
+                BulkPayoutService.release_claim('affiliate', payout.id, claim_id)
                 raise ValueError(f"Failed to process payout: {payout_error}")
             except Exception as e:
                 # API error - log but don't fail the approval
@@ -356,6 +416,7 @@ class AffiliateService:
         if payout_error:
             payout.payout_error = payout_error
         payout.save()
+        BulkPayoutService.release_claim('affiliate', payout.id, claim_id)
         
         # Update affiliate earnings
         # Note: Amount was already deducted from pending_earnings when request was created
@@ -363,18 +424,10 @@ class AffiliateService:
         if affiliate:
             currency = payout.currency if hasattr(payout, 'currency') and payout.currency else 'SAR'
             
-            # Update currency-specific earnings
-            if not affiliate.earnings_by_currency:
-                affiliate.earnings_by_currency = {}
-            
-            currency_earnings = affiliate.earnings_by_currency.get(currency, {'total': 0.0, 'pending': 0.0, 'paid': 0.0})
-            currency_earnings['paid'] = round(currency_earnings.get('paid', 0.0) + payout.amount, 2)
-            affiliate.earnings_by_currency[currency] = currency_earnings
-            
-            # Update legacy fields (for backward compatibility) - sum all currencies
-            all_paid = sum(e['paid'] for e in affiliate.earnings_by_currency.values())
-            affiliate.paid_earnings = str(round(all_paid, 2))
-            affiliate.save()
+            # Atomic increments, then the legacy paid_earnings total recomputed from them
+            Affiliate._get_collection().bulk_write(
+                affiliate_paid_operations(affiliate.id, {currency: payout.amount}), ordered=True
+            )
         
         # Send notification to affiliate
         try:
@@ -0,0 +1,42 @@
+"""
+Affiliate service tests.
+
+MongoDB is not needed: aggregation results are mocked.
+"""
+from unittest import mock
+from bson import ObjectId
+from django.test import SimpleTestCase
+from affiliates.services import AffiliateService
+
+
+class AffiliateTransactionTotalsTests(SimpleTestCase):
+    """Commission totals for a page of affiliates come from one $group"""
+
+    def test_grouped_rows_are_folded_per_affiliate(self):
+        earning, idle = ObjectId(), ObjectId()
+        rows = [
+            {'_id': {'affiliate': earning, 'status': 'pending', 'currency': 'SAR'}, 'count': 2, 'total': 10.105},
+            {'_id': {'affiliate': earning, 'status': 'paid', 'currency': 'SAR'}, 'count': 1, 'total': 5.0},
+            {'_id': {'affiliate': earning, 'status': 'paid', 'currency': 'USD'}, 'count': 1, 'total': 3.0},
+        ]
+        objects = mock.Mock()
+        objects.aggregate.return_value = rows
+        with mock.patch('affiliates.services.AffiliateTransaction.objects', objects):
+            totals = AffiliateService.get_transaction_totals([str(earning), idle])
+
+        self.assertEqual(objects.aggregate.call_count, 1)
+        match = objects.aggregate.call_args[0][0][0]['$match']
+        self.assertEqual(match, {'affiliate_id': {'$in': [earning, idle]}})
+        self.assertEqual(totals[idle], {'count': 0, 'total': 0.0, 'byStatus': {}, 'byCurrency': {}})
+        summary = totals[earning]
+        self.assertEqual(summary['count'], 4)
+        self.assertAlmostEqual(summary['total'], 18.105)
+        self.assertEqual(summary['byStatus']['paid'], {'count': 2, 'total': 8.0})
+        self.assertEqual(summary['byStatus']['pending'], {'count': 2, 'total': 10.11})
+        self.assertEqual(summary['byCurrency'], {'SAR': {'count': 3, 'total': 15.11}, 'USD': {'count': 1, 'total': 3.0}})
+
+    def test_no_affiliates_means_no_query(self):
+        objects = mock.Mock()
+        with mock.patch('affiliates.services.AffiliateTransaction.objects', objects):
+            self.assertEqual(AffiliateService.get_transaction_totals([]), {})
+        objects.aggregate.assert_not_called()
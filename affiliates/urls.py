@@ -17,6 +17,7 @@ urlpatterns = [
     path('<str:affiliate_id>/update-commission/', views.update_commission_rate, name='update_commission_rate'),
     path('<str:affiliate_id>/suspend/', views.suspend_affiliate, name='suspend_affiliate'),
     path('payout-requests/', views.get_payout_requests, name='get_payout_requests'),
+    path('payout-requests/bulk-approve/', views.bulk_approve_payouts, name='bulk_approve_payouts'),
     path('payout-requests/<str:payout_id>/approve/', views.approve_payout, name='approve_payout'),
     path('payout-requests/<str:payout_id>/reject/', views.reject_payout, name='reject_payout'),
 ]
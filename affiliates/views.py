@@ -292,6 +292,23 @@ def approve_payout(request, payout_id):
         return Response({'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@api_view(['POST'])
+def bulk_approve_payouts(request):
+    """Approve pending affiliate payout requests in one batch and send their payouts (admin)"""
+    if not check_admin(request):
+        return Response({'success': False, 'error': 'Unauthorized'}, status=status.HTTP_403_FORBIDDEN)
+    
+    try:
+        from payments.bulk_payouts import BulkPayoutService
+        admin_id = str(request.user.id)
+        report = BulkPayoutService.execute('affiliate', request.data.get('ids', []), admin_id)
+        return Response({'success': True, **report}, status=status.HTTP_200_OK)
+    except ValueError as e:
+        return Response({'success': False, 'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @api_view(['PUT'])
 def reject_payout(request, payout_id):
     """Reject affiliate payout (admin)"""
@@ -0,0 +1,120 @@
+"""
+Principal resolution shared by the HTTP JWTAuthentication class and the WebSocket consumers.
+
+A token is verified locally (JWT signature and expiry). Buyer/seller users are
+then resolved through a short-lived Redis cache keyed by user id, so reconnect
+storms do not each read the users collection. Only what authentication needs
+(id, role, status) is cached, as a UserPrincipal; handlers that read or change
+profile, bank or password data load the User document with
+PrincipalResolver.load_account. Code that changes a user's role or status calls
+PrincipalResolver.invalidate. Admins and affiliates are few, and their
+documents carry balances, so they are always read from Mongo.
+Suspended or deactivated accounts are rejected.
+"""
+import json
+import logging
+import os
+from bson import ObjectId
+from authentication.models import Admin, User, Affiliate
+from authentication.services import JWTService
+from dolabb_backend.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+PRINCIPAL_CACHE_TTL_SECONDS = int(os.getenv('PRINCIPAL_CACHE_TTL_SECONDS', 30))
+BLOCKED_STATUSES = ('suspended', 'deactivated')
+
+
+def _cache_key(user_id):
+    return f'principal:user:{user_id}'
+
+
+class UserPrincipal:
+    """Authenticated buyer/seller as seen by request handlers: id, role and status only"""
+
+    user_type = 'user'
+
+    def __init__(self, id, role, status):
+        self.id = id
+        self.role = role
+        self.status = status
+
+    @property
+    def is_authenticated(self):
+        """Required by Django REST Framework"""
+        return True
+
+    def to_json(self):
+        return json.dumps({'id': str(self.id), 'role': self.role, 'status': self.status})
+
+    @classmethod
+    def from_json(cls, raw):
+        data = json.loads(raw)
+        return cls(ObjectId(data['id']), data.get('role'), data.get('status'))
+
+
+class PrincipalResolver:
+    """Resolve a JWT to an Admin or Affiliate document, or a UserPrincipal"""
+
+    @staticmethod
+    def resolve(token):
+        """Return the principal for a token; raises ValueError when it is invalid or not allowed"""
+        payload = JWTService.verify_token(token)
+        if not payload:
+            raise ValueError('Invalid or expired token')
+
+        user_type = payload.get('user_type') or 'user'
+        user_id = payload.get('user_id')
+        if not user_id or not ObjectId.is_valid(str(user_id)):
+            raise ValueError('Invalid user ID format')
+        user_id = ObjectId(str(user_id))
+
+        if user_type == 'admin':
+            principal = Admin.objects(id=user_id).first()
+        elif user_type == 'affiliate':
+            principal = Affiliate.objects(id=user_id).first()
+        else:
+            principal = PrincipalResolver._load_user(user_id)
+
+        if not principal:
+            raise ValueError('User not found')
+        if getattr(principal, 'status', None) in BLOCKED_STATUSES:
+            raise ValueError('Account is suspended or deactivated')
+        return principal
+
+    @staticmethod
+    def load_account(principal):
+        """Full document behind a principal; a UserPrincipal is re-read from Mongo, never from the cache"""
+        if isinstance(principal, UserPrincipal):
+            return User.objects(id=principal.id).first()
+        return principal
+
+    @staticmethod
+    def _load_user(user_id):
+        """UserPrincipal from the cache, falling back to Mongo (and filling the cache)"""
+        key = _cache_key(user_id)
+        try:
+            cached = get_redis().get(key)
+        except Exception as e:
+            logger.warning(f"Principal cache read failed: {str(e)}")
+            cached = None
+        if cached:
+            return UserPrincipal.from_json(cached)
+
+        doc = User.objects(id=user_id).only('id', 'role', 'status').as_pymongo().first()
+        if not doc:
+            return None
+        principal = UserPrincipal(doc['_id'], doc.get('role', 'buyer'), doc.get('status', 'active'))
+        try:
+            get_redis().set(key, principal.to_json(), ex=PRINCIPAL_CACHE_TTL_SECONDS)
+        except Exception as e:
+            logger.warning(f"Principal cache write failed: {str(e)}")
+        return principal
+
+    @staticmethod
+    def invalidate(user_id):
+        """Drop a user's cached principal after it changes"""
+        try:
+            get_redis().delete(_cache_key(user_id))
+        except Exception as e:
+            logger.warning(f"Principal cache invalidation failed for {user_id}: {str(e)}")
@@ -526,6 +526,8 @@ class AuthService:
             user.set_password(new_password)
             user.otp = None
             user.save()
+            from authentication.principal import PrincipalResolver
+            PrincipalResolver.invalidate(user.id)
             return user
         except Exception as e:
             # Rollback: password change failed, don't clear OTP
@@ -0,0 +1,108 @@
+"""
+Authentication tests.
+
+MongoDB and Redis are not needed: model queries are mocked and the principal
+cache is an in-memory dict.
+"""
+import json
+from unittest import mock
+from bson import ObjectId
+from django.test import SimpleTestCase
+from authentication.principal import PrincipalResolver, UserPrincipal
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+
+class PrincipalResolverTests(SimpleTestCase):
+    """Users resolve through a cache holding only id, role and status; blocked accounts never resolve"""
+
+    def setUp(self):
+        self.user_id = ObjectId()
+        self.redis = FakeRedis()
+        self.users = mock.MagicMock()
+        self.user_doc = {'_id': self.user_id, 'role': 'seller', 'status': 'active'}
+        self.users.return_value.only.return_value.as_pymongo.return_value.first.side_effect = lambda: self.user_doc
+        verify = mock.patch('authentication.principal.JWTService.verify_token', return_value={
+            'user_id': str(self.user_id), 'user_type': 'user'
+        })
+        self.verify_token = verify.start()
+        self.addCleanup(verify.stop)
+        for patcher in (
+            mock.patch('authentication.principal.get_redis', return_value=self.redis),
+            mock.patch('authentication.principal.User.objects', self.users),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_user_is_cached_as_id_role_and_status(self):
+        principal = PrincipalResolver.resolve('token')
+        self.assertIsInstance(principal, UserPrincipal)
+        self.assertEqual((principal.id, principal.role, principal.status), (self.user_id, 'seller', 'active'))
+        self.users.return_value.only.assert_called_once_with('id', 'role', 'status')
+        cached = json.loads(self.redis.values[f'principal:user:{self.user_id}'])
+        self.assertEqual(cached, {'id': str(self.user_id), 'role': 'seller', 'status': 'active'})
+
+        again = PrincipalResolver.resolve('token')
+        self.assertEqual(again.id, self.user_id)
+        self.assertEqual(self.users.call_count, 1)  # Served from the cache
+
+    def test_invalidate_drops_the_cached_principal(self):
+        PrincipalResolver.resolve('token')
+        PrincipalResolver.invalidate(self.user_id)
+        self.user_doc = dict(self.user_doc, status='suspended')
+        with self.assertRaisesMessage(ValueError, 'suspended or deactivated'):
+            PrincipalResolver.resolve('token')
+
+    def test_blocked_and_unknown_users_are_rejected(self):
+        for status in ('suspended', 'deactivated'):
+            self.redis.values.clear()
+            self.user_doc = dict(self.user_doc, status=status)
+            with self.assertRaisesMessage(ValueError, 'suspended or deactivated'):
+                PrincipalResolver.resolve('token')
+        self.redis.values.clear()
+        self.user_doc = None
+        with self.assertRaisesMessage(ValueError, 'User not found'):
+            PrincipalResolver.resolve('token')
+
+    def test_invalid_tokens_are_rejected(self):
+        self.verify_token.return_value = None
+        with self.assertRaisesMessage(ValueError, 'Invalid or expired token'):
+            PrincipalResolver.resolve('token')
+        self.verify_token.return_value = {'user_id': 'nope'}
+        with self.assertRaisesMessage(ValueError, 'Invalid user ID format'):
+            PrincipalResolver.resolve('token')
+
+    def test_admins_are_read_from_mongo(self):
+        admin = mock.Mock(status='active')
+        self.verify_token.return_value = {'user_id': str(self.user_id), 'user_type': 'admin'}
+        with mock.patch('authentication.principal.Admin.objects') as admins:
+            admins.return_value.first.return_value = admin
+            self.assertIs(PrincipalResolver.resolve('token'), admin)
+        self.assertEqual(self.redis.values, {})
+
+    def test_cache_outage_falls_back_to_mongo(self):
+        with mock.patch('authentication.principal.get_redis', side_effect=ConnectionError('down')):
+            with self.assertLogs('authentication.principal', 'WARNING'):
+                principal = PrincipalResolver.resolve('token')
+        self.assertEqual(principal.role, 'seller')
+
+    def test_load_account_rereads_the_user_document(self):
+        account = mock.Mock()
+        self.users.return_value.first.return_value = account
+        principal = UserPrincipal(self.user_id, 'seller', 'active')
+        self.assertIs(PrincipalResolver.load_account(principal), account)
+        self.assertEqual(self.users.call_args[1], {'id': self.user_id})
+        admin = mock.Mock()
+        self.assertIs(PrincipalResolver.load_account(admin), admin)
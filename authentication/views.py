@@ -14,6 +14,7 @@ from authentication.serializers import (
     ResendOTPSerializer, ContactFormSerializer
 )
 from authentication.models import User
+from authentication.principal import PrincipalResolver
 from authentication.otp_views import verify_otp, admin_verify_otp, user_verify_otp, affiliate_verify_otp
 from products.services import ProductService
 
@@ -436,7 +437,7 @@ def get_profile(request):
     # Handle GET request - return profile
     if request.method == 'GET':
         try:
-            user = request.user
+            user = PrincipalResolver.load_account(request.user)
             
             if not user or not hasattr(user, 'id'):
                 return Response({'success': False, 'error': 'User not authenticated'}, status=status.HTTP_401_UNAUTHORIZED)
@@ -586,7 +587,7 @@ def get_profile(request):
     # Handle PATCH/PUT request - update profile
     elif request.method in ['PATCH', 'PUT']:
         try:
-            user = request.user
+            user = PrincipalResolver.load_account(request.user)
             data = request.data
             
             if not user or not hasattr(user, 'id'):
@@ -667,6 +668,12 @@ def get_profile(request):
                         user.language = language
                 
                 user.save()
+                PrincipalResolver.invalidate(user.id)
+                
+                # Keep the name/avatar shown in chat inboxes current
+                if any(field in data for field in ['full_name', 'username', 'profile_image']):
+                    from chat.services import ChatService
+                    ChatService.refresh_user_snapshot(user)
                 
                 # Send notification if bank details were updated
                 if bank_details_updated:
@@ -748,7 +755,7 @@ def get_profile(request):
 @api_view(['PUT', 'PATCH'])
 def update_profile(request):
     """Update user profile"""
-    user = request.user
+    user = PrincipalResolver.load_account(request.user)
     data = request.data
     
     if hasattr(user, 'username'):  # User
@@ -826,6 +833,12 @@ def update_profile(request):
                 user.language = language
         
         user.save()
+        PrincipalResolver.invalidate(user.id)
+        
+        # Keep the name/avatar shown in chat inboxes current
+        if any(field in data for field in ['full_name', 'username', 'profile_image']):
+            from chat.services import ChatService
+            ChatService.refresh_user_snapshot(user)
         
         # Send notification if bank details were updated
         if bank_details_updated:
@@ -875,9 +888,12 @@ def update_language(request):
         # Check if user is authenticated (has id attribute = real database model, not AnonymousUser)
         if hasattr(request, 'user') and request.user and hasattr(request.user, 'id'):
             # User is authenticated - update language in database
-            user = request.user
+            user = PrincipalResolver.load_account(request.user)
+            if not user:
+                return Response({'success': False, 'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
             user.language = language
             user.save()
+            PrincipalResolver.invalidate(user.id)
             
             return Response({
                 'success': True,
@@ -10,6 +10,9 @@ pip install -r requirements.txt
 # MongoDB migrations are optional since MongoDB is schemaless
 python manage.py migrate --noinput || echo "Migrations skipped (MongoDB may not be available during build)"
 
+# Chat search needs the pair-scoped text index before the new code touches messages
+python manage.py rebuild_message_text_index || echo "Message text index rebuild skipped (MongoDB may not be available during build)"
+
 # Collect static files
 python manage.py collectstatic --noinput
 
@@ -0,0 +1,149 @@
+"""
+Hot/cold tiering of chat messages.
+
+Messages older than CHAT_ARCHIVE_AFTER_DAYS move from `messages` into
+`messages_archive`. Each archived document holds a run of consecutive messages
+for one participant pair (pair_key), stored as zlib-compressed BSON, and the
+collection has one small index. Archiving always takes the oldest messages, so
+for any pair every cold message is older than every hot one. Reads can therefore
+continue from the hot tier into the cold tier (and back) at the boundary.
+"""
+import logging
+import zlib
+from datetime import datetime, timedelta
+import bson
+from django.conf import settings
+from chat.models import Message, ArchivedMessageBatch
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_BATCH_SIZE = 500
+ANCHOR_CLOCK_SLACK = timedelta(minutes=5)  # created_at vs the _id timestamp of the same message
+
+
+def compress_messages(docs):
+    return bson.Binary(zlib.compress(bson.encode({'messages': docs}), 6))
+
+
+def decompress_messages(payload):
+    return bson.decode(zlib.decompress(bytes(payload)))['messages']
+
+
+def _key(doc):
+    return doc['created_at'], doc['_id']
+
+
+class ColdMessageStore:
+    """Archive messages and read them back in the same order as the hot tier"""
+
+    @staticmethod
+    def _batches(query, ascending):
+        cursor = ArchivedMessageBatch._get_collection().find(
+            query, {'payload': 1}
+        ).sort([('last_created_at', 1 if ascending else -1), ('_id', 1 if ascending else -1)]).batch_size(5)
+        for batch in cursor:
+            messages = decompress_messages(batch['payload'])
+            yield messages if ascending else list(reversed(messages))
+
+    @staticmethod
+    def find_anchor(pair_key, message_id):
+        """created_at/_id of an archived message of this pair, or None"""
+        generated = message_id.generation_time.replace(tzinfo=None)
+        for messages in ColdMessageStore._batches({
+            'pair_key': pair_key,
+            'last_created_at': {'$gte': generated - ANCHOR_CLOCK_SLACK},
+            'first_created_at': {'$lte': generated + ANCHOR_CLOCK_SLACK}
+        }, ascending=True):
+            for doc in messages:
+                if doc['_id'] == message_id:
+                    return {'_id': doc['_id'], 'created_at': doc['created_at'], 'cold': True}
+        return None
+
+    @staticmethod
+    def older(pair_key, anchor=None, count=50, skip=0):
+        """Archived messages before the anchor (all, when None), newest first"""
+        query = {'pair_key': pair_key}
+        if anchor:
+            query['first_created_at'] = {'$lte': anchor['created_at']}
+        results = []
+        for messages in ColdMessageStore._batches(query, ascending=False):
+            for doc in messages:
+                if anchor and _key(doc) >= _key(anchor):
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                results.append(doc)
+                if len(results) >= count:
+                    return results
+        return results
+
+    @staticmethod
+    def newer(pair_key, anchor, count=50, inclusive=False):
+        """Archived messages after the anchor (including it when inclusive), oldest first"""
+        results = []
+        for messages in ColdMessageStore._batches(
+            {'pair_key': pair_key, 'last_created_at': {'$gte': anchor['created_at']}}, ascending=True
+        ):
+            for doc in messages:
+                if _key(doc) < _key(anchor) or (not inclusive and _key(doc) == _key(anchor)):
+                    continue
+                results.append(doc)
+                if len(results) >= count:
+                    return results
+        return results
+
+    @staticmethod
+    def archive(older_than=None, batch_size=ARCHIVE_BATCH_SIZE, limit=None):
+        """
+        Move hot messages created before older_than (default: CHAT_ARCHIVE_AFTER_DAYS ago) to
+        the cold tier, per pair in created_at order. Each batch is written (upserted by its
+        first message id) before its messages are deleted, so an interrupted run loses
+        nothing and can simply be re-run. Returns the number of messages archived.
+        """
+        if older_than is None:
+            older_than = datetime.utcnow() - timedelta(days=getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 180))
+        hot = Message._get_collection()
+        cold = ArchivedMessageBatch._get_collection()
+
+        cursor = hot.find(
+            {'pair_key': {'$ne': None}, 'created_at': {'$lt': older_than}},
+            no_cursor_timeout=True
+        ).sort([('pair_key', 1), ('created_at', 1), ('_id', 1)]).hint(
+            [('pair_key', 1), ('created_at', 1), ('_id', 1)]
+        ).batch_size(batch_size)
+
+        archived = 0
+
+        def flush(pair_key, docs):
+            cold.replace_one({'_id': docs[0]['_id']}, {
+                '_id': docs[0]['_id'],
+                'pair_key': pair_key,
+                'first_created_at': docs[0]['created_at'],
+                'last_created_at': docs[-1]['created_at'],
+                'message_count': len(docs),
+                'payload': compress_messages(docs),
+                'archived_at': datetime.utcnow()
+            }, upsert=True)
+            hot.delete_many({'_id': {'$in': [doc['_id'] for doc in docs]}})
+            return len(docs)
+
+        current_pair = None
+        pending = []
+        try:
+            for doc in cursor:
+                if pending and (doc['pair_key'] != current_pair or len(pending) >= batch_size):
+                    archived += flush(current_pair, pending)
+                    pending = []
+                    if limit is not None and archived >= limit:
+                        break
+                current_pair = doc['pair_key']
+                pending.append(doc)
+            else:
+                if pending:
+                    archived += flush(current_pair, pending)
+        finally:
+            cursor.close()
+
+        logger.info(f"Archived {archived} chat message(s) created before {older_than.isoformat()}")
+        return archived
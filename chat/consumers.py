@@ -1,24 +1,26 @@
 """
 WebSocket consumers for chat and notifications
 """
+import asyncio
 import json
 import logging
 from datetime import datetime
 from urllib.parse import parse_qs
 from bson import ObjectId
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from chat.services import ChatService
 from chat.models import Message, Conversation
+from chat.presence import PresenceService, HEARTBEAT_INTERVAL_SECONDS
+from chat.rate_limit import ChatRateLimiter
 from authentication.models import User
-from authentication.services import JWTService
+from authentication.principal import PrincipalResolver
 from notifications.models import UserNotification
+from notifications.services import NotificationService
 
 logger = logging.getLogger(__name__)
 
-# Track online users per conversation: {conversation_id: {user_id: count}}
-online_users = {}
-
 
 class ChatConsumer(AsyncWebsocketConsumer):
     """WebSocket consumer for chat"""
@@ -78,6 +80,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 await self.close(code=1011)  # Internal error
                 return
             
+            # Participants and their display data do not change during a connection
+            await self.load_conversation_context()
+            
             # Join room group
             await self.safe_channel_layer_operation(
                 self.channel_layer.group_add,
@@ -87,6 +92,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
             
             await self.accept()
             
+            # Frames are rate limited and processed from a bounded queue
+            self.rate_limiter = ChatRateLimiter(user.id)
+            self.inbox = asyncio.Queue(maxsize=getattr(settings, 'CHAT_MAX_IN_FLIGHT', 8))
+            self.inbox_worker = asyncio.ensure_future(self.process_inbox())
+            
             # Track user as online
             await self.mark_user_online()
             
@@ -107,32 +117,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
     def authenticate_user(self, token):
         """Authenticate user from JWT token"""
         try:
-            payload = JWTService.verify_token(token)
-            if not payload:
-                return None
-            
-            user_id = payload.get('user_id')
-            user_type = payload.get('user_type', 'user')
-            
-            # Convert string ID to ObjectId if needed
-            try:
-                if isinstance(user_id, str):
-                    user_id = ObjectId(user_id)
-            except Exception:
-                return None
-            
-            if user_type == 'admin':
-                from authentication.models import Admin
-                return Admin.objects(id=user_id).first()
-            elif user_type == 'affiliate':
-                from authentication.models import Affiliate
-                return Affiliate.objects(id=user_id).first()
-            else:
-                return User.objects(id=user_id).first()
+            return PrincipalResolver.resolve(token)
         except Exception:
             return None
     
     async def disconnect(self, close_code):
+        if getattr(self, 'inbox_worker', None):
+            self.inbox_worker.cancel()
+        
         # Mark user as offline before disconnecting
         if hasattr(self, 'user') and self.user and hasattr(self, 'conversation_id'):
             await self.mark_user_offline()
@@ -145,21 +137,19 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
     
     async def mark_user_online(self):
-        """Mark user as online and broadcast status"""
+        """Mark user as online (shared across workers) and broadcast status"""
         if not hasattr(self, 'conversation_id') or not self.user:
             return
         
         user_id = str(self.user.id)
         conversation_id = self.conversation_id
         
-        # Track online users
-        if conversation_id not in online_users:
-            online_users[conversation_id] = {}
+        online_user_ids, came_online = await PresenceService.connect(conversation_id, user_id, self.channel_name)
+        self.presence_heartbeat = asyncio.ensure_future(self.presence_heartbeat_loop())
         
-        # Increment connection count for this user
-        if user_id not in online_users[conversation_id]:
-            online_users[conversation_id][user_id] = 0
-        online_users[conversation_id][user_id] += 1
+        # Another tab/device already announced this user
+        if not came_online:
+            return
         
         # Get conversation participants to determine who to notify
         participants = await self.get_conversation_participants(conversation_id)
@@ -172,40 +162,51 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 'type': 'user_status',
                 'user_id': user_id,
                 'status': 'online',
-                'participants': participants
+                'participants': participants,
+                'online_users': online_user_ids
             }
         )
     
     async def mark_user_offline(self):
-        """Mark user as offline and broadcast status"""
+        """Mark user as offline and broadcast status once their last connection closes"""
         if not hasattr(self, 'conversation_id') or not self.user:
             return
         
+        heartbeat = getattr(self, 'presence_heartbeat', None)
+        if heartbeat:
+            heartbeat.cancel()
+        
         user_id = str(self.user.id)
         conversation_id = self.conversation_id
         
-        # Decrement connection count
-        if conversation_id in online_users and user_id in online_users[conversation_id]:
-            online_users[conversation_id][user_id] -= 1
-            
-            # If count reaches 0, user is offline
-            if online_users[conversation_id][user_id] <= 0:
-                del online_users[conversation_id][user_id]
-                
-                # Get conversation participants
-                participants = await self.get_conversation_participants(conversation_id)
-                
-                # Broadcast user offline status
-                await self.safe_channel_layer_operation(
-                    self.channel_layer.group_send,
-                    self.room_group_name,
-                    {
-                        'type': 'user_status',
-                        'user_id': user_id,
-                        'status': 'offline',
-                        'participants': participants
-                    }
-                )
+        online_user_ids, went_offline = await PresenceService.disconnect(conversation_id, user_id, self.channel_name)
+        if not went_offline:
+            return
+        
+        # Get conversation participants
+        participants = await self.get_conversation_participants(conversation_id)
+        
+        # Broadcast user offline status
+        await self.safe_channel_layer_operation(
+            self.channel_layer.group_send,
+            self.room_group_name,
+            {
+                'type': 'user_status',
+                'user_id': user_id,
+                'status': 'offline',
+                'participants': participants,
+                'online_users': online_user_ids
+            }
+        )
+    
+    async def presence_heartbeat_loop(self):
+        """Keep this connection's presence entry alive while the socket is open"""
+        try:
+            while True:
+                await asyncio.sleep(HEARTBEAT_INTERVAL_SECONDS)
+                await PresenceService.heartbeat(self.conversation_id, str(self.user.id), self.channel_name)
+        except asyncio.CancelledError:
+            pass
     
     async def send_current_online_users(self):
         """Send current online users list to the connected user with user details"""
@@ -213,10 +214,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
         
         conversation_id = self.conversation_id
-        online_user_ids = []
-        
-        if conversation_id in online_users:
-            online_user_ids = list(online_users[conversation_id].keys())
+        online_user_ids = await PresenceService.online_users(conversation_id)
         
         # Get user details for online users
         online_users_details = await self.get_users_details(online_user_ids)
@@ -232,8 +230,45 @@ class ChatConsumer(AsyncWebsocketConsumer):
         }))
     
     @database_sync_to_async
-    def get_conversation_participants(self, conversation_id):
-        """Get conversation participant IDs"""
+    def load_conversation_context(self):
+        """Cache this conversation's participants and their user details on the connection"""
+        self.participants = None
+        self.conversation_product_id = None
+        self.user_details_cache = {}
+        self.user_full_names = {}
+        try:
+            conversation = Conversation.objects(id=self.conversation_id).only(
+                'participants', 'product_id'
+            ).as_pymongo().first()
+            if not conversation:
+                return
+            self.participants = [str(p) for p in conversation.get('participants') or []]
+            product_id = conversation.get('product_id')
+            self.conversation_product_id = str(product_id) if product_id else None
+            
+            users = User.objects(id__in=[ObjectId(p) for p in self.participants]).only(
+                'id', 'username', 'profile_image', 'full_name'
+            ).as_pymongo()
+            for user in users:
+                user_id = str(user['_id'])
+                self.user_details_cache[user_id] = {
+                    'id': user_id,
+                    'username': user.get('username') or '',
+                    'profileImage': user.get('profile_image') or ''
+                }
+                self.user_full_names[user_id] = user.get('full_name')
+        except Exception as e:
+            logger.error(f"Error loading conversation context for {self.conversation_id}: {str(e)}")
+    
+    async def get_conversation_participants(self, conversation_id):
+        """Get conversation participant IDs (cached for this connection's conversation)"""
+        if conversation_id == getattr(self, 'conversation_id', None) and getattr(self, 'participants', None) is not None:
+            return list(self.participants)
+        return await self.fetch_conversation_participants(conversation_id)
+    
+    @database_sync_to_async
+    def fetch_conversation_participants(self, conversation_id):
+        """Load conversation participant IDs from the database"""
         try:
             conversation = Conversation.objects(id=conversation_id).first()
             if conversation and conversation.participants:
@@ -243,9 +278,21 @@ class ChatConsumer(AsyncWebsocketConsumer):
             logger.error(f"Error getting conversation participants: {str(e)}")
             return []
     
+    async def get_users_details(self, user_ids):
+        """Get user details (username and profile_image), loading only users not cached on the connection"""
+        if not user_ids:
+            return []
+        if not hasattr(self, 'user_details_cache'):
+            self.user_details_cache = {}
+        missing = [user_id for user_id in user_ids if str(user_id) not in self.user_details_cache]
+        if missing:
+            for detail in await self.fetch_users_details(missing):
+                self.user_details_cache[detail['id']] = detail
+        return [dict(self.user_details_cache[str(user_id)]) for user_id in user_ids if str(user_id) in self.user_details_cache]
+    
     @database_sync_to_async
-    def get_users_details(self, user_ids):
-        """Get user details (username and profile_image) for given user IDs"""
+    def fetch_users_details(self, user_ids):
+        """Load user details (username and profile_image) for given user IDs"""
         if not user_ids:
             return []
         
@@ -304,7 +351,61 @@ class ChatConsumer(AsyncWebsocketConsumer):
             message_type = data.get('type')
             
             logger.info(f"[WEBSOCKET_RECEIVE] Parsed message - user_id: {user_id}, conversation_id: {conversation_id}, message_type: {message_type}, data_keys: {list(data.keys())}")
-            
+        except (json.JSONDecodeError, AttributeError) as e:
+            error_response = {
+                'type': 'error',
+                'message': 'Invalid JSON format',
+                'error': 'INVALID_JSON',
+                'conversationId': conversation_id
+            }
+            logger.error(f"[WEBSOCKET_RECEIVE] JSON decode error - user_id: {user_id}, error: {str(e)}, response: {json.dumps(error_response)}")
+            await self.send(text_data=json.dumps(error_response))
+            return
+        
+        # Backpressure: drop frames over the rate limits or beyond the in-flight queue
+        if hasattr(self, 'rate_limiter'):
+            throttled = await self.rate_limiter.check(message_type)
+            if throttled:
+                scope, retry_after = throttled
+                await self.send_slow_down('RATE_LIMITED', message_type, scope, retry_after)
+                return
+            try:
+                self.inbox.put_nowait(data)
+            except asyncio.QueueFull:
+                await self.send_slow_down('TOO_MANY_IN_FLIGHT', message_type, 'connection', 1.0)
+            return
+        
+        await self.dispatch_frame(data)
+    
+    async def send_slow_down(self, reason, message_type, scope, retry_after):
+        """Tell the client a frame was dropped and when to retry"""
+        await ChatRateLimiter.record_throttled(reason, message_type)
+        logger.warning(f"[WEBSOCKET_RECEIVE] Throttled - user_id: {str(self.user.id)}, conversation_id: {self.conversation_id}, reason: {reason}, scope: {scope}, message_type: {message_type}")
+        await self.send(text_data=json.dumps({
+            'type': 'slow_down',
+            'error': reason,
+            'message': 'Too many messages, please slow down',
+            'scope': scope,  # 'connection' or 'user' (all of the user's connections)
+            'messageType': message_type,
+            'retryAfter': round(retry_after, 2),
+            'conversationId': self.conversation_id
+        }))
+    
+    async def process_inbox(self):
+        """Handle queued frames one at a time, so a connection holds at most one DB thread"""
+        try:
+            while True:
+                data = await self.inbox.get()
+                await self.dispatch_frame(data)
+        except asyncio.CancelledError:
+            pass
+    
+    async def dispatch_frame(self, data):
+        """Route one client frame to its handler"""
+        user_id = str(self.user.id)
+        conversation_id = self.conversation_id if hasattr(self, 'conversation_id') else None
+        message_type = data.get('type')
+        try:
             if message_type == 'chat_message':
                 await self.handle_chat_message(data)
             elif message_type == 'send_offer':
@@ -315,6 +416,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 await self.handle_accept_offer(data)
             elif message_type == 'reject_offer':
                 await self.handle_reject_offer(data)
+            elif message_type == 'mark_read':
+                await self.handle_mark_read(data)
             else:
                 error_response = {
                     'type': 'error',
@@ -324,15 +427,6 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 }
                 logger.warning(f"[WEBSOCKET_RECEIVE] Unknown message type - user_id: {user_id}, message_type: {message_type}, response: {json.dumps(error_response)}")
                 await self.send(text_data=json.dumps(error_response))
-        except json.JSONDecodeError as e:
-            error_response = {
-                'type': 'error',
-                'message': 'Invalid JSON format',
-                'error': 'INVALID_JSON',
-                'conversationId': conversation_id
-            }
-            logger.error(f"[WEBSOCKET_RECEIVE] JSON decode error - user_id: {user_id}, error: {str(e)}, response: {json.dumps(error_response)}")
-            await self.send(text_data=json.dumps(error_response))
         except Exception as e:
             error_response = {
                 'type': 'error',
@@ -376,6 +470,34 @@ class ChatConsumer(AsyncWebsocketConsumer):
             }
         )
     
+    async def handle_mark_read(self, data):
+        """Mark this conversation's received messages as read up to readUpTo and broadcast one receipt"""
+        try:
+            receipt = await database_sync_to_async(ChatService.mark_read)(
+                self.conversation_id, str(self.user.id), data.get('readUpTo')
+            )
+        except ValueError as e:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'message': str(e),
+                'error': 'MARK_READ_FAILED',
+                'conversationId': self.conversation_id
+            }))
+            return
+        
+        if receipt['markedCount']:
+            await self.safe_channel_layer_operation(
+                self.channel_layer.group_send,
+                self.room_group_name,
+                {
+                    'type': 'read_receipt',
+                    'receipt': receipt
+                }
+            )
+        else:
+            # Nothing changed for the other participant; just acknowledge to the reader
+            await self.send(text_data=json.dumps({'type': 'read_receipt', **receipt}))
+    
     async def handle_send_offer(self, data):
         """Handle sending a new offer via WebSocket"""
         from products.services import OfferService
@@ -899,15 +1021,26 @@ class ChatConsumer(AsyncWebsocketConsumer):
     
     @database_sync_to_async
     def get_message_data(self, message, current_user_id):
-        """Get message data with sender/receiver information"""
-        sender_id = str(message.sender_id.id) if message.sender_id else None
-        receiver_id = str(message.receiver_id.id) if message.receiver_id else None
+        """
+        Get message data with sender/receiver information.
+        Built once per message and broadcast to every recipient; the sender comes from the
+        connection cache and the offer/product are read with projections.
+        """
+        # Raw ids straight from the document (reading the reference fields would dereference them)
+        raw = message.to_mongo()
+        sender_id = str(raw['sender_id']) if raw.get('sender_id') else None
+        receiver_id = str(raw['receiver_id']) if raw.get('receiver_id') else None
+        offer_oid = raw.get('offer_id')
+        product_oid = raw.get('product_id')
         is_sender = sender_id == str(current_user_id)
         
-        # Get sender user info
-        sender = None
-        if message.sender_id:
-            sender = User.objects(id=message.sender_id.id).first()
+        # Get sender name
+        user_full_names = getattr(self, 'user_full_names', {})
+        if sender_id in user_full_names:
+            sender_name = user_full_names[sender_id]
+        else:
+            sender = User.objects(id=sender_id).only('full_name').as_pymongo().first() if sender_id else None
+            sender_name = sender.get('full_name') if sender else None
         
         # Ensure timestamp is in ISO format
         timestamp = message.created_at.isoformat() if message.created_at else datetime.utcnow().isoformat()
@@ -920,65 +1053,72 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'conversationId': message.conversation_id,  # Add conversation_id for frontend query refetch
             'isSender': is_sender,  # True if current user sent this message
             'sender': 'me' if is_sender else 'other',  # For backward compatibility
-            'senderName': sender.full_name if sender else None,
+            'senderName': sender_name,
             'timestamp': timestamp,
             'createdAt': timestamp,  # Include createdAt for consistency
             'attachments': message.attachments or [],
-            'offerId': str(message.offer_id.id) if message.offer_id else None,
-            'productId': str(message.product_id.id) if message.product_id else None,
+            'offerId': str(offer_oid) if offer_oid else None,
+            'productId': str(product_oid) if product_oid else None,
             'messageType': message.message_type or 'text',
             'isRead': message.is_read if hasattr(message, 'is_read') else False
         }
         
         # If message has an offer, include complete offer details with product information
-        if message.offer_id:
+        if offer_oid:
             from products.models import Offer, Product
-            offer = Offer.objects(id=message.offer_id.id).first()
+            offer = Offer.objects(id=offer_oid).only(
+                'product_id', 'buyer_id', 'seller_id', 'offer_amount', 'original_price', 'status',
+                'created_at', 'updated_at', 'counter_offer_amount', 'shipping_cost', 'expiration_date'
+            ).as_pymongo().first()
             if offer:
                 offer_data = {
-                    'id': str(offer.id),
-                    'productId': str(offer.product_id.id) if offer.product_id else None,
-                    'buyerId': str(offer.buyer_id.id) if offer.buyer_id else None,
-                    'sellerId': str(offer.seller_id.id) if offer.seller_id else None,
-                    'offerAmount': float(offer.offer_amount) if offer.offer_amount else 0.0,
-                    'originalPrice': float(offer.original_price) if offer.original_price else 0.0,
-                    'status': offer.status,
-                    'createdAt': offer.created_at.isoformat() if offer.created_at else None,
-                    'updatedAt': offer.updated_at.isoformat() if offer.updated_at else None,
+                    'id': str(offer['_id']),
+                    'productId': str(offer['product_id']) if offer.get('product_id') else None,
+                    'buyerId': str(offer['buyer_id']) if offer.get('buyer_id') else None,
+                    'sellerId': str(offer['seller_id']) if offer.get('seller_id') else None,
+                    'offerAmount': float(offer['offer_amount']) if offer.get('offer_amount') else 0.0,
+                    'originalPrice': float(offer['original_price']) if offer.get('original_price') else 0.0,
+                    'status': offer.get('status'),
+                    'createdAt': offer['created_at'].isoformat() if offer.get('created_at') else None,
+                    'updatedAt': offer['updated_at'].isoformat() if offer.get('updated_at') else None,
                 }
                 
                 # Include counter offer if it exists
-                if offer.counter_offer_amount:
-                    offer_data['counterAmount'] = float(offer.counter_offer_amount)
+                if offer.get('counter_offer_amount'):
+                    offer_data['counterAmount'] = float(offer['counter_offer_amount'])
                 
                 # Include shipping cost if available
-                if hasattr(offer, 'shipping_cost') and offer.shipping_cost:
-                    offer_data['shippingCost'] = float(offer.shipping_cost)
+                if offer.get('shipping_cost'):
+                    offer_data['shippingCost'] = float(offer['shipping_cost'])
                 
                 # Include expiration date if available
-                if hasattr(offer, 'expiration_date') and offer.expiration_date:
-                    offer_data['expirationDate'] = offer.expiration_date.isoformat()
+                if offer.get('expiration_date'):
+                    offer_data['expirationDate'] = offer['expiration_date'].isoformat()
                 
                 # Get complete product details
-                if offer.product_id:
-                    product = Product.objects(id=offer.product_id.id).first()
+                if offer.get('product_id'):
+                    product = Product.objects(id=offer['product_id']).only(
+                        'title', 'images', 'price', 'original_price', 'currency',
+                        'size', 'condition', 'brand', 'category'
+                    ).as_pymongo().first()
                     if product:
-                        product_images = product.images or []
-                        # Use first image as main image, or fallback to image field
-                        main_image = product_images[0] if product_images else (product.image if hasattr(product, 'image') else None)
+                        product_images = product.get('images') or []
+                        # Use first image as main image
+                        main_image = product_images[0] if product_images else None
+                        price = float(product['price']) if product.get('price') else 0.0
                         
                         offer_data['product'] = {
-                            'id': str(product.id),
-                            'title': product.title or '',
+                            'id': str(product['_id']),
+                            'title': product.get('title') or '',
                             'image': main_image,
                             'images': product_images,
-                            'price': float(product.price) if product.price else 0.0,
-                            'originalPrice': float(product.original_price) if product.original_price else float(product.price) if product.price else 0.0,
-                            'currency': product.currency or 'SAR',
-                            'size': product.size or '',
-                            'condition': product.condition or '',
-                            'brand': product.brand or '' if hasattr(product, 'brand') else '',
-                            'category': product.category or '' if hasattr(product, 'category') else '',
+                            'price': price,
+                            'originalPrice': float(product['original_price']) if product.get('original_price') else price,
+                            'currency': product.get('currency') or 'SAR',
+                            'size': product.get('size') or '',
+                            'condition': product.get('condition') or '',
+                            'brand': product.get('brand') or '',
+                            'category': product.get('category') or '',
                         }
                 
                 message_data['offer'] = offer_data
@@ -1011,11 +1151,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
         status = event['status']
         participants = event.get('participants', [])
         
-        # Get current online users for this conversation
-        conversation_id = self.conversation_id
-        online_user_ids = []
-        if conversation_id in online_users:
-            online_user_ids = list(online_users[conversation_id].keys())
+        # Online users as seen by the sender of the event (one Redis read per change, not per recipient)
+        online_user_ids = event.get('online_users')
+        if online_user_ids is None:
+            online_user_ids = await PresenceService.online_users(self.conversation_id)
         
         # Get user details for the user who changed status
         user_details = await self.get_users_details([user_id])
@@ -1106,9 +1245,35 @@ class ChatConsumer(AsyncWebsocketConsumer):
         await self.send(text_data=json.dumps(response_data))
         logger.info(f"[OFFER_REJECTED_EVENT] Event sent successfully - user_id: {user_id}, conversation_id: {conversation_id}")
     
+    async def read_receipt(self, event):
+        """Send read receipt (messages read up to a timestamp) to WebSocket"""
+        await self.send(text_data=json.dumps({
+            'type': 'read_receipt',
+            **event['receipt']
+        }))
+    
+    async def offer_expired(self, event):
+        """Send offer expired event (batch of offers expired by the sweeper) to WebSocket"""
+        await self.send(text_data=json.dumps({
+            'type': 'offer_expired',
+            'offers': event['offers'],
+            'conversationId': event.get('conversationId')
+        }))
+    
     @database_sync_to_async
     def save_message(self, sender_id, receiver_id, text, product_id, attachments, offer_id):
         """Save message to database"""
+        participants = getattr(self, 'participants', None)
+        if (
+            participants
+            and str(sender_id) in participants
+            and str(receiver_id) in participants
+            and (str(product_id) if product_id else None) == self.conversation_product_id
+        ):
+            # This connection's conversation: participants are already verified
+            return ChatService.send_message_to_conversation(
+                self.conversation_id, participants, sender_id, receiver_id, text, product_id, attachments, offer_id
+            )
         return ChatService.send_message(sender_id, receiver_id, text, product_id, attachments, offer_id)
     
     @database_sync_to_async
@@ -1206,46 +1371,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
     @database_sync_to_async
     def accept_counter_offer_async(self, offer_id, buyer_id):
         """Buyer accepts seller's counter offer"""
-        from products.models import Offer, Product
-        offer = Offer.objects(id=offer_id, buyer_id=buyer_id).first()
-        if not offer:
-            raise ValueError("Offer not found")
-        if offer.status != 'countered':
-            raise ValueError("Offer is not in countered status")
-        
-        offer.status = 'accepted'
-        offer.updated_at = datetime.utcnow()
-        offer.save()
-        
-        # Update product quantity - deduct 1 when offer is accepted
-        if offer.product_id:
-            product = Product.objects(id=offer.product_id.id).first()
-            if product:
-                # Deduct 1 from quantity
-                if product.quantity is None or product.quantity <= 0:
-                    product.quantity = 0
-                else:
-                    product.quantity -= 1
-                
-                # Mark as sold if quantity reaches 0
-                if product.quantity <= 0:
-                    product.status = 'sold'
-                
-                product.updated_at = datetime.utcnow()
-                product.save()
-        
-        # Send notification to buyer with payment button (same as when seller accepts)
-        try:
-            from notifications.notification_helper import NotificationHelper
-            NotificationHelper.send_offer_accepted(
-                str(buyer_id),
-                offer_id=str(offer.id),
-                product_id=str(offer.product_id.id) if offer.product_id else None
-            )
-        except Exception as e:
-            logger.error(f"Error sending offer accepted notification for counter offer: {str(e)}")
-        
-        return offer
+        from products.services import OfferService
+        return OfferService.accept_counter_offer(offer_id, buyer_id)
 
 
 class NotificationConsumer(AsyncWebsocketConsumer):
@@ -1314,6 +1441,9 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             
             await self.accept()
             logger.info(f"Notification WebSocket connected successfully - user_id: {self.user_id}")
+            
+            # Catch up on anything sent while the socket was down
+            await self.send_sync_snapshot(query_params.get('since', [None])[0])
         except Exception as e:
             logger.error(f"Notification WebSocket connection error: {str(e)}", exc_info=True)
             try:
@@ -1326,31 +1456,39 @@ class NotificationConsumer(AsyncWebsocketConsumer):
     def authenticate_user(self, token):
         """Authenticate user from JWT token"""
         try:
-            payload = JWTService.verify_token(token)
-            if not payload:
-                return None
-            
-            user_id = payload.get('user_id')
-            user_type = payload.get('user_type', 'user')
-            
-            # Convert string ID to ObjectId if needed
-            try:
-                if isinstance(user_id, str):
-                    user_id = ObjectId(user_id)
-            except Exception:
-                return None
-            
-            if user_type == 'admin':
-                from authentication.models import Admin
-                return Admin.objects(id=user_id).first()
-            elif user_type == 'affiliate':
-                from authentication.models import Affiliate
-                return Affiliate.objects(id=user_id).first()
-            else:
-                return User.objects(id=user_id).first()
+            return PrincipalResolver.resolve(token)
         except Exception:
             return None
     
+    @database_sync_to_async
+    def load_sync_snapshot(self, since):
+        """Unread count, plus notifications missed since the cursor when one is given"""
+        user_id = str(self.user.id)
+        snapshot = {'unreadCount': NotificationService.get_unread_count(user_id)}
+        if since:
+            try:
+                notifications, has_more = NotificationService.get_missed_notifications(user_id, since)
+                snapshot.update({'notifications': notifications, 'hasMore': has_more})
+            except ValueError as e:
+                snapshot['error'] = str(e)
+        return snapshot
+    
+    async def send_sync_snapshot(self, since):
+        """
+        Send a notification_sync frame on connect. The group is joined first, so a
+        notification created meanwhile may arrive both live and in the replay;
+        clients de-duplicate by id.
+        """
+        # Only the socket's own user gets their history
+        if str(self.user.id) != str(self.user_id):
+            return
+        try:
+            snapshot = await self.load_sync_snapshot(since)
+        except Exception as e:
+            logger.error(f"Notification sync failed for user {self.user_id}: {str(e)}", exc_info=True)
+            return
+        await self.send(text_data=json.dumps({'type': 'notification_sync', **snapshot}))
+    
     async def disconnect(self, close_code):
         # Leave room group
         await self.safe_channel_layer_operation(
@@ -0,0 +1,34 @@
+"""
+Move old chat messages into the compressed cold tier (messages_archive).
+Run periodically (e.g. nightly); safe to interrupt and re-run.
+"""
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat.archive import ColdMessageStore, ARCHIVE_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Archive chat messages older than CHAT_ARCHIVE_AFTER_DAYS into the cold tier'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=None,
+                            help='Override CHAT_ARCHIVE_AFTER_DAYS for this run')
+        parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE,
+                            help='Maximum messages per archived batch')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Stop after roughly this many messages')
+
+    def handle(self, *args, **options):
+        days = options['older_than_days']
+        if days is None:
+            days = getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 180)
+        if days < 1:
+            self.stderr.write(self.style.ERROR('--older-than-days must be at least 1'))
+            return
+
+        older_than = datetime.utcnow() - timedelta(days=days)
+        archived = ColdMessageStore.archive(older_than, options['batch_size'], options['limit'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {archived} message(s) created before {older_than.isoformat()}'
+        ))
@@ -0,0 +1,46 @@
+"""
+Set Message.pair_key on messages stored before the field existed.
+Works in _id ranges with one server-side pipeline update per batch, so no message
+documents are loaded into Python. Safe to re-run; it only touches messages without a pair_key.
+"""
+from django.core.management.base import BaseCommand
+from chat.models import Message
+
+
+# Same result as chat.services.make_pair_key: ObjectId order matches hex string order
+PAIR_KEY_EXPRESSION = {'$cond': [
+    {'$lt': ['$sender_id', '$receiver_id']},
+    {'$concat': [{'$toString': '$sender_id'}, '_', {'$toString': '$receiver_id'}]},
+    {'$concat': [{'$toString': '$receiver_id'}, '_', {'$toString': '$sender_id'}]}
+]}
+
+
+class Command(BaseCommand):
+    help = 'Backfill the participant pair key on chat messages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Messages per update')
+
+    def handle(self, *args, **options):
+        collection = Message._get_collection()
+        batch_size = options['batch_size']
+        missing = {'pair_key': None, 'sender_id': {'$ne': None}, 'receiver_id': {'$ne': None}}
+        last_id = None
+        updated = 0
+
+        while True:
+            query = dict(missing)
+            if last_id is not None:
+                query['_id'] = {'$gt': last_id}
+            ids = [doc['_id'] for doc in collection.find(query, {'_id': 1}).sort('_id', 1).limit(batch_size)]
+            if not ids:
+                break
+            result = collection.update_many(
+                {'_id': {'$in': ids}, 'pair_key': None},
+                [{'$set': {'pair_key': PAIR_KEY_EXPRESSION}}]
+            )
+            updated += result.modified_count
+            last_id = ids[-1]
+            self.stdout.write(f'Backfilled {updated} message(s)...')
+
+        self.stdout.write(self.style.SUCCESS(f'Backfilled pair_key on {updated} message(s)'))
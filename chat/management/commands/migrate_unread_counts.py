@@ -0,0 +1,60 @@
+"""
+Fold the legacy string unread counters (unread_count_sender / unread_count_receiver)
+into the integer unread_counts map keyed by participant id.
+Safe to run while chat is live and to re-run: each legacy value is added with $inc
+and unset in the same update, guarded on the value that was read.
+"""
+from django.core.management.base import BaseCommand
+from pymongo import UpdateOne
+from chat.models import Conversation
+
+
+def _to_int(value):
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class Command(BaseCommand):
+    help = 'Migrate conversation unread counters to integer counts keyed by participant id'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Conversations per bulk write')
+
+    def handle(self, *args, **options):
+        collection = Conversation._get_collection()
+        batch_size = options['batch_size']
+        cursor = collection.find(
+            {'$or': [{'unread_count_sender': {'$exists': True}}, {'unread_count_receiver': {'$exists': True}}]},
+            {'participants': 1, 'unread_count_sender': 1, 'unread_count_receiver': 1}
+        ).batch_size(batch_size)
+
+        operations = []
+        migrated = 0
+        for doc in cursor:
+            participants = doc.get('participants') or []
+            increments = {}
+            guard = {'_id': doc['_id']}
+            for index, field in enumerate(['unread_count_sender', 'unread_count_receiver']):
+                if field not in doc:
+                    continue
+                guard[field] = doc[field]  # Skip if a reader reset it meanwhile; the next run picks it up
+                count = _to_int(doc[field])
+                if count and index < len(participants):
+                    key = f'unread_counts.{participants[index]}'
+                    increments[key] = increments.get(key, 0) + count
+
+            update = {'$unset': {'unread_count_sender': '', 'unread_count_receiver': ''}}
+            # Make sure every participant has a counter so reads never need the legacy fields
+            update['$inc'] = {f'unread_counts.{p}': 0 for p in participants}
+            update['$inc'].update(increments)
+            operations.append(UpdateOne(guard, update))
+
+            if len(operations) >= batch_size:
+                migrated += collection.bulk_write(operations, ordered=False).modified_count
+                operations = []
+        if operations:
+            migrated += collection.bulk_write(operations, ordered=False).modified_count
+
+        self.stdout.write(self.style.SUCCESS(f'Migrated unread counters on {migrated} conversation(s)'))
@@ -0,0 +1,29 @@
+"""
+Replace the collection-wide text index on messages with the (pair_key, text) index
+declared on Message. A collection can hold only one text index, so Message's own
+index creation fails until the old one is dropped. This command talks to the
+collection directly (Message._get_collection() would try to create the new index
+first) and is safe to re-run.
+"""
+from django.core.management.base import BaseCommand
+from chat.models import Message, MESSAGE_TEXT_INDEX
+
+
+class Command(BaseCommand):
+    help = 'Swap the messages text index for the pair-scoped (pair_key, text) index'
+
+    def handle(self, *args, **options):
+        collection = Message._get_db()[Message._meta['collection']]
+
+        for name, info in collection.index_information().items():
+            is_text = any(direction == 'text' for _, direction in info.get('key', []))
+            if is_text and name != MESSAGE_TEXT_INDEX:
+                collection.drop_index(name)
+                self.stdout.write(f'Dropped text index {name}')
+
+        collection.create_index(
+            [('pair_key', 1), ('text', 'text')],
+            name=MESSAGE_TEXT_INDEX,
+            default_language='none'
+        )
+        self.stdout.write(self.style.SUCCESS(f'Text index {MESSAGE_TEXT_INDEX} is in place'))
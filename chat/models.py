@@ -1,15 +1,18 @@
 """
 Chat models using mongoengine
 """
-from mongoengine import Document, StringField, DateTimeField, ReferenceField, ListField, BooleanField, EmbeddedDocument, EmbeddedDocumentField
+from mongoengine import Document, StringField, DateTimeField, ReferenceField, ListField, BooleanField, EmbeddedDocument, EmbeddedDocumentField, DictField, IntField, BinaryField, ObjectIdField
 from datetime import datetime
 from authentication.models import User
 from products.models import Product, Offer
 
+MESSAGE_TEXT_INDEX = 'pair_key_text_search'
+
 
 class Message(Document):
     """Chat message model"""
     conversation_id = StringField(required=True)
+    pair_key = StringField()  # Sorted "{user_id}_{user_id}" of sender and receiver; see chat.services.make_pair_key
     sender_id = ReferenceField(User, required=True)
     receiver_id = ReferenceField(User, required=True)
     product_id = ReferenceField(Product)
@@ -29,7 +32,15 @@ class Message(Document):
             'created_at',
             # Composite indexes for common query patterns
             [('conversation_id', 1), ('created_at', 1)],  # For paginated message retrieval
-            [('conversation_id', 1), ('receiver_id', 1), ('is_read', 1)]  # For unread messages query
+            [('conversation_id', 1), ('receiver_id', 1), ('is_read', 1)],  # For unread messages query
+            [('pair_key', 1), ('created_at', 1), ('_id', 1)],  # For cursor-paginated history between two users
+            [('pair_key', 1), ('receiver_id', 1), ('is_read', 1)],  # For marking a pair's history as read
+            {'fields': ['offer_id'], 'sparse': True},  # Offer messages by offer (expiry sweep); most messages have none
+            # Full-text chat search, one participant pair at a time: the pair_key prefix keeps each
+            # search inside that pair's index range. No stemming so order numbers, prices and
+            # Arabic text match as typed. Replaces a collection-wide text index; see the
+            # rebuild_message_text_index command.
+            {'fields': ['pair_key', '$text'], 'default_language': 'none', 'name': MESSAGE_TEXT_INDEX}
         ]
     }
 
@@ -40,13 +51,46 @@ class Conversation(Document):
     product_id = ReferenceField(Product)
     last_message = StringField()
     last_message_at = DateTimeField()
-    unread_count_sender = StringField(default='0')
-    unread_count_receiver = StringField(default='0')
+    unread_counts = DictField()  # Unread messages per participant: {user_id: int}, updated with $inc
+    # Legacy string counters (first participant / second participant); folded into
+    # unread_counts by `manage.py migrate_unread_counts`
+    unread_count_sender = StringField()
+    unread_count_receiver = StringField()
+    # Inbox display data, kept in sync by ChatService.refresh_user_snapshot / refresh_product_snapshot:
+    # {user_id: {'username', 'fullName', 'profileImage'}} and {'title', 'image'}
+    participant_snapshots = DictField()
+    product_snapshot = DictField()
     created_at = DateTimeField(default=datetime.utcnow)
     updated_at = DateTimeField(default=datetime.utcnow)
     
     meta = {
         'collection': 'conversations',
-        'indexes': ['participants', 'product_id', 'updated_at']
+        'indexes': [
+            'participants',
+            'product_id',
+            'updated_at',
+            [('participants', 1), ('updated_at', -1), ('_id', -1)]  # For the cursor-paginated inbox
+        ]
     }
 
+
+
+class ArchivedMessageBatch(Document):
+    """
+    Cold-tier chat history: up to a few hundred consecutive messages of one participant
+    pair, stored as one zlib-compressed BSON payload (see chat.archive)
+    """
+    id = ObjectIdField(primary_key=True)  # _id of the batch's first message, so re-archiving is idempotent
+    pair_key = StringField(required=True)
+    first_created_at = DateTimeField(required=True)
+    last_created_at = DateTimeField(required=True)
+    message_count = IntField(default=0)
+    payload = BinaryField(required=True)
+    archived_at = DateTimeField(default=datetime.utcnow)
+    
+    meta = {
+        'collection': 'messages_archive',
+        'indexes': [
+            [('pair_key', 1), ('last_created_at', -1)]  # The only index: batches of a pair by age
+        ]
+    }
@@ -0,0 +1,97 @@
+"""
+Chat presence shared by every Channels worker.
+
+Each conversation has one Redis sorted set, presence:{conversation_id}. Its
+members are "{user_id}|{channel_name}", one per open WebSocket, and the score
+is when that connection's heartbeat expires. A user is online while at least
+one of their connections is live, so several tabs or workers count correctly.
+Connections that stop heartbeating (e.g. a crashed worker) drop out after the
+TTL, and the key expires when a conversation has no live connections, so
+nothing grows without bound.
+"""
+import logging
+import os
+import time
+from dolabb_backend.redis_client import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_TTL_SECONDS = int(os.getenv('CHAT_PRESENCE_TTL_SECONDS', 90))
+HEARTBEAT_INTERVAL_SECONDS = max(PRESENCE_TTL_SECONDS // 3, 5)
+
+
+def _key(conversation_id):
+    return f'presence:{conversation_id}'
+
+
+def _users(members):
+    """Connection counts per user id from live set members"""
+    counts = {}
+    for member in members:
+        user_id = member.split('|', 1)[0]
+        counts[user_id] = counts.get(user_id, 0) + 1
+    return counts
+
+
+class PresenceService:
+    """Per-conversation online users with per-user connection counts"""
+
+    @staticmethod
+    async def _update(conversation_id, add_member=None, remove_member=None):
+        """Apply a change, prune expired connections and return live connection counts per user"""
+        now = time.time()
+        key = _key(conversation_id)
+        pipe = get_async_redis().pipeline(transaction=True)
+        if add_member:
+            pipe.zadd(key, {add_member: now + PRESENCE_TTL_SECONDS})
+        if remove_member:
+            pipe.zrem(key, remove_member)
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zrange(key, 0, -1)
+        pipe.expire(key, PRESENCE_TTL_SECONDS * 2)
+        results = await pipe.execute()
+        return _users(results[-2])
+
+    @staticmethod
+    async def connect(conversation_id, user_id, channel_name):
+        """
+        Register a connection. Returns (online_user_ids, came_online) where came_online
+        is True if this is the user's only live connection.
+        """
+        try:
+            counts = await PresenceService._update(conversation_id, add_member=f'{user_id}|{channel_name}')
+        except Exception as e:
+            logger.error(f"Presence connect failed for conversation {conversation_id}: {str(e)}")
+            return [user_id], True
+        return list(counts.keys()), counts.get(user_id, 0) <= 1
+
+    @staticmethod
+    async def disconnect(conversation_id, user_id, channel_name):
+        """
+        Drop a connection. Returns (online_user_ids, went_offline) where went_offline
+        is True if the user has no live connections left.
+        """
+        try:
+            counts = await PresenceService._update(conversation_id, remove_member=f'{user_id}|{channel_name}')
+        except Exception as e:
+            logger.error(f"Presence disconnect failed for conversation {conversation_id}: {str(e)}")
+            return [], True
+        return list(counts.keys()), user_id not in counts
+
+    @staticmethod
+    async def heartbeat(conversation_id, user_id, channel_name):
+        """Extend a live connection's expiry"""
+        try:
+            await PresenceService._update(conversation_id, add_member=f'{user_id}|{channel_name}')
+        except Exception as e:
+            logger.warning(f"Presence heartbeat failed for conversation {conversation_id}: {str(e)}")
+
+    @staticmethod
+    async def online_users(conversation_id):
+        """User ids with at least one live connection"""
+        try:
+            members = await get_async_redis().zrangebyscore(_key(conversation_id), time.time(), '+inf')
+        except Exception as e:
+            logger.error(f"Presence lookup failed for conversation {conversation_id}: {str(e)}")
+            return []
+        return list(_users(members).keys())
@@ -0,0 +1,144 @@
+"""
+Rate limiting and backpressure for chat WebSockets.
+
+Each inbound frame is checked against two token buckets:
+- one per connection, kept in the consumer (a connection lives in one worker);
+- one per user, kept in Redis so every tab and worker of the user shares it.
+Offer actions draw from a separate, smaller bucket because each one writes
+offers, messages and notifications. A frame that is over a limit is dropped,
+and the client gets a `slow_down` frame with a retry hint. Throttled frames are
+counted per process and in the Redis hash chat:throttle_metrics.
+"""
+import logging
+import time
+from django.conf import settings
+from dolabb_backend.redis_client import get_async_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+# (tokens per second, burst) per scope and bucket kind, when not set in settings
+DEFAULT_LIMITS = {
+    'connection': {'message': (5, 20), 'offer': (0.5, 5)},
+    'user': {'message': (10, 40), 'offer': (1, 10)},
+}
+OFFER_MESSAGE_TYPES = {'send_offer', 'counter_offer', 'accept_offer', 'reject_offer'}
+METRICS_KEY = 'chat:throttle_metrics'
+
+# Atomic token bucket: KEYS[1] hash {tokens, ts}; ARGV rate, burst, now, cost.
+# Returns {allowed (0/1), seconds until a token is available}.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(wait)}
+"""
+
+_local_metrics = {}
+_script = None  # (async client, registered script); clients are per event loop
+
+
+def bucket_kind(message_type):
+    return 'offer' if message_type in OFFER_MESSAGE_TYPES else 'message'
+
+
+def limits(scope, kind):
+    """(tokens per second, burst) for a bucket, from the CHAT_<SCOPE>_<KIND>_RATE/_BURST settings"""
+    prefix = f'CHAT_{scope.upper()}_{kind.upper()}'
+    return (
+        float(getattr(settings, f'{prefix}_RATE', DEFAULT_LIMITS[scope][kind][0])),
+        int(getattr(settings, f'{prefix}_BURST', DEFAULT_LIMITS[scope][kind][1]))
+    )
+
+
+class TokenBucket:
+    """In-process token bucket for one connection"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self, cost=1):
+        """Returns seconds to wait: 0 when the tokens were taken"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def refund(self, cost=1):
+        """Give back tokens taken for a frame that another bucket rejected"""
+        self.tokens = min(self.burst, self.tokens + cost)
+
+
+class ChatRateLimiter:
+    """Connection and user limits for one chat connection"""
+
+    def __init__(self, user_id):
+        self.user_id = str(user_id)
+        self.buckets = {kind: TokenBucket(*limits('connection', kind)) for kind in ('message', 'offer')}
+
+    async def check(self, message_type):
+        """
+        Returns None if the frame may proceed, else (scope, retry_after_seconds).
+        A frame the user bucket rejects gets its connection token back, so it costs nothing.
+        """
+        kind = bucket_kind(message_type)
+        wait = self.buckets[kind].take()
+        if wait:
+            return 'connection', wait
+
+        rate, burst = limits('user', kind)
+        global _script
+        try:
+            client = get_async_redis()
+            if _script is None or _script[0] is not client:
+                _script = (client, client.register_script(TOKEN_BUCKET_SCRIPT))
+            allowed, wait = await _script[1](
+                keys=[f'ratelimit:chat:{kind}:{self.user_id}'], args=[rate, burst, time.time(), 1]
+            )
+        except Exception as e:
+            logger.warning(f"Chat user rate limit unavailable, allowing frame: {str(e)}")
+            return None
+        if int(allowed):
+            return None
+        self.buckets[kind].refund()
+        return 'user', float(wait)
+
+    @staticmethod
+    async def record_throttled(reason, message_type):
+        """Count a dropped frame locally and in the shared Redis hash"""
+        field = f'{reason}:{message_type}'
+        _local_metrics[field] = _local_metrics.get(field, 0) + 1
+        try:
+            await get_async_redis().hincrby(METRICS_KEY, field, 1)
+        except Exception as e:
+            logger.warning(f"Could not record chat throttle metric: {str(e)}")
+
+
+def get_metrics():
+    """Throttled frame counts: {'process': {...}, 'cluster': {...}} keyed by reason:message_type"""
+    try:
+        cluster = {field: int(count) for field, count in get_redis().hgetall(METRICS_KEY).items()}
+    except Exception as e:
+        logger.warning(f"Could not read chat throttle metrics: {str(e)}")
+        cluster = {}
+    return {'process': dict(_local_metrics), 'cluster': cluster}
@@ -1,23 +1,115 @@
 """
 Chat services
 """
-from datetime import datetime
+from datetime import datetime, timezone
+from bson import ObjectId
+from django.conf import settings
+from pymongo import UpdateOne
 from chat.models import Conversation, Message
+from chat.archive import ColdMessageStore
 from authentication.models import User
 from products.models import Product, Offer
+import re
 import uuid
 
 
+def make_pair_key(user_a_id, user_b_id):
+    """Canonical key for all messages between two users, independent of direction"""
+    return '_'.join(sorted([str(user_a_id), str(user_b_id)]))
+
+
+def _user_snapshot(user_doc):
+    """Inbox display fields for a participant, from a raw user document"""
+    return {
+        'username': user_doc.get('username') or '',
+        'fullName': user_doc.get('full_name') or '',
+        'profileImage': user_doc.get('profile_image') or ''
+    }
+
+
+def _product_snapshot(product_doc):
+    """Inbox display fields for a conversation's product, from a raw product document"""
+    images = product_doc.get('images') or []
+    return {
+        'title': product_doc.get('title') or '',
+        'image': images[0] if images else None
+    }
+
+
+def _parse_read_mark(value):
+    """High-water-mark timestamp (ISO 8601) as naive UTC, capped at now; None means now"""
+    now = datetime.utcnow()
+    if not value:
+        return now
+    try:
+        mark = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError("readUpTo must be an ISO 8601 timestamp")
+    if mark.tzinfo is not None:
+        mark = mark.astimezone(timezone.utc).replace(tzinfo=None)
+    return min(mark, now)
+
+
+def _highlight(text, query, window=160):
+    """
+    Snippet of text around the first search term match, with [start, end) offsets
+    of every term match inside the snippet
+    """
+    terms = {term.lower() for term in re.findall(r'\w+', query, re.UNICODE)}
+    lowered = text.lower()
+    ranges = []
+    for term in terms:
+        start = lowered.find(term)
+        while start != -1:
+            ranges.append([start, start + len(term)])
+            start = lowered.find(term, start + len(term))
+    ranges.sort()
+    
+    snippet_start = 0
+    if ranges and len(text) > window:
+        snippet_start = max(0, ranges[0][0] - window // 3)
+    snippet_end = min(len(text), snippet_start + window)
+    highlights = []
+    for start, end in ranges:
+        if start >= snippet_start and end <= snippet_end:
+            start, end = start - snippet_start, end - snippet_start
+            if highlights and start <= highlights[-1][1]:
+                highlights[-1][1] = max(highlights[-1][1], end)  # Overlapping terms
+            else:
+                highlights.append([start, end])
+    return {
+        'snippet': text[snippet_start:snippet_end],
+        'snippetStart': snippet_start,
+        'highlights': highlights
+    }
+
+
+def _legacy_unread_field(participant_ids, user_id):
+    """Pre-migration string counter for a user: the first participant's was stored as unread_count_sender"""
+    return 'unread_count_sender' if str(participant_ids[0]) == str(user_id) else 'unread_count_receiver'
+
+
+def _unread_count(conversation_doc, user_id):
+    """Unread count for a user from a raw conversation document (integer counter plus any unmigrated legacy count)"""
+    count = int((conversation_doc.get('unread_counts') or {}).get(str(user_id), 0) or 0)
+    participants = conversation_doc.get('participants') or []
+    if participants:
+        legacy = conversation_doc.get(_legacy_unread_field(participants, user_id))
+        try:
+            count += int(legacy or 0)
+        except (TypeError, ValueError):
+            pass
+    return count
+
+
 class ChatService:
     """Chat service"""
     
     @staticmethod
     def get_or_create_conversation(user1_id, user2_id, product_id=None):
         """Get or create conversation between two users"""
-        user1 = User.objects(id=user1_id).first()
-        user2 = User.objects(id=user2_id).first()
-        
-        if not user1 or not user2:
+        users = list(User.objects(id__in=[user1_id, user2_id]).only('id', 'username', 'full_name', 'profile_image').as_pymongo())
+        if len({str(user['_id']) for user in users}) < len({str(user1_id), str(user2_id)}):
             raise ValueError("Users not found")
         
         # Find existing conversation
@@ -27,126 +119,271 @@ class ChatService:
         ).first()
         
         if not conversation:
+            product_snapshot = {}
+            if product_id:
+                product = Product.objects(id=product_id).only('title', 'images').as_pymongo().first()
+                product_snapshot = _product_snapshot(product) if product else {}
             conversation = Conversation(
                 participants=[user1_id, user2_id],
-                product_id=product_id
+                product_id=product_id,
+                participant_snapshots={str(user['_id']): _user_snapshot(user) for user in users},
+                product_snapshot=product_snapshot
             )
             conversation.save()
         
         return conversation
     
     @staticmethod
-    def get_conversations(user_id):
-        """Get all conversations for a user"""
-        conversations = Conversation.objects(participants=user_id).order_by('-updated_at')
+    def get_conversations(user_id, limit=50, cursor=None):
+        """
+        Get a page of a user's conversations, most recently active first.
+        cursor is the nextCursor of the previous page. Returns (conversations, next_cursor),
+        where next_cursor is None on the last page.
+        
+        Counterpart and product display data come from the snapshots stored on each
+        conversation; conversations created before snapshots existed are filled in with
+        one batched user query and one batched product query, and saved for next time.
+        """
+        user_oid = ObjectId(str(user_id))
+        query = {'participants': user_oid}
+        if cursor:
+            try:
+                updated_at_str, last_id = cursor.rsplit('|', 1)
+                updated_at = datetime.fromisoformat(updated_at_str)
+                last_oid = ObjectId(last_id)
+            except Exception:
+                raise ValueError("Invalid conversations cursor")
+            query['$or'] = [
+                {'updated_at': {'$lt': updated_at}},
+                {'updated_at': updated_at, '_id': {'$lt': last_oid}}
+            ]
+        
+        collection = Conversation._get_collection()
+        docs = list(collection.find(query, {
+            'participants': 1, 'product_id': 1, 'last_message': 1, 'last_message_at': 1, 'updated_at': 1,
+            'unread_counts': 1, 'unread_count_sender': 1, 'unread_count_receiver': 1,
+            'participant_snapshots': 1, 'product_snapshot': 1
+        }).sort([('updated_at', -1), ('_id', -1)]).limit(limit + 1))
+        has_more = len(docs) > limit
+        docs = docs[:limit]
+        
+        # Counterpart of each conversation, and any snapshots that still need filling in
+        other_ids = {}
+        missing_user_ids = set()
+        missing_product_ids = set()
+        for doc in docs:
+            other_id = next((p for p in doc.get('participants') or [] if p != user_oid), None)
+            other_ids[doc['_id']] = other_id
+            if other_id and str(other_id) not in (doc.get('participant_snapshots') or {}):
+                missing_user_ids.add(other_id)
+            if doc.get('product_id') and not doc.get('product_snapshot'):
+                missing_product_ids.add(doc['product_id'])
+        
+        user_snapshots = {}
+        if missing_user_ids:
+            for user in User.objects(id__in=list(missing_user_ids)).only('id', 'username', 'full_name', 'profile_image').as_pymongo():
+                user_snapshots[str(user['_id'])] = _user_snapshot(user)
+        product_snapshots = {}
+        if missing_product_ids:
+            for product in Product.objects(id__in=list(missing_product_ids)).only('id', 'title', 'images').as_pymongo():
+                product_snapshots[product['_id']] = _product_snapshot(product)
         
         conversations_list = []
-        for conv in conversations:
-            other_user = None
-            for participant in conv.participants:
-                if str(participant.id) != str(user_id):
-                    other_user = User.objects(id=participant.id).first()
-                    break
+        backfill = []
+        for doc in docs:
+            other_id = other_ids[doc['_id']]
+            other_key = str(other_id) if other_id else ''
+            other_snapshot = (doc.get('participant_snapshots') or {}).get(other_key)
+            product_snapshot = doc.get('product_snapshot') or product_snapshots.get(doc.get('product_id'))
             
+            fill = {}
+            if other_snapshot is None and other_key in user_snapshots:
+                other_snapshot = user_snapshots[other_key]
+                fill[f'participant_snapshots.{other_key}'] = other_snapshot
+            if not doc.get('product_snapshot') and product_snapshot:
+                fill['product_snapshot'] = product_snapshot
+            if fill:
+                backfill.append(UpdateOne({'_id': doc['_id']}, {'$set': fill}))
+            
+            other_snapshot = other_snapshot or {}
             conversations_list.append({
-                'id': str(conv.id),
-                'conversationId': str(conv.id),
+                'id': str(doc['_id']),
+                'conversationId': str(doc['_id']),
                 'otherUser': {
-                    'id': str(other_user.id) if other_user else '',
-                    'username': other_user.username if other_user else '',
-                    'profileImage': other_user.profile_image if other_user else ''
+                    'id': other_key if other_snapshot else '',
+                    'username': other_snapshot.get('username', ''),
+                    'fullName': other_snapshot.get('fullName', ''),
+                    'profileImage': other_snapshot.get('profileImage', '')
                 },
-                'lastMessage': conv.last_message or '',
-                'lastMessageAt': conv.last_message_at.isoformat() if conv.last_message_at else None,
-                'unreadCount': conv.unread_count_sender if str(conv.participants[0].id) == str(user_id) else conv.unread_count_receiver,
-                'productId': str(conv.product_id.id) if conv.product_id else None
+                'lastMessage': doc.get('last_message') or '',
+                'lastMessageAt': doc['last_message_at'].isoformat() if doc.get('last_message_at') else None,
+                'unreadCount': str(_unread_count(doc, user_id)),
+                'productId': str(doc['product_id']) if doc.get('product_id') else None,
+                'product': {
+                    'id': str(doc['product_id']),
+                    'title': product_snapshot.get('title', ''),
+                    'image': product_snapshot.get('image')
+                } if doc.get('product_id') and product_snapshot else None,
+                'updatedAt': doc['updated_at'].isoformat() if doc.get('updated_at') else None
             })
         
-        return conversations_list
+        if backfill:
+            try:
+                collection.bulk_write(backfill, ordered=False)
+            except Exception as e:
+                import logging
+                logging.getLogger(__name__).warning(f"Could not save conversation snapshots: {str(e)}")
+        
+        next_cursor = None
+        if has_more and docs[-1].get('updated_at'):
+            next_cursor = f"{docs[-1]['updated_at'].isoformat()}|{docs[-1]['_id']}"
+        return conversations_list, next_cursor
     
     @staticmethod
     def get_unread_messages_status(user_id):
-        """Get unread messages status for a user - lightweight check for tab indicator"""
-        conversations = Conversation.objects(participants=user_id).only('participants', 'unread_count_sender', 'unread_count_receiver')
-        
-        total_unread = 0
-        has_unread = False
-        
-        for conv in conversations:
-            # Determine which unread count to use based on user's position in participants
-            unread_count_str = conv.unread_count_sender if str(conv.participants[0].id) == str(user_id) else conv.unread_count_receiver
-            unread_count = int(unread_count_str or '0')
-            
-            if unread_count > 0:
-                has_unread = True
-                total_unread += unread_count
+        """Get unread messages status for a user - lightweight check for tab indicator (one aggregation)"""
+        user_oid = ObjectId(str(user_id))
+        # Legacy string counters are included until migrate_unread_counts has run
+        legacy_count = {'$convert': {
+            'input': {'$cond': [
+                {'$eq': [{'$arrayElemAt': ['$participants', 0]}, user_oid]},
+                '$unread_count_sender',
+                '$unread_count_receiver'
+            ]},
+            'to': 'int',
+            'onError': 0,
+            'onNull': 0
+        }}
+        pipeline = [
+            {'$match': {'participants': user_oid}},
+            {'$group': {
+                '_id': None,
+                'total': {'$sum': {'$add': [
+                    {'$ifNull': [f'$unread_counts.{user_oid}', 0]},
+                    legacy_count
+                ]}}
+            }}
+        ]
+        result = list(Conversation.objects.aggregate(pipeline))
+        total_unread = int(result[0]['total']) if result else 0
         
         return {
-            'hasUnreadMessages': has_unread,
+            'hasUnreadMessages': total_unread > 0,
             'totalUnreadCount': total_unread
         }
     
     @staticmethod
-    def get_messages(conversation_id, user_id, page=1, limit=50):
+    def get_messages(conversation_id, user_id, page=1, limit=50, before=None, after=None, around=None, as_admin=False):
         """Get messages for a conversation - Aggregates messages from ALL conversations between participants
         
         This method aggregates messages from all conversations between the two participants
         because messages can be split across multiple conversations (e.g., product-specific vs general chat).
         This ensures all messages (text, offers, images) between users are returned together.
+        
+        Messages are returned newest first. Pass a message id as `before` for the older page
+        preceding it, as `after` for the newer page following it, or as `around` for a window
+        centred on it (e.g. to jump to a search result); without a cursor, `page` selects a
+        page from the most recent message. Returns (messages, has_more) where has_more tells
+        whether more messages exist in the requested direction (older, for `around`).
+        
+        as_admin lets a dispute admin read the history without being a participant; nothing
+        is marked as read in that case.
         """
         # Only fetch minimal fields from conversation to avoid loading full objects
-        conversation = Conversation.objects(id=conversation_id).only('participants', 'unread_count_sender', 'unread_count_receiver').first()
+        conversation = Conversation.objects(id=conversation_id).only('participants').first()
         if not conversation:
             raise ValueError("Conversation not found")
         
         # Check if user is participant
         is_participant = any(str(p.id) == str(user_id) for p in conversation.participants)
-        if not is_participant:
+        if not is_participant and not as_admin:
             raise ValueError("Not authorized to view this conversation")
         
-        # Get messages with only required fields to prevent ReferenceField auto-dereferencing
-        # Order by created_at DESC (newest first) - Page 1 = most recent messages
         # Extract participant IDs - these are the two users in the conversation
         participant_ids = [str(p.id) for p in conversation.participants]
         if len(participant_ids) != 2:
             raise ValueError("Invalid conversation: must have exactly 2 participants")
         
-        # Query ALL messages between these two participants (regardless of conversation_id)
-        # This aggregates messages from all conversations between the users
-        # This fixes the issue where messages are split across multiple conversations
-        # (e.g., product-specific conversations vs general chat)
-        skip = (page - 1) * limit
-        
-        # Build query: messages where (sender=user1 AND receiver=user2) OR (sender=user2 AND receiver=user1)
-        # This gets all messages between the two participants from ANY conversation
-        from mongoengine import Q
-        messages_queryset = Message.objects(
-            (Q(sender_id=participant_ids[0]) & Q(receiver_id=participant_ids[1])) |
-            (Q(sender_id=participant_ids[1]) & Q(receiver_id=participant_ids[0]))
-        ).only(
-            'id', 'text', 'sender_id', 'receiver_id', 'offer_id', 'product_id', 
-            'message_type', 'attachments', 'created_at', 'is_read', 'conversation_id'
-        ).order_by('-created_at').skip(skip).limit(limit)
-        
-        # Get total count - use estimated count for better performance on large collections
-        # For exact count, use count(), but estimated_count() is faster for large datasets
-        try:
-            # Try to get exact count efficiently - count ALL message types (text, offer, image)
-            total = Message.objects(
-                (Q(sender_id=participant_ids[0]) & Q(receiver_id=participant_ids[1])) |
-                (Q(sender_id=participant_ids[1]) & Q(receiver_id=participant_ids[0]))
-            ).count()
-        except Exception:
-            # Fallback to 0 if count fails
-            total = 0
+        # All messages between the two participants (from ANY of their conversations) share a
+        # pair_key, so one (pair_key, created_at, _id) index range serves every page
+        pair_key = make_pair_key(participant_ids[0], participant_ids[1])
+        
+        def fetch_hot(anchor, op, count, skip=0):
+            """Up to count hot messages past the anchor in created_at/_id order ($lt: older, $gt/$gte: newer)"""
+            query = {'pair_key': pair_key}
+            if anchor:
+                id_op = op
+                op = '$gt' if op == '$gte' else op
+                query['$or'] = [
+                    {'created_at': {op: anchor['created_at']}},
+                    {'created_at': anchor['created_at'], '_id': {id_op: anchor['_id']}}
+                ]
+            ascending = op != '$lt'
+            return list(Message.objects(__raw__=query).only(
+                'id', 'text', 'sender_id', 'receiver_id', 'offer_id', 'product_id', 
+                'message_type', 'attachments', 'created_at', 'is_read', 'conversation_id'
+            ).order_by('+created_at' if ascending else '-created_at', '+id' if ascending else '-id').skip(skip).limit(count))
+        
+        def fetch(anchor, op, count, skip=0):
+            """
+            Up to count+1 messages past the anchor, continuing across the hot/cold boundary.
+            Archived messages are always older than hot ones, so older pages run from the hot
+            tier into the cold tier and newer pages from a cold anchor run back into the hot tier.
+            """
+            wanted = count + 1
+            cold_anchor = bool(anchor and anchor.get('cold'))
+            if op == '$lt':
+                results = [] if cold_anchor else fetch_hot(anchor, op, wanted, skip)
+                if len(results) < wanted:
+                    cold_skip = 0
+                    if skip and not results:
+                        cold_skip = max(0, skip - Message.objects(pair_key=pair_key).count())
+                    results += [Message._from_son(doc) for doc in ColdMessageStore.older(
+                        pair_key, anchor if cold_anchor else None, wanted - len(results), cold_skip
+                    )]
+                return results
+            results = []
+            if cold_anchor:
+                results = [Message._from_son(doc) for doc in ColdMessageStore.newer(
+                    pair_key, anchor, wanted, inclusive=op == '$gte'
+                )]
+                if len(results) >= wanted:
+                    return results
+                anchor = None  # Every hot message is newer than an archived one
+            return results + fetch_hot(anchor, '$gt' if not anchor else op, wanted - len(results))
+        
+        cursor_id = before or after or around
+        anchor = None
+        if cursor_id:
+            if not ObjectId.is_valid(cursor_id):
+                raise ValueError("Invalid message cursor")
+            anchor = Message.objects(id=cursor_id, pair_key=pair_key).only('created_at').as_pymongo().first()
+            if not anchor:
+                anchor = ColdMessageStore.find_anchor(pair_key, ObjectId(cursor_id))
+            if not anchor:
+                raise ValueError("Message cursor not found in this conversation")
+        
+        # Fetch one extra message to learn whether another page exists, instead of counting
+        if around:
+            older_count = limit // 2
+            newer = fetch(anchor, '$gte', limit - older_count)[:limit - older_count]  # Includes the anchor
+            older = fetch(anchor, '$lt', older_count) if older_count else []
+            has_more = len(older) > older_count
+            message_list = list(reversed(newer)) + older[:older_count]
+        elif after:
+            message_list = fetch(anchor, '$gt', limit)
+            has_more = len(message_list) > limit
+            message_list = list(reversed(message_list[:limit]))  # Newer page was read oldest first; respond newest first
+        else:
+            skip = 0 if before else (max(page, 1) - 1) * limit
+            message_list = fetch(anchor, '$lt', limit, skip)
+            has_more = len(message_list) > limit
+            message_list = message_list[:limit]
         
         # Keep conversation_id_str for response consistency
         conversation_id_str = str(conversation_id)
         
-        # Convert to list and extract IDs - using pattern from codebase
-        from bson import ObjectId
-        message_list = list(messages_queryset)
-        
+        # Extract IDs - using pattern from codebase
         # Collect all unique IDs from ReferenceFields (handle both dereferenced and DBRef)
         sender_ids = set()
         offer_ids = set()
@@ -366,36 +603,22 @@ class ChatService:
         
         # Mark-as-read operation - optimized to use exists() instead of count()
         # Mark messages as read across ALL conversations between participants
+        if not is_participant:
+            return messages_list, has_more
         try:
             # Check if any unread messages exist (faster than count)
-            from mongoengine import Q
             has_unread = Message.objects(
-                ((Q(sender_id=participant_ids[0]) & Q(receiver_id=participant_ids[1])) |
-                 (Q(sender_id=participant_ids[1]) & Q(receiver_id=participant_ids[0]))) &
-                Q(receiver_id=user_id) &
-                Q(is_read=False)
-            ).limit(1).first() is not None
+                pair_key=pair_key, receiver_id=user_id, is_read=False
+            ).only('id').limit(1).first() is not None
             
             if has_unread:
-                # Perform bulk update (single operation) - mark all unread messages between participants as read
-                Message.objects(
-                    ((Q(sender_id=participant_ids[0]) & Q(receiver_id=participant_ids[1])) |
-                     (Q(sender_id=participant_ids[1]) & Q(receiver_id=participant_ids[0]))) &
-                    Q(receiver_id=user_id) &
-                    Q(is_read=False)
-                ).update(set__is_read=True)
-                
-                # Update unread count in conversation (only if needed)
-                if str(conversation.participants[0].id) == str(user_id):
-                    conversation.unread_count_sender = '0'
-                else:
-                    conversation.unread_count_receiver = '0'
-                conversation.save()
+                # One update for the pair's history, plus the counters of every conversation it touched
+                ChatService.mark_read(conversation.id, user_id)
         except Exception:
             # Silently fail if update fails - don't block response
             pass
         
-        return messages_list, total
+        return messages_list, has_more
     
     @staticmethod
     def send_message(sender_id, receiver_id, text, product_id=None, attachments=None, offer_id=None):
@@ -412,6 +635,7 @@ class ChatService:
         # Create message
         message = Message(
             conversation_id=str(conversation.id),
+            pair_key=make_pair_key(sender_id, receiver_id),
             sender_id=sender_id,
             receiver_id=receiver_id,
             product_id=product_id,
@@ -422,18 +646,261 @@ class ChatService:
         )
         message.save()
         
-        # Update conversation
-        conversation.last_message = text or 'Offer sent'
-        conversation.last_message_at = datetime.utcnow()
+        ChatService.record_message_in_conversation(conversation.id, receiver_id, text)
         
-        # Update unread count
-        if str(conversation.participants[0].id) == str(receiver_id):
-            conversation.unread_count_sender = str(int(conversation.unread_count_sender or '0') + 1)
-        else:
-            conversation.unread_count_receiver = str(int(conversation.unread_count_receiver or '0') + 1)
+        return message
+    
+    @staticmethod
+    def send_message_to_conversation(conversation_id, participant_ids, sender_id, receiver_id, text,
+                                     product_id=None, attachments=None, offer_id=None):
+        """
+        Send a message in a known conversation whose participants the caller has already
+        verified (e.g. an open WebSocket). One insert plus one atomic conversation update.
+        """
+        now = datetime.utcnow()
+        message = Message(
+            conversation_id=str(conversation_id),
+            pair_key=make_pair_key(sender_id, receiver_id),
+            sender_id=ObjectId(sender_id),
+            receiver_id=ObjectId(receiver_id),
+            product_id=ObjectId(product_id) if product_id else None,
+            text=text,
+            attachments=attachments or [],
+            offer_id=ObjectId(offer_id) if offer_id else None,
+            message_type='offer' if offer_id else 'text',
+            created_at=now
+        )
+        message.save()
         
-        conversation.updated_at = datetime.utcnow()
-        conversation.save()
+        ChatService.record_message_in_conversation(conversation_id, receiver_id, text, now)
         
         return message
+    
+    @staticmethod
+    def record_message_in_conversation(conversation_id, receiver_id, text, now=None):
+        """Set the last message and increment the receiver's unread counter in one atomic update"""
+        now = now or datetime.utcnow()
+        Conversation._get_collection().update_one(
+            {'_id': ObjectId(str(conversation_id))},
+            {
+                '$set': {
+                    'last_message': text or 'Offer sent',
+                    'last_message_at': now,
+                    'updated_at': now
+                },
+                '$inc': {f'unread_counts.{receiver_id}': 1}
+            }
+        )
+    
+    @staticmethod
+    def search_messages(user_id, query, conversation_id=None, limit=20, cursor=None):
+        """
+        Full-text search over the messages a user sent or received, optionally within one
+        conversation's participant pair. Ranked by text score (newest first on ties) and
+        paginated with cursor, the next_cursor of the previous page.
+        The text index is prefixed by pair_key, so each query stays inside one pair's
+        messages however common the terms are. Without a conversation, only the pairs of the
+        user's CHAT_SEARCH_MAX_CONVERSATIONS most recently active conversations are searched,
+        one query each, and the top results merged.
+        Returns (results, next_cursor, scope); each result has the message id and conversation
+        id to open with get_messages(around=<id>), plus a highlighted snippet. scope is
+        {conversationsSearched, truncated}, truncated meaning older conversations were skipped.
+        """
+        query = (query or '').strip()
+        if len(query) < 2:
+            raise ValueError("Search query must be at least 2 characters")
+        if len(query) > 200:
+            raise ValueError("Search query must be at most 200 characters")
+        
+        user_oid = ObjectId(str(user_id))
+        truncated = False
+        if conversation_id:
+            if not ObjectId.is_valid(str(conversation_id)):
+                raise ValueError("Conversation not found")
+            conversation = Conversation.objects(id=conversation_id).only('participants').as_pymongo().first()
+            if not conversation:
+                raise ValueError("Conversation not found")
+            participant_ids = [str(p) for p in conversation.get('participants') or []]
+            if str(user_id) not in participant_ids or len(participant_ids) != 2:
+                raise ValueError("Not authorized to view this conversation")
+            pair_keys = [make_pair_key(participant_ids[0], participant_ids[1])]
+        else:
+            max_pairs = getattr(settings, 'CHAT_SEARCH_MAX_CONVERSATIONS', 10)
+            pair_keys = []
+            recent = Conversation.objects(participants=user_oid).order_by('-updated_at', '-id').only('participants').as_pymongo()
+            for doc in recent:
+                participants = doc.get('participants') or []
+                if len(participants) != 2:
+                    continue
+                pair_key = make_pair_key(*participants)
+                if pair_key in pair_keys:
+                    continue
+                if len(pair_keys) == max_pairs:
+                    truncated = True
+                    break
+                pair_keys.append(pair_key)
+        
+        after = None
+        if cursor:
+            try:
+                score_str, last_id = cursor.rsplit('|', 1)
+                after = (float(score_str), ObjectId(last_id))
+            except Exception:
+                raise ValueError("Invalid search cursor")
+        
+        docs = []
+        for pair_key in pair_keys:
+            pipeline = [
+                {'$match': {'$text': {'$search': query}, 'pair_key': pair_key}},
+                {'$addFields': {'score': {'$meta': 'textScore'}}}
+            ]
+            if after:
+                pipeline.append({'$match': {'$or': [
+                    {'score': {'$lt': after[0]}},
+                    {'score': after[0], '_id': {'$lt': after[1]}}
+                ]}})
+            pipeline += [
+                {'$sort': {'score': -1, '_id': -1}},
+                {'$limit': limit + 1},
+                {'$project': {
+                    'text': 1, 'sender_id': 1, 'receiver_id': 1, 'conversation_id': 1,
+                    'message_type': 1, 'created_at': 1, 'score': 1
+                }}
+            ]
+            docs.extend(Message._get_collection().aggregate(pipeline))
+        docs.sort(key=lambda doc: (doc['score'], doc['_id']), reverse=True)
+        has_more = len(docs) > limit
+        docs = docs[:limit]
+        
+        results = []
+        for doc in docs:
+            results.append({
+                'id': str(doc['_id']),
+                'conversationId': doc.get('conversation_id'),
+                'senderId': str(doc['sender_id']) if doc.get('sender_id') else None,
+                'receiverId': str(doc['receiver_id']) if doc.get('receiver_id') else None,
+                'isSender': doc.get('sender_id') == user_oid,
+                'messageType': doc.get('message_type') or 'text',
+                'createdAt': doc['created_at'].isoformat() if doc.get('created_at') else None,
+                'score': doc['score'],
+                **_highlight(doc.get('text') or '', query)
+            })
+        
+        next_cursor = f"{docs[-1]['score']!r}|{docs[-1]['_id']}" if has_more else None
+        scope = {'conversationsSearched': len(pair_keys), 'truncated': truncated}
+        return results, next_cursor, scope
+    
+    @staticmethod
+    def mark_read(conversation_id, user_id, read_up_to=None):
+        """
+        Mark every message the user received from the other participant up to a timestamp
+        as read, with one update_many, and adjust their unread counters. Like get_messages,
+        this covers the pair's merged history, i.e. every conversation the two users share.
+        Returns the receipt to broadcast: {conversationId, readerId, readUpTo, markedCount}.
+        """
+        if not ObjectId.is_valid(str(conversation_id)):
+            raise ValueError("Conversation not found")
+        conversation = Conversation.objects(id=conversation_id).only('participants').as_pymongo().first()
+        if not conversation:
+            raise ValueError("Conversation not found")
+        participant_ids = [str(p) for p in conversation.get('participants') or []]
+        if str(user_id) not in participant_ids:
+            raise ValueError("Not authorized to view this conversation")
+        if len(participant_ids) != 2:
+            raise ValueError("Invalid conversation: must have exactly 2 participants")
+        
+        mark = _parse_read_mark(read_up_to)
+        unread_query = {
+            'pair_key': make_pair_key(participant_ids[0], participant_ids[1]),
+            'receiver_id': ObjectId(str(user_id)),
+            'is_read': False,
+            'created_at': {'$lte': mark}
+        }
+        # Per-conversation counts first, so each conversation's counter loses only its own messages
+        unread_by_conversation = {
+            row['_id']: row['count'] for row in Message._get_collection().aggregate([
+                {'$match': unread_query},
+                {'$group': {'_id': '$conversation_id', 'count': {'$sum': 1}}}
+            ])
+            if row['_id'] and ObjectId.is_valid(str(row['_id']))
+        }
+        result = Message._get_collection().update_many(unread_query, {'$set': {'is_read': True}})
+        marked = result.modified_count
+        
+        # Zero a counter when the mark covers the conversation's last message; otherwise only
+        # take off what was just marked, so messages that arrived after the mark stay unread
+        counter = f'unread_counts.{user_id}'
+        read_everything = {'$lte': ['$last_message_at', mark]}
+        unread_by_conversation.setdefault(str(conversation_id), 0)
+        operations = []
+        # Participant order (and so the legacy counter's name) can differ between conversations
+        for doc in Conversation.objects(
+            id__in=[ObjectId(str(key)) for key in unread_by_conversation]
+        ).only('participants').as_pymongo():
+            legacy_field = _legacy_unread_field(doc.get('participants') or participant_ids, user_id)
+            operations.append(UpdateOne({'_id': doc['_id']}, [{'$set': {
+                counter: {'$cond': [
+                    read_everything,
+                    0,
+                    {'$max': [0, {'$subtract': [
+                        {'$ifNull': [f'${counter}', 0]}, unread_by_conversation.get(str(doc['_id']), 0)
+                    ]}]}
+                ]},
+                legacy_field: {'$cond': [read_everything, '$$REMOVE', f'${legacy_field}']}
+            }}]))
+        if operations:
+            Conversation._get_collection().bulk_write(operations, ordered=False)
+        
+        return {
+            'conversationId': str(conversation_id),
+            'readerId': str(user_id),
+            'readUpTo': mark.isoformat(),
+            'markedCount': marked
+        }
+    
+    @staticmethod
+    def broadcast_read_receipt(receipt):
+        """Send one read_receipt event to the conversation's chat room"""
+        import logging
+        from channels.layers import get_channel_layer
+        from asgiref.sync import async_to_sync
+        
+        channel_layer = get_channel_layer()
+        if not channel_layer:
+            return
+        try:
+            async_to_sync(channel_layer.group_send)(
+                f"chat_{receipt['conversationId']}",
+                {'type': 'read_receipt', 'receipt': receipt}
+            )
+        except Exception as e:
+            logging.getLogger(__name__).error(f"Error broadcasting read receipt: {str(e)}")
+    
+    @staticmethod
+    def refresh_user_snapshot(user):
+        """Update a user's display name/avatar on every conversation they are in"""
+        try:
+            Conversation._get_collection().update_many(
+                {'participants': user.id},
+                {'$set': {f'participant_snapshots.{user.id}': _user_snapshot({
+                    'username': user.username,
+                    'full_name': user.full_name,
+                    'profile_image': user.profile_image
+                })}}
+            )
+        except Exception as e:
+            import logging
+            logging.getLogger(__name__).error(f"Error refreshing chat snapshot for user {user.id}: {str(e)}")
+    
+    @staticmethod
+    def refresh_product_snapshot(product):
+        """Update a product's title/thumbnail on every conversation about it"""
+        try:
+            Conversation._get_collection().update_many(
+                {'product_id': product.id},
+                {'$set': {'product_snapshot': _product_snapshot({'title': product.title, 'images': product.images})}}
+            )
+        except Exception as e:
+            import logging
+            logging.getLogger(__name__).error(f"Error refreshing chat snapshot for product {product.id}: {str(e)}")
 
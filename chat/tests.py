@@ -0,0 +1,755 @@
+"""
+Chat tests.
+
+MongoDB and Redis are not needed: model queries are mocked and Redis is an
+in-memory stand-in with the commands the chat code uses.
+"""
+import asyncio
+import json
+from datetime import datetime, timedelta
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+from bson import ObjectId
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+import websocket_load_test
+from chat import presence, rate_limit
+from chat.archive import ColdMessageStore, compress_messages, decompress_messages
+from chat.consumers import ChatConsumer
+from chat.models import ArchivedMessageBatch, Conversation, Message
+from chat.presence import PresenceService
+from chat.rate_limit import ChatRateLimiter, TokenBucket
+from chat.services import ChatService, _highlight, _parse_read_mark, _unread_count, make_pair_key
+
+
+class FakeAsyncRedis:
+    """Sorted sets and a transaction pipeline, in memory"""
+
+    def __init__(self):
+        self.sorted_sets = {}
+        self.expiries = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def zadd(self, key, mapping):
+        self.sorted_sets.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, member):
+        self.sorted_sets.get(key, {}).pop(member, None)
+
+    def zremrangebyscore(self, key, low, high):
+        members = self.sorted_sets.get(key, {})
+        for member, score in list(members.items()):
+            if score <= high:
+                del members[member]
+
+    def zrange(self, key, start, end):
+        members = self.sorted_sets.get(key, {})
+        return sorted(members, key=members.get)
+
+    def expire(self, key, seconds):
+        self.expiries[key] = seconds
+
+    async def zrangebyscore(self, key, low, high):
+        return [member for member, score in self.sorted_sets.get(key, {}).items() if score >= low]
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args):
+            self.commands.append((getattr(self.redis, name), args))
+        return queue
+
+    async def execute(self):
+        return [command(*args) for command, args in self.commands]
+
+
+class PresenceTests(SimpleTestCase):
+    """A user is online while any of their connections, on any worker, is live"""
+
+    def setUp(self):
+        self.redis = FakeAsyncRedis()
+        patcher = mock.patch('chat.presence.get_async_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_user_stays_online_until_their_last_connection_closes(self):
+        self.assertEqual(await PresenceService.connect('c1', 'u1', 'tab-1'), (['u1'], True))
+        online, came_online = await PresenceService.connect('c1', 'u1', 'tab-2')
+        self.assertFalse(came_online)
+        await PresenceService.connect('c1', 'u2', 'tab-3')
+
+        online, went_offline = await PresenceService.disconnect('c1', 'u1', 'tab-1')
+        self.assertEqual((sorted(online), went_offline), (['u1', 'u2'], False))
+        online, went_offline = await PresenceService.disconnect('c1', 'u1', 'tab-2')
+        self.assertEqual((online, went_offline), (['u2'], True))
+        self.assertEqual(self.redis.expiries['presence:c1'], presence.PRESENCE_TTL_SECONDS * 2)
+
+    async def test_connections_that_stop_heartbeating_expire(self):
+        with mock.patch('chat.presence.time.time', return_value=1000.0):
+            await PresenceService.connect('c1', 'u1', 'crashed-worker')
+            await PresenceService.connect('c1', 'u2', 'live-worker')
+        later = 1000.0 + presence.PRESENCE_TTL_SECONDS + 1
+        with mock.patch('chat.presence.time.time', return_value=later - 10):
+            await PresenceService.heartbeat('c1', 'u2', 'live-worker')
+        with mock.patch('chat.presence.time.time', return_value=later):
+            self.assertEqual(await PresenceService.online_users('c1'), ['u2'])
+            online, came_online = await PresenceService.connect('c1', 'u1', 'new-tab')
+        self.assertTrue(came_online)
+        self.assertEqual(sorted(online), ['u1', 'u2'])
+
+    async def test_redis_outage_degrades_to_the_local_connection(self):
+        with mock.patch('chat.presence.get_async_redis', side_effect=ConnectionError('down')), \
+                self.assertLogs('chat.presence', 'ERROR'):
+            self.assertEqual(await PresenceService.connect('c1', 'u1', 'tab-1'), (['u1'], True))
+            self.assertEqual(await PresenceService.online_users('c1'), [])
+
+
+class ConnectionCacheTests(SimpleTestCase):
+    """A chat connection loads its conversation context once, at connect"""
+
+    def setUp(self):
+        self.buyer_id, self.seller_id = ObjectId(), ObjectId()
+        self.conversation_id = str(ObjectId())
+        conversations = mock.MagicMock()
+        conversations.return_value.only.return_value.as_pymongo.return_value.first.return_value = {
+            '_id': ObjectId(self.conversation_id), 'participants': [self.buyer_id, self.seller_id], 'product_id': None
+        }
+        users = mock.MagicMock()
+        users.return_value.only.return_value.as_pymongo.return_value = [
+            {'_id': self.buyer_id, 'username': 'buyer', 'full_name': 'Buyer Name'},
+            {'_id': self.seller_id, 'username': 'seller', 'profile_image': 'seller.jpg'},
+        ]
+        for patcher in (
+            mock.patch('chat.consumers.Conversation.objects', conversations),
+            mock.patch('chat.consumers.User.objects', users),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.consumer = ChatConsumer()
+        self.consumer.conversation_id = self.conversation_id
+
+    async def test_participants_and_users_come_from_the_connection_cache(self):
+        await self.consumer.load_conversation_context()
+        with mock.patch.object(ChatConsumer, 'fetch_conversation_participants') as fetch_participants, \
+                mock.patch.object(ChatConsumer, 'fetch_users_details') as fetch_users:
+            participants = await self.consumer.get_conversation_participants(self.conversation_id)
+            details = await self.consumer.get_users_details([str(self.seller_id)])
+        self.assertEqual(participants, [str(self.buyer_id), str(self.seller_id)])
+        self.assertEqual(details, [{'id': str(self.seller_id), 'username': 'seller', 'profileImage': 'seller.jpg'}])
+        self.assertEqual(self.consumer.user_full_names[str(self.buyer_id)], 'Buyer Name')
+        fetch_participants.assert_not_called()
+        fetch_users.assert_not_called()
+
+    async def test_only_uncached_users_are_loaded(self):
+        await self.consumer.load_conversation_context()
+        stranger = str(ObjectId())
+        loaded = [{'id': stranger, 'username': 'stranger', 'profileImage': ''}]
+        with mock.patch.object(ChatConsumer, 'fetch_users_details', return_value=loaded) as fetch_users:
+            details = await self.consumer.get_users_details([str(self.buyer_id), stranger])
+            await self.consumer.get_users_details([stranger])
+        fetch_users.assert_called_once_with([stranger])
+        self.assertEqual([detail['username'] for detail in details], ['buyer', 'stranger'])
+
+    async def test_other_conversations_are_not_served_from_the_cache(self):
+        await self.consumer.load_conversation_context()
+        with mock.patch.object(ChatConsumer, 'fetch_conversation_participants', return_value=[]) as fetch_participants:
+            await self.consumer.get_conversation_participants(str(ObjectId()))
+        fetch_participants.assert_called_once()
+
+    def test_message_in_a_known_conversation_needs_no_user_lookups(self):
+        collection = mock.Mock()
+        with mock.patch.object(Message, 'save') as save, \
+                mock.patch.object(Conversation, '_get_collection', return_value=collection), \
+                mock.patch('chat.services.User.objects') as users:
+            message = ChatService.send_message_to_conversation(
+                self.conversation_id, [self.buyer_id, self.seller_id], str(self.buyer_id), str(self.seller_id), 'Hi'
+            )
+        users.assert_not_called()
+        save.assert_called_once()
+        self.assertEqual(message.message_type, 'text')
+        collection.update_one.assert_called_once()
+
+
+class FakeFindCursor(list):
+    def batch_size(self, size):
+        return self
+
+
+class UnreadCounterTests(SimpleTestCase):
+    """Unread counts are integers keyed by participant and change only with $inc"""
+
+    def test_new_message_increments_the_receiver_counter(self):
+        collection = mock.Mock()
+        conversation_id, receiver_id = ObjectId(), ObjectId()
+        with mock.patch.object(Conversation, '_get_collection', return_value=collection):
+            ChatService.record_message_in_conversation(conversation_id, receiver_id, '')
+        query, update = collection.update_one.call_args[0]
+        self.assertEqual(query, {'_id': conversation_id})
+        self.assertEqual(update['$inc'], {f'unread_counts.{receiver_id}': 1})
+        self.assertEqual(update['$set']['last_message'], 'Offer sent')
+
+    def test_unread_count_adds_any_unmigrated_legacy_counter(self):
+        first, second = ObjectId(), ObjectId()
+        doc = {
+            'participants': [first, second], 'unread_counts': {str(first): 2, str(second): 1},
+            'unread_count_sender': '3', 'unread_count_receiver': 'garbage'
+        }
+        self.assertEqual(_unread_count(doc, first), 5)
+        self.assertEqual(_unread_count(doc, second), 1)
+        self.assertEqual(_unread_count({}, first), 0)
+
+    def test_total_unread_is_one_aggregation(self):
+        objects = mock.Mock()
+        objects.aggregate.return_value = [{'_id': None, 'total': 4}]
+        with mock.patch.object(Conversation, 'objects', objects):
+            self.assertEqual(ChatService.get_unread_messages_status(ObjectId()), {
+                'hasUnreadMessages': True, 'totalUnreadCount': 4
+            })
+        objects.aggregate.assert_called_once()
+
+    def test_migration_folds_legacy_counters_with_a_guard(self):
+        first, second = ObjectId(), ObjectId()
+        doc = {'_id': ObjectId(), 'participants': [first, second], 'unread_count_sender': '3', 'unread_count_receiver': 'x'}
+        collection = mock.Mock()
+        collection.find.return_value = FakeFindCursor([doc])
+        collection.bulk_write.return_value.modified_count = 1
+        out = StringIO()
+        with mock.patch.object(Conversation, '_get_collection', return_value=collection):
+            call_command('migrate_unread_counts', stdout=out)
+
+        operation = collection.bulk_write.call_args[0][0][0]
+        self.assertEqual(operation._filter, {'_id': doc['_id'], 'unread_count_sender': '3', 'unread_count_receiver': 'x'})
+        self.assertEqual(operation._doc['$inc'], {f'unread_counts.{first}': 3, f'unread_counts.{second}': 0})
+        self.assertEqual(operation._doc['$unset'], {'unread_count_sender': '', 'unread_count_receiver': ''})
+        self.assertIn('1 conversation(s)', out.getvalue())
+
+
+class PairMessageHistoryTests(SimpleTestCase):
+    """All messages between two users page by a (created_at, _id) cursor on pair_key"""
+
+    def setUp(self):
+        self.user_a, self.user_b = ObjectId(), ObjectId()
+        self.pair_key = make_pair_key(self.user_b, self.user_a)
+        conversations = mock.MagicMock()
+        conversations.return_value.only.return_value.first.return_value = SimpleNamespace(
+            id=ObjectId(), participants=[SimpleNamespace(id=self.user_a), SimpleNamespace(id=self.user_b)]
+        )
+        self.messages = mock.MagicMock()
+        self.page = self.messages.return_value.only.return_value.order_by.return_value.skip.return_value.limit
+        self.messages.return_value.only.return_value.limit.return_value.first.return_value = None  # Nothing unread
+        for patcher in (
+            mock.patch('chat.services.Conversation.objects', conversations),
+            mock.patch('chat.services.Message.objects', self.messages),
+            mock.patch('chat.services.User.objects'),
+            mock.patch('chat.services.ColdMessageStore.older', return_value=[]),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _message(self, created_at):
+        return SimpleNamespace(
+            id=ObjectId(), text='hi', sender_id=self.user_a, receiver_id=self.user_b, offer_id=None,
+            product_id=None, created_at=created_at, attachments=[], message_type='text', is_read=True,
+            conversation_id='c1'
+        )
+
+    def test_pair_key_ignores_direction(self):
+        self.assertEqual(make_pair_key(self.user_a, self.user_b), make_pair_key(str(self.user_b), str(self.user_a)))
+
+    def test_older_page_continues_before_the_cursor_message(self):
+        anchor = {'_id': ObjectId(), 'created_at': datetime(2026, 3, 1)}
+        self.messages.return_value.only.return_value.as_pymongo.return_value.first.return_value = anchor
+        rows = [self._message(anchor['created_at'] - timedelta(minutes=i)) for i in range(3)]
+        self.page.return_value = rows
+
+        messages, has_more = ChatService.get_messages('c1', self.user_a, limit=2, before=str(anchor['_id']))
+
+        self.assertTrue(has_more)
+        self.assertEqual([m['id'] for m in messages], [str(row.id) for row in rows[:2]])
+        self.assertEqual(self.messages.call_args_list[0][1], {'id': str(anchor['_id']), 'pair_key': self.pair_key})
+        raw = self.messages.call_args_list[1][1]['__raw__']
+        self.assertEqual(raw, {'pair_key': self.pair_key, '$or': [
+            {'created_at': {'$lt': anchor['created_at']}},
+            {'created_at': anchor['created_at'], '_id': {'$lt': anchor['_id']}}
+        ]})
+        self.messages.return_value.only.return_value.order_by.assert_called_with('-created_at', '-id')
+        self.page.assert_called_with(3)
+
+    def test_newer_page_is_returned_newest_first(self):
+        anchor = {'_id': ObjectId(), 'created_at': datetime(2026, 3, 1)}
+        self.messages.return_value.only.return_value.as_pymongo.return_value.first.return_value = anchor
+        rows = [self._message(anchor['created_at'] + timedelta(minutes=i)) for i in (1, 2)]
+        self.page.return_value = rows
+
+        messages, has_more = ChatService.get_messages('c1', self.user_a, limit=2, after=str(anchor['_id']))
+
+        self.assertFalse(has_more)
+        self.assertEqual([m['id'] for m in messages], [str(rows[1].id), str(rows[0].id)])
+        self.messages.return_value.only.return_value.order_by.assert_called_with('+created_at', '+id')
+
+    def test_cursor_from_another_pair_is_rejected(self):
+        self.messages.return_value.only.return_value.as_pymongo.return_value.first.return_value = None
+        with mock.patch('chat.services.ColdMessageStore.find_anchor', return_value=None):
+            with self.assertRaisesMessage(ValueError, 'Message cursor not found'):
+                ChatService.get_messages('c1', self.user_a, before=str(ObjectId()))
+        with self.assertRaisesMessage(ValueError, 'Invalid message cursor'):
+            ChatService.get_messages('c1', self.user_a, before='not-an-id')
+
+
+class ConversationInboxTests(SimpleTestCase):
+    """The inbox is one query per page, with display data from stored snapshots"""
+
+    def setUp(self):
+        self.user_id, self.other_id = ObjectId(), ObjectId()
+        self.collection = mock.Mock()
+        patcher = mock.patch.object(Conversation, '_get_collection', return_value=self.collection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _doc(self, updated_at, **fields):
+        return dict({
+            '_id': ObjectId(), 'participants': [self.user_id, self.other_id], 'updated_at': updated_at,
+            'last_message': 'hi', 'unread_counts': {str(self.user_id): 2},
+            'participant_snapshots': {str(self.other_id): {'username': 'other', 'fullName': 'Other', 'profileImage': ''}}
+        }, **fields)
+
+    def _page(self, docs, **kwargs):
+        self.collection.find.return_value.sort.return_value.limit.return_value = docs
+        return ChatService.get_conversations(self.user_id, **kwargs)
+
+    def test_cursor_round_trip(self):
+        start = datetime(2026, 3, 1)
+        docs = [self._doc(start - timedelta(minutes=i)) for i in range(3)]
+        with mock.patch('chat.services.User.objects') as users:
+            conversations, next_cursor = self._page(docs, limit=2)
+        users.assert_not_called()
+        self.assertEqual(len(conversations), 2)
+        self.assertEqual(conversations[0]['otherUser']['username'], 'other')
+        self.assertEqual(conversations[0]['unreadCount'], '2')
+        self.collection.find.return_value.sort.return_value.limit.assert_called_with(3)
+        self.collection.bulk_write.assert_not_called()
+
+        _, last_cursor = self._page(docs[2:], limit=2, cursor=next_cursor)
+        self.assertIsNone(last_cursor)
+        query = self.collection.find.call_args[0][0]
+        self.assertEqual(query['participants'], self.user_id)
+        self.assertEqual(query['$or'], [
+            {'updated_at': {'$lt': docs[1]['updated_at']}},
+            {'updated_at': docs[1]['updated_at'], '_id': {'$lt': docs[1]['_id']}}
+        ])
+
+    def test_invalid_cursor_is_rejected(self):
+        with self.assertRaisesMessage(ValueError, 'Invalid conversations cursor'):
+            ChatService.get_conversations(self.user_id, cursor='yesterday')
+
+    def test_missing_snapshots_are_batch_loaded_and_saved(self):
+        product_id = ObjectId()
+        doc = self._doc(datetime(2026, 3, 1), participant_snapshots={}, product_id=product_id)
+        users = mock.MagicMock()
+        users.return_value.only.return_value.as_pymongo.return_value = [{'_id': self.other_id, 'username': 'other'}]
+        products = mock.MagicMock()
+        products.return_value.only.return_value.as_pymongo.return_value = [
+            {'_id': product_id, 'title': 'Lamp', 'images': ['lamp.jpg']}
+        ]
+        with mock.patch('chat.services.User.objects', users), mock.patch('chat.services.Product.objects', products):
+            conversations, _ = self._page([doc])
+
+        self.assertEqual(users.call_count, 1)
+        self.assertEqual(conversations[0]['otherUser']['username'], 'other')
+        self.assertEqual(conversations[0]['product'], {'id': str(product_id), 'title': 'Lamp', 'image': 'lamp.jpg'})
+        backfill = self.collection.bulk_write.call_args[0][0][0]
+        self.assertEqual(backfill._doc['$set'], {
+            f'participant_snapshots.{self.other_id}': {'username': 'other', 'fullName': '', 'profileImage': ''},
+            'product_snapshot': {'title': 'Lamp', 'image': 'lamp.jpg'}
+        })
+
+
+class MarkReadTests(SimpleTestCase):
+    """mark_read covers the pair's history and only takes each conversation's own messages off its counter"""
+
+    def setUp(self):
+        self.reader, self.other = ObjectId(), ObjectId()
+        self.conversation_id, self.older_id = ObjectId(), ObjectId()
+        participants = [self.other, self.reader]
+        self.conversations = mock.MagicMock()
+
+        def conversation_objects(**query):
+            queryset = mock.MagicMock()
+            if 'id__in' in query:
+                queryset.only.return_value.as_pymongo.return_value = [
+                    {'_id': conversation_id, 'participants': participants} for conversation_id in query['id__in']
+                ]
+            else:
+                queryset.only.return_value.as_pymongo.return_value.first.return_value = {'participants': participants}
+            return queryset
+        self.conversations.side_effect = conversation_objects
+        self.conversation_collection = mock.Mock()
+        self.message_collection = mock.Mock()
+        self.message_collection.aggregate.return_value = [{'_id': str(self.older_id), 'count': 2}]
+        self.message_collection.update_many.return_value.modified_count = 2
+        for patcher in (
+            mock.patch.object(Conversation, 'objects', self.conversations),
+            mock.patch.object(Conversation, '_get_collection', return_value=self.conversation_collection),
+            mock.patch.object(Message, '_get_collection', return_value=self.message_collection),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_read_mark_is_naive_utc_and_never_in_the_future(self):
+        self.assertEqual(_parse_read_mark('2026-03-01T12:00:00+03:00'), datetime(2026, 3, 1, 9))
+        self.assertEqual(_parse_read_mark('2026-03-01T09:00:00Z'), datetime(2026, 3, 1, 9))
+        self.assertLessEqual(_parse_read_mark('2999-01-01T00:00:00'), datetime.utcnow())
+        with self.assertRaisesMessage(ValueError, 'readUpTo must be an ISO 8601 timestamp'):
+            _parse_read_mark('yesterday')
+
+    def test_messages_are_marked_across_the_pair(self):
+        receipt = ChatService.mark_read(self.conversation_id, self.reader, '2026-03-01T09:00:00Z')
+
+        query, update = self.message_collection.update_many.call_args[0]
+        self.assertEqual(query, {
+            'pair_key': make_pair_key(self.reader, self.other), 'receiver_id': self.reader,
+            'is_read': False, 'created_at': {'$lte': datetime(2026, 3, 1, 9)}
+        })
+        self.assertEqual(update, {'$set': {'is_read': True}})
+        self.assertEqual(receipt, {
+            'conversationId': str(self.conversation_id), 'readerId': str(self.reader),
+            'readUpTo': '2026-03-01T09:00:00', 'markedCount': 2
+        })
+
+    def test_each_counter_loses_only_its_own_messages(self):
+        ChatService.mark_read(self.conversation_id, self.reader)
+
+        operations = {op._filter['_id']: op._doc[0]['$set'] for op in self.conversation_collection.bulk_write.call_args[0][0]}
+        self.assertEqual(set(operations), {self.conversation_id, self.older_id})
+        counter = f'unread_counts.{self.reader}'
+        subtracted = lambda conversation_id: operations[conversation_id][counter]['$cond'][2]['$max'][1]['$subtract'][1]
+        self.assertEqual(subtracted(self.older_id), 2)
+        self.assertEqual(subtracted(self.conversation_id), 0)
+        self.assertIn('unread_count_receiver', operations[self.older_id])  # The reader is the second participant
+
+    def test_only_participants_can_mark_read(self):
+        with self.assertRaisesMessage(ValueError, 'Not authorized to view this conversation'):
+            ChatService.mark_read(self.conversation_id, ObjectId())
+        self.message_collection.update_many.assert_not_called()
+
+
+class MessageSearchTests(SimpleTestCase):
+    """Cross-chat search runs one pair-prefixed query per recent conversation, up to a cap"""
+
+    def setUp(self):
+        self.user = ObjectId()
+        self.others = [ObjectId() for _ in range(3)]
+        conversations = mock.MagicMock()
+        conversations.return_value.order_by.return_value.only.return_value.as_pymongo.return_value = [
+            {'participants': [self.user, self.others[0]]},
+            {'participants': [self.others[0], self.user]},  # Same pair, searched once
+            {'participants': [self.user, self.others[1]]},
+            {'participants': [self.user, self.others[2]]},
+        ]
+        self.collection = mock.Mock()
+        for patcher in (
+            mock.patch.object(Conversation, 'objects', conversations),
+            mock.patch.object(Message, '_get_collection', return_value=self.collection),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _hit(self, score, text='red lamp'):
+        return {
+            '_id': ObjectId(), 'score': score, 'text': text, 'sender_id': self.user, 'receiver_id': self.others[0],
+            'conversation_id': 'c1', 'message_type': 'text', 'created_at': datetime(2026, 3, 1)
+        }
+
+    def _searched_pairs(self):
+        return [call[0][0][0]['$match']['pair_key'] for call in self.collection.aggregate.call_args_list]
+
+    @override_settings(CHAT_SEARCH_MAX_CONVERSATIONS=2)
+    def test_search_is_capped_to_the_most_recent_conversations(self):
+        self.collection.aggregate.return_value = []
+        results, next_cursor, scope = ChatService.search_messages(self.user, 'lamp')
+        self.assertEqual(self._searched_pairs(), [
+            make_pair_key(self.user, self.others[0]), make_pair_key(self.user, self.others[1])
+        ])
+        self.assertEqual((results, next_cursor), ([], None))
+        self.assertEqual(scope, {'conversationsSearched': 2, 'truncated': True})
+
+    def test_results_are_merged_by_score_and_paged_by_cursor(self):
+        best, middle, worst = self._hit(3.0), self._hit(2.0), self._hit(1.0)
+        self.collection.aggregate.side_effect = [[middle], [best, worst], []]
+        results, next_cursor, scope = ChatService.search_messages(self.user, 'red lamp', limit=2)
+        self.assertEqual([r['id'] for r in results], [str(best['_id']), str(middle['_id'])])
+        self.assertEqual(results[0]['highlights'], [[0, 3], [4, 8]])
+        self.assertEqual(next_cursor, f"2.0|{middle['_id']}")
+        self.assertEqual(scope, {'conversationsSearched': 3, 'truncated': False})
+
+        self.collection.aggregate.side_effect = None
+        self.collection.aggregate.return_value = []
+        ChatService.search_messages(self.user, 'red lamp', limit=2, cursor=next_cursor)
+        after = self.collection.aggregate.call_args[0][0][2]['$match']
+        self.assertEqual(after, {'$or': [{'score': {'$lt': 2.0}}, {'score': 2.0, '_id': {'$lt': middle['_id']}}]})
+
+    def test_bad_queries_and_cursors_are_rejected(self):
+        with self.assertRaisesMessage(ValueError, 'at least 2 characters'):
+            ChatService.search_messages(self.user, ' a ')
+        with self.assertRaisesMessage(ValueError, 'Invalid search cursor'):
+            ChatService.search_messages(self.user, 'lamp', cursor='best')
+
+    def test_snippet_is_windowed_around_the_first_match(self):
+        self.assertEqual(_highlight('The red lamp is a Red light', 'red light')['highlights'], [[4, 7], [18, 21], [22, 27]])
+        highlighted = _highlight('x' * 300 + ' lamp here', 'lamp')
+        self.assertEqual(highlighted['snippetStart'], 248)
+        start, end = highlighted['highlights'][0]
+        self.assertEqual(highlighted['snippet'][start:end], 'lamp')
+
+
+class FakeHotCursor(list):
+    def sort(self, keys):
+        return self
+
+    def hint(self, index):
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def close(self):
+        pass
+
+
+class FakeColdCollection:
+    """Archived batches by _id; find() honours pair_key and the sort direction only"""
+
+    def __init__(self):
+        self.batches = {}
+        self.direction = 1
+
+    def replace_one(self, query, doc, upsert=False):
+        self.batches[query['_id']] = doc
+
+    def find(self, query, projection):
+        self.pair_key = query['pair_key']
+        return self
+
+    def sort(self, keys):
+        self.direction = keys[0][1]
+        return self
+
+    def batch_size(self, size):
+        batches = [b for b in self.batches.values() if b['pair_key'] == self.pair_key]
+        return sorted(batches, key=lambda b: (b['last_created_at'], b['_id']), reverse=self.direction < 0)
+
+
+class ColdMessageStoreTests(SimpleTestCase):
+    """Archived messages survive compression and read back in hot-tier order"""
+
+    def setUp(self):
+        self.start = datetime(2025, 1, 1)
+        self.hot = mock.Mock()
+        self.cold = FakeColdCollection()
+        for patcher in (
+            mock.patch.object(Message, '_get_collection', return_value=self.hot),
+            mock.patch.object(ArchivedMessageBatch, '_get_collection', return_value=self.cold),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _messages(self, pair_key, count):
+        return [
+            {'_id': ObjectId(), 'pair_key': pair_key, 'text': f'{pair_key} {i}', 'created_at': self.start + timedelta(minutes=i)}
+            for i in range(count)
+        ]
+
+    def test_compression_round_trip(self):
+        docs = self._messages('a_b', 3)
+        self.assertEqual(decompress_messages(compress_messages(docs)), docs)
+
+    def test_archive_batches_per_pair_and_deletes_after_writing(self):
+        first, second = self._messages('a_b', 5), self._messages('a_c', 2)
+        self.hot.find.return_value = FakeHotCursor(first + second)
+        deleted = []
+        self.hot.delete_many.side_effect = lambda query: deleted.append(
+            (query['_id']['$in'], set(self.cold.batches))
+        )
+        with self.assertLogs('chat.archive', 'INFO'):
+            archived = ColdMessageStore.archive(older_than=datetime(2025, 2, 1), batch_size=2)
+
+        self.assertEqual(archived, 7)
+        counts = sorted((b['pair_key'], b['message_count']) for b in self.cold.batches.values())
+        self.assertEqual(counts, [('a_b', 1), ('a_b', 2), ('a_b', 2), ('a_c', 2)])  # Batches never mix pairs
+        for ids, written in deleted:
+            self.assertIn(ids[0], written)  # The batch was stored before its messages were deleted
+
+    def test_reads_continue_around_an_anchor(self):
+        docs = self._messages('a_b', 5)
+        self.hot.find.return_value = FakeHotCursor(docs)
+        with self.assertLogs('chat.archive', 'INFO'):
+            ColdMessageStore.archive(older_than=datetime(2025, 2, 1), batch_size=2)
+        anchor = {'_id': docs[2]['_id'], 'created_at': docs[2]['created_at']}
+
+        self.assertEqual([d['_id'] for d in ColdMessageStore.older('a_b', anchor)], [docs[1]['_id'], docs[0]['_id']])
+        self.assertEqual([d['_id'] for d in ColdMessageStore.newer('a_b', anchor)], [docs[3]['_id'], docs[4]['_id']])
+        self.assertEqual(ColdMessageStore.newer('a_b', anchor, count=1, inclusive=True)[0]['_id'], docs[2]['_id'])
+        self.assertEqual(ColdMessageStore.older('a_b', count=2, skip=1)[0]['_id'], docs[3]['_id'])
+        self.assertEqual(ColdMessageStore.older('a_c'), [])
+
+
+class FakeCommunicator:
+    """Frames queued by the test, then a closed socket"""
+
+    def __init__(self, frames, connected=True):
+        self.frames = [json.dumps(frame) for frame in frames]
+        self.connected = connected
+        self.sent = []
+
+    async def connect(self, timeout=1):
+        return self.connected, None
+
+    async def receive_from(self, timeout=1):
+        if not self.frames:
+            raise asyncio.TimeoutError()
+        return self.frames.pop(0)
+
+    async def send_to(self, text_data):
+        self.sent.append(json.loads(text_data))
+
+    async def disconnect(self):
+        pass
+
+
+class WebSocketLoadTestTests(SimpleTestCase):
+    """The load-test client only counts usable sockets and classifies every frame it reads"""
+
+    def test_percentiles_are_in_milliseconds(self):
+        self.assertEqual(websocket_load_test.percentile([], 0.5), 0.0)
+        samples = [i / 1000 for i in range(1, 101)]
+        self.assertAlmostEqual(websocket_load_test.percentile(samples, 0.5), 51.0)
+        self.assertAlmostEqual(websocket_load_test.percentile(samples, 0.99), 100.0)
+
+    async def test_chat_socket_is_usable_after_online_users(self):
+        stats = websocket_load_test.Stats()
+        ready = websocket_load_test.Client(FakeCommunicator([{'type': 'online_users'}]), stats, 'chat')
+        silent = websocket_load_test.Client(FakeCommunicator([{'type': 'error'}]), stats, 'chat')
+        refused = websocket_load_test.Client(FakeCommunicator([], connected=False), stats, 'notifications')
+        self.assertTrue(await ready.connect(timeout=1))
+        self.assertFalse(await silent.connect(timeout=1))
+        self.assertFalse(await refused.connect(timeout=1))
+        await ready.close()
+        self.assertEqual(len(stats.connect['chat']), 1)
+        self.assertEqual(stats.connect_failures, {'chat': 1, 'notifications': 1})
+
+    async def test_reader_records_fanout_and_errors(self):
+        stats = websocket_load_test.Stats()
+        sent_at = websocket_load_test.time.perf_counter()
+        client = websocket_load_test.Client(FakeCommunicator([
+            {'type': 'chat_message', 'message': {'text': f'lt|abc|{sent_at}'}},
+            {'type': 'chat_message', 'message': {'text': 'not from the load test'}},
+            {'type': 'notification'},
+            {'type': 'slow_down', 'error': 'rate limited', 'scope': 'user', 'messageType': 'chat_message'},
+            {'type': 'offer_sent', 'offer': {'id': 'o1'}},
+        ]), stats, 'chat')
+        offer = client.expect('offer_sent')
+        await client.read()
+
+        self.assertEqual(len(stats.fanout['chat_message']), 1)
+        self.assertGreaterEqual(stats.fanout['chat_message'][0], 0)
+        self.assertEqual(stats.notifications, 1)
+        self.assertEqual(stats.errors, {'slow_down: rate limited (user, chat_message)': 1})
+        self.assertEqual(offer.result()[1]['offer']['id'], 'o1')
+
+    async def test_offer_event_times_out_without_delivery(self):
+        stats = websocket_load_test.Stats()
+        sender = websocket_load_test.Client(FakeCommunicator([]), stats, 'chat')
+        receiver = websocket_load_test.Client(FakeCommunicator([]), stats, 'chat')
+        result = await websocket_load_test.offer_event(stats, 'offer_sent', sender, receiver, {'type': 'send_offer'}, 0.01)
+        self.assertIsNone(result)
+        self.assertEqual(sender.communicator.sent, [{'type': 'send_offer'}])
+        self.assertEqual(stats.sent['offer_sent'], 1)
+        self.assertEqual(stats.errors, {'offer_sent timeout': 1})
+
+
+class FakeScriptRedis:
+    """Runs the user token bucket script with a fixed answer"""
+
+    def __init__(self, allowed, wait='0'):
+        self.answer = [allowed, wait]
+        self.calls = []
+
+    def register_script(self, script):
+        async def run(keys, args):
+            self.calls.append((keys, args))
+            return self.answer
+        return run
+
+
+class ChatRateLimitTests(SimpleTestCase):
+    """Frames draw from a connection and a user bucket; a rejected frame costs nothing"""
+
+    def setUp(self):
+        patcher = mock.patch.object(rate_limit, '_script', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_bucket_refills_at_its_rate_up_to_the_burst(self):
+        with mock.patch('chat.rate_limit.time.monotonic', return_value=100.0):
+            bucket = TokenBucket(rate=2, burst=2)
+            self.assertEqual(bucket.take(), 0.0)
+            self.assertEqual(bucket.take(), 0.0)
+            self.assertEqual(bucket.take(), 0.5)
+        with mock.patch('chat.rate_limit.time.monotonic', return_value=110.0):
+            self.assertEqual(bucket.take(), 0.0)
+            self.assertEqual(bucket.tokens, 1.0)
+            bucket.refund(5)
+            self.assertEqual(bucket.tokens, 2.0)
+
+    @override_settings(CHAT_USER_OFFER_RATE=3, CHAT_USER_OFFER_BURST=7)
+    def test_limits_come_from_settings_with_defaults(self):
+        self.assertEqual(rate_limit.limits('user', 'offer'), (3.0, 7))
+        self.assertEqual(rate_limit.limits('connection', 'message'), (5.0, 20))
+        self.assertEqual(rate_limit.bucket_kind('counter_offer'), 'offer')
+        self.assertEqual(rate_limit.bucket_kind('chat_message'), 'message')
+
+    @override_settings(CHAT_CONNECTION_OFFER_BURST=1)
+    async def test_connection_bucket_rejects_before_redis(self):
+        redis = FakeScriptRedis(allowed=1)
+        limiter = ChatRateLimiter('u1')
+        with mock.patch('chat.rate_limit.get_async_redis', return_value=redis):
+            self.assertIsNone(await limiter.check('send_offer'))
+            scope, wait = await limiter.check('accept_offer')
+        self.assertEqual(scope, 'connection')
+        self.assertGreater(wait, 0)
+        self.assertEqual(len(redis.calls), 1)
+        self.assertEqual(redis.calls[0][0], ['ratelimit:chat:offer:u1'])
+
+    async def test_user_rejection_refunds_the_connection_token(self):
+        limiter = ChatRateLimiter('u1')
+        before = limiter.buckets['message'].tokens
+        with mock.patch('chat.rate_limit.get_async_redis', return_value=FakeScriptRedis(allowed=0, wait='1.5')):
+            self.assertEqual(await limiter.check('chat_message'), ('user', 1.5))
+        self.assertAlmostEqual(limiter.buckets['message'].tokens, before, places=3)
+
+    async def test_frames_are_allowed_when_redis_is_down(self):
+        limiter = ChatRateLimiter('u1')
+        with mock.patch('chat.rate_limit.get_async_redis', side_effect=ConnectionError('down')):
+            with self.assertLogs('chat.rate_limit', 'WARNING'):
+                self.assertIsNone(await limiter.check('chat_message'))
+
+    async def test_throttled_frames_are_counted_per_process_and_cluster(self):
+        redis = mock.Mock()
+        redis.hincrby = mock.AsyncMock()
+        with mock.patch.dict(rate_limit._local_metrics, clear=True), \
+                mock.patch('chat.rate_limit.get_async_redis', return_value=redis):
+            await ChatRateLimiter.record_throttled('user', 'chat_message')
+            redis.hincrby.assert_awaited_once_with(rate_limit.METRICS_KEY, 'user:chat_message', 1)
+            sync_redis = mock.Mock()
+            sync_redis.hgetall.return_value = {'user:chat_message': '4'}
+            with mock.patch('chat.rate_limit.get_redis', return_value=sync_redis):
+                self.assertEqual(rate_limit.get_metrics(), {
+                    'process': {'user:chat_message': 1}, 'cluster': {'user:chat_message': 4}
+                })
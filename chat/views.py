@@ -2,6 +2,7 @@
 Chat views
 """
 import logging
+from bson import ObjectId
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
@@ -13,15 +14,28 @@ logger = logging.getLogger(__name__)
 
 @api_view(['GET'])
 def get_conversations(request):
-    """Get all conversations"""
+    """Get conversations, most recently active first
+    
+    Paginated with `limit` (default 50, max 100) and `cursor`, the `nextCursor`
+    returned with the previous page.
+    """
     try:
         user_id = str(request.user.id)
-        conversations = ChatService.get_conversations(user_id)
+        limit = min(max(int(request.GET.get('limit', 50)), 1), 100)
+        cursor = request.GET.get('cursor')
+        conversations, next_cursor = ChatService.get_conversations(user_id, limit, cursor)
         
         return Response({
             'success': True,
-            'conversations': conversations
+            'conversations': conversations,
+            'pagination': {
+                'limit': limit,
+                'hasMore': next_cursor is not None,
+                'nextCursor': next_cursor
+            }
         }, status=status.HTTP_200_OK)
+    except ValueError as e:
+        return Response({'success': False, 'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         return Response({'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -43,36 +57,45 @@ def get_unread_status(request):
 
 @api_view(['GET'])
 def get_messages(request, conversation_id):
-    """Get messages for a conversation with pagination
+    """Get messages for a conversation with cursor pagination
     
     Messages are ordered by createdAt in descending order (newest first).
-    Page 1 contains the most recent messages.
+    Without a cursor, page 1 contains the most recent messages. Pass `before=<messageId>`
+    to load older history, `after=<messageId>` to load newer messages, or
+    `around=<messageId>` for the context of a search result; `hasMore` tells whether
+    another page exists in that direction (older, for `around`).
+    Admins may read any conversation (dispute review).
     """
     try:
         user_id = str(request.user.id)
         page = int(request.GET.get('page', 1))
-        limit = int(request.GET.get('limit', 50))
+        limit = min(max(int(request.GET.get('limit', 50)), 1), 100)
+        before = request.GET.get('before')
+        after = request.GET.get('after')
+        around = request.GET.get('around')
+        
+        if len([cursor for cursor in (before, after, around) if cursor]) > 1:
+            return Response({'success': False, 'error': 'Use only one of before, after or around'}, status=status.HTTP_400_BAD_REQUEST)
         
         # Ensure page is at least 1
         if page < 1:
             page = 1
         
-        messages, total = ChatService.get_messages(conversation_id, user_id, page, limit)
-        
-        # Calculate total pages (handle empty conversations)
-        total_pages = (total + limit - 1) // limit if total > 0 else 0
-        
-        # If page exceeds total pages, return empty array but with correct pagination metadata
-        if page > total_pages and total_pages > 0:
-            messages = []
+        messages, has_more = ChatService.get_messages(
+            conversation_id, user_id, page, limit, before, after, around,
+            as_admin=getattr(request.user, 'role', None) == 'admin'
+        )
         
         return Response({
             'success': True,
             'messages': messages,
             'pagination': {
-                'currentPage': page,
-                'totalPages': total_pages,
-                'totalItems': total
+                'currentPage': None if (before or after or around) else page,
+                'limit': limit,
+                'hasMore': has_more,
+                # Oldest / newest message on this page, for the next before / after request
+                'nextBefore': messages[-1]['id'] if messages else before,
+                'nextAfter': messages[0]['id'] if messages else after
             }
         }, status=status.HTTP_200_OK)
     except ValueError as e:
@@ -81,6 +104,69 @@ def get_messages(request, conversation_id):
         return Response({'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@api_view(['GET'])
+def search_messages(request):
+    """Search chat history
+    
+    Query params: `q` (required), `conversationId` to search one conversation, `limit`
+    (default 20, max 50) and `cursor` (nextCursor of the previous page). Admins must pass
+    `userId` and search that user's history. Without `conversationId` only the most recently
+    active conversations are searched; `scope.truncated` says older ones were skipped.
+    Open a result with conversations/<conversationId>/messages/?around=<id>.
+    """
+    try:
+        user_id = str(request.user.id)
+        if getattr(request.user, 'role', None) == 'admin':
+            user_id = request.GET.get('userId')
+            if not user_id:
+                return Response({'success': False, 'error': 'userId is required'}, status=status.HTTP_400_BAD_REQUEST)
+        if not ObjectId.is_valid(user_id):
+            return Response({'success': False, 'error': 'Invalid userId'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        limit = min(max(int(request.GET.get('limit', 20)), 1), 50)
+        results, next_cursor, scope = ChatService.search_messages(
+            user_id,
+            request.GET.get('q'),
+            request.GET.get('conversationId'),
+            limit,
+            request.GET.get('cursor')
+        )
+        
+        return Response({
+            'success': True,
+            'results': results,
+            'scope': scope,
+            'pagination': {
+                'limit': limit,
+                'hasMore': next_cursor is not None,
+                'nextCursor': next_cursor
+            }
+        }, status=status.HTTP_200_OK)
+    except ValueError as e:
+        return Response({'success': False, 'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['POST'])
+def mark_read(request, conversation_id):
+    """Mark messages received in a conversation as read, up to `readUpTo` (ISO 8601, default now)"""
+    try:
+        user_id = str(request.user.id)
+        receipt = ChatService.mark_read(conversation_id, user_id, request.data.get('readUpTo'))
+        if receipt['markedCount']:
+            ChatService.broadcast_read_receipt(receipt)
+        
+        return Response({
+            'success': True,
+            'receipt': receipt
+        }, status=status.HTTP_200_OK)
+    except ValueError as e:
+        return Response({'success': False, 'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @api_view(['POST'])
 def send_message(request):
     """Send a message"""
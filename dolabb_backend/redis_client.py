@@ -0,0 +1,69 @@
+"""
+Shared Redis client for application code (caches, pub/sub, counters).
+Channels keeps its own connections through CHANNEL_LAYERS.
+"""
+import asyncio
+import os
+import threading
+import redis
+import redis.asyncio
+from django.conf import settings
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+_async_client = None
+_async_client_loop = None
+
+
+def get_redis_url():
+    """Resolve the Redis URL from settings/env, falling back to REDIS_HOST/REDIS_PORT/REDIS_PASSWORD"""
+    url = getattr(settings, 'REDIS_URL', None) or os.getenv('REDIS_URL')
+    if url:
+        return url
+    host = getattr(settings, 'REDIS_HOST', None) or os.getenv('REDIS_HOST', '127.0.0.1')
+    port = getattr(settings, 'REDIS_PORT', None) or os.getenv('REDIS_PORT', 6379)
+    password = getattr(settings, 'REDIS_PASSWORD', None) or os.getenv('REDIS_PASSWORD')
+    if password:
+        return f"redis://:{password}@{host}:{port}/0"
+    return f"redis://{host}:{port}/0"
+
+
+def get_redis():
+    """
+    Return the process-wide Redis client.
+    The client is rebuilt after a fork so gunicorn workers never share sockets.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _lock:
+            if _client is None or _client_pid != pid:
+                _client = redis.Redis.from_url(
+                    get_redis_url(),
+                    decode_responses=True,
+                    socket_connect_timeout=2,
+                    socket_timeout=2,
+                    health_check_interval=30
+                )
+                _client_pid = pid
+    return _client
+
+
+def get_async_redis():
+    """
+    Return an asyncio Redis client for the running event loop (Channels consumers).
+    Connections belong to a loop, so a new loop gets a new client.
+    """
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        _async_client = redis.asyncio.Redis.from_url(
+            get_redis_url(),
+            decode_responses=True,
+            socket_connect_timeout=2,
+            socket_timeout=2,
+            health_check_interval=30
+        )
+        _async_client_loop = loop
+    return _async_client
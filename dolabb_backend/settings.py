@@ -210,9 +210,44 @@ FRONTEND_URL = os.getenv('FRONTEND_URL', 'https://dolabb.com')
 # Moyasar Payment Configuration
 MOYASAR_PUBLISHABLE_KEY = os.getenv('MOYASAR_PUBLISHABLE_KEY', '')
 MOYASAR_SECRET_KEY = os.getenv('MOYASAR_SECRET_KEY', '')
-MOYASAR_API_URL = 'https://api.moyasar.com/v1/payments'
+MOYASAR_API_URL = os.getenv('MOYASAR_API_URL', 'https://api.moyasar.com/v1/payments')  # Point at moyasar_fake_server.py for offline load tests
 MOYASAR_PAYOUT_API_URL = os.getenv('MOYASAR_PAYOUT_API_URL', 'https://api.moyasar.com/v1/payouts')
 MOYASAR_PAYOUT_SOURCE_ID = os.getenv('MOYASAR_PAYOUT_SOURCE_ID', '')  # Payout account source ID
+# Moyasar HTTP client: timeouts (seconds), GET retries and circuit breaker
+MOYASAR_CONNECT_TIMEOUT = float(os.getenv('MOYASAR_CONNECT_TIMEOUT', 3.05))
+MOYASAR_READ_TIMEOUT = float(os.getenv('MOYASAR_READ_TIMEOUT', 15))
+MOYASAR_GET_RETRIES = int(os.getenv('MOYASAR_GET_RETRIES', 2))
+MOYASAR_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('MOYASAR_CIRCUIT_FAILURE_THRESHOLD', 5))
+MOYASAR_CIRCUIT_RESET_SECONDS = float(os.getenv('MOYASAR_CIRCUIT_RESET_SECONDS', 30))
+BULK_PAYOUT_CONCURRENCY = int(os.getenv('BULK_PAYOUT_CONCURRENCY', 8))  # Parallel Moyasar payout calls per batch
+
+# Fee settings: seconds a worker's cached snapshot may be used if a reload notice is missed
+FEE_SETTINGS_MAX_AGE_SECONDS = int(os.getenv('FEE_SETTINGS_MAX_AGE_SECONDS', 300))
+
+# Outbox: side effects run by `manage.py drain_outbox --loop`; inline drain is for local development
+OUTBOX_INLINE_DRAIN = os.getenv('OUTBOX_INLINE_DRAIN', 'True') == 'True'
+
+# Chat WebSocket rate limits: tokens per second and burst, per connection and per user
+CHAT_CONNECTION_MESSAGE_RATE = float(os.getenv('CHAT_CONNECTION_MESSAGE_RATE', 5))
+CHAT_CONNECTION_MESSAGE_BURST = int(os.getenv('CHAT_CONNECTION_MESSAGE_BURST', 20))
+CHAT_CONNECTION_OFFER_RATE = float(os.getenv('CHAT_CONNECTION_OFFER_RATE', 0.5))
+CHAT_CONNECTION_OFFER_BURST = int(os.getenv('CHAT_CONNECTION_OFFER_BURST', 5))
+CHAT_USER_MESSAGE_RATE = float(os.getenv('CHAT_USER_MESSAGE_RATE', 10))
+CHAT_USER_MESSAGE_BURST = int(os.getenv('CHAT_USER_MESSAGE_BURST', 40))
+CHAT_USER_OFFER_RATE = float(os.getenv('CHAT_USER_OFFER_RATE', 1))
+CHAT_USER_OFFER_BURST = int(os.getenv('CHAT_USER_OFFER_BURST', 10))
+CHAT_MAX_IN_FLIGHT = int(os.getenv('CHAT_MAX_IN_FLIGHT', 8))  # Frames queued per connection behind the one being handled
+
+# Chat: messages older than this move to the compressed cold tier (`manage.py archive_messages`)
+CHAT_ARCHIVE_AFTER_DAYS = int(os.getenv('CHAT_ARCHIVE_AFTER_DAYS', 180))
+# Chat search without a conversationId covers this many of the user's most recent conversations
+CHAT_SEARCH_MAX_CONVERSATIONS = int(os.getenv('CHAT_SEARCH_MAX_CONVERSATIONS', 10))
+
+# Checkout stock reservations
+RESERVATION_HOLD_MINUTES = int(os.getenv('RESERVATION_HOLD_MINUTES', 15))  # Hold stock while the buyer pays
+
+# Redis (application cache and pub/sub; channels uses CHANNEL_LAYERS below)
+REDIS_URL = os.getenv('REDIS_URL', 'redis://127.0.0.1:6379/0')
 
 # Channels Configuration (WebSockets)
 CHANNEL_LAYERS = {
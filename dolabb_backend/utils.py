@@ -24,3 +24,63 @@ def custom_exception_handler(exc, context):
     
     return response
 
+
+
+def encode_cursor(*values):
+    """
+    Encode a keyset pagination position (e.g. created_at, id) as an opaque string.
+    datetimes and ObjectIds are stored as strings; decode_cursor restores them.
+    """
+    import base64
+    import json
+    from datetime import datetime
+    
+    parts = []
+    for value in values:
+        if isinstance(value, datetime):
+            parts.append({'t': 'dt', 'v': value.isoformat()})
+        elif value.__class__.__name__ == 'ObjectId':
+            parts.append({'t': 'oid', 'v': str(value)})
+        else:
+            parts.append({'t': 'raw', 'v': value})
+    return base64.urlsafe_b64encode(json.dumps(parts, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor. Raises ValueError on malformed input."""
+    import base64
+    import json
+    from datetime import datetime
+    from bson import ObjectId
+    
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        parts = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        values = []
+        for part in parts:
+            if part['t'] == 'dt':
+                values.append(datetime.fromisoformat(part['v']))
+            elif part['t'] == 'oid':
+                values.append(ObjectId(part['v']))
+            else:
+                values.append(part['v'])
+        return values
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def parse_cursor_page_params(request, max_limit=100):
+    """
+    Read the query params of a cursor-paginated list: `status` (comma-separated filter),
+    `cursor` and `limit` (default 20, clamped to 1..max_limit).
+    Returns (statuses, cursor, limit). Raises ValueError if limit is not an integer.
+    """
+    status_param = request.GET.get('status', '')
+    statuses = [s.strip() for s in status_param.split(',') if s.strip()]
+    cursor = request.GET.get('cursor') or None
+    try:
+        limit = int(request.GET.get('limit', 20))
+    except (TypeError, ValueError):
+        raise ValueError("limit must be an integer")
+    limit = max(1, min(limit, max_limit))
+    return statuses, cursor, limit
@@ -0,0 +1,205 @@
+"""
+Local stand-in for the Moyasar payments/payouts API (for offline load tests)
+
+Point the backend at it before starting Django:
+    MOYASAR_API_URL=http://127.0.0.1:8765/v1/payments
+    MOYASAR_PAYOUT_API_URL=http://127.0.0.1:8765/v1/payouts
+    MOYASAR_SECRET_KEY=sk_test_local
+    MOYASAR_PAYOUT_SOURCE_ID=src_local
+
+Run:
+    python moyasar_fake_server.py --latency-ms 120 --jitter-ms 60 --error-rate 0.02 \
+        --decline-rate 0.05 --webhook-url http://127.0.0.1:8000/api/payments/webhook/
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+payments = {}
+payouts = {}
+payouts_by_key = {}  # Idempotency-Key -> payout
+store_lock = threading.Lock()
+options = None
+
+
+def simulate_latency():
+    delay = max(0.0, options.latency_ms + random.uniform(-options.jitter_ms, options.jitter_ms)) / 1000.0
+    if delay:
+        time.sleep(delay)
+
+
+def send_webhook(payment):
+    """POST a Moyasar-style webhook for the payment after the configured delay"""
+    time.sleep(options.webhook_delay_ms / 1000.0)
+    body = json.dumps({
+        'id': str(uuid.uuid4()),
+        'type': f"payment_{payment['status']}",
+        'created_at': payment['created_at'],
+        'data': payment
+    }).encode()
+    request = urllib.request.Request(
+        options.webhook_url, data=body, headers={'Content-Type': 'application/json'}, method='POST'
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
+    except Exception as e:
+        print(f"Webhook to {options.webhook_url} failed: {e}")
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real API
+
+    def log_message(self, format, *args):
+        if options.verbose:
+            super().log_message(format, *args)
+
+    def _reply(self, status_code, body):
+        data = json.dumps(body).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return None
+
+    def _check_request(self):
+        """Returns False (after replying) when auth is missing or a failure is injected"""
+        simulate_latency()
+        auth = self.headers.get('Authorization', '')
+        if not auth.startswith('Bearer sk_'):
+            self._reply(401, {'type': 'authentication_error', 'message': 'Invalid authorization credentials'})
+            return False
+        if random.random() < options.error_rate:
+            self._reply(503, {'type': 'api_error', 'message': 'Injected failure'})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._check_request():
+            return
+        parts = [p for p in self.path.split('?')[0].split('/') if p]
+        if parts == ['v1', 'payouts']:
+            # List payouts, filtered by metadata[<key>]=<value> query params
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            filters = {key[len('metadata['):-1]: values[0] for key, values in query.items()
+                       if key.startswith('metadata[') and key.endswith(']')}
+            with store_lock:
+                matches = [payout for payout in payouts.values()
+                           if all(payout['metadata'].get(k) == v for k, v in filters.items())]
+            return self._reply(200, {'payouts': matches, 'meta': {'total_count': len(matches)}})
+        if len(parts) == 3 and parts[:2] == ['v1', 'payments']:
+            with store_lock:
+                payment = payments.get(parts[2])
+            if payment:
+                return self._reply(200, payment)
+        self._reply(404, {'type': 'invalid_request_error', 'message': 'Object not found'})
+
+    def do_POST(self):
+        body = self._read_json()
+        if not self._check_request():
+            return
+        if body is None:
+            return self._reply(400, {'type': 'invalid_request_error', 'message': 'Malformed JSON'})
+
+        path = self.path.split('?')[0].rstrip('/')
+        if path == '/v1/payments':
+            return self._create_payment(body)
+        if path == '/v1/payouts':
+            return self._create_payout(body)
+        self._reply(404, {'type': 'invalid_request_error', 'message': 'Not found'})
+
+    def _create_payment(self, body):
+        if not body.get('amount') or not body.get('source'):
+            return self._reply(400, {'type': 'invalid_request_error', 'message': 'amount and source are required'})
+        declined = random.random() < options.decline_rate
+        source = dict(body['source'])
+        source.pop('number', None)
+        source.pop('cvc', None)
+        source.update({
+            'company': 'visa',
+            'message': 'INSUFFICIENT FUNDS' if declined else 'APPROVED',
+            'response_code': '51' if declined else '00'
+        })
+        payment = {
+            'id': str(uuid.uuid4()),
+            'status': 'failed' if declined else 'paid',
+            'amount': int(body['amount']),
+            'fee': 0,
+            'currency': body.get('currency', 'SAR'),
+            'description': body.get('description'),
+            'metadata': body.get('metadata') or {},
+            'source': source,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+        }
+        with store_lock:
+            payments[payment['id']] = payment
+        if options.webhook_url:
+            threading.Thread(target=send_webhook, args=(payment,), daemon=True).start()
+        self._reply(201, payment)
+
+    def _create_payout(self, body):
+        if not body.get('amount') or not body.get('destination'):
+            return self._reply(400, {'type': 'invalid_request_error', 'message': 'amount and destination are required'})
+        idempotency_key = self.headers.get('Idempotency-Key')
+        if idempotency_key:
+            with store_lock:
+                existing = payouts_by_key.get(idempotency_key)
+            if existing:
+                return self._reply(201, existing)
+        payout = {
+            'id': str(uuid.uuid4()),
+            'status': 'queued',
+            'amount': int(body['amount']),
+            'currency': body.get('currency', 'SAR'),
+            'purpose': body.get('purpose'),
+            'destination': body['destination'],
+            'metadata': body.get('metadata') or {},
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+        }
+        with store_lock:
+            payouts[payout['id']] = payout
+            if idempotency_key:
+                payouts_by_key[idempotency_key] = payout
+        self._reply(201, payout)
+
+
+def main():
+    global options
+    parser = argparse.ArgumentParser(description='Local Moyasar API stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=80, help='Mean simulated latency per request')
+    parser.add_argument('--jitter-ms', type=float, default=40, help='Uniform +/- jitter around the mean')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with 503')
+    parser.add_argument('--decline-rate', type=float, default=0.0, help='Fraction of payments created as failed')
+    parser.add_argument('--webhook-url', default='', help='POST a payment webhook here after each payment')
+    parser.add_argument('--webhook-delay-ms', type=float, default=200)
+    parser.add_argument('--verbose', action='store_true', help='Log every request')
+    options = parser.parse_args()
+
+    server = ThreadingHTTPServer((options.host, options.port), Handler)
+    server.daemon_threads = True
+    print(f"Fake Moyasar listening on http://{options.host}:{options.port}/v1/payments")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+"""
+Run queued order/payment side effects (notifications, emails, affiliate updates).
+Use --loop to keep draining as a worker process.
+"""
+import time
+from django.core.management.base import BaseCommand
+from notifications.outbox import OutboxService
+
+
+class Command(BaseCommand):
+    help = 'Drain the outbox of order and payment side effects'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Events to process per pass')
+        parser.add_argument('--loop', action='store_true', help='Keep running as a worker')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when the outbox is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            processed, failed = OutboxService.drain(batch_size=options['batch_size'])
+            if processed or failed or not options['loop']:
+                self.stdout.write(f'Outbox: {processed} processed, {failed} failed')
+            if not options['loop']:
+                break
+            if processed + failed < options['batch_size']:
+                time.sleep(options['interval'])
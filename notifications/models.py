@@ -1,7 +1,7 @@
 """
 Notification models using mongoengine
 """
-from mongoengine import Document, StringField, DateTimeField, ReferenceField, BooleanField, DictField
+from mongoengine import Document, StringField, DateTimeField, ReferenceField, BooleanField, DictField, IntField, ListField
 from datetime import datetime
 from authentication.models import Admin, User
 
@@ -38,6 +38,37 @@ class UserNotification(Document):
     
     meta = {
         'collection': 'user_notifications',
-        'indexes': ['user_id', 'is_read', 'created_at']
+        'indexes': [
+            'user_id', 'is_read', 'created_at',
+            [('user_id', 1), ('created_at', 1), ('_id', 1)],  # Per-user ordered ranges (reconnect replay, lists)
+            [('user_id', 1), ('is_read', 1)]  # Unread counts
+        ]
     }
 
+
+class OutboxEvent(Document):
+    """
+    Side effect recorded alongside a state change and run later by the outbox worker
+    (notifications, emails, affiliate updates).
+    """
+    event_type = StringField(required=True)
+    idempotency_key = StringField(required=True, unique=True)  # One event per logical change
+    payload = DictField()
+    status = StringField(choices=['pending', 'processing', 'done', 'failed'], default='pending')
+    completed_steps = ListField(StringField())  # Steps already run, skipped on retry
+    attempts = IntField(default=0)
+    next_attempt_at = DateTimeField(default=datetime.utcnow)
+    locked_until = DateTimeField()
+    last_error = StringField()
+    created_at = DateTimeField(default=datetime.utcnow)
+    processed_at = DateTimeField()
+    purge_at = DateTimeField()  # Set when done; TTL removes finished events
+    
+    meta = {
+        'collection': 'outbox_events',
+        'indexes': [
+            'idempotency_key',
+            [('status', 1), ('next_attempt_at', 1)],
+            {'fields': ['purge_at'], 'expireAfterSeconds': 0}
+        ]
+    }
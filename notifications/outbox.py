@@ -0,0 +1,238 @@
+"""
+Outbox for order and payment side effects.
+
+State changes (payment completed, order status changed, webhook received) record an OutboxEvent
+right after the write instead of sending notifications, emails and affiliate
+updates inline. MongoDB writes here are not in one transaction: each event has an
+idempotency key, so a caller that retries the state change records the event if
+an earlier attempt failed between the two writes. The drain_outbox worker claims due events, runs each handler
+step once (completed steps are remembered, so a retry never repeats an email),
+and reschedules failures with exponential backoff.
+"""
+import logging
+import random
+import threading
+from datetime import datetime, timedelta
+from django.conf import settings
+from mongoengine.errors import NotUniqueError
+from pymongo import ReturnDocument
+from notifications.models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 8
+LEASE = timedelta(minutes=5)  # A claimed event is retried by another worker after this
+DONE_RETENTION = timedelta(days=7)
+
+
+def _load_order(payload):
+    from products.models import Order
+    order = Order.objects(id=payload['order_id']).first()
+    if not order:
+        raise ValueError(f"Order {payload['order_id']} not found")
+    return order
+
+
+def _load_webhook_event(payload):
+    from payments.models import WebhookEvent
+    webhook_event = WebhookEvent.objects(id=payload['webhook_event_id']).first()
+    if not webhook_event:
+        raise ValueError(f"Webhook event {payload['webhook_event_id']} not found")
+    return webhook_event
+
+
+# Handler steps: (step name, function(target, payload)). Each step runs at most once per event.
+# The target is the order unless LOADERS names another loader for the event type.
+
+def _affiliate_earnings_on_payment(order, payload):
+    from products.services import OrderService
+    OrderService.update_affiliate_earnings_on_payment_completion(order)
+
+
+def _notify_seller_payment_confirmed(order, payload):
+    from notifications.notification_helper import NotificationHelper
+    NotificationHelper.send_payment_confirmed(str(order.seller_id.id))
+
+
+def _notify_seller_needs_shipping(order, payload):
+    from notifications.notification_helper import NotificationHelper
+    NotificationHelper.send_order_needs_shipping(str(order.seller_id.id))
+
+
+def _notify_buyer_payment_successful(order, payload):
+    from notifications.notification_helper import NotificationHelper
+    NotificationHelper.send_payment_successful(str(order.buyer_id.id), order)
+
+
+def _notify_seller_item_sold(order, payload):
+    from notifications.notification_helper import NotificationHelper
+    NotificationHelper.send_item_sold(str(order.seller_id.id))
+
+
+def _notify_buyer_order_confirmation(order, payload):
+    from notifications.notification_helper import NotificationHelper
+    NotificationHelper.send_order_confirmation(str(order.buyer_id.id), order)
+
+
+def _is_new_cancellation(payload):
+    return payload.get('new_status') == 'cancelled' and payload.get('old_status') != 'cancelled'
+
+
+def _notify_buyer_order_canceled(order, payload):
+    if _is_new_cancellation(payload):
+        from notifications.notification_helper import NotificationHelper
+        NotificationHelper.send_order_canceled(str(order.buyer_id.id))
+
+
+def _notify_seller_buyer_rejected(order, payload):
+    if _is_new_cancellation(payload):
+        from notifications.notification_helper import NotificationHelper
+        NotificationHelper.send_buyer_rejected_order(str(order.seller_id.id))
+
+
+def _affiliate_earnings_on_shipment(order, payload):
+    # Seller uploaded shipment proof after the buyer had already reviewed
+    if payload.get('shipment_proof_uploaded') and order.shipment_proof and order.review_submitted:
+        from products.services import OrderService
+        OrderService.update_affiliate_earnings_on_review_and_shipment(order)
+
+
+def _process_moyasar_webhook(webhook_event, payload):
+    from payments.webhooks import WebhookService
+    WebhookService.process_event(webhook_event)
+
+
+def _moyasar_webhook_gave_up(payload, error):
+    from payments.models import WebhookEvent
+    WebhookEvent.objects(id=payload['webhook_event_id']).update_one(set__status='failed', set__last_error=error)
+
+
+HANDLERS = {
+    'payment_completed': [
+        ('affiliate_earnings', _affiliate_earnings_on_payment),
+        ('notify_seller_payment_confirmed', _notify_seller_payment_confirmed),
+        ('notify_seller_needs_shipping', _notify_seller_needs_shipping),
+        ('notify_buyer_payment_successful', _notify_buyer_payment_successful),
+    ],
+    'order_confirmed': [
+        ('notify_seller_item_sold', _notify_seller_item_sold),
+        ('notify_buyer_order_confirmation', _notify_buyer_order_confirmation),
+    ],
+    'order_status_changed': [
+        ('notify_buyer_order_canceled', _notify_buyer_order_canceled),
+        ('notify_seller_buyer_rejected', _notify_seller_buyer_rejected),
+        ('affiliate_earnings_on_shipment', _affiliate_earnings_on_shipment),
+    ],
+    'moyasar_webhook': [
+        ('process_webhook', _process_moyasar_webhook),
+    ],
+}
+
+LOADERS = {
+    'moyasar_webhook': _load_webhook_event,
+}
+
+# Called with (payload, error) when an event fails permanently
+ON_FAILED = {
+    'moyasar_webhook': _moyasar_webhook_gave_up,
+}
+
+
+class OutboxService:
+    """Record and drain outbox events"""
+
+    @staticmethod
+    def enqueue(event_type, idempotency_key, payload):
+        """
+        Record a side effect to run asynchronously.
+        Returns the event, or None if an event with this key was already recorded.
+        """
+        if event_type not in HANDLERS:
+            raise ValueError(f"Unknown outbox event type: {event_type}")
+
+        try:
+            event = OutboxEvent(event_type=event_type, idempotency_key=idempotency_key, payload=payload)
+            event.save()
+        except NotUniqueError:
+            return None
+
+        # Local development has no worker process; drain in the background instead
+        if getattr(settings, 'OUTBOX_INLINE_DRAIN', False):
+            threading.Thread(target=OutboxService.drain, kwargs={'batch_size': 10}, daemon=True).start()
+        return event
+
+    @staticmethod
+    def claim(now=None):
+        """Atomically lease the next due event (or one whose lease expired). Returns the raw document."""
+        now = now or datetime.utcnow()
+        return OutboxEvent._get_collection().find_one_and_update(
+            {'$or': [
+                {'status': 'pending', 'next_attempt_at': {'$lte': now}},
+                {'status': 'processing', 'locked_until': {'$lte': now}},
+            ]},
+            {'$set': {'status': 'processing', 'locked_until': now + LEASE}, '$inc': {'attempts': 1}},
+            sort=[('next_attempt_at', 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    @staticmethod
+    def run(event):
+        """Run the outstanding steps of a claimed event and record the outcome"""
+        collection = OutboxEvent._get_collection()
+        completed = set(event.get('completed_steps') or [])
+        payload = event.get('payload') or {}
+
+        try:
+            target = LOADERS.get(event['event_type'], _load_order)(payload)
+            for step_name, step in HANDLERS[event['event_type']]:
+                if step_name in completed:
+                    continue
+                step(target, payload)
+                collection.update_one({'_id': event['_id']}, {'$addToSet': {'completed_steps': step_name}})
+        except Exception as e:
+            attempts = event.get('attempts', 1)
+            now = datetime.utcnow()
+            if attempts >= MAX_ATTEMPTS:
+                update = {'status': 'failed', 'last_error': str(e), 'locked_until': None}
+                logger.error(f"Outbox event {event['_id']} ({event['event_type']}) failed permanently: {str(e)}")
+                on_failed = ON_FAILED.get(event['event_type'])
+                if on_failed:
+                    try:
+                        on_failed(payload, str(e))
+                    except Exception as hook_error:
+                        logger.error(f"Outbox failure hook for {event['_id']} failed: {str(hook_error)}")
+            else:
+                delay = min(30 * (2 ** (attempts - 1)), 3600) * random.uniform(0.8, 1.2)
+                update = {
+                    'status': 'pending',
+                    'last_error': str(e),
+                    'next_attempt_at': now + timedelta(seconds=delay),
+                    'locked_until': None
+                }
+                logger.warning(f"Outbox event {event['_id']} ({event['event_type']}) failed, retrying in {int(delay)}s: {str(e)}")
+            collection.update_one({'_id': event['_id']}, {'$set': update})
+            return False
+
+        now = datetime.utcnow()
+        collection.update_one({'_id': event['_id']}, {'$set': {
+            'status': 'done',
+            'processed_at': now,
+            'purge_at': now + DONE_RETENTION,
+            'locked_until': None,
+            'last_error': None
+        }})
+        return True
+
+    @staticmethod
+    def drain(batch_size=100):
+        """Process up to batch_size due events. Returns (processed, failed)."""
+        processed = failed = 0
+        for _ in range(batch_size):
+            event = OutboxService.claim()
+            if not event:
+                break
+            if OutboxService.run(event):
+                processed += 1
+            else:
+                failed += 1
+        return processed, failed
@@ -1,12 +1,37 @@
 """
 Notification services
 """
-from datetime import datetime
+from datetime import datetime, timezone
+from bson import ObjectId
 from notifications.models import Notification, UserNotification
 from authentication.models import User, Admin, Affiliate
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
+REPLAY_LIMIT = 100  # Notifications replayed on reconnect; clients fall back to a REST refresh beyond this
+
+
+def _replay_anchor(user_id, since):
+    """
+    created_at/_id position to replay after: since is the last seen notification id or an
+    ISO 8601 timestamp
+    """
+    since = str(since)
+    if ObjectId.is_valid(since):
+        notification_id = ObjectId(since)
+        doc = UserNotification.objects(id=notification_id, user_id=user_id).only('created_at').as_pymongo().first()
+        if doc:
+            return {'created_at': doc['created_at'], '_id': notification_id}
+        # Deleted since it was seen: fall back to when its id was generated
+        return {'created_at': notification_id.generation_time.replace(tzinfo=None), '_id': notification_id}
+    try:
+        created_at = datetime.fromisoformat(since.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError("since must be a notification ID or an ISO 8601 timestamp")
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+    return {'created_at': created_at, '_id': None}
+
 
 class NotificationService:
     """Notification service"""
@@ -106,6 +131,43 @@ class NotificationService:
         
         return notifications_list, total
     
+    @staticmethod
+    def get_missed_notifications(user_id, since, limit=REPLAY_LIMIT):
+        """
+        Notifications created after the since cursor, oldest first, from one
+        (user_id, created_at, _id) index range. Returns (notifications, has_more).
+        """
+        user_oid = ObjectId(str(user_id))
+        anchor = _replay_anchor(user_oid, since)
+        if anchor['_id']:
+            query = {'user_id': user_oid, '$or': [
+                {'created_at': {'$gt': anchor['created_at']}},
+                {'created_at': anchor['created_at'], '_id': {'$gt': anchor['_id']}}
+            ]}
+        else:
+            query = {'user_id': user_oid, 'created_at': {'$gt': anchor['created_at']}}
+        
+        docs = list(UserNotification.objects(__raw__=query).only(
+            'id', 'title', 'message', 'notification_type', 'is_read', 'created_at'
+        ).order_by('+created_at', '+id').limit(limit + 1).as_pymongo())
+        has_more = len(docs) > limit
+        
+        notifications_list = [{
+            'id': str(doc['_id']),
+            'title': doc.get('title'),
+            'message': doc.get('message'),
+            'type': doc.get('notification_type'),
+            'isRead': doc.get('is_read', False),
+            'createdAt': doc['created_at'].isoformat()
+        } for doc in docs[:limit]]
+        
+        return notifications_list, has_more
+    
+    @staticmethod
+    def get_unread_count(user_id):
+        """Unread notification count"""
+        return UserNotification.objects(user_id=user_id, is_read=False).count()
+    
     @staticmethod
     def mark_as_read(notification_id, user_id):
         """Mark notification as read"""
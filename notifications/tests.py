@@ -0,0 +1,183 @@
+"""
+Notification and outbox tests.
+
+MongoDB is not needed: collection calls are mocked.
+"""
+import json
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
+from bson import ObjectId
+from django.test import SimpleTestCase
+from mongoengine.errors import NotUniqueError
+from chat.consumers import NotificationConsumer
+from notifications import outbox
+from notifications.models import OutboxEvent, UserNotification
+from notifications.outbox import OutboxService
+from notifications.services import NotificationService
+
+
+class OutboxTests(SimpleTestCase):
+    """Side effects run once per step and failures back off until they give up"""
+
+    def setUp(self):
+        self.collection = mock.Mock()
+        patcher = mock.patch.object(OutboxEvent, '_get_collection', return_value=self.collection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.first_step = mock.Mock()
+        self.second_step = mock.Mock()
+        self.on_failed = mock.Mock()
+        for patcher in (
+            mock.patch.dict(outbox.HANDLERS, {'test_event': [('first', self.first_step), ('second', self.second_step)]}),
+            mock.patch.dict(outbox.LOADERS, {'test_event': lambda payload: 'target'}),
+            mock.patch.dict(outbox.ON_FAILED, {'test_event': self.on_failed}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _event(self, **fields):
+        return dict({'_id': ObjectId(), 'event_type': 'test_event', 'payload': {'id': 1}, 'attempts': 1}, **fields)
+
+    def _final_set(self):
+        return self.collection.update_one.call_args[0][1]['$set']
+
+    def test_recording_the_same_key_twice_is_a_no_op(self):
+        with mock.patch.object(OutboxEvent, 'save', side_effect=NotUniqueError('duplicate')):
+            self.assertIsNone(OutboxService.enqueue('test_event', 'key-1', {}))
+        with self.assertRaises(ValueError):
+            OutboxService.enqueue('unknown_event', 'key-1', {})
+
+    def test_claim_takes_due_events_and_expired_leases(self):
+        now = datetime(2026, 3, 1)
+        OutboxService.claim(now=now)
+        query, update = self.collection.find_one_and_update.call_args[0]
+        self.assertEqual(query['$or'], [
+            {'status': 'pending', 'next_attempt_at': {'$lte': now}},
+            {'status': 'processing', 'locked_until': {'$lte': now}},
+        ])
+        self.assertEqual(update['$set'], {'status': 'processing', 'locked_until': now + outbox.LEASE})
+        self.assertEqual(update['$inc'], {'attempts': 1})
+
+    def test_completed_steps_are_not_repeated(self):
+        event = self._event(completed_steps=['first'])
+        self.assertTrue(OutboxService.run(event))
+        self.first_step.assert_not_called()
+        self.second_step.assert_called_once_with('target', {'id': 1})
+        self.assertEqual(self.collection.update_one.call_args_list[0][0][1], {'$addToSet': {'completed_steps': 'second'}})
+        self.assertEqual(self._final_set()['status'], 'done')
+
+    def test_failed_step_is_rescheduled_with_backoff(self):
+        self.second_step.side_effect = RuntimeError('smtp down')
+        before = datetime.utcnow()
+        with self.assertLogs('notifications.outbox', 'WARNING'):
+            self.assertFalse(OutboxService.run(self._event(attempts=3)))
+        self.assertEqual(self.collection.update_one.call_args_list[0][0][1], {'$addToSet': {'completed_steps': 'first'}})
+        update = self._final_set()
+        self.assertEqual((update['status'], update['last_error']), ('pending', 'smtp down'))
+        delay = (update['next_attempt_at'] - before).total_seconds()
+        self.assertTrue(120 * 0.8 <= delay <= 120 * 1.2 + 1)
+        self.on_failed.assert_not_called()
+
+    def test_event_gives_up_after_max_attempts(self):
+        self.first_step.side_effect = RuntimeError('gone')
+        with self.assertLogs('notifications.outbox', 'ERROR'):
+            self.assertFalse(OutboxService.run(self._event(attempts=outbox.MAX_ATTEMPTS)))
+        self.assertEqual(self._final_set()['status'], 'failed')
+        self.on_failed.assert_called_once_with({'id': 1}, 'gone')
+
+    def test_drain_stops_when_nothing_is_due(self):
+        events = [self._event(), self._event(), None]
+        with mock.patch.object(OutboxService, 'claim', side_effect=events), \
+                mock.patch.object(OutboxService, 'run', side_effect=[True, False]):
+            self.assertEqual(OutboxService.drain(batch_size=10), (1, 1))
+
+
+class MissedNotificationTests(SimpleTestCase):
+    """Reconnecting sockets replay what they missed after a (created_at, _id) cursor, oldest first"""
+
+    def setUp(self):
+        self.user_id = ObjectId()
+        self.objects = mock.MagicMock()
+        self.page = self.objects.return_value.only.return_value.order_by.return_value.limit
+        self.page.return_value.as_pymongo.return_value = []
+        patcher = mock.patch.object(UserNotification, 'objects', self.objects)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _replay_query(self):
+        return self.objects.call_args[1]['__raw__']
+
+    def test_replay_continues_after_the_last_seen_notification(self):
+        seen = {'_id': ObjectId(), 'created_at': datetime(2026, 3, 1, 9)}
+        self.objects.return_value.only.return_value.as_pymongo.return_value.first.return_value = seen
+        newer = {'_id': ObjectId(), 'title': 'Sold', 'notification_type': 'order', 'created_at': datetime(2026, 3, 1, 10)}
+        self.page.return_value.as_pymongo.return_value = [newer, dict(newer, _id=ObjectId())]
+
+        notifications, has_more = NotificationService.get_missed_notifications(self.user_id, str(seen['_id']), limit=1)
+
+        self.assertEqual(self._replay_query(), {'user_id': self.user_id, '$or': [
+            {'created_at': {'$gt': seen['created_at']}},
+            {'created_at': seen['created_at'], '_id': {'$gt': seen['_id']}}
+        ]})
+        self.page.assert_called_with(2)
+        self.assertTrue(has_more)
+        self.assertEqual(notifications, [{
+            'id': str(newer['_id']), 'title': 'Sold', 'message': None, 'type': 'order', 'isRead': False,
+            'createdAt': '2026-03-01T10:00:00'
+        }])
+
+    def test_deleted_notification_falls_back_to_its_id_time(self):
+        self.objects.return_value.only.return_value.as_pymongo.return_value.first.return_value = None
+        seen_id = ObjectId.from_datetime(datetime(2026, 3, 1, 9))
+        NotificationService.get_missed_notifications(self.user_id, str(seen_id))
+        self.assertEqual(self._replay_query()['$or'][0], {'created_at': {'$gt': datetime(2026, 3, 1, 9)}})
+
+    def test_timestamp_cursor_and_invalid_cursor(self):
+        NotificationService.get_missed_notifications(self.user_id, '2026-03-01T12:00:00+03:00')
+        self.assertEqual(self._replay_query(), {'user_id': self.user_id, 'created_at': {'$gt': datetime(2026, 3, 1, 9)}})
+        with self.assertRaisesMessage(ValueError, 'since must be a notification ID or an ISO 8601 timestamp'):
+            NotificationService.get_missed_notifications(self.user_id, 'yesterday')
+
+
+class NotificationSyncTests(SimpleTestCase):
+    """A connecting socket gets one notification_sync frame, for its own user only"""
+
+    def _consumer(self, user_id, socket_user_id):
+        consumer = NotificationConsumer()
+        consumer.user = SimpleNamespace(id=user_id)
+        consumer.user_id = str(socket_user_id)
+        consumer.send = mock.AsyncMock()
+        return consumer
+
+    def _frame(self, consumer):
+        return json.loads(consumer.send.call_args[1]['text_data'])
+
+    async def test_snapshot_has_the_unread_count_and_the_replay(self):
+        user_id = ObjectId()
+        consumer = self._consumer(user_id, user_id)
+        with mock.patch.object(NotificationService, 'get_unread_count', return_value=3), \
+                mock.patch.object(NotificationService, 'get_missed_notifications', return_value=([{'id': 'n1'}], False)) as missed:
+            await consumer.send_sync_snapshot('2026-03-01T09:00:00Z')
+        missed.assert_called_once_with(str(user_id), '2026-03-01T09:00:00Z')
+        self.assertEqual(self._frame(consumer), {
+            'type': 'notification_sync', 'unreadCount': 3, 'notifications': [{'id': 'n1'}], 'hasMore': False
+        })
+
+    async def test_invalid_cursor_is_reported_in_the_frame(self):
+        user_id = ObjectId()
+        consumer = self._consumer(user_id, user_id)
+        with mock.patch.object(NotificationService, 'get_unread_count', return_value=0), \
+                mock.patch.object(UserNotification, 'objects'):
+            await consumer.send_sync_snapshot('yesterday')
+        self.assertEqual(self._frame(consumer), {
+            'type': 'notification_sync', 'unreadCount': 0,
+            'error': 'since must be a notification ID or an ISO 8601 timestamp'
+        })
+
+    async def test_other_users_get_no_snapshot(self):
+        consumer = self._consumer(ObjectId(), ObjectId())
+        with mock.patch.object(NotificationService, 'get_unread_count') as unread:
+            await consumer.send_sync_snapshot(None)
+        unread.assert_not_called()
+        consumer.send.assert_not_called()
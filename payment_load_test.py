@@ -0,0 +1,123 @@
+"""
+End-to-end payment load test: checkout -> process payment -> webhook
+
+Run against a local backend that points at moyasar_fake_server.py
+(see that file for the MOYASAR_* environment variables). Products need enough
+quantity for the number of checkouts, since each checkout reserves stock.
+
+    python payment_load_test.py --token <buyer JWT> --product-id <id> [--product-id <id> ...] \
+        --concurrency 20 --iterations 500
+"""
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+STEPS = ['checkout', 'process_payment', 'payment_webhook']
+
+local = threading.local()
+
+
+def get_session():
+    if not hasattr(local, 'session'):
+        local.session = requests.Session()
+    return local.session
+
+
+def timed_post(url, payload, headers):
+    started = time.perf_counter()
+    response = get_session().post(url, json=payload, headers=headers, timeout=60)
+    elapsed = time.perf_counter() - started
+    try:
+        body = response.json()
+    except ValueError:
+        body = {}
+    return response.status_code, body, elapsed
+
+
+def run_flow(index, args):
+    """One purchase; returns {step: (ok, seconds)} for the steps that ran"""
+    api = args.base_url.rstrip('/') + '/api/payments'
+    headers = {'Authorization': f'Bearer {args.token}'}
+    product_id = args.product_id[index % len(args.product_id)]
+    results = {}
+
+    status_code, body, elapsed = timed_post(f'{api}/checkout/', {'cartItems': [product_id]}, headers)
+    ok = status_code == 201 and body.get('orderId')
+    results['checkout'] = (bool(ok), elapsed)
+    if not ok:
+        return results, body.get('error') or f'checkout HTTP {status_code}'
+
+    status_code, body, elapsed = timed_post(
+        f'{api}/process/', {'orderId': body['orderId'], 'tokenId': f'tok_load_{index}'}, headers
+    )
+    payment = body.get('payment') or {}
+    ok = status_code == 200 and payment.get('moyasarPaymentId')
+    results['process_payment'] = (bool(ok), elapsed)
+    if not ok:
+        return results, body.get('error') or f'process HTTP {status_code}'
+
+    moyasar_status = 'paid' if payment.get('status') == 'completed' else 'failed'
+    status_code, body, elapsed = timed_post(f'{api}/webhook/', {
+        'type': f'payment_{moyasar_status}',
+        'data': {'id': payment['moyasarPaymentId'], 'status': moyasar_status}
+    }, {})
+    results['payment_webhook'] = (status_code == 200, elapsed)
+    return results, None if status_code == 200 else f'webhook HTTP {status_code}'
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Payment path load test')
+    parser.add_argument('--base-url', default='http://localhost:8000')
+    parser.add_argument('--token', required=True, help='Buyer JWT access token')
+    parser.add_argument('--product-id', action='append', required=True, help='Product to buy (repeatable)')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=100, help='Total purchases to run')
+    args = parser.parse_args()
+
+    latencies = {step: [] for step in STEPS}
+    failures = {step: 0 for step in STEPS}
+    errors = {}
+    completed = 0
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for results, error in pool.map(lambda i: run_flow(i, args), range(args.iterations)):
+            for step, (ok, elapsed) in results.items():
+                latencies[step].append(elapsed)
+                if not ok:
+                    failures[step] += 1
+            if error:
+                errors[error] = errors.get(error, 0) + 1
+            else:
+                completed += 1
+    duration = time.perf_counter() - started
+
+    print(f"\n{'='*72}")
+    print(f"Purchases: {args.iterations}  concurrency: {args.concurrency}  duration: {duration:.1f}s")
+    print(f"Completed flows: {completed}  throughput: {completed / duration:.1f} flows/s")
+    print(f"{'='*72}")
+    print(f"{'step':<18}{'requests':>10}{'failed':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>8}")
+    for step in STEPS:
+        samples = latencies[step]
+        print(
+            f"{step:<18}{len(samples):>10}{failures[step]:>8}"
+            f"{percentile(samples, 0.50):>10.1f}{percentile(samples, 0.95):>10.1f}"
+            f"{percentile(samples, 0.99):>10.1f}{len(samples) / duration:>8.1f}"
+        )
+    if errors:
+        print("\nErrors:")
+        for error, count in sorted(errors.items(), key=lambda item: -item[1]):
+            print(f"  {count:>5}  {error}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+"""
+Bulk payout execution for approved seller cashouts and affiliate payouts.
+
+A batch claims the pending requests it was given by setting payout_batch_id
+with a conditional update; single approvals claim their request the same way,
+so overlapping runs and concurrent approvals cannot pay twice. Before a payout
+is sent its attempt id is stored on the request and used as the provider
+idempotency key, so a run that reclaims a dead run's request finds the payout
+already sent instead of paying again. It then sends the Moyasar payouts
+with bounded concurrency over the shared client and writes every state
+transition with one bulk_write per collection. The result is a per-item report.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from bson import ObjectId
+from django.conf import settings
+from pymongo import UpdateOne
+from payments.services import MoyasarPaymentService
+
+logger = logging.getLogger(__name__)
+
+PAYOUT_SENT_STATUSES = ['completed', 'paid', 'success']
+PAYOUT_IN_PROGRESS_STATUSES = ['pending', 'processing', 'queued', 'initiated']
+MAX_BATCH_SIZE = 500
+STALE_CLAIM_AFTER = timedelta(hours=1)  # A batch that has not finished by then is assumed dead
+
+
+def _build_destination(account_details):
+    """Moyasar bank destination from stored account details; raises ValueError if incomplete"""
+    account_info = MoyasarPaymentService.parse_account_details(account_details)
+    if not account_info.get('iban'):
+        raise ValueError("IBAN or account number is required in account details")
+    if not account_info.get('name'):
+        raise ValueError("Account holder name is required in account details")
+
+    destination = {
+        'type': 'bank',
+        'iban': account_info['iban'],
+        'name': account_info['name']
+    }
+    for field in ['mobile', 'country', 'city']:
+        if account_info.get(field):
+            destination[field] = account_info[field]
+    return destination
+
+
+def _stale_before():
+    """Claims (ObjectId strings, ordered by creation time) older than this belong to a dead run"""
+    return str(ObjectId.from_datetime(datetime.utcnow() - STALE_CLAIM_AFTER))
+
+
+def affiliate_paid_operations(affiliate_id, paid_by_currency):
+    """
+    Writes that add paid amounts ({currency: amount}) to an affiliate's earnings: $inc on each
+    currency's paid total, then paid_earnings recomputed from the stored map, so concurrent
+    commission credits and payouts are never overwritten
+    """
+    increments = {}
+    for currency, amount in paid_by_currency.items():
+        increments[f'earnings_by_currency.{currency}.paid'] = round(amount, 2)
+        # Create missing totals the way the rest of the code expects them
+        increments[f'earnings_by_currency.{currency}.total'] = 0.0
+        increments[f'earnings_by_currency.{currency}.pending'] = 0.0
+    paid_total = {'$sum': {'$map': {
+        'input': {'$objectToArray': {'$ifNull': ['$earnings_by_currency', {}]}},
+        'in': {'$ifNull': ['$$this.v.paid', 0]}
+    }}}
+    return [
+        # $inc cannot create fields under a null map (older documents)
+        UpdateOne({'_id': affiliate_id, 'earnings_by_currency': None}, {'$set': {'earnings_by_currency': {}}}),
+        UpdateOne({'_id': affiliate_id}, {'$inc': increments}),
+        UpdateOne({'_id': affiliate_id}, [{'$set': {'paid_earnings': {'$toString': {'$round': [paid_total, 2]}}}}])
+    ]
+
+
+class BulkPayoutService:
+    """Approve and pay out many cashout / affiliate payout requests at once"""
+
+    @staticmethod
+    def _model(kind):
+        if kind == 'cashout':
+            from admin_dashboard.models import CashoutRequest
+            return CashoutRequest
+        if kind == 'affiliate':
+            from affiliates.models import AffiliatePayoutRequest
+            return AffiliatePayoutRequest
+        raise ValueError("Invalid payout kind. Must be 'cashout' or 'affiliate'")
+
+    @staticmethod
+    def claim_request(kind, request_id, current_status):
+        """
+        Claim one request for a single approval, if it still has current_status and no live
+        batch holds it. Returns the claim id (release it with release_claim), or None.
+        """
+        claim_id = str(ObjectId())
+        result = BulkPayoutService._model(kind)._get_collection().update_one(
+            {'_id': ObjectId(str(request_id)), 'status': current_status, '$or': [
+                {'payout_batch_id': None},
+                {'payout_batch_id': {'$lt': _stale_before()}}
+            ]},
+            {'$set': {'payout_batch_id': claim_id}}
+        )
+        return claim_id if result.modified_count else None
+
+    @staticmethod
+    def release_claim(kind, request_id, claim_id):
+        BulkPayoutService._model(kind)._get_collection().update_one(
+            {'_id': ObjectId(str(request_id)), 'payout_batch_id': claim_id},
+            {'$unset': {'payout_batch_id': ''}}
+        )
+
+    @staticmethod
+    def send_claimed_payout(kind, request_id, claim_id, attempt_id, amount, currency, destination, purpose, metadata):
+        """
+        Send the provider payout for a request held by claim_id, at most once per attempt.
+        The attempt id is stored on the request before Moyasar is called and sent as the
+        idempotency key and in metadata. A request that already has one (an earlier run died
+        after sending) is looked up first, and its existing payout is returned if found.
+        amount is in the smallest currency unit. Raises ValueError when the payout fails.
+        """
+        if attempt_id:
+            existing = MoyasarPaymentService.find_payout(attempt_id)
+            if existing:
+                logger.info(f"Found existing Moyasar payout {existing.get('id')} for {kind} request {request_id}")
+                return existing
+        else:
+            attempt_id = str(ObjectId())
+            result = BulkPayoutService._model(kind)._get_collection().update_one(
+                {'_id': ObjectId(str(request_id)), 'payout_batch_id': claim_id},
+                {'$set': {'payout_attempt_id': attempt_id}}
+            )
+            if not result.modified_count:
+                raise ValueError("Payout request is no longer claimed by this run")
+        return MoyasarPaymentService.create_payout(
+            amount=amount,
+            currency=currency,
+            destination=destination,
+            purpose=purpose,
+            metadata=dict(metadata, payout_attempt_id=attempt_id),
+            idempotency_key=attempt_id
+        )
+
+    @staticmethod
+    def execute(kind, request_ids, admin_id, max_workers=None):
+        """
+        Approve the given pending requests and send their payouts.
+        Returns {'batchId', 'summary', 'results'} with one result per requested id.
+        """
+        model = BulkPayoutService._model(kind)
+
+        unique_ids = list(dict.fromkeys(str(request_id) for request_id in request_ids or []))
+        if not unique_ids:
+            raise ValueError("At least one request id is required")
+        if len(unique_ids) > MAX_BATCH_SIZE:
+            raise ValueError(f"A batch can contain at most {MAX_BATCH_SIZE} requests")
+        invalid_ids = [request_id for request_id in unique_ids if not ObjectId.is_valid(request_id)]
+        if invalid_ids:
+            raise ValueError(f"Invalid request id: {invalid_ids[0]}")
+
+        results = {request_id: {'id': request_id, 'status': 'skipped', 'error': None} for request_id in unique_ids}
+        batch_id = str(ObjectId())
+        collection = model._get_collection()
+
+        # Claim pending requests that are unclaimed or held by a batch that died. Batch ids are
+        # ObjectId strings, whose leading timestamp makes them compare by creation time.
+        object_ids = [ObjectId(request_id) for request_id in unique_ids]
+        stale_before = _stale_before()
+        collection.update_many(
+            {'_id': {'$in': object_ids}, 'status': 'pending', '$or': [
+                {'payout_batch_id': None},
+                {'payout_batch_id': {'$lt': stale_before}}
+            ]},
+            {'$set': {'payout_batch_id': batch_id}}
+        )
+        claimed = list(collection.find({'_id': {'$in': object_ids}, 'payout_batch_id': batch_id}))
+        claimed_ids = {str(doc['_id']) for doc in claimed}
+
+        # Report why the rest were not claimed
+        for doc in collection.find(
+            {'_id': {'$in': [oid for oid in object_ids if str(oid) not in claimed_ids]}},
+            {'status': 1, 'payout_batch_id': 1}
+        ):
+            result = results[str(doc['_id'])]
+            if doc.get('status') != 'pending':
+                result['error'] = f"Request is already {doc.get('status')}"
+            else:
+                result['error'] = 'Request is being processed by another payout batch'
+        for request_id, result in results.items():
+            if request_id not in claimed_ids and not result['error']:
+                result['status'] = 'not_found'
+                result['error'] = 'Payout request not found'
+
+        # Send provider payouts with bounded concurrency
+        max_workers = max_workers or int(getattr(settings, 'BULK_PAYOUT_CONCURRENCY', 8))
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(claimed) or 1))) as pool:
+            outcomes = list(pool.map(lambda doc: BulkPayoutService._send_payout(kind, doc, batch_id), claimed))
+
+        # Apply all transitions in one bulk write
+        now = datetime.utcnow()
+        operations = []
+        approved_docs = []
+        for doc, outcome in zip(claimed, outcomes):
+            result = results[str(doc['_id'])]
+            result.update(outcome)
+            claim_filter = {'_id': doc['_id'], 'payout_batch_id': batch_id}
+            if outcome['status'] == 'failed':
+                # Left pending for a retry; the error is recorded for the admin
+                operations.append(UpdateOne(claim_filter, {
+                    '$set': {'payout_error': outcome['error']},
+                    '$unset': {'payout_batch_id': ''}
+                }))
+                continue
+            update = {
+                'status': 'approved',
+                'reviewed_at': now,
+                'reviewed_by': admin_id
+            }
+            if outcome.get('moyasarPayoutId'):
+                update['moyasar_payout_id'] = outcome['moyasarPayoutId']
+            if outcome.get('error'):
+                update['payout_error'] = outcome['error']
+            operations.append(UpdateOne(claim_filter, {'$set': update, '$unset': {'payout_batch_id': ''}}))
+            approved_docs.append(doc)
+
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+
+        if approved_docs:
+            if kind == 'cashout':
+                BulkPayoutService._record_seller_ledger(approved_docs)
+            else:
+                BulkPayoutService._record_affiliate_earnings(approved_docs)
+            BulkPayoutService._notify(kind, approved_docs, max_workers)
+
+        summary = {'requested': len(unique_ids), 'approved': 0, 'failed': 0, 'skipped': 0, 'not_found': 0}
+        for result in results.values():
+            key = 'approved' if result['status'] in ('approved', 'approved_with_error') else result['status']
+            summary[key] = summary.get(key, 0) + 1
+        summary['totalAmount'] = round(sum(doc.get('amount', 0.0) for doc in approved_docs), 2)
+
+        logger.info(f"Bulk {kind} payout batch {batch_id}: {summary}")
+        return {'batchId': batch_id, 'summary': summary, 'results': [results[request_id] for request_id in unique_ids]}
+
+    @staticmethod
+    def _send_payout(kind, doc, batch_id):
+        """Run one provider payout. Returns the item's status, error and Moyasar payout id."""
+        amount = doc.get('amount', 0.0)
+        if doc.get('payment_method') != 'Bank Transfer' or not doc.get('account_details'):
+            # Paid outside Moyasar, same as a single approval
+            return {'status': 'approved', 'amount': amount, 'moyasarPayoutId': None, 'error': None}
+
+        if kind == 'cashout':
+            currency = 'SAR'
+            purpose = 'seller_payout'
+            metadata = {
+                'cashout_id': str(doc['_id']),
+                'seller_id': str(doc.get('seller_id')),
+                'seller_name': doc.get('seller_name'),
+                'payment_method': doc.get('payment_method')
+            }
+        else:
+            currency = doc.get('currency') or 'SAR'
+            purpose = 'affiliate_payout'
+            metadata = {
+                'payout_id': str(doc['_id']),
+                'affiliate_id': str(doc.get('affiliate_id')),
+                'affiliate_name': doc.get('affiliate_name'),
+                'payment_method': doc.get('payment_method'),
+                'currency': currency
+            }
+
+        try:
+            destination = _build_destination(doc['account_details'])
+            payout_response = BulkPayoutService.send_claimed_payout(
+                kind, doc['_id'], batch_id, doc.get('payout_attempt_id'),
+                int(amount * 100), currency, destination, purpose, metadata
+            )
+        except Exception as e:
+            logger.error(f"Bulk payout for {kind} request {doc['_id']} failed: {str(e)}")
+            return {'status': 'failed', 'amount': amount, 'moyasarPayoutId': None, 'error': f"Failed to process payout: {str(e)}"}
+
+        payout_status = payout_response.get('status', 'pending')
+        outcome = {'status': 'approved', 'amount': amount, 'moyasarPayoutId': payout_response.get('id'), 'error': None}
+        if payout_status not in PAYOUT_SENT_STATUSES + PAYOUT_IN_PROGRESS_STATUSES:
+            outcome['status'] = 'approved_with_error'
+            outcome['error'] = f"Payout status: {payout_status}"
+        return outcome
+
+    @staticmethod
+    def _record_seller_ledger(approved_docs):
+        from admin_dashboard.models import CashoutRequest
+        from products.seller_service import SellerLedgerService
+
+        cashouts = CashoutRequest.objects(id__in=[doc['_id'] for doc in approved_docs])
+        for cashout in cashouts:
+            try:
+                SellerLedgerService.record_payout_reviewed(cashout, 'pending')
+            except Exception as e:
+                logger.error(f"Error recording seller ledger payout for cashout {cashout.id}: {str(e)}")
+
+    @staticmethod
+    def _record_affiliate_earnings(approved_docs):
+        """Add approved amounts to each affiliate's paid earnings (one bulk write)"""
+        from authentication.models import Affiliate
+
+        paid_by_affiliate = {}
+        for doc in approved_docs:
+            by_currency = paid_by_affiliate.setdefault(doc['affiliate_id'], {})
+            currency = doc.get('currency') or 'SAR'
+            by_currency[currency] = by_currency.get(currency, 0.0) + doc.get('amount', 0.0)
+
+        operations = []
+        for affiliate_id, paid_by_currency in paid_by_affiliate.items():
+            operations.extend(affiliate_paid_operations(affiliate_id, paid_by_currency))
+        if operations:
+            # Ordered so each affiliate's paid_earnings is recomputed after its increments
+            Affiliate._get_collection().bulk_write(operations, ordered=True)
+
+    @staticmethod
+    def _notify(kind, approved_docs, max_workers):
+        from notifications.notification_helper import NotificationHelper
+
+        def send(doc):
+            try:
+                if kind == 'cashout':
+                    NotificationHelper.send_payout_sent(str(doc['seller_id']))
+                else:
+                    NotificationHelper.send_payout_sent(str(doc['affiliate_id']), 'affiliate')
+            except Exception as e:
+                logger.error(f"Error sending payout notification for {kind} request {doc['_id']}: {str(e)}")
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(approved_docs)))) as pool:
+            list(pool.map(send, approved_docs))
@@ -0,0 +1,45 @@
+"""
+Reconcile payments, order payment status, affiliate transactions and the seller ledger.
+Streams every collection in order-id order; safe to run nightly and to resume.
+
+    python manage.py reconcile_payments                # new run
+    python manage.py reconcile_payments --resume       # continue the last unfinished run
+    python manage.py reconcile_payments --output report.jsonl
+"""
+from django.core.management.base import BaseCommand
+from payments.reconciliation import ReconciliationService
+
+
+class Command(BaseCommand):
+    help = 'Reconcile payments, orders, affiliate transactions and seller ledger entries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resume', action='store_true', help='Continue the latest unfinished run from its checkpoint')
+        parser.add_argument('--checkpoint-every', type=int, default=1000, help='Order ids between checkpoints')
+        parser.add_argument('--limit', type=int, default=None, help='Stop after this many order ids (resumable)')
+        parser.add_argument('--output', default=None, help='Also append discrepancies to this JSON-lines file')
+
+    def handle(self, *args, **options):
+        run = ReconciliationService.start(resume=options['resume'])
+        if run.last_order_id:
+            self.stdout.write(f'Resuming run {run.id} after order {run.last_order_id}')
+        else:
+            self.stdout.write(f'Starting reconciliation run {run.id}')
+
+        report_file = open(options['output'], 'a') if options['output'] else None
+        try:
+            run = ReconciliationService.run(
+                run,
+                checkpoint_every=options['checkpoint_every'],
+                limit=options['limit'],
+                report_file=report_file
+            )
+        finally:
+            if report_file:
+                report_file.close()
+
+        self.stdout.write(f'Run {run.id}: {run.status}, {run.orders_checked} order(s) checked')
+        for kind, count in sorted((run.discrepancy_counts or {}).items()):
+            self.stdout.write(f'  {kind}: {count}')
+        if not run.discrepancy_counts:
+            self.stdout.write(self.style.SUCCESS('No discrepancies found'))
@@ -9,6 +9,7 @@ from mongoengine import (
     ReferenceField,
     DictField,
     ListField,
+    IntField,
 )
 from datetime import datetime
 from authentication.models import User
@@ -60,3 +61,72 @@ class Payment(Document):
         ],
     }
 
+
+class WebhookEvent(Document):
+    """
+    Idempotency record for a Moyasar webhook delivery.
+    One document per (payment, event); provider retries hit the unique index and are
+    acknowledged without further work, except that a retry of a 'failed' event (the outbox
+    gave up on it) queues it again. The outbox worker verifies and applies the event.
+    """
+
+    moyasar_payment_id = StringField(required=True)
+    event = StringField(required=True, unique_with='moyasar_payment_id')  # e.g. payment_paid
+    status = StringField(
+        choices=['received', 'processing', 'processed', 'failed'], default='received'
+    )
+    payload = DictField()  # Delivery body as received
+    result = DictField()  # Outcome of processing (verified status, updated, offerId)
+    attempts = IntField(default=0)
+    last_error = StringField()
+    created_at = DateTimeField(default=datetime.utcnow)
+    processed_at = DateTimeField()
+
+    meta = {
+        'collection': 'webhook_events',
+        'indexes': [
+            'status',
+            'created_at',
+        ],
+    }
+
+
+class ReconciliationRun(Document):
+    """
+    One run of the payment/order reconciliation job.
+    last_order_id is the checkpoint: a resumed run continues after it.
+    """
+
+    status = StringField(choices=['running', 'completed', 'failed'], default='running')
+    last_order_id = StringField()  # Highest order id fully reconciled
+    orders_checked = IntField(default=0)
+    discrepancy_counts = DictField()  # kind -> count
+    error = StringField()
+    started_at = DateTimeField(default=datetime.utcnow)
+    checkpointed_at = DateTimeField()
+    finished_at = DateTimeField()
+
+    meta = {
+        'collection': 'reconciliation_runs',
+        'indexes': [
+            [('status', 1), ('started_at', -1)],
+        ],
+    }
+
+
+class ReconciliationDiscrepancy(Document):
+    """A disagreement between payments, orders, affiliate transactions and the seller ledger"""
+
+    run_id = StringField(required=True)
+    order_id = StringField(required=True)
+    kind = StringField(required=True)  # e.g. missing_payment, ledger_amount_mismatch
+    details = DictField()
+    created_at = DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        'collection': 'reconciliation_discrepancies',
+        'indexes': [
+            [('run_id', 1), ('kind', 1)],
+            'order_id',
+        ],
+    }
@@ -0,0 +1,211 @@
+"""
+Shared HTTP client for the Moyasar API.
+
+One keep-alive requests.Session per process (rebuilt after a fork) with
+connect/read timeouts on every call. Idempotent GETs are retried on connection
+errors, timeouts, 429 and 5xx with jittered exponential backoff; POSTs are sent
+once. A circuit breaker fails fast while Moyasar is unreachable, and per-endpoint
+latency is recorded for get_metrics(). The base URLs come from settings, so the
+client works the same against a local stand-in server.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+LATENCY_SAMPLES = 500  # Recent samples kept per endpoint for percentiles
+SLOW_CALL_SECONDS = 2.0
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised without calling Moyasar while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: open after `threshold` failures, one trial call after `reset_seconds`"""
+
+    def __init__(self, threshold, reset_seconds):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.reset_seconds:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.threshold:
+                if self._opened_at is None:
+                    logger.warning(f"Moyasar circuit opened after {self._failures} consecutive failures")
+                self._opened_at = time.monotonic()
+
+
+class MoyasarClient:
+    """Pooled, timeout-bounded Moyasar HTTP client"""
+
+    def __init__(self):
+        self.timeout = (
+            float(getattr(settings, 'MOYASAR_CONNECT_TIMEOUT', 3.05)),
+            float(getattr(settings, 'MOYASAR_READ_TIMEOUT', 15))
+        )
+        self.get_retries = int(getattr(settings, 'MOYASAR_GET_RETRIES', 2))
+        self.backoff_base = float(getattr(settings, 'MOYASAR_RETRY_BACKOFF', 0.25))
+        self.breaker = CircuitBreaker(
+            threshold=int(getattr(settings, 'MOYASAR_CIRCUIT_FAILURE_THRESHOLD', 5)),
+            reset_seconds=float(getattr(settings, 'MOYASAR_CIRCUIT_RESET_SECONDS', 30))
+        )
+        pool_size = int(getattr(settings, 'MOYASAR_POOL_SIZE', 10))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._metrics = {}
+        self._metrics_lock = threading.Lock()
+
+    def get(self, url, endpoint, headers=None):
+        """GET with bounded retries (safe to repeat)"""
+        attempts = 1 + max(self.get_retries, 0)
+        for attempt in range(1, attempts + 1):
+            try:
+                response = self._send('GET', url, endpoint, headers=headers)
+            except CircuitOpenError:
+                raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == attempts:
+                    raise
+                self._sleep_before_retry(attempt)
+                continue
+            if response.status_code in RETRYABLE_STATUS_CODES and attempt < attempts:
+                self._sleep_before_retry(attempt, response)
+                continue
+            return response
+
+    def post(self, url, endpoint, json=None, headers=None):
+        """POST once; creating payments and payouts is not safe to repeat"""
+        return self._send('POST', url, endpoint, json=json, headers=headers)
+
+    def _send(self, method, url, endpoint, **kwargs):
+        if not self.breaker.allow():
+            self._record(endpoint, None, error=True)
+            raise CircuitOpenError(f"Moyasar circuit is open; skipping {method} {endpoint}")
+
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            self.breaker.record_failure()
+            self._record(endpoint, time.monotonic() - started, error=True)
+            raise
+
+        failed = response.status_code >= 500
+        if failed:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        elapsed = time.monotonic() - started
+        self._record(endpoint, elapsed, error=failed)
+        if elapsed > SLOW_CALL_SECONDS:
+            logger.warning(f"Slow Moyasar call: {method} {endpoint} took {elapsed:.2f}s (status {response.status_code})")
+        return response
+
+    def _sleep_before_retry(self, attempt, response=None):
+        """Full-jitter exponential backoff, honouring a short Retry-After"""
+        delay = random.uniform(0, self.backoff_base * (2 ** (attempt - 1)))
+        if response is not None:
+            try:
+                delay = max(delay, min(float(response.headers.get('Retry-After', 0)), 5.0))
+            except (TypeError, ValueError):
+                pass
+        time.sleep(delay)
+
+    def _record(self, endpoint, elapsed, error=False):
+        with self._metrics_lock:
+            stats = self._metrics.get(endpoint)
+            if stats is None:
+                stats = self._metrics[endpoint] = {
+                    'count': 0,
+                    'errors': 0,
+                    'samples': deque(maxlen=LATENCY_SAMPLES)
+                }
+            stats['count'] += 1
+            if error:
+                stats['errors'] += 1
+            if elapsed is not None:
+                stats['samples'].append(elapsed * 1000)
+
+    def get_metrics(self):
+        """Per-endpoint call counts, error counts and latency percentiles (ms)"""
+        with self._metrics_lock:
+            snapshot = {endpoint: (stats['count'], stats['errors'], sorted(stats['samples']))
+                        for endpoint, stats in self._metrics.items()}
+
+        def percentile(samples, p):
+            if not samples:
+                return None
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))], 2)
+
+        return {
+            'circuit': self.breaker.state,
+            'endpoints': {
+                endpoint: {
+                    'count': count,
+                    'errors': errors,
+                    'p50Ms': percentile(samples, 0.50),
+                    'p95Ms': percentile(samples, 0.95),
+                    'p99Ms': percentile(samples, 0.99),
+                    'maxMs': round(samples[-1], 2) if samples else None
+                }
+                for endpoint, (count, errors, samples) in snapshot.items()
+            }
+        }
+
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+
+def get_moyasar_client():
+    """Return the process-wide client (rebuilt after a fork so workers never share sockets)"""
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _lock:
+            if _client is None or _client_pid != pid:
+                _client = MoyasarClient()
+                _client_pid = pid
+    return _client
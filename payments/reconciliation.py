@@ -0,0 +1,288 @@
+"""
+Streaming reconciliation of payments, orders, affiliate transactions and the seller ledger.
+
+Each collection is read with a cursor sorted by order id and a narrow
+projection; group payments are also joined to each of their secondary orders. The cursors are merge-joined by order id, so memory holds only the
+documents for one order at a time. Progress is checkpointed on the
+ReconciliationRun, and a resumed run continues after the last fully checked order.
+"""
+import heapq
+import json
+import logging
+from datetime import datetime
+from bson import ObjectId
+from payments.models import Payment, ReconciliationRun, ReconciliationDiscrepancy
+
+logger = logging.getLogger(__name__)
+
+AMOUNT_TOLERANCE = 0.01
+CURSOR_BATCH_SIZE = 1000
+DISCREPANCY_FLUSH_SIZE = 500
+
+
+def _stream(collection, key_field, projection, after=None):
+    """Yield (order_id, doc) from a cursor sorted by key_field, skipping docs without a key"""
+    query = {key_field: {'$gt': after} if after else {'$ne': None}}
+    cursor = collection.find(query, projection, no_cursor_timeout=True).sort(key_field, 1).batch_size(CURSOR_BATCH_SIZE)
+    try:
+        for doc in cursor:
+            key = doc.get(key_field)
+            if isinstance(key, ObjectId):
+                yield key, doc
+    finally:
+        cursor.close()
+
+
+def _stream_payments(collection, projection, after=None):
+    """
+    Yield (order_id, payment) for every order a payment covers, sorted by order id: the
+    primary order_id from its index, merged with the secondary orders of group payments
+    (Payment.orders), which are unwound by an aggregation over group payments only
+    """
+    match = {'is_group_payment': 'group', 'orders.0': {'$exists': True}}
+    secondary_match = {'$expr': {'$ne': ['$order_key', '$order_id']}}
+    if after:
+        secondary_match['order_key'] = {'$gt': after}
+    cursor = collection.aggregate([
+        {'$match': match},
+        {'$project': dict(projection, order_key='$orders')},
+        {'$unwind': '$order_key'},
+        {'$match': secondary_match},
+        {'$sort': {'order_key': 1, '_id': 1}}
+    ], allowDiskUse=True, batchSize=CURSOR_BATCH_SIZE)
+
+    def secondary():
+        try:
+            for doc in cursor:
+                if isinstance(doc.get('order_key'), ObjectId):
+                    yield doc['order_key'], doc
+        finally:
+            cursor.close()
+
+    yield from heapq.merge(
+        _stream(collection, 'order_id', projection, after), secondary(), key=lambda item: item[0]
+    )
+
+
+def _grouped(stream):
+    """Collapse consecutive docs with the same key into (key, [docs])"""
+    current_key = None
+    group = []
+    for key, doc in stream:
+        if group and key != current_key:
+            yield current_key, group
+            group = []
+        current_key = key
+        group.append(doc)
+    if group:
+        yield current_key, group
+
+
+def merge_join(streams):
+    """
+    Merge-join sorted grouped streams. Yields (key, [docs per stream]) for every key
+    present in any stream, in ascending key order.
+    """
+    iterators = [_grouped(stream) for stream in streams]
+    heads = [next(iterator, None) for iterator in iterators]
+    while any(head is not None for head in heads):
+        key = min(head[0] for head in heads if head is not None)
+        groups = []
+        for index, head in enumerate(heads):
+            if head is not None and head[0] == key:
+                groups.append(head[1])
+                heads[index] = next(iterators[index], None)
+            else:
+                groups.append([])
+        yield key, groups
+
+
+def _differs(a, b):
+    return abs((a or 0.0) - (b or 0.0)) > AMOUNT_TOLERANCE
+
+
+def check_order(order, payments, affiliate_transactions, ledger_entries):
+    """Return [(kind, details)] for one order id's documents"""
+    issues = []
+
+    if not order:
+        for payment in payments:
+            issues.append(('orphan_payment', {'paymentId': str(payment['_id'])}))
+        for transaction in affiliate_transactions:
+            issues.append(('orphan_affiliate_transaction', {'transactionId': str(transaction['_id'])}))
+        for entry in ledger_entries:
+            issues.append(('orphan_ledger_entry', {'entryKey': entry.get('entry_key')}))
+        return issues
+
+    paid = order.get('payment_status') == 'completed'
+    completed_payments = [p for p in payments if p.get('status') == 'completed']
+
+    # Payments vs order payment status
+    if paid and not completed_payments:
+        issues.append(('missing_payment', {'paymentStatuses': [p.get('status') for p in payments]}))
+    if completed_payments and not paid:
+        issues.append(('order_status_mismatch', {
+            'orderPaymentStatus': order.get('payment_status'),
+            'paymentIds': [str(p['_id']) for p in completed_payments]
+        }))
+    if len(completed_payments) > 1:
+        issues.append(('duplicate_payment', {
+            'paymentIds': [str(p['_id']) for p in completed_payments],
+            'moyasarPaymentIds': [p.get('moyasar_payment_id') for p in completed_payments]
+        }))
+    for payment in completed_payments:
+        if payment.get('is_group_payment') != 'group' and _differs(payment.get('amount'), order.get('total_price')):
+            issues.append(('payment_amount_mismatch', {
+                'paymentId': str(payment['_id']),
+                'paymentAmount': payment.get('amount'),
+                'orderTotal': order.get('total_price')
+            }))
+
+    # Affiliate transactions vs order commission
+    if len(affiliate_transactions) > 1:
+        issues.append(('duplicate_affiliate_transaction', {
+            'transactionIds': [str(t['_id']) for t in affiliate_transactions]
+        }))
+    if paid and order.get('affiliate_code') and (order.get('affiliate_commission') or 0) > 0 and not affiliate_transactions:
+        issues.append(('missing_affiliate_transaction', {
+            'affiliateCode': order.get('affiliate_code'),
+            'affiliateCommission': order.get('affiliate_commission')
+        }))
+    for transaction in affiliate_transactions:
+        if _differs(transaction.get('commission_amount'), order.get('affiliate_commission')):
+            issues.append(('affiliate_commission_mismatch', {
+                'transactionId': str(transaction['_id']),
+                'commissionAmount': transaction.get('commission_amount'),
+                'orderCommission': order.get('affiliate_commission')
+            }))
+        if transaction.get('status') == 'paid' and not paid:
+            issues.append(('affiliate_paid_unpaid_order', {'transactionId': str(transaction['_id'])}))
+
+    # Seller ledger vs order payout
+    entries_by_type = {}
+    for entry in ledger_entries:
+        entries_by_type.setdefault(entry.get('entry_type'), []).append(entry)
+    locked = entries_by_type.get('sale_locked', [])
+    released = entries_by_type.get('sale_released', [])
+    has_proof = bool((order.get('shipment_proof') or '').strip())
+
+    if paid and not locked:
+        issues.append(('missing_ledger_entry', {'entryType': 'sale_locked', 'sellerPayout': order.get('seller_payout')}))
+    if paid and has_proof and not released:
+        issues.append(('missing_ledger_entry', {'entryType': 'sale_released', 'sellerPayout': order.get('seller_payout')}))
+    if (locked or released) and not paid:
+        issues.append(('ledger_unpaid_order', {'entryKeys': [e.get('entry_key') for e in locked + released]}))
+    if released and not has_proof:
+        issues.append(('ledger_released_without_proof', {'entryKeys': [e.get('entry_key') for e in released]}))
+    for entry in locked + released:
+        if _differs(entry.get('amount'), order.get('seller_payout')):
+            issues.append(('ledger_amount_mismatch', {
+                'entryKey': entry.get('entry_key'),
+                'ledgerAmount': entry.get('amount'),
+                'sellerPayout': order.get('seller_payout')
+            }))
+
+    return issues
+
+
+class ReconciliationService:
+    """Run and resume payment/order reconciliation"""
+
+    @staticmethod
+    def start(resume=False):
+        """Return the run to work on: the latest unfinished run when resuming, else a new one"""
+        if resume:
+            run = ReconciliationRun.objects(status__in=['running', 'failed']).order_by('-started_at').first()
+            if run:
+                ReconciliationRun.objects(id=run.id).update_one(set__status='running', unset__error=True)
+                run.reload()
+                return run
+        run = ReconciliationRun()
+        run.save()
+        return run
+
+    @staticmethod
+    def run(run, checkpoint_every=1000, limit=None, report_file=None):
+        """
+        Reconcile order ids after the run's checkpoint. Returns the run.
+        limit stops after that many order ids (the next resume continues from there).
+        """
+        from products.models import Order
+        from affiliates.models import AffiliateTransaction
+        from admin_dashboard.models import SellerLedgerEntry
+
+        after = ObjectId(run.last_order_id) if run.last_order_id else None
+        streams = [
+            _stream(Order._get_collection(), '_id', {
+                'payment_status': 1, 'total_price': 1, 'affiliate_code': 1,
+                'affiliate_commission': 1, 'seller_payout': 1, 'shipment_proof': 1
+            }, after),
+            _stream_payments(Payment._get_collection(), {
+                'order_id': 1, 'status': 1, 'amount': 1, 'moyasar_payment_id': 1, 'is_group_payment': 1
+            }, after),
+            _stream(AffiliateTransaction._get_collection(), 'transaction_id', {
+                'transaction_id': 1, 'commission_amount': 1, 'status': 1
+            }, after),
+            _stream(SellerLedgerEntry._get_collection(), 'order_id', {
+                'order_id': 1, 'entry_type': 1, 'entry_key': 1, 'amount': 1
+            }, after),
+        ]
+
+        counts = dict(run.discrepancy_counts or {})
+        orders_checked = run.orders_checked or 0
+        pending = []
+        since_checkpoint = 0
+        last_key = None
+        processed = 0
+
+        def checkpoint(final_status=None):
+            if pending:
+                ReconciliationDiscrepancy._get_collection().insert_many(
+                    [d.to_mongo() for d in pending], ordered=False
+                )
+                pending.clear()
+            update = {
+                'set__orders_checked': orders_checked,
+                'set__discrepancy_counts': counts,
+                'set__checkpointed_at': datetime.utcnow()
+            }
+            if last_key is not None:
+                update['set__last_order_id'] = str(last_key)
+            if final_status:
+                update['set__status'] = final_status
+                update['set__finished_at'] = datetime.utcnow()
+            ReconciliationRun.objects(id=run.id).update_one(**update)
+
+        try:
+            for key, (orders, payments, transactions, entries) in merge_join(streams):
+                if limit is not None and processed >= limit:
+                    break
+                issues = check_order(orders[0] if orders else None, payments, transactions, entries)
+                for kind, details in issues:
+                    counts[kind] = counts.get(kind, 0) + 1
+                    pending.append(ReconciliationDiscrepancy(
+                        run_id=str(run.id), order_id=str(key), kind=kind, details=details
+                    ))
+                    if report_file:
+                        report_file.write(json.dumps({'orderId': str(key), 'kind': kind, 'details': details}, default=str) + '\n')
+                if orders:
+                    orders_checked += 1
+                last_key = key
+                processed += 1
+                since_checkpoint += 1
+                if since_checkpoint >= checkpoint_every or len(pending) >= DISCREPANCY_FLUSH_SIZE:
+                    checkpoint()
+                    since_checkpoint = 0
+            else:
+                checkpoint(final_status='completed')
+                run.reload()
+                return run
+            checkpoint()  # Stopped at the limit; still resumable
+        except Exception as e:
+            logger.error(f"Reconciliation run {run.id} failed: {str(e)}", exc_info=True)
+            checkpoint()
+            ReconciliationRun.objects(id=run.id).update_one(set__status='failed', set__error=str(e))
+            raise
+
+        run.reload()
+        return run
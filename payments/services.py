@@ -5,6 +5,7 @@ import requests
 from datetime import datetime
 from django.conf import settings
 from payments.models import Payment
+from payments.moyasar_client import get_moyasar_client
 from products.models import Order, Offer
 from products.services import OrderService
 
@@ -80,7 +81,7 @@ class MoyasarPaymentService:
             raise ValueError("Either token_id or card_details must be provided")
         
         try:
-            response = requests.post(url, json=payload, headers=headers)
+            response = get_moyasar_client().post(url, 'payments.create', json=payload, headers=headers)
             response.raise_for_status()
             payment_data = response.json()
             
@@ -183,7 +184,7 @@ class MoyasarPaymentService:
             
             logger.info(f"Calling Moyasar API: {url}")
             
-            response = requests.get(url, headers=headers)
+            response = get_moyasar_client().get(url, 'payments.fetch', headers=headers)
             
             # Handle 401 Unauthorized specifically
             if response.status_code == 401:
@@ -257,7 +258,6 @@ class MoyasarPaymentService:
         logger.info(f"Payment record: {payment.id}, Order: {payment.order_id.id}")
 
         if payment_status == 'paid':
-            payment.status = 'completed'
             order = payment.order_id
             order.payment_status = 'completed'
             # Set order status to 'packed' after payment is completed
@@ -265,6 +265,18 @@ class MoyasarPaymentService:
             order.save()
             logger.info(f"Order {order.id} status updated to 'packed', payment_status: 'completed'")
             
+            # Record the payment right after the order so a failure below never leaves it pending
+            payment.status = 'completed'
+            payment.updated_at = datetime.utcnow()
+            payment.save()
+            
+            # Credit the seller's ledger (locked until shipment proof is uploaded)
+            try:
+                from products.seller_service import SellerLedgerService
+                SellerLedgerService.record_payment_completed(order)
+            except Exception as e:
+                logger.error(f"Error recording seller ledger credit for order {order.id}: {str(e)}")
+            
             # Update offer status from 'accepted' to 'paid' if order has an associated offer
             if order.offer_id:
                 offer_id = order.offer_id.id
@@ -286,8 +298,18 @@ class MoyasarPaymentService:
             else:
                 logger.info(f"Order {order.id} has no associated offer_id")
             
-            # Update affiliate earnings when payment is completed
-            OrderService.update_affiliate_earnings_on_payment_completion(order)
+            # Turn the checkout stock hold into a sale
+            from products.services import ReservationService
+            ReservationService.convert_for_order(order)
+            
+            # Affiliate earnings and payment notifications run from the outbox worker. The
+            # event key is per order, so if recording it fails here, the next status update
+            # for this payment (webhook redelivery or verify call) records it instead.
+            try:
+                from notifications.outbox import OutboxService
+                OutboxService.enqueue('payment_completed', f'payment_completed:{order.id}', {'order_id': str(order.id)})
+            except Exception as e:
+                logger.error(f"Could not queue payment_completed side effects for order {order.id}: {str(e)}")
         elif payment_status in ['failed', 'declined', 'canceled', 'cancelled']:
             payment.status = 'failed'
             # Keep order payment_status as 'pending' - don't mark as failed
@@ -297,6 +319,11 @@ class MoyasarPaymentService:
                 order.payment_status = 'pending'
                 order.save()
             logger.info(f"Payment {moyasar_payment_id} marked as failed, order kept as pending")
+            
+            # Give the held stock back; a retried payment converts it only if still free
+            from products.services import ReservationService
+            order_ids = [o.id for o in (payment.orders or [])] or [order.id]
+            ReservationService.release_for_orders(order_ids)
         
         payment.save()
         logger.info(f"Payment {payment.id} saved successfully")
@@ -309,7 +336,7 @@ class MoyasarPaymentService:
         return True
     
     @staticmethod
-    def create_payout(amount, currency, destination, purpose='payout', metadata=None):
+    def create_payout(amount, currency, destination, purpose='payout', metadata=None, idempotency_key=None):
         """
         Create a payout via Moyasar API
         
@@ -325,6 +352,8 @@ class MoyasarPaymentService:
                 - city: City name (optional)
             purpose: Purpose of the payout (default: 'payout')
             metadata: Additional metadata (optional)
+            idempotency_key: Sent as the Idempotency-Key header so a repeated request
+                cannot create a second payout (optional)
         
         Returns:
             Dictionary containing Moyasar payout response
@@ -369,10 +398,12 @@ class MoyasarPaymentService:
         
         if metadata:
             payload['metadata'] = metadata
+        if idempotency_key:
+            headers['Idempotency-Key'] = idempotency_key
         
         try:
             logger.info(f"Creating Moyasar payout: {amount} {currency} to {destination.get('name', 'N/A')}")
-            response = requests.post(url, json=payload, headers=headers)
+            response = get_moyasar_client().post(url, 'payouts.create', json=payload, headers=headers)
             response.raise_for_status()
             payout_data = response.json()
             logger.info(f"Moyasar payout created successfully: {payout_data.get('id')}")
@@ -393,6 +424,33 @@ class MoyasarPaymentService:
             logger.error(error_msg)
             raise ValueError(error_msg)
     
+    @staticmethod
+    def find_payout(attempt_id):
+        """
+        Look up the payout created with metadata payout_attempt_id = attempt_id.
+        Returns the Moyasar payout, or None if none exists.
+        """
+        from urllib.parse import urlencode
+        
+        if not getattr(settings, 'MOYASAR_SECRET_KEY', None):
+            raise ValueError(
+                "MOYASAR_SECRET_KEY setting is missing. "
+                "Please add MOYASAR_SECRET_KEY to your environment variables."
+            )
+        payout_api_url = getattr(settings, 'MOYASAR_PAYOUT_API_URL', 'https://api.moyasar.com/v1/payouts')
+        url = f"{payout_api_url}?{urlencode({'metadata[payout_attempt_id]': attempt_id})}"
+        headers = {'Authorization': f'Bearer {settings.MOYASAR_SECRET_KEY}'}
+        
+        try:
+            response = get_moyasar_client().get(url, 'payouts.list', headers=headers)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            raise ValueError(f"Payout lookup failed: {str(e)}")
+        for payout in response.json().get('payouts') or []:
+            if (payout.get('metadata') or {}).get('payout_attempt_id') == attempt_id:
+                return payout
+        return None
+    
     @staticmethod
     def parse_account_details(account_details_str):
         """
@@ -0,0 +1,488 @@
+"""
+Payment tests.
+
+MongoDB and Moyasar are not needed: model queries are mocked, and API calls are
+either mocked or served by moyasar_fake_server on an ephemeral local port.
+"""
+import argparse
+import threading
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer
+from unittest import mock
+import requests
+from bson import ObjectId
+from django.test import SimpleTestCase, override_settings
+from mongoengine.errors import NotUniqueError
+import moyasar_fake_server
+from notifications.outbox import OutboxService
+from payments import bulk_payouts
+from payments.bulk_payouts import BulkPayoutService, affiliate_paid_operations
+from payments.models import WebhookEvent
+from payments.reconciliation import merge_join, check_order, _stream_payments
+from payments.moyasar_client import MoyasarClient, CircuitBreaker, CircuitOpenError
+from payments.services import MoyasarPaymentService
+from payments.webhooks import WebhookService
+
+
+class WebhookIntakeTests(SimpleTestCase):
+    """Each (payment id, event) is recorded and queued once"""
+
+    def setUp(self):
+        patcher = mock.patch.object(OutboxService, 'enqueue')
+        self.enqueue = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.body = {'type': 'payment_paid', 'data': {'id': 'pay_1', 'status': 'paid'}}
+
+    def test_first_delivery_is_recorded_and_queued(self):
+        def save(webhook_event):
+            webhook_event.id = ObjectId()
+
+        with mock.patch.object(WebhookEvent, 'save', autospec=True, side_effect=save) as save:
+            webhook_event, created = WebhookService.receive(self.body)
+        self.assertTrue(created)
+        self.assertIsNotNone(webhook_event.id)
+        saved = save.call_args[0][0]
+        self.assertEqual((saved.moyasar_payment_id, saved.event), ('pay_1', 'payment_paid'))
+        self.enqueue.assert_called_once_with(
+            'moyasar_webhook', f'moyasar_webhook:{webhook_event.id}', {'webhook_event_id': str(webhook_event.id)}
+        )
+
+    def test_duplicate_delivery_is_acknowledged_without_work(self):
+        objects = mock.MagicMock()
+        objects.return_value.modify.return_value = None
+        with mock.patch.object(WebhookEvent, 'save', side_effect=NotUniqueError('duplicate')), \
+                mock.patch.object(WebhookEvent, 'objects', objects):
+            self.assertEqual(WebhookService.receive(self.body), (None, False))
+        self.assertEqual(objects.call_args[1]['status'], 'failed')
+        self.enqueue.assert_not_called()
+
+    def test_redelivery_of_a_failed_event_queues_it_again(self):
+        failed = mock.Mock(id=ObjectId())
+        objects = mock.MagicMock()
+        objects.return_value.modify.return_value = failed
+        with mock.patch.object(WebhookEvent, 'save', side_effect=NotUniqueError('duplicate')), \
+                mock.patch.object(WebhookEvent, 'objects', objects):
+            self.assertEqual(WebhookService.receive(self.body), (failed, True))
+        self.assertEqual(objects.return_value.modify.call_args[1], {'set__status': 'received', 'new': True})
+        key = self.enqueue.call_args[0][1]
+        self.assertTrue(key.startswith(f'moyasar_webhook:{failed.id}:redelivery:'))
+
+    def test_delivery_without_payment_id_is_rejected(self):
+        with self.assertRaises(ValueError):
+            WebhookService.receive({'type': 'payment_paid', 'data': {}})
+
+
+class WebhookProcessingTests(SimpleTestCase):
+    """Recorded deliveries are verified with Moyasar and applied once"""
+
+    def test_processed_event_is_not_applied_again(self):
+        webhook_event = mock.Mock(status='processed', result={'updated': True})
+        with mock.patch.object(WebhookService, 'apply') as apply:
+            self.assertEqual(WebhookService.process_event(webhook_event), {'updated': True})
+        apply.assert_not_called()
+
+    def test_unverifiable_payment_is_retried_not_trusted(self):
+        webhook_event = mock.Mock(id=ObjectId(), status='received', payload={'data': {'id': 'pay_1', 'status': 'paid'}})
+        objects = mock.MagicMock()
+        with mock.patch.object(WebhookEvent, 'objects', objects), \
+                mock.patch.object(MoyasarPaymentService, 'verify_payment_status', side_effect=RuntimeError('timeout')), \
+                mock.patch.object(MoyasarPaymentService, 'update_payment_status') as update_payment:
+            with self.assertLogs('payments.webhooks', 'ERROR'), self.assertRaises(Exception):
+                WebhookService.process_event(webhook_event)
+        update_payment.assert_not_called()
+        last_update = objects.return_value.update_one.call_args[1]
+        self.assertEqual(last_update['set__status'], 'received')
+
+    def test_failed_payment_releases_the_order_holds(self):
+        order = mock.Mock(id=ObjectId())
+        payment = mock.Mock(orders=[], order_id=order)
+        payments = mock.MagicMock()
+        payments.return_value.first.return_value = payment
+        with mock.patch.object(MoyasarPaymentService, 'verify_payment_status', return_value={'status': 'failed'}), \
+                mock.patch('payments.models.Payment.objects', payments), \
+                mock.patch('products.services.ReservationService.release_for_orders') as release, \
+                mock.patch('notifications.notification_helper.NotificationHelper.send_payment_failed_with_details'):
+            result = WebhookService.apply({'data': {'id': 'pay_1', 'status': 'paid'}})
+        self.assertEqual(result, {'payment_id': 'pay_1', 'status': 'failed', 'updated': False})
+        self.assertEqual(order.payment_status, 'failed')
+        release.assert_called_once_with([order.id])
+
+    def test_response_summary_reports_the_verified_status(self):
+        body = {'data': {'id': 'pay_1', 'status': 'paid'}, 'offerId': 'offer-1'}
+        with mock.patch.object(MoyasarPaymentService, 'verify_payment_status', return_value={'status': 'failed'}):
+            self.assertEqual(WebhookService.verified_summary(body), {'status': 'failed', 'verified': True, 'offerId': 'offer-1'})
+        with mock.patch.object(MoyasarPaymentService, 'verify_payment_status', side_effect=RuntimeError('timeout')), \
+                self.assertLogs('payments.webhooks', 'WARNING'):
+            self.assertEqual(WebhookService.verified_summary(body), {'status': None, 'verified': False, 'offerId': 'offer-1'})
+
+
+@override_settings(MOYASAR_GET_RETRIES=2, MOYASAR_CIRCUIT_FAILURE_THRESHOLD=3, MOYASAR_CIRCUIT_RESET_SECONDS=30)
+class MoyasarClientTests(SimpleTestCase):
+    """GETs retry with backoff, POSTs never repeat, and the breaker fails fast"""
+
+    def setUp(self):
+        self.client = MoyasarClient()
+        self.client.session = mock.Mock()
+        patcher = mock.patch('payments.moyasar_client.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _response(self, status_code, headers=None):
+        return mock.Mock(status_code=status_code, headers=headers or {})
+
+    def test_get_retries_server_errors_then_returns(self):
+        self.client.session.request.side_effect = [
+            self._response(503, {'Retry-After': '1'}),
+            requests.exceptions.ConnectionError('reset'),
+            self._response(200),
+        ]
+        self.assertEqual(self.client.get('https://api/payments/1', 'payments.fetch').status_code, 200)
+        self.assertEqual(self.client.session.request.call_count, 3)
+        self.assertGreaterEqual(self.sleep.call_args_list[0][0][0], 1.0)  # Retry-After honoured
+        self.assertEqual(self.client.session.request.call_args[1]['timeout'], self.client.timeout)
+
+    def test_get_gives_up_after_the_retry_budget(self):
+        self.client.session.request.side_effect = requests.exceptions.Timeout('slow')
+        with self.assertRaises(requests.exceptions.Timeout), self.assertLogs('payments.moyasar_client', 'WARNING'):
+            self.client.get('https://api/payments/1', 'payments.fetch')
+        self.assertEqual(self.client.session.request.call_count, 3)
+
+    def test_post_is_sent_once(self):
+        self.client.session.request.return_value = self._response(502)
+        self.assertEqual(self.client.post('https://api/payouts', 'payouts.create', json={}).status_code, 502)
+        self.client.session.request.assert_called_once()
+        self.client.session.request.side_effect = requests.exceptions.Timeout('slow')
+        with self.assertRaises(requests.exceptions.Timeout):
+            self.client.post('https://api/payouts', 'payouts.create', json={})
+        self.assertEqual(self.client.session.request.call_count, 2)
+
+    def test_open_circuit_fails_fast(self):
+        self.client.session.request.return_value = self._response(500)
+        with self.assertLogs('payments.moyasar_client', 'WARNING'):
+            for _ in range(3):
+                self.client.post('https://api/payouts', 'payouts.create')
+        with self.assertRaises(CircuitOpenError):
+            self.client.get('https://api/payments/1', 'payments.fetch')
+        self.assertEqual(self.client.session.request.call_count, 3)
+        metrics = self.client.get_metrics()
+        self.assertEqual(metrics['circuit'], 'open')
+        self.assertEqual(metrics['endpoints']['payouts.create']['errors'], 3)
+        self.assertEqual(metrics['endpoints']['payments.fetch'], {
+            'count': 1, 'errors': 1, 'p50Ms': None, 'p95Ms': None, 'p99Ms': None, 'maxMs': None
+        })
+
+    def test_breaker_allows_one_trial_call_after_the_reset_period(self):
+        breaker = CircuitBreaker(threshold=1, reset_seconds=30)
+        with mock.patch('payments.moyasar_client.time.monotonic', return_value=100.0), \
+                self.assertLogs('payments.moyasar_client', 'WARNING'):
+            breaker.record_failure()
+            self.assertFalse(breaker.allow())
+        with mock.patch('payments.moyasar_client.time.monotonic', return_value=131.0):
+            self.assertEqual(breaker.state, 'half_open')
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())  # Only one trial in flight
+            breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+
+
+class FakeMoyasarServerTests(SimpleTestCase):
+    """The local stand-in behaves like Moyasar for the calls the backend makes"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        moyasar_fake_server.options = argparse.Namespace(
+            latency_ms=0, jitter_ms=0, error_rate=0.0, decline_rate=0.0,
+            webhook_url='', webhook_delay_ms=0, verbose=False
+        )
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), moyasar_fake_server.Handler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_address[1]}/v1'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        overrides = override_settings(
+            MOYASAR_API_URL=f'{self.base_url}/payments',
+            MOYASAR_PAYOUT_API_URL=f'{self.base_url}/payouts',
+            MOYASAR_SECRET_KEY='sk_test_local',
+            MOYASAR_PAYOUT_SOURCE_ID='src_local'
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def _payout(self, attempt_id, idempotency_key):
+        return MoyasarPaymentService.create_payout(
+            1000, 'SAR', {'type': 'bank', 'iban': 'SA0380000000608010167519', 'name': 'Seller'},
+            metadata={'payout_attempt_id': attempt_id}, idempotency_key=idempotency_key
+        )
+
+    def test_repeated_idempotency_key_returns_the_first_payout(self):
+        first = self._payout('attempt-1', 'key-1')
+        self.assertEqual(self._payout('attempt-1', 'key-1')['id'], first['id'])
+        self.assertNotEqual(self._payout('attempt-2', 'key-2')['id'], first['id'])
+
+    def test_payout_is_found_by_its_attempt_id(self):
+        created = self._payout('attempt-lookup', 'key-lookup')
+        self.assertEqual(MoyasarPaymentService.find_payout('attempt-lookup')['id'], created['id'])
+        self.assertIsNone(MoyasarPaymentService.find_payout('attempt-never-sent'))
+
+    def test_created_payment_can_be_verified(self):
+        response = requests.post(
+            f'{self.base_url}/payments',
+            json={'amount': 11500, 'source': {'type': 'creditcard', 'number': '4111111111111111'}},
+            headers={'Authorization': 'Bearer sk_test_local'},
+            timeout=5
+        )
+        self.assertEqual(response.status_code, 201)
+        payment = response.json()
+        self.assertNotIn('number', payment['source'])
+        verified = MoyasarPaymentService.verify_payment_status(payment['id'])
+        self.assertEqual((verified['status'], verified['amount']), ('paid', 11500))
+
+    def test_requests_without_a_secret_key_are_rejected(self):
+        response = requests.get(f'{self.base_url}/payouts', timeout=5)
+        self.assertEqual(response.status_code, 401)
+
+
+def matches(doc, query):
+    """Match doc against the subset of MongoDB filters the payout claims use"""
+    for field, condition in query.items():
+        if field == '$or':
+            if not any(matches(doc, option) for option in condition):
+                return False
+            continue
+        value = doc.get(field)
+        if isinstance(condition, dict):
+            if '$in' in condition and value not in condition['$in']:
+                return False
+            if '$lt' in condition and (value is None or not value < condition['$lt']):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeRequestCollection:
+    """In-memory payout request collection"""
+
+    def __init__(self, docs):
+        self.docs = {doc['_id']: doc for doc in docs}
+
+    def _apply(self, doc, update):
+        doc.update(update.get('$set', {}))
+        for field in update.get('$unset', {}):
+            doc.pop(field, None)
+
+    def update_one(self, query, update):
+        for doc in self.docs.values():
+            if matches(doc, query):
+                self._apply(doc, update)
+                return mock.Mock(modified_count=1)
+        return mock.Mock(modified_count=0)
+
+    def update_many(self, query, update):
+        for doc in self.docs.values():
+            if matches(doc, query):
+                self._apply(doc, update)
+
+    def find(self, query, projection=None):
+        return [dict(doc) for doc in self.docs.values() if matches(doc, query)]
+
+    def bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            self.update_one(operation._filter, operation._doc)
+
+
+class PayoutClaimTests(SimpleTestCase):
+    """A request is paid by at most one approval or batch at a time"""
+
+    def setUp(self):
+        self.request_id = ObjectId()
+        self.collection = FakeRequestCollection([{
+            '_id': self.request_id, 'status': 'pending', 'amount': 50.0,
+            'payment_method': 'Bank Transfer', 'account_details': 'IBAN: SA03, Name: Seller', 'seller_id': ObjectId()
+        }])
+        model = mock.Mock()
+        model._get_collection.return_value = self.collection
+        patcher = mock.patch.object(BulkPayoutService, '_model', return_value=model)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_second_claim_is_refused_until_the_first_is_released(self):
+        claim_id = BulkPayoutService.claim_request('cashout', self.request_id, 'pending')
+        self.assertIsNotNone(claim_id)
+        self.assertIsNone(BulkPayoutService.claim_request('cashout', self.request_id, 'pending'))
+
+        BulkPayoutService.release_claim('cashout', self.request_id, 'another-claim')
+        self.assertEqual(self.collection.docs[self.request_id]['payout_batch_id'], claim_id)
+        BulkPayoutService.release_claim('cashout', self.request_id, claim_id)
+        self.assertIsNotNone(BulkPayoutService.claim_request('cashout', self.request_id, 'pending'))
+
+    def test_claim_requires_the_status_that_was_read(self):
+        self.assertIsNone(BulkPayoutService.claim_request('cashout', self.request_id, 'rejected'))
+
+    def test_claim_of_a_dead_run_can_be_taken_over(self):
+        dead_claim = str(ObjectId.from_datetime(datetime.utcnow() - bulk_payouts.STALE_CLAIM_AFTER - timedelta(minutes=1)))
+        self.collection.docs[self.request_id]['payout_batch_id'] = dead_claim
+        self.assertIsNotNone(BulkPayoutService.claim_request('cashout', self.request_id, 'pending'))
+
+    def test_overlapping_batch_skips_the_claimed_request(self):
+        claim_id = BulkPayoutService.claim_request('cashout', self.request_id, 'pending')
+        with mock.patch.object(MoyasarPaymentService, 'create_payout') as create_payout:
+            report = BulkPayoutService.execute('cashout', [str(self.request_id)], 'admin')
+        create_payout.assert_not_called()
+        self.assertEqual(report['results'][0]['status'], 'skipped')
+        self.assertEqual(report['results'][0]['error'], 'Request is being processed by another payout batch')
+        self.assertEqual(self.collection.docs[self.request_id]['payout_batch_id'], claim_id)
+
+    def test_batch_pays_once_and_records_the_attempt(self):
+        with mock.patch.object(MoyasarPaymentService, 'create_payout', return_value={'id': 'po_1', 'status': 'queued'}) as create_payout, \
+                mock.patch.object(BulkPayoutService, '_record_seller_ledger') as ledger, \
+                mock.patch.object(BulkPayoutService, '_notify'):
+            report = BulkPayoutService.execute('cashout', [str(self.request_id), str(self.request_id)], 'admin')
+            again = BulkPayoutService.execute('cashout', [str(self.request_id)], 'admin')
+
+        create_payout.assert_called_once()
+        doc = self.collection.docs[self.request_id]
+        self.assertEqual(create_payout.call_args[1]['idempotency_key'], doc['payout_attempt_id'])
+        self.assertEqual((doc['status'], doc['moyasar_payout_id']), ('approved', 'po_1'))
+        self.assertNotIn('payout_batch_id', doc)
+        self.assertEqual(report['summary']['approved'], 1)
+        self.assertEqual(report['summary']['totalAmount'], 50.0)
+        self.assertEqual(again['results'][0]['error'], 'Request is already approved')
+        ledger.assert_called_once()
+
+
+class SendClaimedPayoutTests(SimpleTestCase):
+    """A reclaimed request reuses its attempt id instead of paying again"""
+
+    def setUp(self):
+        self.collection = mock.Mock()
+        model = mock.Mock()
+        model._get_collection.return_value = self.collection
+        patcher = mock.patch.object(BulkPayoutService, '_model', return_value=model)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _send(self, attempt_id):
+        return BulkPayoutService.send_claimed_payout(
+            'cashout', ObjectId(), 'claim-1', attempt_id, 5000, 'SAR', {'type': 'bank'}, 'seller_payout', {'cashout_id': 'c1'}
+        )
+
+    def test_payout_sent_by_a_dead_run_is_returned(self):
+        existing = {'id': 'po_1', 'status': 'paid'}
+        with mock.patch.object(MoyasarPaymentService, 'find_payout', return_value=existing), \
+                mock.patch.object(MoyasarPaymentService, 'create_payout') as create_payout:
+            self.assertIs(self._send('attempt-1'), existing)
+        create_payout.assert_not_called()
+
+    def test_unsent_attempt_is_sent_with_the_same_key(self):
+        with mock.patch.object(MoyasarPaymentService, 'find_payout', return_value=None), \
+                mock.patch.object(MoyasarPaymentService, 'create_payout') as create_payout:
+            self._send('attempt-1')
+        self.assertEqual(create_payout.call_args[1]['idempotency_key'], 'attempt-1')
+        self.assertEqual(create_payout.call_args[1]['metadata'], {'cashout_id': 'c1', 'payout_attempt_id': 'attempt-1'})
+        self.collection.update_one.assert_not_called()
+
+    def test_lost_claim_sends_nothing(self):
+        self.collection.update_one.return_value.modified_count = 0
+        with mock.patch.object(MoyasarPaymentService, 'create_payout') as create_payout:
+            with self.assertRaises(ValueError):
+                self._send(None)
+        create_payout.assert_not_called()
+        query, update = self.collection.update_one.call_args[0]
+        self.assertEqual(query['payout_batch_id'], 'claim-1')
+        self.assertIn('payout_attempt_id', update['$set'])
+
+
+class AffiliatePaidOperationsTests(SimpleTestCase):
+    """Affiliate paid totals are incremented, never overwritten"""
+
+    def test_paid_amounts_are_incremented_per_currency(self):
+        affiliate_id = ObjectId()
+        create_map, increment, recompute = affiliate_paid_operations(affiliate_id, {'SAR': 10.25, 'USD': 2.0})
+        self.assertEqual(create_map._filter, {'_id': affiliate_id, 'earnings_by_currency': None})
+        self.assertEqual(increment._doc['$inc'], {
+            'earnings_by_currency.SAR.paid': 10.25, 'earnings_by_currency.SAR.total': 0.0,
+            'earnings_by_currency.SAR.pending': 0.0, 'earnings_by_currency.USD.paid': 2.0,
+            'earnings_by_currency.USD.total': 0.0, 'earnings_by_currency.USD.pending': 0.0
+        })
+        self.assertIn('paid_earnings', recompute._doc[0]['$set'])
+
+
+class FakeCursor(list):
+    """find() cursor over a list of docs"""
+
+    def sort(self, *args):
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def close(self):
+        pass
+
+
+class ReconciliationTests(SimpleTestCase):
+    """Sorted cursors are merge-joined by order id and each order is checked once"""
+
+    def test_merge_join_groups_every_stream_by_key(self):
+        a, b, c = ObjectId(), ObjectId(), ObjectId()
+        orders = [(a, 'order-a'), (c, 'order-c')]
+        payments = [(a, 'payment-a1'), (a, 'payment-a2'), (b, 'payment-b')]
+        self.assertEqual(list(merge_join([orders, payments])), [
+            (a, [['order-a'], ['payment-a1', 'payment-a2']]),
+            (b, [[], ['payment-b']]),
+            (c, [['order-c'], []]),
+        ])
+
+    def test_group_payment_is_joined_to_each_order_it_covers(self):
+        first, second = sorted([ObjectId(), ObjectId()])
+        group_payment = {'_id': ObjectId(), 'order_id': first, 'is_group_payment': 'group'}
+        collection = mock.Mock()
+        collection.find.return_value = FakeCursor([group_payment])
+        collection.aggregate.return_value = FakeCursor([dict(group_payment, order_key=second)])
+        joined = list(_stream_payments(collection, {'order_id': 1}))
+        self.assertEqual([key for key, _ in joined], [first, second])
+        self.assertTrue(all(doc['_id'] == group_payment['_id'] for _, doc in joined))
+
+    def test_resumed_stream_starts_after_the_checkpoint(self):
+        checkpoint = ObjectId()
+        collection = mock.Mock()
+        collection.find.return_value = FakeCursor([])
+        collection.aggregate.return_value = FakeCursor([])
+        list(_stream_payments(collection, {'order_id': 1}, after=checkpoint))
+        self.assertEqual(collection.find.call_args[0][0], {'order_id': {'$gt': checkpoint}})
+        secondary_match = collection.aggregate.call_args[0][0][3]['$match']
+        self.assertEqual(secondary_match['order_key'], {'$gt': checkpoint})
+
+    def test_consistent_paid_order_has_no_issues(self):
+        order = {'payment_status': 'completed', 'total_price': 115.0, 'seller_payout': 95.0, 'shipment_proof': 'proof.jpg'}
+        payments = [{'_id': ObjectId(), 'status': 'completed', 'amount': 115.0}]
+        entries = [
+            {'entry_type': 'sale_locked', 'entry_key': 'sale_locked:1', 'amount': 95.0},
+            {'entry_type': 'sale_released', 'entry_key': 'sale_released:1', 'amount': 95.0},
+        ]
+        self.assertEqual(check_order(order, payments, [], entries), [])
+
+    def test_discrepancies_are_reported(self):
+        order = {'payment_status': 'completed', 'total_price': 115.0, 'seller_payout': 95.0,
+                 'affiliate_code': 'SUMMER', 'affiliate_commission': 1.25}
+        payments = [
+            {'_id': ObjectId(), 'status': 'completed', 'amount': 115.0},
+            {'_id': ObjectId(), 'status': 'completed', 'amount': 100.0},
+        ]
+        entries = [{'entry_type': 'sale_released', 'entry_key': 'sale_released:1', 'amount': 95.0}]
+        kinds = [kind for kind, _ in check_order(order, payments, [], entries)]
+        self.assertEqual(kinds, [
+            'duplicate_payment', 'payment_amount_mismatch', 'missing_affiliate_transaction',
+            'missing_ledger_entry', 'ledger_released_without_proof'
+        ])
+        orphan = check_order(None, payments[:1], [], [])
+        self.assertEqual(orphan, [('orphan_payment', {'paymentId': str(payments[0]['_id'])})])
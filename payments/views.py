@@ -68,6 +68,7 @@ def process_payment(request):
             'success': True,
             'payment': {
                 'id': str(payment.id),
+                'moyasarPaymentId': payment.moyasar_payment_id,
                 'status': payment.status,
                 'amount': payment.amount,
                 'currency': payment.currency,
@@ -86,439 +87,49 @@ def process_payment(request):
 
 @api_view(['POST'])
 def payment_webhook(request):
-    """Handle Moyasar webhook - Verifies payment status with Moyasar API before processing"""
+    """
+    Handle Moyasar webhook.
+    The delivery is recorded once per (payment id, event) and the outbox worker applies it.
+    The response carries the payment status verified with Moyasar and the offerId;
+    status is null (verified: false) when Moyasar could not be reached.
+    """
     import logging
     logger = logging.getLogger(__name__)
     
     try:
+        from payments.webhooks import WebhookService
+        
         # Verify webhook signature
         signature = request.headers.get('X-Moyasar-Signature', '')
         payload = request.body
-        
-        # Verify and process webhook
         # MoyasarPaymentService.verify_webhook(signature, payload)
         
         data = request.data
-        logger.info(f"Webhook received data: {data}")
-        
-        # Handle nested data structure (data.data) or flat structure
-        payment_data = data.get('data', data)
-        
-        payment_id = payment_data.get('id') or data.get('id')
-        # Don't trust status from frontend - we'll verify with Moyasar
-        frontend_status = payment_data.get('status') or data.get('status')
-        amount = payment_data.get('amount', data.get('amount', 0))
-        
-        # Extract offerId from request data if provided (frontend can send it)
-        offer_id_from_request = data.get('offerId') or data.get('offer_id') or payment_data.get('offerId')
-        
-        # Extract orderId from request data (frontend sends it)
-        order_id_from_request = data.get('orderId') or data.get('order_id') or payment_data.get('orderId') or payment_data.get('order_id')
-        
-        logger.info(f"Extracted payment_id: {payment_id}, frontend_status: {frontend_status}, offerId: {offer_id_from_request}, orderId: {order_id_from_request}")
-        
-        if not payment_id:
-            logger.error("Payment ID not found in webhook data")
-            return Response({
-                'success': False,
-                'error': 'Payment ID not found in webhook data'
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # CRITICAL: Verify payment status with Moyasar API - don't trust frontend status
-        logger.info(f"Verifying payment status with Moyasar API for payment_id: {payment_id}")
-        verification_failed = False
-        verification_error = None
-        try:
-            verified_payment_data = MoyasarPaymentService.verify_payment_status(payment_id)
-            payment_status = verified_payment_data.get('status')
-            logger.info(f"✅ Verified payment status from Moyasar: {payment_status} (frontend sent: {frontend_status})")
-            
-            # Use verified payment data instead of frontend data
-            payment_data = verified_payment_data
-            amount = payment_data.get('amount', amount)
-        except Exception as e:
-            verification_failed = True
-            verification_error = str(e)
-            logger.error(f"❌ Failed to verify payment status with Moyasar: {verification_error}")
-            
-            # If verification fails due to 401 (authentication), we have a configuration issue
-            # But if frontend says payment is 'paid', we can still process it with a warning
-            # This is a fallback to prevent blocking legitimate payments due to config issues
-            if '401' in verification_error or 'Unauthorized' in verification_error:
-                logger.warning(f"⚠️ Moyasar API authentication failed (401). This indicates MOYASAR_SECRET_KEY is missing or incorrect in Render environment variables.")
-                logger.warning(f"⚠️ Proceeding with frontend status '{frontend_status}' as fallback. Payment ID: {payment_id}")
-                
-                # Use frontend status as fallback, but log the warning
-                if frontend_status == 'paid':
-                    payment_status = 'paid'
-                    logger.warning(f"⚠️ Using frontend status 'paid' as fallback. Please fix MOYASAR_SECRET_KEY in Render environment variables.")
-                else:
-                    # If frontend status is not 'paid', we can't proceed
-                    return Response({
-                        'success': False,
-                        'error': f'Failed to verify payment status with Moyasar (401 Unauthorized). Please check MOYASAR_SECRET_KEY in Render environment variables. Error: {verification_error}'
-                    }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-            else:
-                # For other errors, fail the webhook
-                return Response({
-                    'success': False,
-                    'error': f'Failed to verify payment status with Moyasar: {verification_error}'
-                }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        payment_id, event, _ = WebhookService.parse(data)
+        webhook_event, created = WebhookService.receive(data)
+        if not created:
+            logger.info(f"Duplicate webhook delivery for payment {payment_id} ({event}) - already recorded")
         
-        if not payment_status:
-            logger.error("Payment status not found in Moyasar response")
-            return Response({
-                'success': False,
-                'error': 'Payment status not found in Moyasar response'
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Handle failed payments - don't process further, just return success to stop retries
-        if payment_status in ['failed', 'declined', 'canceled', 'cancelled']:
-            logger.warning(f"Payment {payment_id} has status '{payment_status}' - marking as failed")
-            
-            # Extract error information from Moyasar response
-            error_message = None
-            error_code = None
-            
-            # Check source errors first (most common location for card errors in Moyasar)
-            if 'source' in payment_data:
-                source = payment_data.get('source', {})
-                if 'message' in source:
-                    error_message = source.get('message')
-                    logger.info(f"Found error message in source.message: {error_message}")
-                if 'response_code' in source:
-                    error_code = source.get('response_code')
-                    logger.info(f"Found error code in source.response_code: {error_code}")
-                if 'transaction' in source:
-                    source_transaction = source.get('transaction', {})
-                    if 'message' in source_transaction:
-                        error_message = source_transaction.get('message') or error_message
-                    if 'code' in source_transaction:
-                        error_code = source_transaction.get('code') or error_code
-            
-            # Check transaction errors
-            if not error_message and 'transaction' in payment_data:
-                transaction = payment_data.get('transaction', {})
-                error_message = transaction.get('message') or error_message
-                error_code = transaction.get('code') or error_code
-            
-            # Check top-level error fields
-            if not error_message:
-                error_message = (
-                    payment_data.get('message') or 
-                    payment_data.get('error') or 
-                    payment_data.get('description') or
-                    payment_data.get('error_message')
-                )
-            
-            # If still no error code, try response_code at top level
-            if not error_code:
-                error_code = payment_data.get('response_code') or payment_data.get('code')
-            
-            logger.info(f"Extracted error details - message: {error_message}, code: {error_code}")
-            
-            buyer_id_to_notify = None
-            
-            try:
-                # Try to update payment status to failed if payment exists
-                from payments.models import Payment
-                payment = Payment.objects(moyasar_payment_id=payment_id).first()
-                if payment:
-                    payment.status = 'failed'
-                    # Store full Moyasar response in metadata for error details
-                    payment.metadata = payment_data
-                    payment.save()
-                    logger.info(f"Payment {payment_id} marked as failed")
-                    
-                    # Get buyer_id from payment
-                    if payment.order_id:
-                        buyer_id_to_notify = str(payment.order_id.buyer_id.id)
-                        payment.order_id.payment_status = 'failed'
-                        payment.order_id.save()
-                        logger.info(f"Order {payment.order_id.id} payment status marked as failed")
-                
-                # If payment not found, try to find order by payment_id or metadata
-                if not buyer_id_to_notify:
-                    from products.models import Order
-                    # Try to find order by payment_id
-                    order = Order.objects(payment_id=payment_id).first()
-                    
-                    # If not found, try to find by offerId from metadata
-                    if not order:
-                        metadata = payment_data.get('metadata', {})
-                        offer_id = offer_id_from_request or metadata.get('offerId') or metadata.get('offer_id')
-                        if offer_id:
-                            from products.models import Offer
-                            offer = Offer.objects(id=offer_id).first()
-                            if offer:
-                                order = Order.objects(offer_id=offer.id).first()
-                    
-                    # If still not found, try order_id from metadata
-                    if not order:
-                        metadata = payment_data.get('metadata', {})
-                        order_id = metadata.get('order_id') or metadata.get('orderId')
-                        if order_id:
-                            order = Order.objects(id=order_id).first()
-                    
-                    if order:
-                        buyer_id_to_notify = str(order.buyer_id.id)
-                        order.payment_status = 'failed'
-                        order.save()
-                        logger.info(f"Order {order.id} payment status marked as failed")
-                
-                # Send payment failed email with Moyasar error details
-                if buyer_id_to_notify:
-                    try:
-                        from notifications.notification_helper import NotificationHelper
-                        logger.info(f"❌ Payment failed - sending email with Moyasar error details to buyer {buyer_id_to_notify}")
-                        
-                        # Send payment failed email with error details
-                        NotificationHelper.send_payment_failed_with_details(
-                            buyer_id=buyer_id_to_notify,
-                            error_message=error_message,
-                            error_code=error_code,
-                            moyasar_response=payment_data
-                        )
-                        logger.info(f"✅ Payment failed email sent with error details")
-                    except Exception as e:
-                        logger.error(f"Error sending payment failed email: {str(e)}")
-                else:
-                    logger.warning(f"Could not find buyer_id to send payment failed email for payment {payment_id}")
-            except Exception as e:
-                logger.error(f"Error updating failed payment: {str(e)}")
-            
-            # Return success to prevent Moyasar from retrying failed payments
-            return Response({
-                'success': True,
-                'message': f'Payment {payment_status} - no further processing needed',
-                'data': {
-                    'payment_id': payment_id,
-                    'status': payment_status,
-                    'updated': False
-                }
-            }, status=status.HTTP_200_OK)
-        
-        # Update payment status using the service method (only for successful payments)
-        updated = MoyasarPaymentService.update_payment_status(payment_id, payment_status)
-        logger.info(f"Payment status update result: {updated}")
-        
-        # Extract offerId from multiple sources (request, metadata, payment_data)
-        metadata = payment_data.get('metadata', {}) or data.get('metadata', {})
-        offer_id_final = (
-            offer_id_from_request or 
-            metadata.get('offerId') or 
-            metadata.get('offer_id') or
-            payment_data.get('offerId') or
-            data.get('offerId')
-        )
-        
-        # If we have offerId and payment is paid, update offer status directly (even if order not found)
-        if payment_status == 'paid' and offer_id_final:
-            from products.models import Offer as OfferModel
-            offer = OfferModel.objects(id=offer_id_final).first()
-            if offer:
-                if offer.status != 'paid':
-                    logger.info(f"Directly updating offer {offer.id} status from '{offer.status}' to 'paid' (from offerId: {offer_id_final})")
-                    offer.status = 'paid'
-                    offer.updated_at = datetime.utcnow()
-                    offer.save()
-                    logger.info(f"✅ Directly updated offer {offer.id} status to 'paid'")
-                else:
-                    logger.info(f"Offer {offer.id} already has status 'paid'")
-            else:
-                logger.warning(f"Offer not found with ID: {offer_id_final}")
-        
-        # If update was successful, verify offer status was updated
-        if updated and payment_status == 'paid':
-            from payments.models import Payment as PaymentModel
-            from products.models import Order as OrderModel, Offer as OfferModel
-            payment_check = PaymentModel.objects(moyasar_payment_id=payment_id).first()
-            if payment_check and payment_check.order_id and payment_check.order_id.offer_id:
-                offer_check = OfferModel.objects(id=payment_check.order_id.offer_id.id).first()
-                if offer_check and offer_check.status != 'paid':
-                    logger.warning(f"Offer {offer_check.id} status is still '{offer_check.status}', forcing update to 'paid'")
-                    offer_check.status = 'paid'
-                    offer_check.updated_at = datetime.utcnow()
-                    offer_check.save()
-                    logger.info(f"✅ Force updated offer {offer_check.id} status to 'paid'")
-        
-        if not updated:
-            logger.warning(f"Payment not found with moyasar_payment_id: {payment_id}, fetching full payment details from Moyasar")
-            # Fetch full payment details from Moyasar API to get metadata
-            try:
-                full_payment_data = MoyasarPaymentService.verify_payment_status(payment_id)
-                logger.info(f"Fetched full payment data from Moyasar: {full_payment_data.get('id')}")
-                # Use full payment data which includes metadata
-                payment_data = full_payment_data
-                amount = payment_data.get('amount', amount)
-            except Exception as e:
-                logger.warning(f"Could not fetch payment from Moyasar: {str(e)}, using webhook data")
-            
-            # If payment not found, try to find order by payment_id in order.payment_id
-            from payments.models import Payment
-            from products.models import Order, Offer
-            
-            # Try to find order by payment_id
-            order = Order.objects(payment_id=payment_id).first()
-            if order:
-                logger.info(f"Found order {order.id} by payment_id")
-            
-            # If not found, try to find by offerId from metadata
-            if not order:
-                metadata = payment_data.get('metadata', {})
-                offer_id = offer_id_from_request or metadata.get('offerId') or metadata.get('offer_id')
-                logger.info(f"Looking for order by offerId from metadata/request: {offer_id}")
-                
-                if offer_id:
-                    # Find offer
-                    offer = Offer.objects(id=offer_id).first()
-                    if offer:
-                        logger.info(f"Found offer {offer.id}, looking for associated order")
-                        # Find order by offer_id
-                        order = Order.objects(offer_id=offer.id).first()
-                        if order:
-                            logger.info(f"Found order {order.id} by offer_id")
-                        else:
-                            logger.warning(f"No order found for offer {offer.id}")
-                    else:
-                        logger.warning(f"Offer not found: {offer_id}")
-            
-            # If still not found, try to find by orderId from request (frontend sends it)
-            if not order and order_id_from_request:
-                logger.info(f"Trying to find order by orderId from request: {order_id_from_request}")
-                order = Order.objects(id=order_id_from_request).first()
-                if order:
-                    logger.info(f"Found order {order.id} by orderId from request")
-            
-            # If still not found, try to find by metadata order_id
-            if not order:
-                order_id = payment_data.get('metadata', {}).get('order_id') or data.get('metadata', {}).get('order_id')
-                if order_id:
-                    logger.info(f"Trying to find order by order_id from metadata: {order_id}")
-                    order = Order.objects(id=order_id).first()
-            
-            if order:
-                logger.info(f"Found order {order.id}")
-                # Create payment record if it doesn't exist
-                existing_payment = Payment.objects(moyasar_payment_id=payment_id).first()
-                if not existing_payment:
-                    # Get currency from order first, then payment_data, then default to SAR
-                    payment_currency = order.currency or payment_data.get('currency') or 'SAR'
-                    
-                    # Enhance metadata with product title and ensure isGroup is false for cart type
-                    enhanced_metadata = payment_data.copy() if isinstance(payment_data, dict) else {}
-                    if order.product_title:
-                        enhanced_metadata['product'] = order.product_title
-                    # Ensure isGroup is false for cart type (not grouped)
-                    if enhanced_metadata.get('type') == 'cart':
-                        enhanced_metadata['isGroup'] = False
-                        enhanced_metadata['isGroupOrder'] = False
-                    
-                    payment = Payment(
-                        order_id=order.id,
-                        buyer_id=order.buyer_id.id,
-                        moyasar_payment_id=payment_id,
-                        amount=float(amount) / 100 if amount else 0,
-                        currency=payment_currency,
-                        status='completed' if payment_status == 'paid' else 'pending',
-                        metadata=enhanced_metadata
-                    )
-                    payment.save()
-                    logger.info(f"Created payment record for order {order.id} with enhanced metadata")
-                else:
-                    logger.info(f"Payment record already exists: {existing_payment.id}")
-                    # Update metadata if payment exists but metadata is missing product title
-                    if existing_payment.metadata:
-                        if not existing_payment.metadata.get('product') and order.product_title:
-                            existing_payment.metadata['product'] = order.product_title
-                        # Ensure isGroup is false for cart type
-                        if existing_payment.metadata.get('type') == 'cart':
-                            existing_payment.metadata['isGroup'] = False
-                            existing_payment.metadata['isGroupOrder'] = False
-                        existing_payment.save()
-                        logger.info(f"Updated payment {existing_payment.id} metadata with product title")
-                
-                # Update order payment_id if not set
-                if not order.payment_id:
-                    order.payment_id = payment_id
-                    order.save()
-                    logger.info(f"Updated order {order.id} payment_id")
-                
-                # Update status - this will update payment, order, and offer
-                updated = MoyasarPaymentService.update_payment_status(payment_id, payment_status)
-                logger.info(f"Payment status update after creation: {updated}")
-            else:
-                logger.error(f"Could not find order for payment {payment_id}. Payment data: {payment_data}")
-                # Still return success to avoid webhook retries, but log the error
-                return Response({
-                    'success': True,
-                    'message': 'Webhook received but order not found',
-                    'data': {
-                        'payment_id': payment_id,
-                        'status': payment_status,
-                        'updated': False,
-                        'warning': 'Order not found - payment record may need manual update'
-                    }
-                }, status=status.HTTP_200_OK)
-        
-        # Final verification: Ensure offer status is updated if payment is paid
-        # Only send emails if Moyasar confirms payment status is 'paid'
-        if payment_status == 'paid':
-            from products.models import Offer as OfferModel
-            
-            # Try to find offer from order (if order exists)
-            if updated:
-                from payments.models import Payment as PaymentModel
-                from products.models import Order as OrderModel
-                payment_check = PaymentModel.objects(moyasar_payment_id=payment_id).first()
-                if payment_check and payment_check.order_id:
-                    order_check = payment_check.order_id
-                    
-                    # Send email notifications only when Moyasar confirms payment is 'paid'
-                    try:
-                        from notifications.notification_helper import NotificationHelper
-                        logger.info(f"✅ Payment confirmed as 'paid' by Moyasar - sending email notifications")
-                        # Notify seller - payment confirmed
-                        NotificationHelper.send_payment_confirmed(str(order_check.seller_id.id))
-                        # Notify seller - order needs shipping
-                        NotificationHelper.send_order_needs_shipping(str(order_check.seller_id.id))
-                        # Notify buyer - payment successful
-                        NotificationHelper.send_payment_successful(str(order_check.buyer_id.id), order_check)
-                        logger.info(f"✅ Email notifications sent successfully")
-                    except Exception as e:
-                        logger.error(f"Error sending payment notifications: {str(e)}")
-                    
-                    if order_check.offer_id:
-                        offer_check = OfferModel.objects(id=order_check.offer_id.id).first()
-                        if offer_check and offer_check.status != 'paid':
-                            logger.warning(f"Final check: Offer {offer_check.id} status is still '{offer_check.status}', forcing update")
-                            offer_check.status = 'paid'
-                            offer_check.updated_at = datetime.utcnow()
-                            offer_check.save()
-                            logger.info(f"✅ Final update: Offer {offer_check.id} status set to 'paid'")
-                        elif offer_check:
-                            logger.info(f"Final verification - Offer {offer_check.id} status: '{offer_check.status}'")
-            
-            # Also try to update offer directly from offerId if we have it
-            if offer_id_final:
-                offer_final = OfferModel.objects(id=offer_id_final).first()
-                if offer_final and offer_final.status != 'paid':
-                    logger.info(f"Final check: Updating offer {offer_final.id} status to 'paid' from offerId")
-                    offer_final.status = 'paid'
-                    offer_final.updated_at = datetime.utcnow()
-                    offer_final.save()
-                    logger.info(f"✅ Final update: Offer {offer_final.id} status set to 'paid'")
+        # Callers read the verified status and offerId from the response, never the body's status
+        summary = WebhookService.verified_summary(data)
         
         return Response({
             'success': True,
-            'message': 'Webhook processed successfully',
+            'message': 'Webhook received' if created else 'Webhook already received',
             'data': {
                 'payment_id': payment_id,
-                'status': payment_status,
-                'updated': updated,
-                'offerId': offer_id_final
+                'event': event,
+                'duplicate': not created,
+                'status': summary['status'],
+                'verified': summary['verified'],
+                'offerId': summary['offerId']
             }
         }, status=status.HTTP_200_OK)
+    except ValueError as e:
+        return Response({
+            'success': False,
+            'error': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         logger.error(f"Payment webhook error: {str(e)}", exc_info=True)
         return Response({
@@ -801,24 +412,14 @@ def verify_payment(request):
                 updated = MoyasarPaymentService.update_payment_status(moyasar_payment_id, payment_status)
                 logger.info(f"Payment status update after creation: {updated}")
                 
-                # Send order confirmation emails ONLY when payment is confirmed as 'paid'
+                # Queue order confirmation emails ONLY when payment is confirmed as 'paid'
+                # (payment confirmed/shipping/successful emails are queued by update_payment_status)
                 if payment_status == 'paid' and updated:
                     try:
-                        from notifications.notification_helper import NotificationHelper
-                        logger.info(f"✅ Payment confirmed as 'paid' by Moyasar - sending order confirmation emails")
-                        # Notify seller - item sold (only when payment is confirmed)
-                        NotificationHelper.send_item_sold(str(order.seller_id.id))
-                        # Notify buyer - order confirmation (only when payment is confirmed)
-                        NotificationHelper.send_order_confirmation(str(order.buyer_id.id), order)
-                        # Notify seller - payment confirmed
-                        NotificationHelper.send_payment_confirmed(str(order.seller_id.id))
-                        # Notify seller - order needs shipping
-                        NotificationHelper.send_order_needs_shipping(str(order.seller_id.id))
-                        # Notify buyer - payment successful
-                        NotificationHelper.send_payment_successful(str(order.buyer_id.id), order)
-                        logger.info(f"✅ All order confirmation emails sent successfully")
+                        from notifications.outbox import OutboxService
+                        OutboxService.enqueue('order_confirmed', f'order_confirmed:{order.id}', {'order_id': str(order.id)})
                     except Exception as e:
-                        logger.error(f"Error sending order confirmation emails: {str(e)}")
+                        logger.error(f"Error queueing order confirmation emails: {str(e)}")
             else:
                 logger.error(f"Could not find order for payment {moyasar_payment_id}")
         
@@ -0,0 +1,401 @@
+"""
+Moyasar webhook intake and processing.
+
+The webhook view only records a WebhookEvent (unique per payment id and event)
+and acknowledges it. Retried deliveries fail that insert and are acknowledged
+without further work, unless processing the recorded event gave up; then the
+redelivery queues it again. The outbox worker verifies the payment with Moyasar
+and applies it to payments, orders and offers exactly once. The webhook body is
+never trusted: if Moyasar cannot be reached or rejects our key, processing fails
+and is retried.
+"""
+import logging
+from datetime import datetime
+from bson import ObjectId
+from mongoengine.errors import NotUniqueError
+from payments.models import WebhookEvent
+from payments.services import MoyasarPaymentService
+
+logger = logging.getLogger(__name__)
+
+
+def _extract_error_details(payment_data):
+    """Pull the card/transaction error message and code out of a Moyasar payment"""
+    error_message = None
+    error_code = None
+
+    # Check source errors first (most common location for card errors in Moyasar)
+    if 'source' in payment_data:
+        source = payment_data.get('source', {})
+        if 'message' in source:
+            error_message = source.get('message')
+        if 'response_code' in source:
+            error_code = source.get('response_code')
+        if 'transaction' in source:
+            source_transaction = source.get('transaction', {})
+            if 'message' in source_transaction:
+                error_message = source_transaction.get('message') or error_message
+            if 'code' in source_transaction:
+                error_code = source_transaction.get('code') or error_code
+
+    # Check transaction errors
+    if not error_message and 'transaction' in payment_data:
+        transaction = payment_data.get('transaction', {})
+        error_message = transaction.get('message') or error_message
+        error_code = transaction.get('code') or error_code
+
+    # Check top-level error fields
+    if not error_message:
+        error_message = (
+            payment_data.get('message') or
+            payment_data.get('error') or
+            payment_data.get('description') or
+            payment_data.get('error_message')
+        )
+
+    # If still no error code, try response_code at top level
+    if not error_code:
+        error_code = payment_data.get('response_code') or payment_data.get('code')
+
+    return error_message, error_code
+
+
+def _mark_offer_paid(offer_id):
+    from products.models import Offer
+
+    offer = Offer.objects(id=offer_id).first()
+    if offer and offer.status != 'paid':
+        offer.status = 'paid'
+        offer.updated_at = datetime.utcnow()
+        offer.save()
+        logger.info(f"✅ Offer {offer.id} status set to 'paid'")
+    elif not offer:
+        logger.warning(f"Offer not found with ID: {offer_id}")
+
+
+class WebhookService:
+    """Record Moyasar webhook deliveries and apply them once"""
+
+    @staticmethod
+    def parse(data):
+        """Return (payment_id, event, frontend_status) from a webhook body (nested data.data or flat)"""
+        payment_data = data.get('data', data)
+        if not isinstance(payment_data, dict):
+            payment_data = data
+        payment_id = payment_data.get('id') or data.get('id')
+        frontend_status = payment_data.get('status') or data.get('status')
+        # Moyasar sends e.g. type=payment_paid; frontend calls carry only the status
+        event = data.get('type') or (f"payment_{frontend_status}" if frontend_status else 'payment_updated')
+        return payment_id, event, frontend_status
+
+    @staticmethod
+    def receive(data):
+        """
+        Persist a delivery. Returns (webhook_event, created); created is False for a
+        repeat of an already recorded (payment id, event) pair.
+        """
+        payment_id, event, _ = WebhookService.parse(data)
+        if not payment_id:
+            raise ValueError('Payment ID not found in webhook data')
+
+        from notifications.outbox import OutboxService
+
+        try:
+            webhook_event = WebhookEvent(
+                moyasar_payment_id=str(payment_id),
+                event=event,
+                payload=dict(data)
+            )
+            webhook_event.save()
+        except NotUniqueError:
+            # A delivery whose processing ran out of outbox attempts is queued again;
+            # the conditional update lets only one concurrent redelivery do so
+            webhook_event = WebhookEvent.objects(
+                moyasar_payment_id=str(payment_id), event=event, status='failed'
+            ).modify(set__status='received', new=True)
+            if not webhook_event:
+                return None, False
+            logger.info(f"Re-queueing failed webhook event {webhook_event.id} on redelivery")
+            OutboxService.enqueue(
+                'moyasar_webhook',
+                f'moyasar_webhook:{webhook_event.id}:redelivery:{ObjectId()}',
+                {'webhook_event_id': str(webhook_event.id)}
+            )
+            return webhook_event, True
+
+        OutboxService.enqueue(
+            'moyasar_webhook',
+            f'moyasar_webhook:{webhook_event.id}',
+            {'webhook_event_id': str(webhook_event.id)}
+        )
+        return webhook_event, True
+
+    @staticmethod
+    def process_event(webhook_event):
+        """Verify and apply a recorded delivery (called by the outbox worker)"""
+        if webhook_event.status == 'processed':
+            return webhook_event.result
+
+        WebhookEvent.objects(id=webhook_event.id).update_one(set__status='processing', inc__attempts=1)
+        try:
+            result = WebhookService.apply(webhook_event.payload or {})
+        except Exception as e:
+            # Back to received while the outbox retries; it marks the event failed when it gives up
+            WebhookEvent.objects(id=webhook_event.id).update_one(set__status='received', set__last_error=str(e))
+            raise
+
+        WebhookEvent.objects(id=webhook_event.id).update_one(
+            set__status='processed',
+            set__result=result,
+            set__processed_at=datetime.utcnow(),
+            unset__last_error=True
+        )
+        return result
+
+    @staticmethod
+    def _request_ids(data):
+        """(offerId, orderId) the frontend sent with the delivery, if any"""
+        payment_data = data.get('data', data)
+        if not isinstance(payment_data, dict):
+            payment_data = data
+        offer_id = data.get('offerId') or data.get('offer_id') or payment_data.get('offerId')
+        order_id = data.get('orderId') or data.get('order_id') or payment_data.get('orderId') or payment_data.get('order_id')
+        return offer_id, order_id
+
+    @staticmethod
+    def _offer_id(data, verified_payment_data):
+        """Offer id sent with the delivery, else the one in the verified payment's metadata"""
+        offer_id_from_request, _ = WebhookService._request_ids(data)
+        metadata = verified_payment_data.get('metadata', {}) or data.get('metadata', {})
+        return (
+            offer_id_from_request or
+            metadata.get('offerId') or
+            metadata.get('offer_id') or
+            verified_payment_data.get('offerId')
+        )
+
+    @staticmethod
+    def verified_summary(data):
+        """
+        {'status', 'verified', 'offerId'} for the webhook response: the payment status as
+        verified with Moyasar now (None if it could not be reached) and its offer id.
+        Applying the payment still happens in the outbox worker.
+        """
+        payment_id, _, _ = WebhookService.parse(data)
+        try:
+            verified_payment_data = MoyasarPaymentService.verify_payment_status(payment_id)
+        except Exception as e:
+            logger.warning(f"Could not verify payment {payment_id} for the webhook response: {str(e)}")
+            return {'status': None, 'verified': False, 'offerId': WebhookService._offer_id(data, {})}
+        return {
+            'status': verified_payment_data.get('status'),
+            'verified': True,
+            'offerId': WebhookService._offer_id(data, verified_payment_data)
+        }
+
+    @staticmethod
+    def apply(data):
+        """
+        Verify the payment status with Moyasar and update payment, order and offer.
+        Returns a result summary; raises on errors worth retrying.
+        """
+        payment_data = data.get('data', data)
+        if not isinstance(payment_data, dict):
+            payment_data = data
+        payment_id, _, frontend_status = WebhookService.parse(data)
+        amount = payment_data.get('amount', data.get('amount', 0))
+
+        # Extract offerId / orderId from request data if provided (frontend can send them)
+        offer_id_from_request, order_id_from_request = WebhookService._request_ids(data)
+
+        # CRITICAL: Verify payment status with Moyasar API - don't trust frontend status
+        try:
+            verified_payment_data = MoyasarPaymentService.verify_payment_status(payment_id)
+            payment_status = verified_payment_data.get('status')
+            logger.info(f"✅ Verified payment status from Moyasar: {payment_status} (webhook sent: {frontend_status})")
+
+            # Use verified payment data instead of webhook data
+            payment_data = verified_payment_data
+            amount = payment_data.get('amount', amount)
+        except Exception as e:
+            # Never fall back to the unauthenticated webhook status; the outbox retries
+            logger.error(f"❌ Failed to verify payment status with Moyasar: {str(e)}")
+            raise Exception(f'Failed to verify payment status with Moyasar: {str(e)}')
+
+        if not payment_status:
+            raise ValueError('Payment status not found in Moyasar response')
+
+        if payment_status in ['failed', 'declined', 'canceled', 'cancelled']:
+            WebhookService._apply_failed(payment_id, payment_data, offer_id_from_request)
+            return {'payment_id': payment_id, 'status': payment_status, 'updated': False}
+
+        # Update payment status using the service method (only for successful payments)
+        updated = MoyasarPaymentService.update_payment_status(payment_id, payment_status)
+
+        offer_id_final = WebhookService._offer_id(data, payment_data)
+
+        if not updated:
+            order = WebhookService._find_order(payment_id, payment_data, data, offer_id_from_request, order_id_from_request)
+            if not order:
+                logger.error(f"Could not find order for payment {payment_id}. Payment data: {payment_data}")
+                return {
+                    'payment_id': payment_id,
+                    'status': payment_status,
+                    'updated': False,
+                    'warning': 'Order not found - payment record may need manual update'
+                }
+            WebhookService._ensure_payment_record(order, payment_id, payment_status, payment_data, amount)
+
+            # Update status - this will update payment, order, and offer
+            updated = MoyasarPaymentService.update_payment_status(payment_id, payment_status)
+
+        # Ensure offer status is updated if payment is paid
+        if payment_status == 'paid':
+            if updated:
+                from payments.models import Payment
+                payment_check = Payment.objects(moyasar_payment_id=payment_id).first()
+                if payment_check and payment_check.order_id and payment_check.order_id.offer_id:
+                    _mark_offer_paid(payment_check.order_id.offer_id.id)
+            if offer_id_final:
+                _mark_offer_paid(offer_id_final)
+
+        return {
+            'payment_id': payment_id,
+            'status': payment_status,
+            'updated': bool(updated),
+            'offerId': offer_id_final
+        }
+
+    @staticmethod
+    def _find_order(payment_id, payment_data, data, offer_id_from_request, order_id_from_request):
+        """Locate the order for a payment that has no Payment record yet"""
+        from products.models import Order, Offer
+
+        order = Order.objects(payment_id=payment_id).first()
+
+        # Try offerId from metadata or request
+        if not order:
+            metadata = payment_data.get('metadata', {}) or {}
+            offer_id = offer_id_from_request or metadata.get('offerId') or metadata.get('offer_id')
+            if offer_id:
+                offer = Offer.objects(id=offer_id).first()
+                if offer:
+                    order = Order.objects(offer_id=offer.id).first()
+                else:
+                    logger.warning(f"Offer not found: {offer_id}")
+
+        # Try orderId from request (frontend sends it)
+        if not order and order_id_from_request:
+            order = Order.objects(id=order_id_from_request).first()
+
+        # Try order_id from metadata
+        if not order:
+            order_id = (payment_data.get('metadata', {}) or {}).get('order_id') or (data.get('metadata', {}) or {}).get('order_id')
+            if order_id:
+                order = Order.objects(id=order_id).first()
+
+        return order
+
+    @staticmethod
+    def _ensure_payment_record(order, payment_id, payment_status, payment_data, amount):
+        """Create (or tidy) the Payment record for an order found through the webhook"""
+        from payments.models import Payment
+
+        existing_payment = Payment.objects(moyasar_payment_id=payment_id).first()
+        if not existing_payment:
+            # Get currency from order first, then payment_data, then default to SAR
+            payment_currency = order.currency or payment_data.get('currency') or 'SAR'
+
+            # Enhance metadata with product title and ensure isGroup is false for cart type
+            enhanced_metadata = payment_data.copy() if isinstance(payment_data, dict) else {}
+            if order.product_title:
+                enhanced_metadata['product'] = order.product_title
+            if enhanced_metadata.get('type') == 'cart':
+                enhanced_metadata['isGroup'] = False
+                enhanced_metadata['isGroupOrder'] = False
+
+            Payment(
+                order_id=order.id,
+                buyer_id=order.buyer_id.id,
+                moyasar_payment_id=payment_id,
+                amount=float(amount) / 100 if amount else 0,
+                currency=payment_currency,
+                status='completed' if payment_status == 'paid' else 'pending',
+                metadata=enhanced_metadata
+            ).save()
+            logger.info(f"Created payment record for order {order.id} with enhanced metadata")
+        elif existing_payment.metadata:
+            if not existing_payment.metadata.get('product') and order.product_title:
+                existing_payment.metadata['product'] = order.product_title
+            if existing_payment.metadata.get('type') == 'cart':
+                existing_payment.metadata['isGroup'] = False
+                existing_payment.metadata['isGroupOrder'] = False
+            existing_payment.save()
+
+        # Update order payment_id if not set
+        if not order.payment_id:
+            order.payment_id = payment_id
+            order.save()
+
+    @staticmethod
+    def _apply_failed(payment_id, payment_data, offer_id_from_request):
+        """Mark the payment and order failed and email the buyer the Moyasar error"""
+        from payments.models import Payment
+        from products.models import Order, Offer
+
+        error_message, error_code = _extract_error_details(payment_data)
+        logger.info(f"Payment {payment_id} failed - message: {error_message}, code: {error_code}")
+
+        buyer_id_to_notify = None
+        failed_order_ids = []
+        payment = Payment.objects(moyasar_payment_id=payment_id).first()
+        if payment:
+            payment.status = 'failed'
+            # Store full Moyasar response in metadata for error details
+            payment.metadata = payment_data
+            payment.save()
+            failed_order_ids = [o.id for o in (payment.orders or [])]
+            if payment.order_id:
+                buyer_id_to_notify = str(payment.order_id.buyer_id.id)
+                payment.order_id.payment_status = 'failed'
+                payment.order_id.save()
+                failed_order_ids = failed_order_ids or [payment.order_id.id]
+
+        # If payment not found, try to find order by payment_id or metadata
+        if not buyer_id_to_notify:
+            metadata = payment_data.get('metadata', {}) or {}
+            order = Order.objects(payment_id=payment_id).first()
+            if not order:
+                offer_id = offer_id_from_request or metadata.get('offerId') or metadata.get('offer_id')
+                if offer_id:
+                    offer = Offer.objects(id=offer_id).first()
+                    if offer:
+                        order = Order.objects(offer_id=offer.id).first()
+            if not order:
+                order_id = metadata.get('order_id') or metadata.get('orderId')
+                if order_id:
+                    order = Order.objects(id=order_id).first()
+            if order:
+                buyer_id_to_notify = str(order.buyer_id.id)
+                order.payment_status = 'failed'
+                order.save()
+                failed_order_ids = [order.id]
+
+        # Give the held stock back
+        if failed_order_ids:
+            from products.services import ReservationService
+            ReservationService.release_for_orders(failed_order_ids)
+
+        if buyer_id_to_notify:
+            try:
+                from notifications.notification_helper import NotificationHelper
+                NotificationHelper.send_payment_failed_with_details(
+                    buyer_id=buyer_id_to_notify,
+                    error_message=error_message,
+                    error_code=error_code,
+                    moyasar_response=payment_data
+                )
+            except Exception as e:
+                logger.error(f"Error sending payment failed email: {str(e)}")
+        else:
+            logger.warning(f"Could not find buyer_id to send payment failed email for payment {payment_id}")
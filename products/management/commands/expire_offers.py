@@ -0,0 +1,34 @@
+"""
+Expire pending/countered offers whose expiration_date has passed.
+Run once from cron, or with --loop as a long-running scheduler process.
+"""
+import time
+from django.core.management.base import BaseCommand
+from products.services import OfferService
+
+
+class Command(BaseCommand):
+    help = 'Expire overdue offers and notify their chat rooms'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Offers to expire per update_many')
+        parser.add_argument('--loop', action='store_true', help='Keep running, sweeping every --interval seconds')
+        parser.add_argument('--interval', type=int, default=60, help='Seconds between sweeps with --loop')
+
+    def sweep(self, batch_size):
+        total = 0
+        while True:
+            expired = OfferService.expire_overdue_offers(batch_size=batch_size)
+            total += expired
+            if expired < batch_size:
+                return total
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        while True:
+            total = self.sweep(batch_size)
+            self.stdout.write(f'Expired {total} offer(s)')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS('Offer expiry sweep finished'))
@@ -0,0 +1,33 @@
+"""
+Rebuild seller balance documents from the seller ledger.
+With --backfill, first (re)writes ledger entries for historical orders and
+cashouts; entry keys make this safe to repeat.
+"""
+from django.core.management.base import BaseCommand
+from products.seller_service import SellerLedgerService
+
+
+class Command(BaseCommand):
+    help = 'Rebuild seller balances from the append-only seller ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seller', help='Only rebuild this seller id')
+        parser.add_argument('--backfill', action='store_true', help='Backfill ledger entries from orders and cashouts first')
+
+    def handle(self, *args, **options):
+        seller_id = options.get('seller')
+
+        if options['backfill']:
+            if seller_id:
+                seller_ids = [seller_id]
+            else:
+                from products.models import Order
+                from admin_dashboard.models import CashoutRequest
+                seller_ids = set(Order.objects(payment_status='completed').distinct('seller_id'))
+                seller_ids |= set(CashoutRequest.objects.distinct('seller_id'))
+            for sid in seller_ids:
+                SellerLedgerService.backfill_seller(getattr(sid, 'id', sid))
+            self.stdout.write(f'Backfilled ledger for {len(seller_ids)} seller(s)')
+
+        rebuilt = SellerLedgerService.rebuild_balances(seller_id=seller_id)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rebuilt} seller balance(s)'))
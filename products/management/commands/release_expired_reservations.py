@@ -0,0 +1,24 @@
+"""
+Release checkout reservations whose hold has expired.
+Run periodically (e.g. every minute from cron) so abandoned checkouts
+give their stock back to the listing.
+"""
+from django.core.management.base import BaseCommand
+from products.services import ReservationService
+
+
+class Command(BaseCommand):
+    help = 'Release expired checkout stock reservations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Reservations to release per pass')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        total = 0
+        while True:
+            released = ReservationService.release_expired(limit=batch_size)
+            total += released
+            if released < batch_size:
+                break
+        self.stdout.write(self.style.SUCCESS(f'Released {total} expired reservation(s)'))
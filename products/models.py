@@ -26,6 +26,8 @@ class Product(Document):
     original_price = FloatField()
     currency = StringField(default='SAR', max_length=10)
     quantity = IntField(default=1)
+    reserved_quantity = IntField(default=0)  # Units held by open checkout reservations
+    fully_reserved = BooleanField(default=False)  # True while every unit is held by a reservation
     gender = StringField(max_length=50)
     size = StringField(max_length=50)
     color = StringField(max_length=50)
@@ -47,7 +49,7 @@ class Product(Document):
     
     meta = {
         'collection': 'products',
-        'indexes': ['seller_id', 'category', 'status', 'created_at', 'title']
+        'indexes': ['seller_id', 'category', 'status', 'created_at', 'title', ('status', 'fully_reserved')]
     }
 
 
@@ -90,7 +92,18 @@ class Offer(Document):
     
     meta = {
         'collection': 'offers',
-        'indexes': ['product_id', 'buyer_id', 'seller_id', 'status', 'created_at']
+        'indexes': [
+            'product_id',
+            'buyer_id',
+            'seller_id',
+            'status',
+            'created_at',
+            # Keyset pagination of offer inboxes (newest first)
+            [('buyer_id', 1), ('created_at', -1), ('_id', -1)],
+            [('seller_id', 1), ('created_at', -1), ('_id', -1)],
+            # Expiry sweeper: overdue pending/countered offers
+            [('status', 1), ('expiration_date', 1)]
+        ]
     }
 
 
@@ -135,7 +148,16 @@ class Order(Document):
     
     meta = {
         'collection': 'orders',
-        'indexes': ['buyer_id', 'seller_id', 'status', 'created_at', 'order_number']
+        'indexes': [
+            'buyer_id',
+            'seller_id',
+            'status',
+            'created_at',
+            'order_number',
+            'offer_id',
+            # Money summaries over completed orders in a date range
+            [('payment_status', 1), ('created_at', 1)]
+        ]
     }
 
 
@@ -159,3 +181,25 @@ class Review(Document):
         'unique_together': [('order_id', 'buyer_id')]  # One review per order per buyer
     }
 
+
+class Reservation(Document):
+    """Stock hold taken at checkout and converted to a sale on confirmed payment"""
+    product_id = ReferenceField(Product, required=True)
+    buyer_id = ReferenceField(User, required=True)
+    order_id = ReferenceField(Order)
+    quantity = IntField(default=1, min_value=1)
+    status = StringField(choices=['held', 'converted', 'released'], default='held')
+    expires_at = DateTimeField(required=True)  # Hold is abandoned after this time
+    purge_at = DateTimeField(required=True)  # TTL: document is removed by MongoDB after this time
+    created_at = DateTimeField(default=datetime.utcnow)
+    updated_at = DateTimeField(default=datetime.utcnow)
+    
+    meta = {
+        'collection': 'reservations',
+        'indexes': [
+            'product_id',
+            'order_id',
+            ('status', 'expires_at'),
+            {'fields': ['purge_at'], 'expireAfterSeconds': 0}
+        ]
+    }
@@ -12,6 +12,7 @@ from payments.models import Payment
 import os
 from django.conf import settings
 from datetime import datetime
+from dolabb_backend.utils import parse_cursor_page_params
 
 logger = logging.getLogger(__name__)
 
@@ -59,21 +60,23 @@ def create_offer(request):
 
 @api_view(['GET'])
 def get_offers(request):
-    """Get offers"""
+    """Get offers (cursor paginated, optional ?status=pending,countered)"""
     try:
         user_id = str(request.user.id)
         user_type = 'buyer'  # Default, can be determined from user role
         if hasattr(request.user, 'role') and request.user.role == 'seller':
             user_type = 'seller'
         
-        offers = OfferService.get_offers(user_id, user_type)
+        statuses, cursor, limit = parse_cursor_page_params(request)
+        offers, next_cursor = OfferService.get_offers(user_id, user_type, statuses=statuses, cursor=cursor, limit=limit)
+        products, orders, payments, _ = OfferService.get_offer_page_relations(offers)
         
         offers_list = []
         for offer in offers:
-            product = Product.objects(id=offer.product_id.id).first()
+            product = products.get(offer.product_id.id)
             
             # Get associated order if exists
-            order = Order.objects(offer_id=offer.id).first()
+            order = orders.get(offer.id)
             
             # Get payment details if order exists OR if offer status is 'paid'
             payment_object = None
@@ -89,10 +92,8 @@ def get_offers(request):
                 moyasar_payment_id = None
                 
                 # Get Moyasar payment ID from Payment model
-                if payment_id:
-                    payment = Payment.objects(moyasar_payment_id=payment_id).first()
-                    if payment:
-                        moyasar_payment_id = payment.moyasar_payment_id
+                if payment_id and payment_id in payments:
+                    moyasar_payment_id = payment_id
                 
                 # Only add payment object when payment is completed
                 payment_object = {
@@ -127,7 +128,12 @@ def get_offers(request):
         
         response_data = {
             'success': True,
-            'offers': offers_list
+            'offers': offers_list,
+            'pagination': {
+                'limit': limit,
+                'nextCursor': next_cursor,
+                'hasMore': next_cursor is not None
+            }
         }
         
         # Log data to console for buyer profile offers section
@@ -170,6 +176,8 @@ def get_offers(request):
             print("=" * 80 + "\n")
         
         return Response(response_data, status=status.HTTP_200_OK)
+    except ValueError as e:
+        return Response({'success': False, 'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         logger.error(f"Error in get_offers: {str(e)}")
         return Response({'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -277,27 +285,23 @@ def counter_offer(request, offer_id):
 
 @api_view(['GET'])
 def get_accepted_offers(request):
-    """Get all accepted offers with payment status and order details"""
+    """Get accepted offers with payment status and order details (cursor paginated)"""
     try:
         seller_id = str(request.user.id)
         
-        # Get all accepted and paid offers for this seller
-        # Exclude new optional fields to avoid validation errors on old documents
-        fields_to_load = [
-            'id', 'product_id', 'buyer_id', 'buyer_name', 'seller_id', 'seller_name',
-            'offer_amount', 'original_price', 'shipping_cost', 'shipping_address',
-            'zip_code', 'house_number', 'status', 'expiration_date', 'counter_offer_amount',
-            'created_at', 'updated_at'
-        ]
-        offers = Offer.objects(seller_id=seller_id, status__in=['accepted', 'paid']).only(*fields_to_load).order_by('-created_at')
+        # Accepted and paid offers by default; ?status= may narrow it to one of them
+        statuses, cursor, limit = parse_cursor_page_params(request)
+        statuses = [s for s in statuses if s in ('accepted', 'paid')] or ['accepted', 'paid']
+        offers, next_cursor = OfferService.get_offers(seller_id, 'seller', statuses=statuses, cursor=cursor, limit=limit)
+        products, orders, payments, buyers = OfferService.get_offer_page_relations(offers, include_buyers=True)
         
         offers_list = []
         for offer in offers:
             # Get product details
-            product = Product.objects(id=offer.product_id.id).first()
+            product = products.get(offer.product_id.id)
             
             # Get associated order if exists
-            order = Order.objects(offer_id=offer.id).first()
+            order = orders.get(offer.id)
             
             # Get payment details if order exists
             payment_status = 'not_paid'
@@ -321,13 +325,11 @@ def get_accepted_offers(request):
                 shipment_proof = order.shipment_proof
                 
                 # Get Moyasar payment ID from Payment model
-                if payment_id:
-                    payment = Payment.objects(moyasar_payment_id=payment_id).first()
-                    if payment:
-                        moyasar_payment_id = payment.moyasar_payment_id
+                if payment_id and payment_id in payments:
+                    moyasar_payment_id = payment_id
             
             # Get buyer details
-            buyer = User.objects(id=offer.buyer_id.id).first()
+            buyer = buyers.get(offer.buyer_id.id)
             
             # Get currency from offer (stored when offer was created) or product as fallback
             offer_currency = offer.currency if hasattr(offer, 'currency') and offer.currency else (product.currency if product else 'SAR')
@@ -371,8 +373,14 @@ def get_accepted_offers(request):
         return Response({
             'success': True,
             'offers': offers_list,
-            'total': len(offers_list)
+            'pagination': {
+                'limit': limit,
+                'nextCursor': next_cursor,
+                'hasMore': next_cursor is not None
+            }
         }, status=status.HTTP_200_OK)
+    except ValueError as e:
+        return Response({'success': False, 'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         return Response({'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -599,6 +607,13 @@ def upload_shipment_proof(request, offer_id):
         order.updated_at = datetime.utcnow()
         order.save()
         
+        # Shipment proof makes the order's earnings available for payout
+        try:
+            from products.seller_service import SellerLedgerService
+            SellerLedgerService.record_shipment_proof(order)
+        except Exception as e:
+            logger.error(f"Error releasing seller earnings for order {order.id}: {str(e)}")
+        
         return Response({
             'success': True,
             'message': 'Shipment proof uploaded and order status updated to Delivered',
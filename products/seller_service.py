@@ -1,90 +1,279 @@
 """
 Seller service for earnings and payout management
+
+Ledger entries and the running balance are written in one MongoDB transaction,
+so the deployment must be a replica set (Atlas clusters are).
 """
 from datetime import datetime
+from bson import ObjectId
+from mongoengine.errors import NotUniqueError
+from pymongo.errors import DuplicateKeyError
 from products.models import Order
-from admin_dashboard.models import CashoutRequest
+from admin_dashboard.models import CashoutRequest, SellerLedgerEntry, SellerBalance
 from authentication.models import User
 
+# Bucket changes per ledger entry type, as multiples of the entry amount
+LEDGER_ENTRY_DELTAS = {
+    'sale_locked': {'locked': 1},
+    'sale_released': {'locked': -1, 'earned': 1, 'available': 1},
+    'payout_requested': {'available': -1, 'pending_payout': 1},
+    'payout_approved': {'pending_payout': -1, 'paid_out': 1},
+    'payout_rejected': {'pending_payout': -1, 'available': 1},
+    'payout_reversed': {'paid_out': -1, 'available': 1},
+}
+BALANCE_BUCKETS = ['locked', 'earned', 'available', 'pending_payout', 'paid_out']
 
-class SellerService:
-    """Seller service for earnings and payout management"""
+
+class _BalanceNotCovered(Exception):
+    """Rolls back a ledger transaction whose conditional balance update matched nothing"""
+
+
+class SellerLedgerService:
+    """Append-only seller ledger and running balances"""
     
     @staticmethod
-    def get_seller_earnings(seller_id):
+    def _deltas(entry_type, amount):
+        return {bucket: factor * amount for bucket, factor in LEDGER_ENTRY_DELTAS[entry_type].items()}
+    
+    @staticmethod
+    def _append(seller_id, entry_type, amount, entry_key, order_id=None, cashout_id=None, source='live'):
+        """Insert a ledger entry without touching the balance (backfill); returns the deltas, or None if the key was already recorded"""
+        deltas = SellerLedgerService._deltas(entry_type, float(amount or 0.0))
+        try:
+            SellerLedgerEntry(
+                seller_id=seller_id,
+                entry_key=entry_key,
+                entry_type=entry_type,
+                amount=float(amount or 0.0),
+                order_id=order_id,
+                cashout_id=cashout_id,
+                source=source,
+                **deltas
+            ).save()
+        except NotUniqueError:
+            return None
+        return deltas
+    
+    @staticmethod
+    def _write(seller_id, entry_type, amount, entry_key, order_id=None, cashout_id=None, min_available=None):
         """
-        Calculate seller earnings summary with shipment proof security:
-        - totalEarnings: Sum of seller_payout from completed orders WITH shipment_proof uploaded
-        - totalPayouts: Sum of all approved payout requests
-        - pendingPayouts: Sum of pending payout requests + orders without shipment_proof
-        - availableBalance: totalEarnings - totalPayouts - pendingPayouts
-        
-        Security: Orders without shipment_proof are NOT added to available balance
-        until seller uploads shipment proof.
+        Insert a ledger entry and $inc the seller's balance by its deltas in one transaction,
+        so the two never disagree. With min_available, the balance update only matches while
+        available covers it. Returns False (and writes nothing) if the key was already
+        recorded or the balance does not cover min_available.
         """
-        # Get all completed orders (payment_status='completed')
-        completed_orders = Order.objects(
+        deltas = SellerLedgerService._deltas(entry_type, float(amount or 0.0))
+        entry = SellerLedgerEntry(
             seller_id=seller_id,
-            payment_status='completed'
+            entry_key=entry_key,
+            entry_type=entry_type,
+            amount=float(amount or 0.0),
+            order_id=order_id,
+            cashout_id=cashout_id,
+            source='live',
+            **deltas
         )
+        entry.validate()
         
-        # Separate orders with and without shipment proof
-        orders_with_proof = []
-        orders_without_proof = []
-        
-        for order in completed_orders:
-            if order.shipment_proof and order.shipment_proof.strip():
-                # Order has shipment proof uploaded
-                orders_with_proof.append(order)
-            else:
-                # Order is pending shipment proof upload
-                orders_without_proof.append(order)
-        
-        # Calculate total earnings ONLY from orders with shipment proof
-        # This is the amount that can be withdrawn
-        total_earnings = sum(
-            float(order.seller_payout) if order.seller_payout else 0.0 
-            for order in orders_with_proof
-        )
+        balance_filter = {'seller_id': ObjectId(str(seller_id))}
+        if min_available is not None:
+            balance_filter['available'] = {'$gte': round(min_available, 2) - 0.005}  # Tolerate float drift in the running sum
+        update = {'$set': {'updated_at': datetime.utcnow()}}
+        increments = {bucket: delta for bucket, delta in deltas.items() if delta}
+        if increments:
+            update['$inc'] = increments
         
-        # Calculate pending earnings from orders without shipment proof
-        # These are "locked" until shipment proof is uploaded
-        pending_shipment_proof_amount = sum(
-            float(order.seller_payout) if order.seller_payout else 0.0
-            for order in orders_without_proof
-        )
+        entries = SellerLedgerEntry._get_collection()
+        balances = SellerBalance._get_collection()
         
-        # Get all payout requests for this seller
-        payout_requests = CashoutRequest.objects(seller_id=seller_id)
+        def write(session):
+            entries.insert_one(entry.to_mongo().to_dict(), session=session)
+            if not balances.update_one(balance_filter, update, session=session).matched_count:
+                raise _BalanceNotCovered()
         
-        # Calculate total approved payouts
-        total_payouts = sum(
-            float(req.amount) if req.status == 'approved' else 0.0
-            for req in payout_requests
+        try:
+            with entries.database.client.start_session() as session:
+                session.with_transaction(write)
+        except (DuplicateKeyError, _BalanceNotCovered):
+            return False
+        return True
+    
+    @staticmethod
+    def record(seller_id, entry_type, amount, entry_key, order_id=None, cashout_id=None):
+        """Append an entry and apply it to the running balance. Idempotent per entry_key."""
+        SellerLedgerService.ensure_balance(seller_id)
+        return SellerLedgerService._write(seller_id, entry_type, amount, entry_key, order_id, cashout_id)
+    
+    @staticmethod
+    def record_payment_completed(order):
+        """Credit a paid order as locked earnings (released at once if proof is already uploaded)"""
+        seller_id = order.seller_id.id
+        SellerLedgerService.record(
+            seller_id, 'sale_locked', order.seller_payout, f'sale_locked:{order.id}', order_id=order.id
         )
-        
-        # Calculate pending payout requests
-        pending_payout_requests = sum(
-            float(req.amount) if req.status == 'pending' else 0.0
-            for req in payout_requests
+        if order.shipment_proof and order.shipment_proof.strip():
+            SellerLedgerService.record_shipment_proof(order)
+    
+    @staticmethod
+    def record_shipment_proof(order):
+        """Move a paid order's earnings from locked to available"""
+        if order.payment_status != 'completed':
+            return False  # Released when the payment completes
+        return SellerLedgerService.record(
+            order.seller_id.id, 'sale_released', order.seller_payout, f'sale_released:{order.id}', order_id=order.id
+        )
+    
+    @staticmethod
+    def reserve_payout(seller_id, amount, cashout, entry_key=None):
+        """
+        Move amount from available to pending payout if the balance covers it.
+        The balance check, the debit and the ledger entry are one transaction.
+        """
+        SellerLedgerService.ensure_balance(seller_id)
+        return SellerLedgerService._write(
+            seller_id, 'payout_requested', amount, entry_key or f'payout_requested:{cashout.id}',
+            cashout_id=cashout.id, min_available=amount
+        )
+    
+    @staticmethod
+    def reserve_reapproval(cashout, review_id):
+        """
+        Take a rejected cashout's amount out of available again before it is re-approved.
+        review_id identifies this approval attempt. False if the balance no longer covers it.
+        """
+        return SellerLedgerService.reserve_payout(
+            cashout.seller_id.id, cashout.amount, cashout,
+            entry_key=f'payout_requested:{cashout.id}:reapproved:{review_id}'
         )
+    
+    @staticmethod
+    def release_reapproval(cashout, review_id):
+        """Return a reserve_reapproval whose approval did not go through"""
+        return SellerLedgerService.record(
+            cashout.seller_id.id, 'payout_rejected', cashout.amount,
+            f'payout_rejected:{cashout.id}:reapproved:{review_id}', cashout_id=cashout.id
+        )
+    
+    @staticmethod
+    def record_payout_reviewed(cashout, previous_status, review_id=None):
+        """
+        Settle a reviewed cashout: approved moves pending to paid out, rejected returns it.
+        Re-approving a rejected cashout must first reserve_reapproval with the same review_id.
+        """
+        seller_id = cashout.seller_id.id
+        suffix = f':reapproved:{review_id}' if review_id else ''
+        if cashout.status == 'approved':
+            return SellerLedgerService.record(
+                seller_id, 'payout_approved', cashout.amount, f'payout_approved:{cashout.id}{suffix}', cashout_id=cashout.id
+            )
+        if cashout.status == 'rejected' and previous_status == 'pending':
+            return SellerLedgerService.record(
+                seller_id, 'payout_rejected', cashout.amount, f'payout_rejected:{cashout.id}', cashout_id=cashout.id
+            )
+        if cashout.status == 'rejected' and previous_status == 'approved':
+            return SellerLedgerService.record(
+                seller_id, 'payout_reversed', cashout.amount, f'payout_reversed:{cashout.id}', cashout_id=cashout.id
+            )
+        return False
+    
+    @staticmethod
+    def ensure_balance(seller_id):
+        """Return the seller's balance, backfilling the ledger from history on first use"""
+        balance = SellerBalance.objects(seller_id=seller_id).first()
+        if balance:
+            return balance
+        SellerLedgerService.backfill_seller(seller_id)
+        return SellerBalance.objects(seller_id=seller_id).first()
+    
+    @staticmethod
+    def backfill_seller(seller_id):
+        """Write ledger entries for orders and cashouts that predate the ledger, then rebuild the balance"""
+        for order in Order.objects(seller_id=seller_id, payment_status='completed').only(
+            'id', 'seller_payout', 'shipment_proof'
+        ):
+            SellerLedgerService._append(
+                seller_id, 'sale_locked', order.seller_payout, f'sale_locked:{order.id}',
+                order_id=order.id, source='backfill'
+            )
+            if order.shipment_proof and order.shipment_proof.strip():
+                SellerLedgerService._append(
+                    seller_id, 'sale_released', order.seller_payout, f'sale_released:{order.id}',
+                    order_id=order.id, source='backfill'
+                )
+        
+        for cashout in CashoutRequest.objects(seller_id=seller_id).only('id', 'amount', 'status'):
+            SellerLedgerService._append(
+                seller_id, 'payout_requested', cashout.amount, f'payout_requested:{cashout.id}',
+                cashout_id=cashout.id, source='backfill'
+            )
+            if cashout.status == 'approved':
+                SellerLedgerService._append(
+                    seller_id, 'payout_approved', cashout.amount, f'payout_approved:{cashout.id}',
+                    cashout_id=cashout.id, source='backfill'
+                )
+            elif cashout.status == 'rejected':
+                SellerLedgerService._append(
+                    seller_id, 'payout_rejected', cashout.amount, f'payout_rejected:{cashout.id}',
+                    cashout_id=cashout.id, source='backfill'
+                )
         
-        # Total pending payouts = pending payout requests + orders waiting for shipment proof
-        pending_payouts = pending_payout_requests + pending_shipment_proof_amount
+        SellerLedgerService.rebuild_balances(seller_id=seller_id)
+    
+    @staticmethod
+    def rebuild_balances(seller_id=None):
+        """Recompute balance documents by summing the ledger. Returns the number of sellers rebuilt."""
+        match = {'seller_id': ObjectId(str(seller_id))} if seller_id else {}
+        pipeline = [
+            {'$match': match},
+            {'$group': dict(
+                {'_id': '$seller_id'},
+                **{bucket: {'$sum': f'${bucket}'} for bucket in BALANCE_BUCKETS}
+            )}
+        ]
+        rebuilt = 0
+        for row in SellerLedgerEntry.objects.aggregate(pipeline):
+            SellerBalance.objects(seller_id=row['_id']).update_one(
+                upsert=True,
+                set__updated_at=datetime.utcnow(),
+                **{f'set__{bucket}': row.get(bucket, 0.0) for bucket in BALANCE_BUCKETS}
+            )
+            rebuilt += 1
+        
+        if seller_id and not rebuilt:
+            # No history yet: create an empty balance so the next read is a point lookup
+            SellerBalance.objects(seller_id=seller_id).update_one(upsert=True, set__updated_at=datetime.utcnow())
+        return rebuilt
+
+
+class SellerService:
+    """Seller service for earnings and payout management"""
+    
+    @staticmethod
+    def get_seller_earnings(seller_id):
+        """
+        Seller earnings summary, read from the running balance (one point lookup):
+        - totalEarnings: seller_payout of completed orders WITH shipment_proof uploaded
+        - totalPayouts: Sum of all approved payout requests
+        - pendingPayouts: Sum of pending payout requests + orders without shipment_proof
+        - availableBalance: totalEarnings - totalPayouts - pending payout requests
         
-        # Calculate available balance (only from orders with shipment proof)
-        available_balance = total_earnings - total_payouts - pending_payout_requests
+        Security: Orders without shipment_proof are NOT added to available balance
+        until seller uploads shipment proof.
+        """
+        balance = SellerLedgerService.ensure_balance(seller_id)
+        locked = balance.locked if balance else 0.0
+        available_balance = balance.available if balance else 0.0
         
         # Ensure available balance is not negative
         if available_balance < 0:
             available_balance = 0.0
         
         return {
-            'totalEarnings': round(total_earnings, 2),
-            'totalPayouts': round(total_payouts, 2),
-            'pendingPayouts': round(pending_payouts, 2),
+            'totalEarnings': round(balance.earned if balance else 0.0, 2),
+            'totalPayouts': round(balance.paid_out if balance else 0.0, 2),
+            'pendingPayouts': round((balance.pending_payout if balance else 0.0) + locked, 2),
             'availableBalance': round(available_balance, 2),
-            'pendingShipmentProof': round(pending_shipment_proof_amount, 2)  # Additional info
+            'pendingShipmentProof': round(locked, 2)  # Additional info
         }
     
     @staticmethod
@@ -102,20 +291,14 @@ class SellerService:
         if not seller:
             raise ValueError("Seller not found")
         
-        # Get current earnings to validate available balance
-        earnings = SellerService.get_seller_earnings(seller_id)
-        available_balance = earnings['availableBalance']
-        
-        # Validate amount doesn't exceed available balance
-        if amount > available_balance:
-            raise ValueError("Amount exceeds available balance")
-        
         # Validate payment method
         valid_methods = ['Bank Transfer', 'PayPal', 'Stripe']
         if payment_method not in valid_methods:
             raise ValueError(f"Invalid payment method. Must be one of: {', '.join(valid_methods)}")
         
-        # Create payout request
+        # Make sure history is in the ledger before this request is added to it
+        SellerLedgerService.ensure_balance(seller.id)
+        
         payout_request = CashoutRequest(
             seller_id=seller_id,
             seller_name=seller.full_name if hasattr(seller, 'full_name') else seller.username,
@@ -125,6 +308,16 @@ class SellerService:
         )
         payout_request.save()
         
+        # Validate and debit the available balance in one conditional update
+        try:
+            reserved = SellerLedgerService.reserve_payout(seller.id, amount, payout_request)
+        except Exception:
+            payout_request.delete()
+            raise
+        if not reserved:
+            payout_request.delete()
+            raise ValueError("Amount exceeds available balance")
+        
         return payout_request
     
     @staticmethod
@@ -7,6 +7,7 @@ from rest_framework.response import Response
 from rest_framework import status
 from products.seller_service import SellerService
 from authentication.models import User
+from authentication.principal import PrincipalResolver
 
 
 @api_view(['GET', 'POST', 'PUT'])
@@ -21,7 +22,12 @@ def bank_details(request):
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        seller = request.user
+        seller = PrincipalResolver.load_account(request.user)
+        if not seller:
+            return Response(
+                {'success': False, 'error': 'User not found'},
+                status=status.HTTP_404_NOT_FOUND
+            )
         
         # GET - Return current bank details
         if request.method == 'GET':
@@ -52,6 +58,7 @@ def bank_details(request):
             seller.account_holder_name = data.get('account_holder_name') or data.get('accountHolderName')
         
         seller.save()
+        PrincipalResolver.invalidate(seller.id)
         
         # Send notification for bank details update
         try:
@@ -119,7 +126,12 @@ def request_seller_payout(request):
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        seller = request.user
+        seller = PrincipalResolver.load_account(request.user)
+        if not seller:
+            return Response(
+                {'success': False, 'error': 'User not found'},
+                status=status.HTTP_404_NOT_FOUND
+            )
         seller_id = str(seller.id)
         amount = float(request.data.get('amount', 0))
         payment_method = request.data.get('paymentMethod', 'Bank Transfer')
@@ -124,6 +124,8 @@ class ProductService:
         if seller.role == 'buyer':
             seller.role = 'seller'
             seller.save()
+            from authentication.principal import PrincipalResolver
+            PrincipalResolver.invalidate(seller.id)
             role_changed = True
         
         # Convert seller_id to ObjectId if it's a string
@@ -252,6 +254,9 @@ class ProductService:
         else:
             query = Product.objects(status='active', approved=True)
         
+        # Hide listings whose whole stock is held by open checkouts
+        query = query.filter(fully_reserved__ne=True)
+        
         if filters:
             if filters.get('category'):
                 query = query.filter(category=filters['category'])
@@ -758,6 +763,12 @@ class ProductService:
         
         product.updated_at = datetime.utcnow()
         product.save()
+        if quantity_updated:
+            ReservationService.refresh_fully_reserved(product.id)
+        
+        # Keep the title/thumbnail shown in chat inboxes current
+        from chat.services import ChatService
+        ChatService.refresh_product_snapshot(product)
         
         return product
     
@@ -1009,7 +1020,7 @@ class ProductService:
         else:
             query = Product.objects(status='active', approved=True).order_by('-created_at')
         # Return products with specified limit (default: 5)
-        products = query.limit(limit)
+        products = query.filter(fully_reserved__ne=True).limit(limit)
         return products
     
     @staticmethod
@@ -1033,7 +1044,7 @@ class ProductService:
                 base_query = Product.objects(status='active', approved=True)
             
             # Get all active products and calculate sales count for each
-            all_products = list(base_query.all())
+            all_products = list(base_query.filter(fully_reserved__ne=True))
             
             if not all_products:
                 # If no products found, return empty list
@@ -1540,8 +1551,16 @@ class OfferService:
         return offer
     
     @staticmethod
-    def get_offers(user_id, user_type='buyer'):
-        """Get offers for user"""
+    def get_offers(user_id, user_type='buyer', statuses=None, cursor=None, limit=20):
+        """
+        Get a page of offers for user, newest first.
+        statuses: optional list of offer statuses to include
+        cursor: opaque position returned as next_cursor by the previous page
+        Returns (offers, next_cursor); next_cursor is None on the last page.
+        """
+        from mongoengine import Q
+        from dolabb_backend.utils import encode_cursor, decode_cursor
+        
         # Exclude new optional fields to avoid validation errors on old documents
         # Only load fields that exist in all documents
         fields_to_load = [
@@ -1552,11 +1571,146 @@ class OfferService:
         ]
         
         if user_type == 'buyer':
-            offers = Offer.objects(buyer_id=user_id).only(*fields_to_load).order_by('-created_at')
+            query = Offer.objects(buyer_id=user_id)
         else:
-            offers = Offer.objects(seller_id=user_id).only(*fields_to_load).order_by('-created_at')
+            query = Offer.objects(seller_id=user_id)
+        
+        if statuses:
+            query = query.filter(status__in=list(statuses))
+        
+        if cursor:
+            created_at, last_id = decode_cursor(cursor)
+            query = query.filter(Q(created_at__lt=created_at) | (Q(created_at=created_at) & Q(id__lt=last_id)))
+        
+        # Fetch one extra row to know whether another page exists
+        offers = list(
+            query.only(*fields_to_load).no_dereference().order_by('-created_at', '-id').limit(limit + 1)
+        )
+        next_cursor = None
+        if len(offers) > limit:
+            offers = offers[:limit]
+            next_cursor = encode_cursor(offers[-1].created_at, offers[-1].id)
+        
+        return offers, next_cursor
+    
+    @staticmethod
+    def expire_overdue_offers(batch_size=500, now=None):
+        """
+        Move one batch of overdue pending/countered offers to 'expired' with a single
+        update_many, then tell the affected chat rooms. Returns the number expired.
+        """
+        now = now or datetime.utcnow()
+        open_statuses = ['pending', 'countered']
+        
+        candidate_ids = [
+            row['_id'] for row in Offer.objects(
+                status__in=open_statuses,
+                expiration_date__lte=now
+            ).only('id').limit(batch_size).as_pymongo()
+        ]
+        if not candidate_ids:
+            return 0
+        
+        # Status guard in the filter skips offers accepted/rejected since the read
+        expired_count = Offer.objects(id__in=candidate_ids, status__in=open_statuses).update(
+            set__status='expired',
+            set__updated_at=now
+        )
+        if expired_count:
+            expired_rows = list(Offer.objects(
+                id__in=candidate_ids,
+                status='expired',
+                updated_at=now
+            ).only('id', 'product_id', 'buyer_id', 'seller_id', 'expiration_date').as_pymongo())
+            OfferService._broadcast_expired_offers(expired_rows)
+        
+        return expired_count
+    
+    @staticmethod
+    def _broadcast_expired_offers(offer_rows):
+        """Send one offer_expired event per chat room covering all of its offers in the batch"""
+        import logging
+        from collections import defaultdict
+        from channels.layers import get_channel_layer
+        from asgiref.sync import async_to_sync
+        from chat.models import Message
+        
+        logger = logging.getLogger(__name__)
+        channel_layer = get_channel_layer()
+        if not channel_layer or not offer_rows:
+            return
+        
+        offers_by_id = {row['_id']: row for row in offer_rows}
+        offers_by_conversation = defaultdict(dict)
+        for row in Message.objects(
+            offer_id__in=list(offers_by_id.keys()),
+            message_type='offer'
+        ).only('offer_id', 'conversation_id').as_pymongo():
+            offer = offers_by_id.get(row.get('offer_id'))
+            if offer and row.get('conversation_id'):
+                offers_by_conversation[str(row['conversation_id'])][offer['_id']] = {
+                    'id': str(offer['_id']),
+                    'productId': str(offer['product_id']),
+                    'buyerId': str(offer['buyer_id']),
+                    'sellerId': str(offer['seller_id']),
+                    'status': 'expired',
+                    'expirationDate': offer['expiration_date'].isoformat() if offer.get('expiration_date') else None
+                }
+        
+        for conversation_id, offers in offers_by_conversation.items():
+            try:
+                async_to_sync(channel_layer.group_send)(
+                    f'chat_{conversation_id}',
+                    {
+                        'type': 'offer_expired',
+                        'offers': list(offers.values()),
+                        'conversationId': conversation_id
+                    }
+                )
+            except Exception as e:
+                logger.error(f"Error broadcasting expired offers to conversation {conversation_id}: {str(e)}")
+    
+    @staticmethod
+    def get_offer_page_relations(offers, include_buyers=False):
+        """
+        Load the products, orders, payments and (optionally) buyers for a page of offers
+        with one query per collection. Returns dicts keyed by ObjectId; orders by offer id.
+        """
+        from payments.models import Payment
+        
+        offer_ids = [offer.id for offer in offers]
+        product_ids = {offer.product_id.id for offer in offers if offer.product_id}
+        
+        products = {
+            product.id: product
+            for product in Product.objects(id__in=product_ids).only(
+                'title', 'images', 'price', 'original_price', 'currency'
+            )
+        } if product_ids else {}
+        
+        orders = {}
+        if offer_ids:
+            for order in Order.objects(offer_id__in=offer_ids).only(
+                'offer_id', 'status', 'payment_status', 'payment_id', 'shipment_proof'
+            ).no_dereference():
+                orders.setdefault(order.offer_id.id, order)
+        
+        payment_ids = {order.payment_id for order in orders.values() if order.payment_id}
+        payments = {
+            row['moyasar_payment_id']: row
+            for row in Payment.objects(moyasar_payment_id__in=payment_ids).only('moyasar_payment_id').as_pymongo()
+        } if payment_ids else {}
+        
+        buyers = {}
+        if include_buyers:
+            buyer_ids = {offer.buyer_id.id for offer in offers if offer.buyer_id}
+            if buyer_ids:
+                buyers = {
+                    buyer.id: buyer
+                    for buyer in User.objects(id__in=buyer_ids).only('full_name', 'email', 'phone')
+                }
         
-        return offers
+        return products, orders, payments, buyers
     
     @staticmethod
     def accept_offer(offer_id, seller_id):
@@ -1568,23 +1722,7 @@ class OfferService:
         offer.status = 'accepted'
         offer.updated_at = datetime.utcnow()
         offer.save()
-        
-        # Update product quantity - deduct 1 when offer is accepted
-        if offer.product_id:
-            product = Product.objects(id=offer.product_id.id).first()
-            if product:
-                # Deduct 1 from quantity
-                if product.quantity is None or product.quantity <= 0:
-                    product.quantity = 0
-                else:
-                    product.quantity -= 1
-                
-                # Mark as sold if quantity reaches 0
-                if product.quantity <= 0:
-                    product.status = 'sold'
-                
-                product.updated_at = datetime.utcnow()
-                product.save()
+        OfferService._deduct_accepted_unit(offer)
         
         # Send notification to buyer - offer accepted
         try:
@@ -1600,6 +1738,55 @@ class OfferService:
         
         return offer
     
+    @staticmethod
+    def accept_counter_offer(offer_id, buyer_id):
+        """Buyer accepts the seller's counter offer"""
+        offer = Offer.objects(id=offer_id, buyer_id=buyer_id).first()
+        if not offer:
+            raise ValueError("Offer not found")
+        if offer.status != 'countered':
+            raise ValueError("Offer is not in countered status")
+        
+        offer.status = 'accepted'
+        offer.updated_at = datetime.utcnow()
+        offer.save()
+        OfferService._deduct_accepted_unit(offer)
+        
+        # Send notification to buyer with payment button (same as when seller accepts)
+        try:
+            from notifications.notification_helper import NotificationHelper
+            NotificationHelper.send_offer_accepted(
+                str(buyer_id),
+                offer_id=str(offer.id),
+                product_id=str(offer.product_id.id) if offer.product_id else None
+            )
+        except Exception as e:
+            import logging
+            logging.error(f"Error sending offer accepted notification for counter offer: {str(e)}")
+        
+        return offer
+    
+    @staticmethod
+    def _deduct_accepted_unit(offer):
+        """Deduct 1 from the product's quantity for an accepted offer and refresh its reserved state"""
+        if not offer.product_id:
+            return
+        product = Product.objects(id=offer.product_id.id).first()
+        if not product:
+            return
+        if product.quantity is None or product.quantity <= 0:
+            product.quantity = 0
+        else:
+            product.quantity -= 1
+        
+        # Mark as sold if quantity reaches 0
+        if product.quantity <= 0:
+            product.status = 'sold'
+        
+        product.updated_at = datetime.utcnow()
+        product.save()
+        ReservationService.refresh_fully_reserved(product.id)
+    
     @staticmethod
     def reject_offer(offer_id, seller_id):
         """Reject offer"""
@@ -1783,30 +1970,9 @@ class OrderService:
         - Fee percentage (for amounts > threshold_amount_1 and <= threshold_amount_2)
         - Maximum fee (for amounts > threshold_amount_2)
         """
-        from admin_dashboard.models import FeeSettings
-        
-        # Get fee settings from database
-        settings = FeeSettings.objects().first()
-        if not settings:
-            # Use defaults if settings don't exist
-            minimum_fee = 5.0
-            fee_percentage = 5.0
-            threshold_1 = 100.0
-            threshold_2 = 2000.0
-            maximum_fee = 100.0
-        else:
-            minimum_fee = settings.minimum_fee
-            fee_percentage = settings.fee_percentage
-            threshold_1 = settings.threshold_amount_1
-            threshold_2 = settings.threshold_amount_2
-            maximum_fee = settings.maximum_fee
-        
-        if order_amount <= threshold_1:
-            return round(minimum_fee, 2)
-        elif order_amount <= threshold_2:
-            return round(order_amount * (fee_percentage / 100.0), 2)
-        else:
-            return round(maximum_fee, 2)
+        from admin_dashboard.fee_snapshot import get_fee_snapshot
+        
+        return get_fee_snapshot().platform_fees([order_amount])[0]
     
     @staticmethod
     def calculate_affiliate_commission(platform_fee, affiliate=None):
@@ -1814,27 +1980,35 @@ class OrderService:
         Calculate affiliate commission based on affiliate's commission rate or default
         If affiliate has individual commission rate (and it's not '0'), use it; otherwise use default from settings
         """
-        from admin_dashboard.models import FeeSettings
+        from admin_dashboard.fee_snapshot import get_fee_snapshot
         
-        # Get default commission percentage from settings
-        settings = FeeSettings.objects().first()
-        if settings:
-            default_commission_percentage = settings.default_affiliate_commission_percentage
-        else:
-            default_commission_percentage = 25.0  # Default 25%
-        
-        # Use affiliate's individual commission rate if available and valid, otherwise use default
-        commission_percentage = default_commission_percentage
-        if affiliate and affiliate.commission_rate:
-            try:
-                affiliate_rate = float(affiliate.commission_rate)
-                # Only use affiliate's rate if it's greater than 0 (0 means use default)
-                if affiliate_rate > 0:
-                    commission_percentage = affiliate_rate
-            except (ValueError, TypeError):
-                pass  # Use default if conversion fails
+        return get_fee_snapshot().affiliate_commissions([platform_fee], [affiliate] if affiliate else None)[0]
+    
+    @staticmethod
+    def calculate_fees_bulk(order_amounts, affiliates=None):
+        """
+        Calculate platform fee, affiliate commission and seller payout (before shipping)
+        for many order amounts against a single fee settings snapshot.
+        affiliates: optional list parallel to order_amounts (None entries earn no commission)
+        """
+        from admin_dashboard.fee_snapshot import get_fee_snapshot
         
-        return round(platform_fee * (commission_percentage / 100.0), 2)
+        snapshot = get_fee_snapshot()
+        fees = snapshot.platform_fees(order_amounts)
+        if affiliates is None:
+            commissions = [0.0] * len(fees)
+        else:
+            commissions = snapshot.affiliate_commissions(fees, affiliates)
+        
+        return [
+            {
+                'amount': amount,
+                'platformFee': fee,
+                'affiliateCommission': commission,
+                'sellerPayout': round(amount - fee, 2)
+            }
+            for amount, fee, commission in zip(order_amounts, fees, commissions)
+        ]
     
     @staticmethod
     def generate_order_number():
@@ -1865,6 +2039,7 @@ class OrderService:
             if not affiliate:
                 affiliate_code = None  # Invalid affiliate code, ignore it
         
+        order_oid = None  # Set once cart stock is held for this order
         if 'offerId' in data and data['offerId']:
             # Order from offer
             offer = Offer.objects(id=data['offerId']).first()
@@ -1927,18 +2102,27 @@ class OrderService:
             product = products_in_cart[0]
             product_id = str(product.id)
             seller = User.objects(id=str(product.seller_id.id)).first()
+            if not seller:
+                raise ValueError("Seller not found")
+            
+            # Hold the stock until payment is confirmed so a second buyer cannot pay for
+            # the same units. Offer checkouts skip this: accepting the offer already
+            # deducted the quantity.
+            order_oid = ObjectId()
+            ReservationService.reserve_for_checkout(cart_items, buyer_id, order_oid)
         
         # Create order
         if 'offerId' in data and data['offerId'] or (product is not None and seller is not None):
             # Calculate platform fee (based on base amount, not including shipping)
-            platform_fee = OrderService.calculate_platform_fee(base_amount)
-            
-            # Calculate affiliate commission (using affiliate's individual rate or default)
+            # and affiliate commission (using affiliate's individual rate or default)
             # IMPORTANT: Affiliate commission is calculated from platform fee, NOT from order fee
             # The commission comes from the platform's revenue, not from the seller's payout
-            affiliate_commission = 0.0
-            if affiliate and affiliate_code:
-                affiliate_commission = OrderService.calculate_affiliate_commission(platform_fee, affiliate)
+            pricing = OrderService.calculate_fees_bulk(
+                [base_amount],
+                [affiliate if affiliate and affiliate_code else None]
+            )[0]
+            platform_fee = pricing['platformFee']
+            affiliate_commission = pricing['affiliateCommission']
             
             # Calculate seller payout (subtotal - platform fee)
             # NOTE: Affiliate commission is NOT deducted from seller payout
@@ -1975,6 +2159,7 @@ class OrderService:
                 # Get currency from product
                 order_currency = product.currency if product and hasattr(product, 'currency') and product.currency else 'SAR'
                 order = Order(
+                    id=order_oid,
                     order_number=order_number,
                     buyer_id=buyer_id,
                     buyer_name=buyer.full_name,
@@ -2002,7 +2187,13 @@ class OrderService:
             order.country = address.get('country', '')
             order.additional_info = address.get('additionalInfo', '')
             
-            order.save()
+            try:
+                order.save()
+            except Exception:
+                # Give the held stock back at once rather than when the holds expire
+                if order_oid:
+                    ReservationService.release_for_orders([order_oid])
+                raise
             
             # DO NOT send notifications here - emails will be sent only when payment is confirmed as 'paid'
             # This prevents sending "order created" and "item sold" emails for failed payments
@@ -2012,17 +2203,10 @@ class OrderService:
             if affiliate and affiliate_code and affiliate_commission > 0:
                 try:
                     from affiliates.models import AffiliateTransaction
-                    from admin_dashboard.models import FeeSettings
+                    from admin_dashboard.fee_snapshot import get_fee_snapshot
                     
                     # Get the commission rate that was used
-                    settings = FeeSettings.objects().first()
-                    if affiliate and affiliate.commission_rate:
-                        try:
-                            used_commission_rate = float(affiliate.commission_rate)
-                        except (ValueError, TypeError):
-                            used_commission_rate = settings.default_affiliate_commission_percentage if settings else 25.0
-                    else:
-                        used_commission_rate = settings.default_affiliate_commission_percentage if settings else 25.0
+                    used_commission_rate = get_fee_snapshot().commission_percentage(affiliate)
                     
                     # Get currency from order
                     order_currency = order.currency if hasattr(order, 'currency') and order.currency else 'SAR'
@@ -2256,25 +2440,28 @@ class OrderService:
         order.updated_at = datetime.utcnow()
         order.save()
         
-        # Send notifications based on status change
-        try:
-            from notifications.notification_helper import NotificationHelper
-            if status == 'cancelled' and old_status != 'cancelled':
-                # Notify buyer - order canceled
-                NotificationHelper.send_order_canceled(str(order.buyer_id.id))
-                # Notify seller - buyer rejected order
-                NotificationHelper.send_buyer_rejected_order(str(order.seller_id.id))
-        except Exception as e:
-            import logging
-            logging.error(f"Error sending order cancellation notifications: {str(e)}")
-        
-        # Reload order to get latest state
-        order.reload()
-        
-        # Update affiliate earnings if shipment_proof is uploaded AND review already exists
-        # This handles the case where seller uploads shipment_proof after buyer has reviewed
-        if shipment_proof and shipment_proof.strip() and order.review_submitted:
-            OrderService.update_affiliate_earnings_on_review_and_shipment(order)
+        # Shipment proof makes the order's earnings available for payout
+        if shipment_proof:
+            try:
+                from products.seller_service import SellerLedgerService
+                SellerLedgerService.record_shipment_proof(order)
+            except Exception as e:
+                import logging
+                logging.error(f"Error releasing seller earnings for order {order.id}: {str(e)}")
+        
+        # Cancellation notifications and affiliate updates (when shipment proof arrives after
+        # the buyer's review) run from the outbox worker
+        from notifications.outbox import OutboxService
+        OutboxService.enqueue(
+            'order_status_changed',
+            f'order_status_changed:{order.id}:{order.updated_at.isoformat()}',
+            {
+                'order_id': str(order.id),
+                'old_status': old_status,
+                'new_status': status,
+                'shipment_proof_uploaded': bool(shipment_proof and shipment_proof.strip())
+            }
+        )
         
         return order
 
@@ -2434,3 +2621,198 @@ class ReviewService:
             'rating_distribution': rating_distribution
         }
 
+
+
+class ReservationService:
+    """Checkout stock reservations"""
+    
+    # Purged reservations are kept this long after expiry so the release sweep
+    # can still return their units to the product before MongoDB's TTL monitor
+    # deletes them.
+    PURGE_GRACE = timedelta(days=1)
+    
+    @staticmethod
+    def _hold_expression(delta):
+        """Pipeline $set that moves reserved_quantity by delta and refreshes fully_reserved"""
+        reserved = {'$max': [{'$add': [{'$ifNull': ['$reserved_quantity', 0]}, delta]}, 0]}
+        return {
+            'reserved_quantity': reserved,
+            'fully_reserved': {'$gte': [reserved, {'$ifNull': ['$quantity', 1]}]},
+            'updated_at': datetime.utcnow()
+        }
+    
+    @staticmethod
+    def refresh_fully_reserved(product_id):
+        """Recompute fully_reserved after the product's quantity was changed outside this service"""
+        Product._get_collection().update_one(
+            {'_id': ObjectId(str(product_id))},
+            [{'$set': ReservationService._hold_expression(0)}]
+        )
+    
+    @staticmethod
+    def reserve(product_id, buyer_id, quantity=1, order_id=None):
+        """
+        Hold stock for a checkout.
+        The availability check and the hold are one findAndModify on the product _id,
+        so two buyers can never both hold the last unit.
+        Returns the Reservation, or None if the stock is already sold or held.
+        """
+        from products.models import Reservation
+        
+        product_oid = ObjectId(str(product_id))
+        reserved = {'$ifNull': ['$reserved_quantity', 0]}
+        held = Product._get_collection().find_one_and_update(
+            {
+                '_id': product_oid,
+                'status': 'active',
+                '$expr': {'$lte': [{'$add': [reserved, quantity]}, {'$ifNull': ['$quantity', 1]}]}
+            },
+            [{'$set': ReservationService._hold_expression(quantity)}],
+            projection={'_id': 1}
+        )
+        if not held:
+            return None
+        
+        now = datetime.utcnow()
+        expires_at = now + timedelta(minutes=getattr(settings, 'RESERVATION_HOLD_MINUTES', 15))
+        try:
+            reservation = Reservation(
+                product_id=product_oid,
+                buyer_id=buyer_id,
+                order_id=order_id,
+                quantity=quantity,
+                expires_at=expires_at,
+                purge_at=expires_at + ReservationService.PURGE_GRACE
+            )
+            reservation.save()
+        except Exception:
+            # Give the units back if the hold could not be recorded
+            Product._get_collection().update_one(
+                {'_id': product_oid},
+                [{'$set': ReservationService._hold_expression(-quantity)}]
+            )
+            raise
+        return reservation
+    
+    @staticmethod
+    def reserve_for_checkout(product_ids, buyer_id, order_id):
+        """
+        Hold every product in a checkout, releasing expired holds on contended products once.
+        Raises ValueError (after returning any units already held) if an item is unavailable.
+        """
+        from collections import Counter
+        
+        reservations = []
+        for product_id, quantity in Counter(str(pid) for pid in product_ids).items():
+            reservation = ReservationService.reserve(product_id, buyer_id, quantity, order_id)
+            if reservation is None and ReservationService.release_expired(product_id=product_id):
+                reservation = ReservationService.reserve(product_id, buyer_id, quantity, order_id)
+            if reservation is None:
+                for held in reservations:
+                    ReservationService.release(held.id)
+                raise ValueError("One of the products in cart is no longer available")
+            reservations.append(reservation)
+        return reservations
+    
+    @staticmethod
+    def release(reservation_id):
+        """Release a held reservation and return its units to the product"""
+        from products.models import Reservation
+        
+        reservation = Reservation.objects(id=reservation_id, status='held').modify(
+            set__status='released',
+            set__updated_at=datetime.utcnow()
+        )
+        if not reservation:
+            return False
+        Product._get_collection().update_one(
+            {'_id': reservation.to_mongo()['product_id']},
+            [{'$set': ReservationService._hold_expression(-reservation.quantity)}]
+        )
+        return True
+    
+    @staticmethod
+    def release_expired(product_id=None, limit=500):
+        """Release abandoned holds whose expiry has passed. Returns the number released."""
+        from products.models import Reservation
+        
+        query = Reservation.objects(status='held', expires_at__lte=datetime.utcnow())
+        if product_id:
+            query = query.filter(product_id=product_id)
+        
+        released = 0
+        for row in query.only('id').limit(limit).as_pymongo():
+            if ReservationService.release(row['_id']):
+                released += 1
+        return released
+    
+    @staticmethod
+    def release_for_orders(order_ids):
+        """Release every hold still held for these orders (payment failed or was cancelled)"""
+        from products.models import Reservation
+        
+        released = 0
+        for row in Reservation.objects(order_id__in=order_ids, status='held').only('id').as_pymongo():
+            if ReservationService.release(row['_id']):
+                released += 1
+        return released
+    
+    @staticmethod
+    def _sell(product_oid, sold, held):
+        """
+        Deduct sold units (held of them from reserved_quantity). Units that are no longer
+        held must come from unreserved stock; returns False when there is not enough.
+        """
+        quantity = {'$ifNull': ['$quantity', 1]}
+        current_reserved = {'$ifNull': ['$reserved_quantity', 0]}
+        remaining = {'$max': [{'$subtract': [quantity, sold]}, 0]}
+        reserved = {'$max': [{'$subtract': [current_reserved, held]}, 0]}
+        query = {'_id': product_oid}
+        if sold > held:
+            query['$expr'] = {'$gte': [{'$subtract': [quantity, current_reserved]}, sold - held]}
+        result = Product._get_collection().update_one(query, [{'$set': {
+            'quantity': remaining,
+            'reserved_quantity': reserved,
+            'fully_reserved': {'$gte': [reserved, remaining]},
+            'status': {'$cond': [{'$lte': [remaining, 0]}, 'sold', '$status']},
+            'updated_at': datetime.utcnow()
+        }}])
+        return result.modified_count > 0
+    
+    @staticmethod
+    def convert_for_order(order):
+        """
+        Turn an order's reservations into a sale once payment is confirmed.
+        Safe to call repeatedly; each reservation is converted at most once.
+        A hold that expired and was released before payment is only converted if its
+        units are still free; otherwise it stays released and is logged for follow-up,
+        so a late payment can never sell units another buyer now holds.
+        """
+        import logging
+        from products.models import Reservation
+        
+        logger = logging.getLogger(__name__)
+        converted = 0
+        for row in Reservation.objects(order_id=order.id, status__in=['held', 'released']).only('id').as_pymongo():
+            # modify() returns the document as it was before the update
+            reservation = Reservation.objects(id=row['_id'], status__in=['held', 'released']).modify(
+                set__status='converted',
+                set__updated_at=datetime.utcnow()
+            )
+            if not reservation:
+                continue
+            
+            sold = reservation.quantity
+            held = sold if reservation.status == 'held' else 0
+            product_oid = reservation.to_mongo()['product_id']
+            if not ReservationService._sell(product_oid, sold, held):
+                Reservation.objects(id=row['_id'], status='converted').update_one(
+                    set__status='released', set__updated_at=datetime.utcnow()
+                )
+                logger.error(
+                    f"Order {order.id} was paid after its hold expired and product {product_oid} "
+                    f"no longer has {sold} free unit(s); stock not deducted"
+                )
+                continue
+            converted += 1
+        return converted
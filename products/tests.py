@@ -0,0 +1,623 @@
+"""
+Product service tests.
+
+MongoDB is not needed: collection calls are mocked, and the aggregation
+expressions the services send are evaluated against plain dicts with
+evaluate() so the stock arithmetic itself is checked.
+"""
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+from bson import ObjectId
+from django.test import SimpleTestCase
+from pymongo.errors import DuplicateKeyError
+from rest_framework.test import APIRequestFactory, force_authenticate
+from authentication.principal import UserPrincipal
+from dolabb_backend.utils import encode_cursor, decode_cursor, parse_cursor_page_params
+from products.models import Product, Reservation
+from products.services import ReservationService, OfferService, OrderService
+from products.seller_service import SellerLedgerService, SellerService
+from admin_dashboard.models import SellerLedgerEntry, SellerBalance
+from products import user_views
+
+
+def evaluate(expr, doc):
+    """Evaluate the subset of aggregation expressions used by the services against doc"""
+    if isinstance(expr, str) and expr.startswith('$'):
+        return doc.get(expr[1:])
+    if isinstance(expr, list):
+        return [evaluate(item, doc) for item in expr]
+    if not isinstance(expr, dict) or len(expr) != 1 or not next(iter(expr)).startswith('$'):
+        return expr
+    op, args = next(iter(expr.items()))
+    if op == '$ifNull':
+        value = evaluate(args[0], doc)
+        return evaluate(args[1], doc) if value is None else value
+    if op == '$cond':
+        return evaluate(args[1], doc) if evaluate(args[0], doc) else evaluate(args[2], doc)
+    values = evaluate(args, doc)
+    if op == '$add':
+        return sum(values)
+    if op == '$subtract':
+        return values[0] - values[1]
+    if op == '$max':
+        return max(values)
+    if op == '$gte':
+        return values[0] >= values[1]
+    if op == '$lte':
+        return values[0] <= values[1]
+    raise NotImplementedError(op)
+
+
+def apply_set(stage, doc):
+    """Apply a pipeline {'$set': {...}} stage to a copy of doc"""
+    updated = dict(doc)
+    updated.update({field: evaluate(expr, doc) for field, expr in stage['$set'].items()})
+    return updated
+
+
+class ReservationHoldTests(SimpleTestCase):
+    """Holds never take more units than are free, and fully_reserved follows them"""
+
+    def test_hold_expression_tracks_fully_reserved(self):
+        product = {'quantity': 2, 'reserved_quantity': 1}
+        held = apply_set({'$set': ReservationService._hold_expression(1)}, product)
+        self.assertEqual(held['reserved_quantity'], 2)
+        self.assertTrue(held['fully_reserved'])
+
+        released = apply_set({'$set': ReservationService._hold_expression(-5)}, held)
+        self.assertEqual(released['reserved_quantity'], 0)
+        self.assertFalse(released['fully_reserved'])
+
+    def test_refresh_fully_reserved_after_quantity_edit(self):
+        collection = mock.MagicMock()
+        product_id = ObjectId()
+        with mock.patch.object(Product, '_get_collection', return_value=collection):
+            ReservationService.refresh_fully_reserved(product_id)
+
+        query, pipeline = collection.update_one.call_args[0]
+        self.assertEqual(query, {'_id': product_id})
+        # The seller lowered the quantity to the units already held
+        self.assertTrue(apply_set(pipeline[0], {'quantity': 1, 'reserved_quantity': 1})['fully_reserved'])
+        self.assertFalse(apply_set(pipeline[0], {'quantity': 3, 'reserved_quantity': 1})['fully_reserved'])
+
+    def test_reserve_only_matches_free_units(self):
+        collection = mock.MagicMock()
+        collection.find_one_and_update.return_value = None
+        with mock.patch.object(Product, '_get_collection', return_value=collection), \
+                mock.patch.object(Reservation, 'save') as save:
+            self.assertIsNone(ReservationService.reserve(ObjectId(), ObjectId(), 1))
+        save.assert_not_called()
+
+        query = collection.find_one_and_update.call_args[0][0]
+        self.assertEqual(query['status'], 'active')
+        self.assertFalse(evaluate(query['$expr'], {'quantity': 1, 'reserved_quantity': 1}))
+        self.assertTrue(evaluate(query['$expr'], {'quantity': 2, 'reserved_quantity': 1}))
+        self.assertTrue(evaluate(query['$expr'], {}))  # Legacy product: one unit, none held
+
+    def test_reserve_returns_units_when_the_hold_cannot_be_saved(self):
+        collection = mock.MagicMock()
+        collection.find_one_and_update.return_value = {'_id': ObjectId()}
+        with mock.patch.object(Product, '_get_collection', return_value=collection), \
+                mock.patch.object(Reservation, 'save', side_effect=RuntimeError('write failed')):
+            with self.assertRaises(RuntimeError):
+                ReservationService.reserve(ObjectId(), ObjectId(), 2)
+
+        pipeline = collection.update_one.call_args[0][1]
+        restored = apply_set(pipeline[0], {'quantity': 2, 'reserved_quantity': 2})
+        self.assertEqual(restored['reserved_quantity'], 0)
+
+    def test_checkout_releases_earlier_holds_when_an_item_is_unavailable(self):
+        first = mock.Mock(id=ObjectId())
+        first_id, second_id = str(ObjectId()), str(ObjectId())
+        with mock.patch.object(ReservationService, 'reserve', side_effect=[first, None]), \
+                mock.patch.object(ReservationService, 'release_expired', return_value=0), \
+                mock.patch.object(ReservationService, 'release') as release:
+            with self.assertRaises(ValueError):
+                ReservationService.reserve_for_checkout([first_id, second_id], ObjectId(), ObjectId())
+        release.assert_called_once_with(first.id)
+
+    def test_checkout_retries_once_after_releasing_expired_holds(self):
+        reservation = mock.Mock(id=ObjectId())
+        product_id = str(ObjectId())
+        with mock.patch.object(ReservationService, 'reserve', side_effect=[None, reservation]) as reserve, \
+                mock.patch.object(ReservationService, 'release_expired', return_value=1) as release_expired:
+            held = ReservationService.reserve_for_checkout([product_id], ObjectId(), ObjectId())
+        self.assertEqual(held, [reservation])
+        self.assertEqual(reserve.call_count, 2)
+        release_expired.assert_called_once_with(product_id=product_id)
+
+
+class ReservationExpiryTests(SimpleTestCase):
+    """Expired holds are released once and their units returned"""
+
+    def test_release_expired_selects_only_expired_held_reservations(self):
+        rows = [{'_id': ObjectId()}, {'_id': ObjectId()}]
+        objects = mock.MagicMock()
+        objects.return_value.only.return_value.limit.return_value.as_pymongo.return_value = rows
+        before = datetime.utcnow()
+        with mock.patch.object(Reservation, 'objects', objects), \
+                mock.patch.object(ReservationService, 'release', side_effect=[True, False]) as release:
+            released = ReservationService.release_expired()
+
+        self.assertEqual(released, 1)  # The second was released concurrently
+        filters = objects.call_args[1]
+        self.assertEqual(filters['status'], 'held')
+        self.assertGreaterEqual(filters['expires_at__lte'], before)
+        self.assertEqual([c[0][0] for c in release.call_args_list], [row['_id'] for row in rows])
+
+    def test_release_is_conditional_on_the_hold_still_being_held(self):
+        objects = mock.MagicMock()
+        objects.return_value.modify.return_value = None
+        collection = mock.MagicMock()
+        with mock.patch.object(Reservation, 'objects', objects), \
+                mock.patch.object(Product, '_get_collection', return_value=collection):
+            self.assertFalse(ReservationService.release(ObjectId()))
+        self.assertEqual(objects.call_args[1]['status'], 'held')
+        collection.update_one.assert_not_called()
+
+    def test_release_for_orders_releases_each_held_reservation(self):
+        rows = [{'_id': ObjectId()}]
+        objects = mock.MagicMock()
+        objects.return_value.only.return_value.as_pymongo.return_value = rows
+        order_id = ObjectId()
+        with mock.patch.object(Reservation, 'objects', objects), \
+                mock.patch.object(ReservationService, 'release', return_value=True) as release:
+            self.assertEqual(ReservationService.release_for_orders([order_id]), 1)
+        self.assertEqual(objects.call_args[1], {'order_id__in': [order_id], 'status': 'held'})
+        release.assert_called_once_with(rows[0]['_id'])
+
+
+class ReservationConversionTests(SimpleTestCase):
+    """Paid orders sell their held units; late payments never oversell"""
+
+    def _sell(self, sold, held, modified=1):
+        collection = mock.MagicMock()
+        collection.update_one.return_value.modified_count = modified
+        with mock.patch.object(Product, '_get_collection', return_value=collection):
+            result = ReservationService._sell(ObjectId(), sold, held)
+        query, pipeline = collection.update_one.call_args[0]
+        return result, query, pipeline
+
+    def test_selling_a_held_unit_needs_no_free_stock(self):
+        result, query, pipeline = self._sell(1, 1)
+        self.assertTrue(result)
+        self.assertNotIn('$expr', query)
+        product = apply_set(pipeline[0], {'quantity': 1, 'reserved_quantity': 1, 'status': 'active'})
+        self.assertEqual(product['quantity'], 0)
+        self.assertEqual(product['reserved_quantity'], 0)
+        self.assertEqual(product['status'], 'sold')
+
+    def test_selling_a_released_unit_requires_free_stock(self):
+        result, query, pipeline = self._sell(1, 0, modified=0)
+        self.assertFalse(result)
+        # Another buyer holds the only unit: the update must not match
+        self.assertFalse(evaluate(query['$expr'], {'quantity': 1, 'reserved_quantity': 1}))
+        self.assertTrue(evaluate(query['$expr'], {'quantity': 2, 'reserved_quantity': 1}))
+        product = apply_set(pipeline[0], {'quantity': 2, 'reserved_quantity': 1, 'status': 'active'})
+        self.assertEqual((product['quantity'], product['reserved_quantity']), (1, 1))
+        self.assertTrue(product['fully_reserved'])
+        self.assertEqual(product['status'], 'active')
+
+    def _convert(self, previous_status, sold):
+        rows = [{'_id': ObjectId()}]
+        reservation = mock.Mock(quantity=1, status=previous_status)
+        reservation.to_mongo.return_value = {'product_id': ObjectId()}
+        objects = mock.MagicMock()
+        objects.return_value.only.return_value.as_pymongo.return_value = rows
+        objects.return_value.modify.return_value = reservation
+        with mock.patch.object(Reservation, 'objects', objects), \
+                mock.patch.object(ReservationService, '_sell', return_value=sold) as sell:
+            converted = ReservationService.convert_for_order(mock.Mock(id=ObjectId()))
+        return converted, objects, sell
+
+    def test_convert_sells_held_units_from_the_reservation(self):
+        converted, objects, sell = self._convert('held', True)
+        self.assertEqual(converted, 1)
+        self.assertEqual(sell.call_args[0][1:], (1, 1))
+        objects.return_value.update_one.assert_not_called()
+
+    def test_convert_reverts_a_released_hold_when_its_units_are_gone(self):
+        with self.assertLogs('products.services', 'ERROR'):
+            converted, objects, sell = self._convert('released', False)
+        self.assertEqual(converted, 0)
+        self.assertEqual(sell.call_args[0][1:], (1, 0))
+        objects.return_value.update_one.assert_called_once()
+        self.assertEqual(objects.return_value.update_one.call_args[1]['set__status'], 'released')
+
+
+class OfferAcceptStockTests(SimpleTestCase):
+    """Both accept paths deduct a unit and refresh the reserved state"""
+
+    def test_counter_offer_accept_deducts_and_refreshes_fully_reserved(self):
+        product = mock.Mock(id=ObjectId(), quantity=2, status='active')
+        offer = mock.Mock(id=ObjectId(), status='countered')
+        offer_objects = mock.MagicMock()
+        offer_objects.return_value.first.return_value = offer
+        product_objects = mock.MagicMock()
+        product_objects.return_value.first.return_value = product
+        with mock.patch('products.services.Offer.objects', offer_objects), \
+                mock.patch('products.services.Product.objects', product_objects), \
+                mock.patch.object(ReservationService, 'refresh_fully_reserved') as refresh, \
+                mock.patch('notifications.notification_helper.NotificationHelper.send_offer_accepted'):
+            OfferService.accept_counter_offer(offer.id, ObjectId())
+
+        self.assertEqual(offer.status, 'accepted')
+        self.assertEqual(product.quantity, 1)
+        product.save.assert_called_once()
+        refresh.assert_called_once_with(product.id)
+
+    def test_counter_offer_accept_requires_countered_status(self):
+        offer_objects = mock.MagicMock()
+        offer_objects.return_value.first.return_value = mock.Mock(status='pending')
+        with mock.patch('products.services.Offer.objects', offer_objects), \
+                mock.patch.object(OfferService, '_deduct_accepted_unit') as deduct:
+            with self.assertRaises(ValueError):
+                OfferService.accept_counter_offer(ObjectId(), ObjectId())
+        deduct.assert_not_called()
+
+
+class CheckoutHoldLeakTests(SimpleTestCase):
+    """Holds taken for an order that is never saved are released at once"""
+
+    def test_failed_order_save_releases_the_checkout_holds(self):
+        buyer_id, seller_id = ObjectId(), ObjectId()
+        product = mock.Mock(
+            id=ObjectId(), status='active', price=100.0, shipping_cost=10.0,
+            currency='SAR', title='Lamp', affiliate_code=None
+        )
+        product.seller_id.id = seller_id
+        users = mock.MagicMock()
+        users.return_value.first.return_value = mock.Mock(id=buyer_id, full_name='Buyer')
+        products = mock.MagicMock()
+        products.return_value.first.return_value = product
+        orders = mock.MagicMock()
+        orders.return_value.first.return_value = None
+
+        with mock.patch('products.services.User.objects', users), \
+                mock.patch('products.services.Product.objects', products), \
+                mock.patch('products.services.Order.objects', orders), \
+                mock.patch.object(OrderService, 'calculate_fees_bulk',
+                                  return_value=[{'platformFee': 5.0, 'affiliateCommission': 0.0}]), \
+                mock.patch.object(ReservationService, 'reserve_for_checkout') as reserve, \
+                mock.patch.object(ReservationService, 'release_for_orders') as release, \
+                mock.patch('products.services.Order.save', side_effect=RuntimeError('write failed')):
+            with self.assertRaises(RuntimeError):
+                OrderService.create_order(buyer_id, {'cartItems': [str(product.id)]})
+
+        order_oid = reserve.call_args[0][2]
+        release.assert_called_once_with([order_oid])
+
+    def test_missing_seller_is_rejected_before_any_stock_is_held(self):
+        product = mock.Mock(id=ObjectId(), status='active', price=100.0, shipping_cost=10.0)
+        product.seller_id.id = ObjectId()
+        users = mock.MagicMock()
+        users.return_value.first.side_effect = [mock.Mock(full_name='Buyer'), None]
+        products = mock.MagicMock()
+        products.return_value.first.return_value = product
+        orders = mock.MagicMock()
+        orders.return_value.first.return_value = None
+
+        with mock.patch('products.services.User.objects', users), \
+                mock.patch('products.services.Product.objects', products), \
+                mock.patch('products.services.Order.objects', orders), \
+                mock.patch.object(ReservationService, 'reserve_for_checkout') as reserve:
+            with self.assertRaises(ValueError):
+                OrderService.create_order(ObjectId(), {'cartItems': [str(product.id)]})
+        reserve.assert_not_called()
+
+
+def make_order(buyer_id, seller_id, product_id, **fields):
+    values = {
+        'id': ObjectId(), 'order_number': 'ORD-1', 'product_id': SimpleNamespace(id=product_id),
+        'buyer_id': SimpleNamespace(id=buyer_id), 'seller_id': SimpleNamespace(id=seller_id),
+        'product_title': 'Lamp', 'created_at': datetime(2026, 1, 1), 'status': 'paid',
+        'payment_status': 'completed', 'offer_id': None, 'price': 100.0, 'offer_price': None,
+        'total_price': 115.0, 'full_name': 'Buyer', 'phone': '', 'delivery_address': '', 'city': '',
+        'postal_code': '', 'country': '', 'additional_info': '', 'tracking_number': '',
+        'review_submitted': False, 'dolabb_fee': 5.0, 'seller_payout': 95.0, 'affiliate_code': None,
+        'payment_id': None, 'shipment_proof': None
+    }
+    values.update(fields)
+    return SimpleNamespace(**values)
+
+
+class UserOrdersEnrichmentTests(SimpleTestCase):
+    """The orders page joins related documents with one query per collection"""
+
+    def _get(self, principal, orders, products=(), users=(), reviews=(), disputes=()):
+        page = mock.Mock()
+        page.no_dereference.return_value = orders
+        mocks = {}
+        for name, rows in (('Product', products), ('User', users), ('Review', reviews), ('Dispute', disputes)):
+            objects = mock.MagicMock()
+            objects.return_value.only.return_value.as_pymongo.return_value = list(rows)
+            mocks[name] = objects
+        request = APIRequestFactory().get('/api/user/orders/')
+        force_authenticate(request, user=principal)
+        with mock.patch.object(OrderService, 'get_user_orders', return_value=(page, len(orders))), \
+                mock.patch.object(user_views.Product, 'objects', mocks['Product']), \
+                mock.patch.object(user_views.User, 'objects', mocks['User']), \
+                mock.patch.object(user_views.Review, 'objects', mocks['Review']), \
+                mock.patch.object(user_views.Dispute, 'objects', mocks['Dispute']):
+            response = user_views.get_user_orders(request)
+        return response, mocks
+
+    def test_buyer_orders_are_joined_with_one_query_per_collection(self):
+        buyer_id, seller_id, product_id = ObjectId(), ObjectId(), ObjectId()
+        reviewed = make_order(buyer_id, seller_id, product_id)
+        disputed = make_order(buyer_id, seller_id, product_id, order_number='ORD-2')
+        disputed.product_id = None  # Product since deleted
+        response, mocks = self._get(
+            UserPrincipal(buyer_id, 'buyer', 'active'),
+            [reviewed, disputed],
+            products=[{'_id': product_id, 'title': 'Brass lamp', 'images': ['a.jpg']}],
+            users=[{'_id': seller_id, 'username': 'seller'}],
+            reviews=[{'_id': ObjectId(), 'order_id': reviewed.id, 'rating': 5, 'comment': 'ok'}],
+            disputes=[{'_id': ObjectId(), 'order_id': disputed.id, 'case_number': 'C-1', 'status': 'open'}]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        for objects in mocks.values():
+            self.assertEqual(objects.call_count, 1)
+        self.assertEqual(mocks['Product'].call_args[1], {'id__in': {product_id}})
+        self.assertEqual(mocks['User'].call_args[1], {'id__in': {seller_id}})
+        self.assertEqual(mocks['Review'].call_args[1]['order_id__in'], [reviewed.id, disputed.id])
+
+        first, second = response.data['orders']
+        self.assertEqual(first['product']['title'], 'Brass lamp')
+        self.assertEqual(first['seller']['username'], 'seller')
+        self.assertEqual((first['reviewStatus'], first['review']['rating']), ('submitted', 5))
+        self.assertEqual(first['disputeStatus'], 'none')
+        self.assertEqual(second['product'], {'id': '', 'title': 'Lamp', 'images': []})
+        self.assertEqual(second['reviewStatus'], 'not_submitted')
+        self.assertEqual((second['disputeStatus'], second['dispute']['caseNumber']), ('open', 'C-1'))
+
+    def test_seller_orders_skip_review_and_dispute_queries(self):
+        buyer_id, seller_id, product_id = ObjectId(), ObjectId(), ObjectId()
+        response, mocks = self._get(
+            UserPrincipal(seller_id, 'seller', 'active'),
+            [make_order(buyer_id, seller_id, product_id)],
+            users=[{'_id': buyer_id, 'username': 'buyer'}]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mocks['User'].call_args[1], {'id__in': {buyer_id}})
+        mocks['Review'].assert_not_called()
+        mocks['Dispute'].assert_not_called()
+        order = response.data['orders'][0]
+        self.assertEqual(order['buyer']['username'], 'buyer')
+        self.assertIsNone(order['disputeStatus'])
+
+
+class OfferCursorTests(SimpleTestCase):
+    """Offer lists page by an opaque (created_at, id) keyset cursor"""
+
+    def test_cursor_round_trip(self):
+        position = [datetime(2026, 3, 1, 12, 30, 5, 123000), ObjectId(), 7]
+        cursor = encode_cursor(*position)
+        self.assertNotIn('=', cursor)
+        self.assertEqual(decode_cursor(cursor), position)
+
+    def test_malformed_cursor_is_rejected(self):
+        for cursor in ('not-a-cursor', encode_cursor('x')[:-2] + '!!', ''):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+    def test_page_params_are_parsed_and_clamped(self):
+        factory = APIRequestFactory()
+        request = factory.get('/api/offers/', {'status': 'pending, countered,', 'cursor': 'abc', 'limit': '500'})
+        self.assertEqual(parse_cursor_page_params(request), (['pending', 'countered'], 'abc', 100))
+        self.assertEqual(parse_cursor_page_params(factory.get('/', {'limit': '0'})), ([], None, 1))
+        with self.assertRaises(ValueError):
+            parse_cursor_page_params(factory.get('/', {'limit': 'ten'}))
+
+    def _page(self, rows, **kwargs):
+        objects = mock.MagicMock()
+        query = objects.return_value
+        query.filter.return_value = query
+        query.only.return_value.no_dereference.return_value.order_by.return_value.limit.return_value = rows
+        with mock.patch('products.services.Offer.objects', objects):
+            offers, next_cursor = OfferService.get_offers(ObjectId(), **kwargs)
+        return offers, next_cursor, query
+
+    def test_next_cursor_resumes_after_the_last_offer(self):
+        start = datetime(2026, 3, 1)
+        rows = [SimpleNamespace(id=ObjectId(), created_at=start - timedelta(minutes=i)) for i in range(3)]
+        offers, next_cursor, query = self._page(rows, limit=2)
+        self.assertEqual(offers, rows[:2])
+        query.only.return_value.no_dereference.return_value.order_by.return_value.limit.assert_called_once_with(3)
+        self.assertEqual(decode_cursor(next_cursor), [rows[1].created_at, rows[1].id])
+
+        _, last_cursor, query = self._page(rows[2:], statuses=['pending'], cursor=next_cursor, limit=2)
+        self.assertIsNone(last_cursor)
+        status_filter, keyset = [c[0][0] if c[0] else c[1] for c in query.filter.call_args_list]
+        self.assertEqual(status_filter, {'status__in': ['pending']})
+        older, same_time = keyset.children
+        self.assertEqual(older.query, {'created_at__lt': rows[1].created_at})
+        self.assertEqual([q.query for q in same_time.children], [{'created_at': rows[1].created_at}, {'id__lt': rows[1].id}])
+
+
+class OfferExpiryTests(SimpleTestCase):
+    """Overdue open offers expire in one guarded update and one event per chat room"""
+
+    def test_nothing_is_updated_without_overdue_offers(self):
+        objects = mock.MagicMock()
+        objects.return_value.only.return_value.limit.return_value.as_pymongo.return_value = []
+        with mock.patch('products.services.Offer.objects', objects):
+            self.assertEqual(OfferService.expire_overdue_offers(), 0)
+        objects.return_value.update.assert_not_called()
+
+    def test_overdue_offers_expire_only_while_still_open(self):
+        now = datetime(2026, 3, 1)
+        candidate_ids = [ObjectId(), ObjectId()]
+        objects = mock.MagicMock()
+        objects.return_value.only.return_value.limit.return_value.as_pymongo.return_value = [
+            {'_id': offer_id} for offer_id in candidate_ids
+        ]
+        objects.return_value.update.return_value = 1  # The other was accepted since the read
+        expired_rows = [{'_id': candidate_ids[0]}]
+        objects.return_value.only.return_value.as_pymongo.return_value = expired_rows
+        with mock.patch('products.services.Offer.objects', objects), \
+                mock.patch.object(OfferService, '_broadcast_expired_offers') as broadcast:
+            self.assertEqual(OfferService.expire_overdue_offers(batch_size=50, now=now), 1)
+
+        select, update, reload = [c[1] for c in objects.call_args_list]
+        self.assertEqual(select, {'status__in': ['pending', 'countered'], 'expiration_date__lte': now})
+        objects.return_value.only.return_value.limit.assert_called_once_with(50)
+        self.assertEqual(update, {'id__in': candidate_ids, 'status__in': ['pending', 'countered']})
+        self.assertEqual(objects.return_value.update.call_args[1], {'set__status': 'expired', 'set__updated_at': now})
+        self.assertEqual(reload, {'id__in': candidate_ids, 'status': 'expired', 'updated_at': now})
+        broadcast.assert_called_once_with(expired_rows)
+
+    def test_one_expiry_event_per_conversation(self):
+        conversation_id = ObjectId()
+        offers = [
+            {'_id': ObjectId(), 'product_id': ObjectId(), 'buyer_id': ObjectId(), 'seller_id': ObjectId(),
+             'expiration_date': datetime(2026, 3, 1)}
+            for _ in range(2)
+        ]
+        messages = mock.MagicMock()
+        messages.return_value.only.return_value.as_pymongo.return_value = [
+            {'offer_id': offers[0]['_id'], 'conversation_id': conversation_id},
+            {'offer_id': offers[0]['_id'], 'conversation_id': conversation_id},  # Offer and counter messages
+            {'offer_id': offers[1]['_id'], 'conversation_id': conversation_id},
+        ]
+        channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        with mock.patch('chat.models.Message.objects', messages), \
+                mock.patch('channels.layers.get_channel_layer', return_value=channel_layer):
+            OfferService._broadcast_expired_offers(offers)
+
+        channel_layer.group_send.assert_awaited_once()
+        group, event = channel_layer.group_send.await_args[0]
+        self.assertEqual(group, f'chat_{conversation_id}')
+        self.assertEqual(event['type'], 'offer_expired')
+        self.assertEqual(event['conversationId'], str(conversation_id))  # Must survive msgpack and json.dumps
+        self.assertEqual([offer['id'] for offer in event['offers']], [str(offer['_id']) for offer in offers])
+
+
+class FakeLedger:
+    """In-memory seller_ledger and seller_balances collections with all-or-nothing transactions"""
+
+    def __init__(self, **balance):
+        self.entries = {}
+        self.balance = dict({'available': 0.0, 'pending_payout': 0.0, 'paid_out': 0.0}, **balance)
+        self.entry_collection = mock.Mock()
+        self.entry_collection.insert_one.side_effect = self._insert
+        self.entry_collection.database.client.start_session.return_value = self
+        self.balance_collection = mock.Mock()
+        self.balance_collection.update_one.side_effect = self._update
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def with_transaction(self, callback):
+        entries, balance = dict(self.entries), dict(self.balance)
+        try:
+            callback(self)
+        except Exception:
+            self.entries, self.balance = entries, balance
+            raise
+
+    def _insert(self, doc, session=None):
+        if doc['entry_key'] in self.entries:
+            raise DuplicateKeyError('E11000 duplicate key error')
+        self.entries[doc['entry_key']] = doc
+
+    def _update(self, query, update, session=None):
+        minimum = query.get('available', {}).get('$gte')
+        if minimum is not None and self.balance['available'] < minimum:
+            return mock.Mock(matched_count=0)
+        for bucket, delta in update.get('$inc', {}).items():
+            self.balance[bucket] = self.balance.get(bucket, 0.0) + delta
+        return mock.Mock(matched_count=1)
+
+    def patch(self):
+        patches = [
+            mock.patch.object(SellerLedgerEntry, '_get_collection', return_value=self.entry_collection),
+            mock.patch.object(SellerBalance, '_get_collection', return_value=self.balance_collection),
+            mock.patch.object(SellerLedgerService, 'ensure_balance'),
+        ]
+        for patcher in patches:
+            patcher.start()
+        return patches
+
+
+class SellerLedgerTests(SimpleTestCase):
+    """Ledger entries and balance changes land together, or not at all"""
+
+    def setUp(self):
+        self.seller_id = ObjectId()
+        self.cashout = SimpleNamespace(id=ObjectId(), seller_id=SimpleNamespace(id=self.seller_id), amount=80.0)
+
+    def _ledger(self, **balance):
+        ledger = FakeLedger(**balance)
+        for patcher in ledger.patch():
+            self.addCleanup(patcher.stop)
+        return ledger
+
+    def test_payout_reserve_moves_available_to_pending(self):
+        ledger = self._ledger(available=100.0)
+        self.assertTrue(SellerLedgerService.reserve_payout(self.seller_id, 80.0, self.cashout))
+        self.assertEqual(ledger.balance['available'], 20.0)
+        self.assertEqual(ledger.balance['pending_payout'], 80.0)
+        entry = ledger.entries[f'payout_requested:{self.cashout.id}']
+        self.assertEqual((entry['available'], entry['pending_payout']), (-80.0, 80.0))
+
+    def test_insufficient_balance_writes_nothing(self):
+        ledger = self._ledger(available=79.99)
+        self.assertFalse(SellerLedgerService.reserve_payout(self.seller_id, 80.0, self.cashout))
+        self.assertEqual(ledger.entries, {})
+        self.assertEqual(ledger.balance['available'], 79.99)
+
+    def test_float_drift_in_the_running_sum_is_tolerated(self):
+        ledger = self._ledger(available=0.1 + 0.2)
+        self.assertTrue(SellerLedgerService.reserve_payout(self.seller_id, 0.3, self.cashout))
+        self.assertAlmostEqual(ledger.balance['available'], 0.0)
+
+    def test_replayed_entry_is_applied_once(self):
+        ledger = self._ledger()
+        order = SimpleNamespace(
+            id=ObjectId(), seller_id=SimpleNamespace(id=self.seller_id), seller_payout=50.0,
+            payment_status='completed', shipment_proof=' proof.jpg '
+        )
+        SellerLedgerService.record_payment_completed(order)
+        SellerLedgerService.record_payment_completed(order)
+        self.assertEqual(sorted(ledger.entries), [f'sale_locked:{order.id}', f'sale_released:{order.id}'])
+        self.assertEqual(ledger.balance['available'], 50.0)
+        self.assertEqual(ledger.balance['locked'], 0.0)
+
+    def test_reapproval_needs_the_amount_available_again(self):
+        ledger = self._ledger(available=30.0)
+        self.assertFalse(SellerLedgerService.reserve_reapproval(self.cashout, 'claim-1'))
+        self.assertEqual(ledger.entries, {})
+
+        ledger.balance['available'] = 100.0
+        self.assertTrue(SellerLedgerService.reserve_reapproval(self.cashout, 'claim-2'))
+        self.cashout.status = 'approved'
+        SellerLedgerService.record_payout_reviewed(self.cashout, 'rejected', 'claim-2')
+        self.assertEqual(ledger.balance['available'], 20.0)
+        self.assertEqual(ledger.balance['paid_out'], 80.0)
+        self.assertEqual(ledger.balance['pending_payout'], 0.0)
+        self.assertIn(f'payout_approved:{self.cashout.id}:reapproved:claim-2', ledger.entries)
+
+    def test_released_reapproval_returns_the_amount(self):
+        ledger = self._ledger(available=100.0)
+        SellerLedgerService.reserve_reapproval(self.cashout, 'claim-1')
+        SellerLedgerService.release_reapproval(self.cashout, 'claim-1')
+        self.assertEqual(ledger.balance['available'], 100.0)
+        self.assertEqual(ledger.balance['pending_payout'], 0.0)
+
+    def test_payout_request_over_the_balance_is_deleted(self):
+        self._ledger(available=10.0)
+        users = mock.MagicMock()
+        users.return_value.first.return_value = mock.Mock(id=self.seller_id, full_name='Seller')
+        with mock.patch('products.seller_service.User.objects', users), \
+                mock.patch('products.seller_service.CashoutRequest.save'), \
+                mock.patch('products.seller_service.CashoutRequest.delete') as delete:
+            with self.assertRaisesMessage(ValueError, 'Amount exceeds available balance'):
+                SellerService.request_payout(self.seller_id, 80.0, 'Bank Transfer')
+        delete.assert_called_once()
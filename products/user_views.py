@@ -10,6 +10,7 @@ from products.services import ProductService, OfferService, OrderService, Review
 from products.models import Product, Order, Offer, Review, SavedProduct
 from authentication.models import User
 from admin_dashboard.models import Dispute
+from dolabb_backend.utils import parse_cursor_page_params
 
 
 @api_view(['GET'])
@@ -83,23 +84,47 @@ def get_user_orders(request):
             limit=limit
         )
         
+        # Load the page without dereferencing, then fetch related documents with one
+        # projected query per collection and join them in memory
+        orders = list(orders.no_dereference())
+        order_ids = [order.id for order in orders]
+        product_ids = {order.product_id.id for order in orders if order.product_id}
+        other_user_ids = {
+            (order.seller_id if user_type == 'buyer' else order.buyer_id).id
+            for order in orders
+        }
+        
+        products_by_id = {
+            row['_id']: row
+            for row in Product.objects(id__in=product_ids).only('title', 'images').as_pymongo()
+        } if product_ids else {}
+        users_by_id = {
+            row['_id']: row
+            for row in User.objects(id__in=other_user_ids).only('username', 'profile_image').as_pymongo()
+        } if other_user_ids else {}
+        
+        reviews_by_order = {}
+        disputes_by_order = {}
+        if user_type == 'buyer' and order_ids:
+            for row in Review.objects(order_id__in=order_ids, buyer_id=user_id).only(
+                'order_id', 'rating', 'comment', 'created_at'
+            ).as_pymongo():
+                reviews_by_order.setdefault(row['order_id'], row)
+            for row in Dispute.objects(order_id__in=order_ids, buyer_id=user_id).only(
+                'order_id', 'case_number', 'dispute_type', 'status', 'created_at'
+            ).as_pymongo():
+                disputes_by_order.setdefault(row['order_id'], row)
+        
         orders_list = []
         for order in orders:
-            product = Product.objects(id=order.product_id.id).first()
-            if user_type == 'buyer':
-                seller = User.objects(id=order.seller_id.id).first()
-                other_user = {
-                    'id': str(seller.id) if seller else '',
-                    'username': seller.username if seller else '',
-                    'profileImage': seller.profile_image if seller else ''
-                }
-            else:
-                buyer = User.objects(id=order.buyer_id.id).first()
-                other_user = {
-                    'id': str(buyer.id) if buyer else '',
-                    'username': buyer.username if buyer else '',
-                    'profileImage': buyer.profile_image if buyer else ''
-                }
+            product = products_by_id.get(order.product_id.id) if order.product_id else None
+            other_user_ref = order.seller_id if user_type == 'buyer' else order.buyer_id
+            other = users_by_id.get(other_user_ref.id)
+            other_user = {
+                'id': str(other['_id']) if other else '',
+                'username': other.get('username', '') if other else '',
+                'profileImage': other.get('profile_image', '') if other else ''
+            }
             
             # Determine purchase type: 'buy_now' (direct purchase) or 'offer' (purchased after offer)
             # Check if order has offer_id set (works for both old and new orders)
@@ -112,14 +137,14 @@ def get_user_orders(request):
             review_status = None
             review_data = None
             if user_type == 'buyer':
-                review = Review.objects(order_id=order.id, buyer_id=user_id).first()
+                review = reviews_by_order.get(order.id)
                 if review:
                     review_status = 'submitted'
                     review_data = {
-                        'id': str(review.id),
-                        'rating': review.rating,
-                        'comment': review.comment,
-                        'createdAt': review.created_at.isoformat() if review.created_at else None
+                        'id': str(review['_id']),
+                        'rating': review.get('rating'),
+                        'comment': review.get('comment'),
+                        'createdAt': review['created_at'].isoformat() if review.get('created_at') else None
                     }
                 elif hasattr(order, 'review_submitted') and order.review_submitted:
                     review_status = 'submitted'  # Review exists but might not be in Review collection
@@ -130,39 +155,15 @@ def get_user_orders(request):
             dispute_status = None
             dispute_data = None
             if user_type == 'buyer':
-                # Query dispute by order_id and buyer_id
-                # Try multiple query methods to handle different ReferenceField formats
-                dispute = None
-                
-                # Method 1: Query using Order object reference (as stored in Dispute model)
-                dispute = Dispute.objects(order_id=order, buyer_id=user_id).first()
-                
-                # Method 2: If not found, query all buyer disputes and filter by order
-                if not dispute:
-                    buyer_disputes = Dispute.objects(buyer_id=user_id)
-                    for d in buyer_disputes:
-                        # Check if dispute's order_id matches current order
-                        if d.order_id and (str(d.order_id.id) == str(order.id) or d.order_id.id == order.id):
-                            dispute = d
-                            break
-                
-                # Method 3: If still not found, try with order.id directly
-                if not dispute:
-                    try:
-                        from bson import ObjectId
-                        order_obj_id = ObjectId(str(order.id)) if not isinstance(order.id, ObjectId) else order.id
-                        dispute = Dispute.objects(order_id=order_obj_id, buyer_id=user_id).first()
-                    except Exception:
-                        pass
-                
+                dispute = disputes_by_order.get(order.id)
                 if dispute:
-                    dispute_status = dispute.status  # 'open', 'resolved', 'closed'
+                    dispute_status = dispute.get('status')  # 'open', 'resolved', 'closed'
                     dispute_data = {
-                        'id': str(dispute.id),
-                        'caseNumber': dispute.case_number,
-                        'type': dispute.dispute_type,
-                        'status': dispute.status,
-                        'createdAt': dispute.created_at.isoformat() if dispute.created_at else None
+                        'id': str(dispute['_id']),
+                        'caseNumber': dispute.get('case_number'),
+                        'type': dispute.get('dispute_type'),
+                        'status': dispute.get('status'),
+                        'createdAt': dispute['created_at'].isoformat() if dispute.get('created_at') else None
                     }
                 else:
                     dispute_status = 'none'
@@ -171,9 +172,9 @@ def get_user_orders(request):
                 'id': str(order.id),
                 'orderNumber': order.order_number,
                 'product': {
-                    'id': str(product.id) if product else '',
-                    'title': product.title if product else order.product_title,
-                    'images': product.images if product else []
+                    'id': str(product['_id']) if product else '',
+                    'title': product.get('title') if product else order.product_title,
+                    'images': product.get('images', []) if product else []
                 },
                 'buyer' if user_type == 'seller' else 'seller': other_user,
                 'orderDate': order.created_at.isoformat(),
@@ -243,11 +244,13 @@ def get_user_offers(request):
         if hasattr(request.user, 'role') and request.user.role == 'seller':
             user_type = 'seller'
         
-        offers = OfferService.get_offers(user_id, user_type)
+        statuses, cursor, limit = parse_cursor_page_params(request)
+        offers, next_cursor = OfferService.get_offers(user_id, user_type, statuses=statuses, cursor=cursor, limit=limit)
+        products, _, _, _ = OfferService.get_offer_page_relations(offers)
         
         offers_list = []
         for offer in offers:
-            product = Product.objects(id=offer.product_id.id).first()
+            product = products.get(offer.product_id.id)
             offers_list.append({
                 'id': str(offer.id),
                 'productId': str(offer.product_id.id),
@@ -260,8 +263,15 @@ def get_user_offers(request):
         
         return Response({
             'success': True,
-            'offers': offers_list
+            'offers': offers_list,
+            'pagination': {
+                'limit': limit,
+                'nextCursor': next_cursor,
+                'hasMore': next_cursor is not None
+            }
         }, status=status.HTTP_200_OK)
+    except ValueError as e:
+        return Response({'success': False, 'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         return Response({'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
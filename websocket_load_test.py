@@ -0,0 +1,422 @@
+"""
+WebSocket load test for ChatConsumer and NotificationConsumer
+
+Runs the ASGI app from dolabb_backend.asgi in this process and drives it with
+simulated clients (channels' WebsocketCommunicator), so no server has to be
+started. MongoDB must be reachable with the configured settings. Point it at a
+test database: the fixtures create users, products, conversations and offers.
+Presence uses REDIS_URL if it is reachable; otherwise it only logs errors.
+
+    # Create 500 buyer/seller conversations (written to loadtest_fixtures.json)
+    python websocket_load_test.py setup --conversations 500
+
+    # 500 conversations x 2 chat sockets (+ 1000 notification sockets), 60s of traffic
+    python websocket_load_test.py run --duration 60 --message-rate 0.5 --offer-cycles 2 \
+        --channel-layer memory --notifications
+
+    # Remove everything the fixtures created
+    python websocket_load_test.py cleanup
+
+Reports connect latency per consumer, fan-out latency (send -> delivery to every
+socket in the room) for chat_message, offer_sent, offer_countered and
+offer_accepted, error frames, and process CPU / memory. Clients run in the same
+process as the server, so CPU and memory include the client side.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import time
+import uuid
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dolabb_backend.settings')
+
+FIXTURES_FILE = 'loadtest_fixtures.json'
+EVENT_TYPES = ['chat_message', 'offer_sent', 'offer_countered', 'offer_accepted']
+OFFER_EVENT_TYPES = EVENT_TYPES[1:]
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000
+
+
+def rss_mb():
+    """Current resident memory of this process (MB)"""
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def configure_django(channel_layer):
+    import django
+    django.setup()
+    from django.conf import settings
+    if channel_layer == 'memory':
+        settings.CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+# ---------------------------------------------------------------------------
+# Fixtures
+# ---------------------------------------------------------------------------
+
+def setup_fixtures(args):
+    configure_django('memory')
+    from authentication.models import User
+    from products.models import Product
+    from chat.services import ChatService
+
+    prefix = f'loadtest_{uuid.uuid4().hex[:8]}'
+    conversations = []
+    for index in range(args.conversations):
+        buyer = User(
+            full_name=f'Load Buyer {index}', username=f'{prefix}_{index}_b', email=f'{prefix}_{index}_b@loadtest.invalid',
+            password_hash='loadtest', role='buyer'
+        )
+        buyer.save()
+        seller = User(
+            full_name=f'Load Seller {index}', username=f'{prefix}_{index}_s', email=f'{prefix}_{index}_s@loadtest.invalid',
+            password_hash='loadtest', role='seller'
+        )
+        seller.save()
+        product = Product(title=f'Load test product {index}', seller_id=seller.id, category='women', price=100.0)
+        product.save()
+        conversation = ChatService.get_or_create_conversation(str(buyer.id), str(seller.id), str(product.id))
+        conversations.append({
+            'id': str(conversation.id),
+            'buyerId': str(buyer.id),
+            'sellerId': str(seller.id),
+            'productId': str(product.id),
+            'price': product.price
+        })
+        if (index + 1) % 100 == 0:
+            print(f'Created {index + 1} conversations...')
+
+    with open(args.fixtures, 'w') as fixtures_file:
+        json.dump({'prefix': prefix, 'conversations': conversations}, fixtures_file)
+    print(f'Created {len(conversations)} conversations ({prefix}); fixtures written to {args.fixtures}')
+
+
+def cleanup_fixtures(args):
+    configure_django('memory')
+    from authentication.models import User
+    from products.models import Product, Offer
+    from chat.models import Conversation, Message
+    from notifications.models import UserNotification
+
+    with open(args.fixtures) as fixtures_file:
+        fixtures = json.load(fixtures_file)
+    conversations = fixtures['conversations']
+    user_ids = [c['buyerId'] for c in conversations] + [c['sellerId'] for c in conversations]
+    product_ids = [c['productId'] for c in conversations]
+    conversation_ids = [c['id'] for c in conversations]
+
+    print(f"Messages:      {Message.objects(conversation_id__in=conversation_ids).delete()}")
+    print(f"Offers:        {Offer.objects(product_id__in=product_ids).delete()}")
+    print(f"Conversations: {Conversation.objects(id__in=conversation_ids).delete()}")
+    print(f"Notifications: {UserNotification.objects(user_id__in=user_ids).delete()}")
+    print(f"Products:      {Product.objects(id__in=product_ids).delete()}")
+    print(f"Users:         {User.objects(id__in=user_ids).delete()}")
+    os.remove(args.fixtures)
+
+
+# ---------------------------------------------------------------------------
+# Load run
+# ---------------------------------------------------------------------------
+
+class Stats:
+    def __init__(self):
+        self.connect = {'chat': [], 'notifications': []}
+        self.connect_failures = {'chat': 0, 'notifications': 0}
+        self.fanout = {event_type: [] for event_type in EVENT_TYPES}
+        self.sent = {event_type: 0 for event_type in EVENT_TYPES}
+        self.errors = {}
+        self.notifications = 0
+        self.cpu_samples = []
+        self.rss_samples = []
+
+    def error(self, key):
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+
+class Client:
+    """One simulated WebSocket with a reader task"""
+
+    def __init__(self, communicator, stats, kind):
+        self.communicator = communicator
+        self.stats = stats
+        self.kind = kind
+        self.waiters = {}  # Offer event type -> future resolved when it arrives
+        self.reader = None
+
+    async def connect(self, timeout):
+        started = time.perf_counter()
+        try:
+            connected, _ = await self.communicator.connect(timeout=timeout)
+        except Exception as e:
+            connected = False
+            self.stats.error(f'{self.kind} connect: {type(e).__name__}')
+        if connected and self.kind == 'chat':
+            # Chat sockets are only usable once the consumer sends its first frame (online_users)
+            try:
+                first = await self.communicator.receive_from(timeout=timeout)
+                connected = json.loads(first).get('type') == 'online_users'
+            except Exception:
+                connected = False
+        if not connected:
+            self.stats.connect_failures[self.kind] += 1
+            return False
+        self.stats.connect[self.kind].append(time.perf_counter() - started)
+        self.reader = asyncio.ensure_future(self.read())
+        return True
+
+    async def read(self):
+        while True:
+            try:
+                raw = await self.communicator.receive_from(timeout=3600)
+            except asyncio.CancelledError:
+                return
+            except Exception:
+                return  # Socket closed by the server
+            received = time.perf_counter()
+            data = json.loads(raw)
+            event_type = data.get('type')
+            if event_type == 'notification':
+                self.stats.notifications += 1
+            elif event_type == 'slow_down':
+                self.stats.error(f"slow_down: {data.get('error')} ({data.get('scope')}, {data.get('messageType')})")
+            elif event_type == 'error':
+                self.stats.error(f"error frame: {data.get('error') or data.get('message')}")
+            elif event_type == 'chat_message':
+                text = (data.get('message') or {}).get('text') or ''
+                if text.startswith('lt|'):
+                    self.stats.fanout['chat_message'].append(received - float(text.split('|')[2]))
+            elif event_type in OFFER_EVENT_TYPES:
+                future = self.waiters.pop(event_type, None)
+                if future and not future.done():
+                    future.set_result((received, data))
+
+    def expect(self, event_type):
+        future = asyncio.get_event_loop().create_future()
+        self.waiters[event_type] = future
+        return future
+
+    async def send(self, payload):
+        await self.communicator.send_to(text_data=json.dumps(payload))
+
+    async def close(self):
+        if self.reader:
+            self.reader.cancel()
+        try:
+            await self.communicator.disconnect()
+        except Exception:
+            pass
+
+
+async def offer_event(stats, event_type, sender, receiver, payload, timeout):
+    """Send one offer action and record fan-out latency to both participants"""
+    sender_future = sender.expect(event_type)
+    receiver_future = receiver.expect(event_type)
+    started = time.perf_counter()
+    await sender.send(payload)
+    stats.sent[event_type] += 1
+    try:
+        results = await asyncio.wait_for(asyncio.gather(sender_future, receiver_future), timeout)
+    except asyncio.TimeoutError:
+        stats.error(f'{event_type} timeout')
+        return None
+    for received, _ in results:
+        stats.fanout[event_type].append(received - started)
+    return results[0][1]
+
+
+async def drive_conversation(fixture, buyer, seller, args, stats, deadline):
+    """Chat messages at the configured rate, plus offer -> counter -> accept cycles"""
+    interval = 1.0 / args.message_rate if args.message_rate > 0 else None
+    cycles_left = args.offer_cycles
+    participants = [(buyer, fixture['buyerId'], fixture['sellerId']), (seller, fixture['sellerId'], fixture['buyerId'])]
+    turn = 0
+    while time.perf_counter() < deadline:
+        if cycles_left > 0:
+            cycles_left -= 1
+            price = fixture['price']
+            sent = await offer_event(stats, 'offer_sent', buyer, seller, {
+                'type': 'send_offer', 'productId': fixture['productId'], 'offerAmount': round(price * 0.8, 2),
+                'receiverId': fixture['sellerId'], 'text': 'load test offer'
+            }, args.timeout)
+            offer_id = ((sent or {}).get('offer') or {}).get('id')
+            if offer_id:
+                countered = await offer_event(stats, 'offer_countered', seller, buyer, {
+                    'type': 'counter_offer', 'offerId': offer_id, 'counterAmount': round(price * 0.9, 2),
+                    'receiverId': fixture['buyerId']
+                }, args.timeout)
+                if countered:
+                    await offer_event(stats, 'offer_accepted', buyer, seller, {
+                        'type': 'accept_offer', 'offerId': offer_id, 'receiverId': fixture['sellerId']
+                    }, args.timeout)
+        if interval is None:
+            if cycles_left <= 0:
+                return
+            continue
+        client, sender_id, receiver_id = participants[turn % 2]
+        turn += 1
+        await client.send({
+            'type': 'chat_message',
+            'receiverId': receiver_id,
+            'text': f'lt|{uuid.uuid4().hex[:8]}|{time.perf_counter()}',
+            'attachments': []
+        })
+        stats.sent['chat_message'] += 1
+        await asyncio.sleep(interval)
+
+
+async def sample_resources(stats, stop):
+    last_wall = time.perf_counter()
+    last_cpu = time.process_time()
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), 1.0)
+        except asyncio.TimeoutError:
+            pass
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        stats.cpu_samples.append((cpu - last_cpu) / max(wall - last_wall, 1e-6) * 100)
+        stats.rss_samples.append(rss_mb())
+        last_wall, last_cpu = wall, cpu
+
+
+async def run_load(args):
+    configure_django(args.channel_layer)
+    from channels.testing import WebsocketCommunicator
+    from authentication.services import JWTService
+    from dolabb_backend.asgi import application
+
+    with open(args.fixtures) as fixtures_file:
+        conversations = json.load(fixtures_file)['conversations']
+    if args.conversations:
+        conversations = conversations[:args.conversations]
+
+    stats = Stats()
+    stop = asyncio.Event()
+    sampler = asyncio.ensure_future(sample_resources(stats, stop))
+    tokens = {}
+    for fixture in conversations:
+        for user_id in (fixture['buyerId'], fixture['sellerId']):
+            tokens[user_id] = JWTService.generate_token(user_id, 'user')
+
+    # Connect everything, with bounded connect concurrency
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+    rss_before = rss_mb()
+
+    async def open_client(path, kind):
+        async with semaphore:
+            client = Client(WebsocketCommunicator(application, path), stats, kind)
+            return client if await client.connect(args.timeout) else None
+
+    chat_tasks = []
+    for fixture in conversations:
+        for user_id in (fixture['buyerId'], fixture['sellerId']):
+            chat_tasks.append(open_client(f"/ws/chat/{fixture['id']}/?token={tokens[user_id]}", 'chat'))
+    notification_tasks = []
+    if args.notifications:
+        for user_id in tokens:
+            notification_tasks.append(open_client(f'/ws/notifications/{user_id}/?token={tokens[user_id]}', 'notifications'))
+
+    connect_started = time.perf_counter()
+    chat_clients = await asyncio.gather(*chat_tasks)
+    notification_clients = await asyncio.gather(*notification_tasks)
+    connect_duration = time.perf_counter() - connect_started
+    rss_connected = rss_mb()
+    print(f"Connected {sum(1 for c in chat_clients if c)} chat and {sum(1 for c in notification_clients if c)} "
+          f"notification sockets in {connect_duration:.1f}s")
+
+    # Drive traffic in every conversation whose two sockets connected
+    traffic_started = time.perf_counter()
+    deadline = traffic_started + args.duration
+    drivers = []
+    for index, fixture in enumerate(conversations):
+        buyer, seller = chat_clients[2 * index], chat_clients[2 * index + 1]
+        if buyer and seller:
+            drivers.append(drive_conversation(fixture, buyer, seller, args, stats, deadline))
+    await asyncio.gather(*drivers)
+    await asyncio.sleep(min(args.timeout, 2.0))  # Let in-flight deliveries land
+    traffic_duration = time.perf_counter() - traffic_started
+
+    stop.set()
+    await sampler
+    await asyncio.gather(*[client.close() for client in chat_clients + notification_clients if client])
+    report(args, stats, len(conversations), connect_duration, traffic_duration, rss_before, rss_connected)
+
+
+def report(args, stats, conversation_count, connect_duration, traffic_duration, rss_before, rss_connected):
+    print(f"\n{'='*78}")
+    print(f"Conversations: {conversation_count}  channel layer: {args.channel_layer}  "
+          f"traffic: {traffic_duration:.1f}s  connect phase: {connect_duration:.1f}s")
+    print(f"{'='*78}")
+    print(f"{'connect':<16}{'ok':>8}{'failed':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, samples in stats.connect.items():
+        if samples or stats.connect_failures[kind]:
+            print(f"{kind:<16}{len(samples):>8}{stats.connect_failures[kind]:>8}"
+                  f"{percentile(samples, 0.50):>10.1f}{percentile(samples, 0.95):>10.1f}{percentile(samples, 0.99):>10.1f}")
+
+    print(f"\n{'fan-out':<16}{'sent':>8}{'deliv.':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'sent/s':>8}")
+    for event_type in EVENT_TYPES:
+        samples = stats.fanout[event_type]
+        print(f"{event_type:<16}{stats.sent[event_type]:>8}{len(samples):>8}"
+              f"{percentile(samples, 0.50):>10.1f}{percentile(samples, 0.95):>10.1f}{percentile(samples, 0.99):>10.1f}"
+              f"{stats.sent[event_type] / max(traffic_duration, 1e-6):>8.1f}")
+    if stats.notifications:
+        print(f"\nNotifications delivered: {stats.notifications}")
+
+    cpu = stats.cpu_samples or [0.0]
+    print(f"\nCPU (process, % of one core): avg {sum(cpu) / len(cpu):.0f}  peak {max(cpu):.0f}")
+    print(f"Memory RSS: start {rss_before:.0f} MB  connected {rss_connected:.0f} MB  "
+          f"peak {max(stats.rss_samples or [rss_connected]):.0f} MB")
+    if stats.errors:
+        print("\nErrors:")
+        for error, count in sorted(stats.errors.items(), key=lambda item: -item[1]):
+            print(f"  {count:>6}  {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='WebSocket load test for the chat and notification consumers')
+    parser.add_argument('--fixtures', default=FIXTURES_FILE, help='Fixture file written by setup')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    setup = commands.add_parser('setup', help='Create load-test users, products and conversations')
+    setup.add_argument('--conversations', type=int, default=100)
+
+    commands.add_parser('cleanup', help='Delete everything created by setup')
+
+    run = commands.add_parser('run', help='Run the load test')
+    run.add_argument('--conversations', type=int, default=0, help='Use only the first N fixture conversations')
+    run.add_argument('--duration', type=float, default=30, help='Seconds of chat traffic')
+    run.add_argument('--message-rate', type=float, default=0.5, help='chat_message per second per conversation')
+    run.add_argument('--offer-cycles', type=int, default=1, help='offer -> counter -> accept cycles per conversation')
+    run.add_argument('--notifications', action='store_true', help='Also open a notification socket per user')
+    run.add_argument('--channel-layer', choices=['memory', 'redis'], default='memory',
+                     help='memory: in-process layer; redis: CHANNEL_LAYERS from settings')
+    run.add_argument('--connect-concurrency', type=int, default=200)
+    run.add_argument('--timeout', type=float, default=10, help='Seconds to wait for a connect or offer event')
+
+    args = parser.parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    if args.command == 'setup':
+        setup_fixtures(args)
+    elif args.command == 'cleanup':
+        cleanup_fixtures(args)
+    else:
+        asyncio.run(run_load(args))
+
+
+if __name__ == '__main__':
+    main()